@@ -10,6 +10,9 @@ Developer:      rakib.hassan@ga.gov.au
 Revision History:
     LastUpdate:     12/12/18   RH
     LastUpdate:     2020-04-10 Fei Zhang  clean up + added example run for the script
+    LastUpdate:     17/10/26   agent    Optional waveform cache
+    LastUpdate:     17/10/26   agent    Added get_waveform_arrays
+    LastUpdate:     17/10/26   agent    Added get_recording_spans
 """
 
 from collections import defaultdict
@@ -23,13 +26,18 @@ from seismic.ASDFdatabase.utils import rtp2xyz
 
 
 class FederatedASDFDataSet():
-    def __init__(self, asdf_source, logger=None, single_item_read_limit_in_mb=1024):
+    def __init__(self, asdf_source, logger=None, single_item_read_limit_in_mb=1024, waveform_cache_size_mb=0):
         """
         Initializer for FederatedASDFDataSet.
 
         :param asdf_source: Path to a text file containing a list of ASDF files. \
                Entries can be commented out with '#'
         :param logger: logger instance
+        :param single_item_read_limit_in_mb: buffer size (MB) for reading waveform data
+        :param waveform_cache_size_mb: size (MB) of an LRU cache of decoded waveform blocks, which is \
+               useful when overlapping time-windows are repeatedly fetched for the same channel. \
+               Traces returned by get_waveforms then share read-only memory with the cache and \
+               must be copied before being modified in place. No caching is done if set to 0
         """
         self.logger = logger
         self.asdf_source = asdf_source
@@ -38,7 +46,8 @@ class FederatedASDFDataSet():
 
         # Instantiate implementation class
         self.fds = _FederatedASDFDataSetImpl(asdf_source, logger=logger,
-                                             single_item_read_limit_in_mb=single_item_read_limit_in_mb)
+                                             single_item_read_limit_in_mb=single_item_read_limit_in_mb,
+                                             waveform_cache_size_mb=waveform_cache_size_mb)
 
         # Populate coordinates
         self._unique_coordinates = defaultdict(list)
@@ -121,6 +130,20 @@ class FederatedASDFDataSet():
 
     # end func
 
+    def get_recording_spans(self, network_list=[], station_list=[]):
+        """
+        Fetches the time-spans of all traces in the index, grouped by station
+
+        :param network_list: list of networks to include; all networks are included if empty
+        :param station_list: list of stations to include; all stations are included if empty
+        :return: dictionary, indexed by (net, sta), of numpy arrays containing start- and end-times
+                 (timestamps) of traces, across all locations and channels, in each row; rows are
+                 ordered by start-time
+        """
+        return self.fds.get_recording_spans(network_list=network_list, station_list=station_list)
+
+    # end func
+
     def get_stations(self, starttime, endtime, network=None, station=None, location=None, channel=None):
         """
         :param starttime: start time string in UTCDateTime format; can also be an instance of obspy.UTCDateTime
@@ -177,6 +200,47 @@ class FederatedASDFDataSet():
 
     # end func
 
+    def get_waveform_arrays(self, network, station, location, channel, starttime,
+                            endtime, trace_count_threshold=200):
+        """
+        A light-weight alternative to get_waveforms for consumers that only need samples. Data are
+        read directly from the underlying HDF5 datasets, using hyperslab selection, into a single
+        contiguous array, without the overhead of constructing, merging and trimming obspy Streams.
+        Output samples lie on the sample-lattice of the earliest waveform segment and gaps are
+        masked. Where segments overlap, later segments take precedence; segments with sampling rates
+        that differ from that of the earliest segment are discarded.
+
+        :param network: network code
+        :param station: station code
+        :param location: location code
+        :param channel: channel code
+        :param starttime: start time string in UTCDateTime format; can also be an instance of obspy.UTCDateTime
+        :param endtime: end time string in UTCDateTime format; can also be an instance of obspy.UTCDateTime
+        :param trace_count_threshold: returns no data if the number of traces within the time-range provided
+                                      exceeds the threshold (default 200)
+        :return: a tuple containing a numpy.ma.MaskedArray of samples, the time of the first sample as an
+                 obspy.UTCDateTime and the sampling rate; (None, None, None) if no data are found
+        """
+        return self.fds.get_waveform_arrays(network, station, location, channel, starttime,
+                                            endtime, trace_count_threshold)
+    # end func
+
+    def get_waveform_cache_stats(self):
+        """
+        :return: a dict containing the number of entries, size (MB), hits, misses, evictions and
+                 bypasses (waveform blocks too large to be cached) of the waveform cache; None if
+                 caching is disabled
+        """
+        return self.fds.get_waveform_cache_stats()
+    # end func
+
+    def clear_waveform_cache(self):
+        """
+        Releases all waveform blocks held in the waveform cache
+        """
+        self.fds.clear_waveform_cache()
+    # end func
+
     def stations_iterator(self, network_list=[], station_list=[]):
         """
         This function provides an iterator over the entire data volume contained in all the ASDF files listed in the
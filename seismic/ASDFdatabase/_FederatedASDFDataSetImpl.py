@@ -9,6 +9,16 @@ Developer:      rakib.hassan@ga.gov.au
 
 Revision History:
     LastUpdate:     03/19/18   RH
+    LastUpdate:     17/10/26   agent    Parameterised queries, R*Tree index on time-ranges, read-only pragmas
+    LastUpdate:     17/10/26   agent    Incremental index builds from per-file shards
+    LastUpdate:     17/10/26   agent    Optional LRU cache of decoded waveform blocks
+    LastUpdate:     17/10/26   agent    Array-based read path with hyperslab reads
+    LastUpdate:     17/10/26   agent    Vectorised application of clock-corrections
+    LastUpdate:     17/10/26   agent    Thread-safe data access
+    LastUpdate:     17/10/26   agent    Added get_recording_spans
+    LastUpdate:     17/10/26   agent    R*Tree indices are added to existing databases on a copy, which then
+                                        replaces the database
+    LastUpdate:     17/10/26   agent    Rank 0 decides which shards are to be created; stale shards are removed
     LastUpdate:     dd/mm/yyyy  Who     Optional description
 """
 from future.utils import iteritems
@@ -17,6 +27,7 @@ from builtins import range
 from mpi4py import MPI
 import os
 import glob
+import shutil
 import atexit
 import logging
 from ordered_set import OrderedSet as set
@@ -30,16 +41,24 @@ from pyasdf.exceptions import ASDFValueError
 import ujson as json
 from collections import defaultdict
 import sqlite3
+import h5py
 import psutil
 import hashlib
-from functools import partial
+from functools import partial, wraps
+import threading
+from urllib.request import pathname2url
 from seismic.ASDFdatabase.utils import MIN_DATE, MAX_DATE
+from seismic.ASDFdatabase.waveform_cache import WaveformBlockCache, slice_block
 import pickle as cPickle
 import pandas as pd
-from rtree import index
 
 logging.basicConfig()
 
+# size of memory-map and page-cache for read-only connections to the index
+SQLITE_MMAP_SIZE = 1024 * 1024 * 1024 # bytes
+SQLITE_CACHE_SIZE = 64 * 1024 # KiB
+SQLITE_CACHED_STATEMENTS = 256
+
 def setup_logger(name, log_file, level=logging.INFO):
     """
     Function to setup a logger; adapted from stackoverflow
@@ -79,12 +98,131 @@ def split_list_by_timespan(l, n):
     return result
 # end func
 
+def synchronized(func):
+    """
+    Serialises calls to methods of _FederatedASDFDataSetImpl through its lock, which allows
+    instances to be shared between threads, e.g. by prefetching readers
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+        # end with
+    # end func
+    return wrapper
+# end func
+
+def decode_tags(tags, type='raw_recording', logger=None):
+    """
+    Decodes waveform tags of the form NET.STA.LOC.CHA__START__END__TYPE, parsing start- and
+    end-times of all tags at once
+
+    :param tags: list of waveform tags
+    :param type: tag type; tags of other types are skipped
+    :param logger: logger instance
+    :return: list of (net, sta, loc, cha, start-timestamp, end-timestamp, tag) tuples
+    """
+    codes = []
+    starts = []
+    ends = []
+    valid = []
+    for tag in tags:
+        if (type not in tag): continue
+        tokens = tag.split('__')
+        ctokens = tokens[0].split('.')
+        if (len(tokens) < 3 or len(ctokens) != 4):
+            if logger: logger.error("Failed to decode tag {}".format(tag))
+            continue
+        # end if
+
+        codes.append(ctokens)
+        starts.append(tokens[1])
+        ends.append(tokens[2])
+        valid.append(tag)
+    # end for
+
+    if (len(valid) == 0): return []
+
+    try:
+        st = np.array(starts, dtype='datetime64[ns]').astype('i8') / 1e9
+        et = np.array(ends, dtype='datetime64[ns]').astype('i8') / 1e9
+    except ValueError:
+        # fall back to parsing time-stamps one at a time
+        result = []
+        for (nc, sc, lc, cc), s, e, tag in zip(codes, starts, ends, valid):
+            try:
+                result.append((nc, sc, lc, cc, UTCDateTime(s).timestamp, UTCDateTime(e).timestamp, tag))
+            except Exception:
+                if logger: logger.error("Failed to decode tag {}".format(tag))
+            # end try
+        # end for
+        return result
+    # end try
+
+    return [(nc, sc, lc, cc, float(s), float(e), tag)
+            for (nc, sc, lc, cc), s, e, tag in zip(codes, st, et, valid)]
+# end func
+
+def assemble_segments(segments, starttime, endtime):
+    """
+    Assembles waveform segments into a single contiguous, gap-masked array covering the
+    time-range given. Output samples lie on the sample-lattice of the first segment and segments
+    are placed at their nearest lattice offsets; where segments overlap, later segments take
+    precedence. Samples are copied straight from each source into the output array, so h5py
+    datasets are read via hyperslab selection without intermediate buffers.
+
+    :param segments: list of (start-time in ns, sampling rate, samples) tuples, where samples can
+                     be numpy arrays or h5py datasets; segments with sampling rates that differ
+                     from that of the first segment are skipped
+    :param starttime: start of time-range in ns
+    :param endtime: end of time-range in ns
+    :return: tuple of (numpy.ma.MaskedArray, start-time in ns of the first sample, sampling rate);
+             (None, None, None) if segments do not overlap the time-range
+    """
+    if (len(segments) == 0): return None, None, None
+
+    ref_ns, sr, _ = segments[0]
+    segments = [seg for seg in segments if seg[1] == sr]
+    dt_ns = 1e9 / sr
+    eps = 1e-6 # tolerance in samples
+
+    # locate segments on the sample-lattice of the first segment
+    offsets = [int(np.round((seg_ns - ref_ns) / dt_ns)) for seg_ns, _, _ in segments]
+    lengths = [src.shape[0] for _, _, src in segments]
+
+    kstart = max(int(np.ceil((starttime - ref_ns) / dt_ns - eps)), min(offsets))
+    kend = min(int(np.floor((endtime - ref_ns) / dt_ns + eps)),
+               max([k + n - 1 for k, n in zip(offsets, lengths)]))
+    if (kend < kstart): return None, None, None
+
+    npts = kend - kstart + 1
+    data = np.zeros(npts, dtype=np.result_type(*[src.dtype for _, _, src in segments]))
+    mask = np.ones(npts, dtype=bool)
+    for k, n, (_, _, src) in zip(offsets, lengths, segments):
+        a = max(k, kstart)
+        b = min(k + n - 1, kend)
+        if (b < a): continue
+
+        if (isinstance(src, h5py.Dataset) and src.dtype == data.dtype):
+            src.read_direct(data, source_sel=np.s_[a - k:b - k + 1], dest_sel=np.s_[a - kstart:b - kstart + 1])
+        else:
+            data[a - kstart:b - kstart + 1] = src[a - k:b - k + 1]
+        # end if
+        mask[a - kstart:b - kstart + 1] = False
+    # end for
+
+    return np.ma.masked_array(data, mask=mask if mask.any() else np.ma.nomask), \
+           int(np.round(ref_ns + kstart * dt_ns)), sr
+# end func
+
 class _FederatedASDFDataSetImpl():
-    def __init__(self, asdf_source, logger=None, single_item_read_limit_in_mb=1024):
+    def __init__(self, asdf_source, logger=None, single_item_read_limit_in_mb=1024, waveform_cache_size_mb=0):
         """
         :param asdf_source: path to a text file containing a list of ASDF files:
                Entries can be commented out with '#'
         :param logger: logger instance
+        :param single_item_read_limit_in_mb: buffer size for reading waveform data
+        :param waveform_cache_size_mb: size of LRU cache of decoded waveform blocks; no caching if 0
         """
 
         self.comm = MPI.COMM_WORLD
@@ -92,6 +230,7 @@ class _FederatedASDFDataSetImpl():
         self.rank = self.comm.Get_rank()
 
         self.logger = logger
+        self.lock = threading.RLock()
         self.asdf_source = None
         self.asdf_file_names = []
         self.asdf_station_coordinates = []
@@ -126,21 +265,30 @@ class _FederatedASDFDataSetImpl():
             # end if
         # end func
 
-        # Create database
+        # Create database; the name of the database reflects the list of ASDF files along with
+        # their sizes and modification times. Databases created by earlier versions were named after
+        # the list of ASDF files alone (<sha1 of asdf_source>.db); they are no longer used and can be
+        # deleted once no jobs running earlier versions depend on them
         self.conn = None
+        self.shard_dir = os.path.join(os.path.dirname(os.path.abspath(self.asdf_source)), '.fds_shards')
+        self.shard_fns = [os.path.join(self.shard_dir, self._shard_name(fn)) for fn in self.asdf_file_names]
+        self.legacy_db_fn = os.path.join(os.path.dirname(self.asdf_source), self.source_sha1 + '.db')
+        self.source_sha1 = hashlib.sha1((self.source_sha1 + ''.join(self.shard_fns)).encode('utf-8')).hexdigest()
         self.db_fn = os.path.join(os.path.dirname(self.asdf_source),  self.source_sha1 + '.db')
         self.masterinv = None
+        self.channel_ids = {} # channel ids in the R*Tree index, keyed by (net, sta, loc, cha)
+        self.has_rtree = False
         self.create_database()
         self._load_corrections()
 
+        self.waveform_cache = WaveformBlockCache(waveform_cache_size_mb) if waveform_cache_size_mb > 0 else None
+
         atexit.register(self.cleanup) # needed for closing asdf files at exit
     # end func
 
     def _load_corrections(self):
         self.correction_files = []
-        self.correction_map_tree = defaultdict(lambda: defaultdict(list))
-        self.correction_map_bounds = defaultdict(lambda: defaultdict(list))
-        self.correction_map_values = defaultdict(lambda: defaultdict(list))
+        self.correction_map = {} # (starts, ends, corrections) arrays, sorted by start, keyed by (net, sta)
 
         # check to see if corrections are to be applied
         self.corrections_enabled = False
@@ -162,256 +310,398 @@ class _FederatedASDFDataSetImpl():
 
         dtypes = {'net':object, 'sta':object, 'loc':object, 'comp':object, 'date':object,
                   'clock_correction':object}
+        dfs = []
         for fname in fnames:
             try:
-                df = pd.read_csv(fname, delimiter=',', header=0, dtype=dtypes)
-
-                for i in np.arange(len(df)):
-                    net = df['net'][i]
-                    sta = df['sta'][i]
-                    corr = df['clock_correction'][i]
-
-                    if(corr == 'NOXCOR'): continue
-                    else: corr = float(df['clock_correction'][i])
-
-                    st = UTCDateTime(df['date'][i]).timestamp
-                    et = st + 24*3600
-
-                    if(type(self.correction_map_tree[net][sta]) != index.Index):
-                        self.correction_map_tree[net][sta] = index.Index()
-                        self.correction_map_bounds[net][sta] = []
-                        self.correction_map_values[net][sta] = []
-                    # end if
-
-                    self.correction_map_tree[net][sta].insert(i, (st, 1, et, 1))
-                    self.correction_map_bounds[net][sta].append([st, et])
-                    self.correction_map_values[net][sta].append(corr)
-                # end for
+                dfs.append(pd.read_csv(fname, delimiter=',', header=0, dtype=dtypes))
             except:
                 raise ValueError('Failed to read corrections file {}..'.format(fname))
             #end try
+            self.correction_files.append(fname)
         # end for
+
+        if(len(dfs)): self._set_corrections(pd.concat(dfs, ignore_index=True))
     #end func
 
-    def _get_correction(self, net, sta, st, et):
-        tindex = self.correction_map_tree[net][sta]
-        if(type(tindex) != index.Index):
-            return None
-        else:
-            epsilon = 1e-5
-            indices = list(tindex.intersection((st.timestamp+epsilon, 1, et.timestamp-epsilon, 1)))
+    def _set_corrections(self, df):
+        """
+        Populates per-station arrays of day-long clock-corrections
 
-            if(len(indices)):
-                if(len(indices) > 1): 
-                    raise ValueError('Error encountered in _get_correction. Aborting..')
-                # end if
+        :param df: pandas DataFrame with columns 'net', 'sta', 'date' and 'clock_correction';
+                   rows with a 'clock_correction' of 'NOXCOR' are ignored
+        """
+        df = df[df['clock_correction'] != 'NOXCOR']
+        if(len(df) == 0): return
+
+        try:
+            starts = np.array(df['date'].values.astype(str), dtype='datetime64[ns]').astype('i8') / 1e9
+        except ValueError:
+            starts = np.array([UTCDateTime(d).timestamp for d in df['date'].values])
+        # end try
+
+        df = pd.DataFrame({'net': df['net'].values, 'sta': df['sta'].values, 'st': starts,
+                           'corr': df['clock_correction'].values.astype(np.float64)})
+        for (net, sta), group in df.groupby(['net', 'sta']):
+            group = group.sort_values('st')
+            st = group['st'].values
+            et = st + 24*3600
+
+            if(np.any(st[1:] < et[:-1])):
+                raise ValueError('Overlapping clock-corrections found for {}.{}. Aborting..'.format(net, sta))
+            # end if
+
+            self.correction_map[(net, sta)] = (st, et, group['corr'].values)
+        # end for
+    # end func
 
-                cst, cet = self.correction_map_bounds[net][sta][indices[0]]
-                a = np.fmax(st.timestamp, cst)
-                b = np.fmin(et.timestamp, cet)
+    def _get_corrections(self, net, sta, st, et):
+        """
+        :param net: network code
+        :param sta: station code
+        :param st: start timestamp
+        :param et: end timestamp
+        :return: (starts, ends, corrections) arrays of clock-corrections overlapping [st, et)
+        """
+        if((net, sta) not in self.correction_map): return None
 
-                if(a > b): 
-                    raise ValueError('Error encountered in _get_correction. Aborting..')
-                # end if
+        starts, ends, corrections = self.correction_map[(net, sta)]
+        lo = np.searchsorted(ends, st, side='right')
+        hi = np.searchsorted(starts, et, side='left')
 
-                # return overlap and correction
-                return [UTCDateTime(a), UTCDateTime(b)], self.correction_map_values[net][sta][indices[0]]
-            else:
-                return None
-            # end if
-        #end if
-    #end func
+        if(hi <= lo): return None
+        return starts[lo:hi], ends[lo:hi], corrections[lo:hi]
+    # end func
 
     def _apply_correction(self, stream):
+        """
+        Applies clock-corrections to each trace in a stream. Where a single correction covers a
+        trace, its start-time is shifted and samples are left untouched. Otherwise, sample-ranges
+        covered by each correction are shifted by the correction, rounded to the nearest sample,
+        and copied in a single pass into a new array; gaps and overlaps resulting from differing
+        corrections are masked.
+
+        :param stream: obspy Stream
+        :return: obspy Stream with clock-corrections applied
+        """
+        resultStream = Stream()
+        for tr in stream:
+            sr = tr.stats.sampling_rate
+            npts = tr.stats.npts
+            t0 = tr.stats.starttime.timestamp
+
+            result = self._get_corrections(tr.stats.network, tr.stats.station,
+                                           t0, tr.stats.endtime.timestamp + 1. / sr) if npts else None
+            if(result is None):
+                resultStream.append(tr)
+                continue
+            # end if
+
+            # sample-index ranges [i0, i1) covered by each correction
+            starts, ends, corrections = result
+            eps = 1e-6 # tolerance in samples
+            i0 = np.clip(np.ceil((starts - t0) * sr - eps).astype(np.int64), 0, npts)
+            i1 = np.clip(np.ceil((ends - t0) * sr - eps).astype(np.int64), 0, npts)
+
+            # add uncorrected ranges
+            bounds = np.unique(np.concatenate([[0, npts], i0, i1]))
+            b0, b1 = bounds[:-1], bounds[1:]
+            cidx = np.searchsorted(i0, b0, side='right') - 1
+            covered = (cidx >= 0) & (b0 < i1[np.maximum(cidx, 0)])
+            shifts = np.where(covered, corrections[np.maximum(cidx, 0)], 0.)
+
+            if(np.all(shifts == shifts[0])):
+                tr.stats.starttime -= shifts[0]
+                resultStream.append(tr)
+                continue
+            # end if
+
+            kshifts = np.round(shifts * sr).astype(np.int64)
+            kmin = np.min(b0 - kshifts)
+            kmax = np.max(b1 - kshifts)
 
-        def day_split(trc):
-            rstream = Stream()
-            daySeconds = 24 * 3600  # seconds
+            src = np.ma.getdata(tr.data)
+            data = np.zeros(kmax - kmin, dtype=src.dtype)
+            counts = np.zeros(kmax - kmin, dtype=np.int32)
+            for a, b, k in zip(b0, b1, kshifts):
+                data[a - k - kmin:b - k - kmin] = src[a:b]
+                counts[a - k - kmin:b - k - kmin] += 1
+            # end for
+            mask = counts != 1
+            if(np.ma.is_masked(tr.data)):
+                srcmask = np.ma.getmaskarray(tr.data)
+                for a, b, k in zip(b0, b1, kshifts): mask[a - k - kmin:b - k - kmin] |= srcmask[a:b]
+            # end if
 
-            st = trc.stats.starttime
-            et = trc.stats.endtime
-            dayAlignedStartTime = UTCDateTime(year=st.year, month=st.month, day=st.day)
-            dayAlignedEndTime = dayAlignedStartTime + daySeconds
+            ctr = Trace(data=np.ma.masked_array(data, mask=mask) if mask.any() else data, header=tr.stats)
+            ctr.stats.npts = len(data)
+            ctr.stats.starttime = UTCDateTime(t0 + kmin / sr)
+            resultStream.append(ctr)
+        # end for
 
-            ct = st
-            trcCopy = trc.copy()
-            while (ct < et):
-                step = daySeconds
+        return resultStream
+    # end func
 
-                if (ct + step > dayAlignedEndTime):
-                    step = dayAlignedEndTime - ct
-                # end if
+    def _connect_readonly(self):
+        """
+        Opens a read-only connection to the index. The index is not modified once created, which
+        allows it to be opened as immutable, i.e. without file-locking, which is slow on network
+        file-systems, with a memory-mapped I/O and a large page-cache.
+        """
+        uri = 'file:%s?mode=ro&immutable=1' % (pathname2url(os.path.abspath(self.db_fn)))
+        conn = sqlite3.connect(uri, uri=True, cached_statements=SQLITE_CACHED_STATEMENTS, check_same_thread=False)
+        conn.execute('pragma query_only=1')
+        conn.execute('pragma mmap_size=%d' % (SQLITE_MMAP_SIZE))
+        conn.execute('pragma cache_size=-%d' % (SQLITE_CACHE_SIZE))
+        conn.execute('pragma temp_store=memory')
+
+        return conn
+    # end func
+
+    def _create_indices(self, conn):
+        """
+        Creates table indices, including an R*Tree index over (channel-id, [st, et]) that is used
+        for time-range queries on a given channel. Note that R*Tree bounds are stored as 32-bit
+        floats, rounded outwards, and queries against it are therefore followed by exact comparisons
+        against st and et in wdb.
+        """
+        conn.execute('create index if not exists allindex on wdb(net, sta, loc, cha, st, et)')
+        conn.execute('create index if not exists netstaindex on netsta(ds_id, net, sta)')
+        conn.execute('create table if not exists wchan(cid integer primary key, net varchar(6), '
+                     'sta varchar(6), loc varchar(6), cha varchar(6))')
+        conn.execute('delete from wchan')
+        conn.execute('insert into wchan(net, sta, loc, cha) select distinct net, sta, loc, cha from wdb')
+        conn.execute('drop table if exists wdb_rtree')
+        conn.execute('create virtual table wdb_rtree using rtree(id, cid_min, cid_max, st, et)')
+        conn.execute('insert into wdb_rtree(id, cid_min, cid_max, st, et) '
+                     'select w.rowid, c.cid, c.cid, w.st, w.et from wdb as w join wchan as c '
+                     'on w.net=c.net and w.sta=c.sta and w.loc=c.loc and w.cha=c.cha')
+        conn.commit()
+    # end func
+
+    def _shard_name(self, fn):
+        """
+        Index shards are keyed by absolute path, size and modification time of an ASDF file, so that
+        only new or modified files need to be indexed when the list of ASDF files changes.
+        """
+        fstat = os.stat(fn)
+        key = '%s|%d|%d'%(os.path.abspath(fn), fstat.st_size, fstat.st_mtime_ns)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest() + '.db'
+    # end func
 
-                rstream += trcCopy.slice(ct, ct + step, nearest_sample=False)
+    def _create_shard(self, ids, shard_fn):
+        """
+        Indexes an ASDF file into a shard. Stations are distributed over all ranks for tag-decoding
+        and the resulting rows are gathered on rank 0, which writes out the shard.
+        """
+        ds = self.asdf_datasets[ids]
+        keys = list(ds.get_all_coordinates().keys())
+        keys = split_list(keys, self.nproc)
 
-                ct += step
-                dayAlignedEndTime += daySeconds
-            # wend
+        tags = []
+        for key in keys[self.rank]:
+            tags += ds.waveforms[key].list()
+        # end for
+        data = decode_tags(tags, logger=self.logger)
 
-            return rstream
-        # end func
+        data = self.comm.gather(data, root=0)
+        if(self.rank==0):
+            coords_dict = ds.get_all_coordinates()
 
-        resultStream = Stream()
-        for mtr in stream:
-            dayStream = day_split(mtr)
-
-            for tr in dayStream:
-                net = tr.stats.network
-                sta = tr.stats.station
-                st  = tr.stats.starttime
-                et  = tr.stats.endtime
-            
-                if(st == et):
-                    resultStream.append(tr)
-                    continue
-                # end if
-                
-                result = self._get_correction(net, sta, st, et)
-
-                if(result):
-                    ost, oet = result[0]
-                    corr = result[1]
-
-                    trCorrected = tr.copy().slice(ost, oet)
-                    trCorrected.stats.starttime -= corr
-                    currStream = Stream([tr.slice(st, ost),
-                                         trCorrected,
-                                         tr.slice(oet, et)])
-
-                    # overlap resulting from correction applied is discarded (method=0)
-                    currStream.merge()
-                    if(len(currStream) == 1):
-                        resultStream.append(currStream[0])
-                    else:
-                        raise ValueError('Merge error in _apply_correction')
-                    # end if
+            inv = None
+            for k in coords_dict.keys():
+                if(not inv):
+                    inv = ds.waveforms[k].StationXML
                 else:
-                    resultStream.append(tr)
+                    try:
+                        inv += ds.waveforms[k].StationXML
+                    except Exception as e:
+                        print(e)
+                    # end try
                 # end if
             # end for
-        # end for
 
-        return resultStream
-    # end func
+            metadatalist = []
+            for k in list(coords_dict.keys()):
+                nc, sc = k.split('.')
+                metadatalist.append([nc, sc, coords_dict[k]['longitude'], coords_dict[k]['latitude']])
+            # end for
 
-    def create_database(self):
-        def decode_tag(tag, type='raw_recording'):
-            if (type not in tag): return None
-            try:
-                tokens = tag.split('.')
-                nc, sc, lc = tokens[0], tokens[1], tokens[2]
+            # write to a temporary file first, so that incomplete shards are never picked up
+            tmp_fn = '%s.%d.tmp'%(shard_fn, os.getpid())
+            conn = sqlite3.connect(tmp_fn)
+            conn.execute('pragma synchronous=off')
+            conn.execute('pragma journal_mode=off')
+            conn.execute('create table wdb(net varchar(6), sta varchar(6), loc varchar(6), cha varchar(6), '
+                         'st double, et double, tag text)')
+            conn.execute('create table netsta(net varchar(6), sta varchar(6), lon double, lat double)')
+            conn.execute('create table inv(inv blob)')
+            conn.execute('create table src(fn text, size integer, mtime_ns integer)')
 
-                tokens = tokens[3].split('__')
-                cc = tokens[0]
-                starttime = UTCDateTime(tokens[1]).timestamp
-                endtime  = UTCDateTime(tokens[2]).timestamp
+            tagsCount = 0
+            for rows in data:
+                conn.executemany('insert into wdb(net, sta, loc, cha, st, et, tag) values '
+                                 '(?, ?, ?, ?, ?, ?, ?)', rows)
+                tagsCount += len(rows)
+            # end for
+            conn.executemany('insert into netsta(net, sta, lon, lat) values (?, ?, ?, ?)', metadatalist)
+            conn.execute('insert into inv(inv) values(?)', [cPickle.dumps(inv, cPickle.HIGHEST_PROTOCOL)])
+            fstat = os.stat(self.asdf_file_names[ids])
+            conn.execute('insert into src(fn, size, mtime_ns) values(?, ?, ?)',
+                         (os.path.abspath(self.asdf_file_names[ids]), fstat.st_size, fstat.st_mtime_ns))
+            conn.commit()
+            conn.close()
+            os.replace(tmp_fn, shard_fn)
+
+            print(('\tIndexed %d entries'%(tagsCount)))
+        # end if
+    # end func
 
-                return nc, sc, lc, cc, starttime, endtime
+    def _remove_stale_shards(self):
+        """
+        Removes shards of ASDF files that no longer exist or have since been modified. Shards are
+        shared by all lists of ASDF files in a folder, so shards of other, unmodified files are
+        retained. Shards without a record of their source file are left alone.
+        """
+        for shard_fn in glob.glob(os.path.join(self.shard_dir, '*.db')):
+            if(shard_fn in self.shard_fns): continue
+
+            try:
+                conn = sqlite3.connect('file:%s?mode=ro'%(pathname2url(shard_fn)), uri=True)
+                src_fn = conn.execute('select fn from src').fetchall()[0][0]
+                conn.close()
             except Exception:
-                if self.logger:
-                    self.logger.error("Failed to decode tag {}".format(tag))
-                return None
+                continue
             # end try
-        # end func
 
-        dbFound = os.path.exists(self.db_fn)
-        self.comm.Barrier()
+            if(os.path.exists(src_fn) and self._shard_name(src_fn) == os.path.basename(shard_fn)): continue
+
+            print(('Removing stale index shard for %s..'%(src_fn)))
+            os.remove(shard_fn)
+        # end for
+    # end func
+
+    def create_database(self):
+        # the file-system may present different views to different ranks; rank 0 decides whether
+        # a database is to be created and which shards are missing, since shards are created
+        # collectively
+        dbFound = None
+        missing_shards = None
+        if(self.rank==0):
+            dbFound = os.path.exists(self.db_fn)
+            if(not dbFound):
+                missing_shards = [ids for ids, shard_fn in enumerate(self.shard_fns) if not os.path.exists(shard_fn)]
+                if(os.path.exists(self.legacy_db_fn)):
+                    print(('Database %s, created by an earlier version, is not used and can be deleted once no '
+                           'jobs running earlier versions depend on it'%(self.legacy_db_fn)))
+                # end if
+            # end if
+        # end if
+        dbFound = self.comm.bcast(dbFound, root=0)
+        missing_shards = self.comm.bcast(missing_shards, root=0)
 
         if(dbFound):
             print(('Found database: %s'%(self.db_fn)))
-            self.conn = sqlite3.connect(self.db_fn)
+
+            # add R*Tree index to databases created by earlier versions. Other jobs may be reading the
+            # database without locks (see _connect_readonly), so the index is added to a copy, which
+            # then atomically replaces the database; readers holding the original file are unaffected
+            if(self.rank==0):
+                conn = self._connect_readonly()
+                has_rtree = conn.execute("select count(*) from sqlite_master "
+                                         "where name='wdb_rtree'").fetchall()[0][0] > 0
+                conn.close()
+
+                if(not has_rtree):
+                    tmp_fn = '%s.%d.tmp'%(self.db_fn, os.getpid())
+                    try:
+                        print('Adding R*Tree index..')
+                        shutil.copyfile(self.db_fn, tmp_fn)
+                        conn = sqlite3.connect(tmp_fn)
+                        self._create_indices(conn)
+                        conn.execute('pragma journal_mode=delete')
+                        conn.close()
+                        os.replace(tmp_fn, self.db_fn)
+                    except Exception as e:
+                        if(os.path.exists(tmp_fn)): os.remove(tmp_fn)
+                        print(('Failed to add R*Tree index with error: %s. Falling back to standard '
+                               'indices..'%(str(e))))
+                    # end try
+                # end if
+            # end if
+            self.comm.Barrier()
+            self.conn = self._connect_readonly()
         else:
+            # index new or modified ASDF files
+            if(self.rank==0): os.makedirs(self.shard_dir, exist_ok=True)
+            self.comm.Barrier()
+
+            for ids in missing_shards:
+                if(self.rank==0): print(('Indexing %s..' % (os.path.basename(self.asdf_file_names[ids]))))
+                self._create_shard(ids, self.shard_fns[ids])
+            # end for
+            self.comm.Barrier()
+
+            # merge shards
             if(self.rank==0):
-                self.conn = sqlite3.connect(self.db_fn)
+                print('Merging index shards..')
+                tmp_fn = '%s.%d.tmp'%(self.db_fn, os.getpid())
+                self.conn = sqlite3.connect(tmp_fn)
+                self.conn.execute('pragma journal_mode=wal')
+                self.conn.execute('pragma synchronous=off')
                 self.conn.execute('create table wdb(ds_id smallint, net varchar(6), sta varchar(6), loc varchar(6), '
                                   'cha varchar(6), st double, et double, tag text)')
                 self.conn.execute('create table netsta(ds_id smallint, net varchar(6), sta varchar(6), lon double, '
                                   'lat double)')
                 self.conn.execute('create table masterinv(inv blob)')
 
-                metadatalist = []
                 masterinv = None
-                for ids, ds in enumerate(self.asdf_datasets):
-                    coords_dict = ds.get_all_coordinates()
-
-                    for k in coords_dict.keys():
-                        if(not masterinv):
-                            masterinv = ds.waveforms[k].StationXML
-                        else:
-                            try:
-                                masterinv += ds.waveforms[k].StationXML
-                            except Exception as e:
-                                print(e)
-                            # end try
-                        # end if
-                    # end for
-
-                    for k in list(coords_dict.keys()):
-                        lon = coords_dict[k]['longitude']
-                        lat = coords_dict[k]['latitude']
-                        nc, sc = k.split('.')
-                        metadatalist.append([ids, nc, sc, lon, lat])
-                    # end for
+                for ids, shard_fn in enumerate(self.shard_fns):
+                    self.conn.execute('attach database ? as shard', (shard_fn,))
+                    self.conn.execute('insert into wdb(ds_id, net, sta, loc, cha, st, et, tag) '
+                                      'select ?, net, sta, loc, cha, st, et, tag from shard.wdb', (ids,))
+                    self.conn.execute('insert into netsta(ds_id, net, sta, lon, lat) '
+                                      'select ?, net, sta, lon, lat from shard.netsta', (ids,))
+                    inv = cPickle.loads(self.conn.execute('select inv from shard.inv').fetchall()[0][0])
+                    self.conn.commit()
+                    self.conn.execute('detach database shard')
+
+                    if(not masterinv):
+                        masterinv = inv
+                    elif(inv):
+                        try:
+                            masterinv += inv
+                        except Exception as e:
+                            print(e)
+                        # end try
+                    # end if
                 # end for
-                self.conn.executemany('insert into netsta(ds_id, net, sta, lon, lat) values '
-                                      '(?, ?, ?, ?, ?)', metadatalist)
                 self.conn.execute('insert into masterinv(inv) values(?)',
                                   [cPickle.dumps(masterinv, cPickle.HIGHEST_PROTOCOL)])
                 self.conn.commit()
-                self.conn.close()
-            # end if
-
-            tagsCount = 0
-            for ids, ds in enumerate(self.asdf_datasets):
-                if(self.rank==0): print(('Indexing %s..' % (os.path.basename(self.asdf_file_names[ids]))))
-
-                keys = list(ds.get_all_coordinates().keys())
-                keys = split_list(keys, self.nproc)
-
-                data = []
-                #print 'Found %d keys'%(len(keys))
-                for ikey, key in enumerate(keys[self.rank]):
-                    sta = ds.waveforms[key]
-                    #print 'Loading key number %d: %s'%(ikey, key)
-                    for tag in sta.list():
-
-                        result = decode_tag(tag)
-                        if (result):
-                            network, station, location, channel, tr_st, tr_et = result
-                            data.append([ids, network, station, location, channel, tr_st, tr_et, tag])
-                        # end if
-                    # end for
-                # end for
-
-                for irank in np.arange(self.nproc):
-                    if(irank == self.rank):
-                        if(len(data)):
-                            self.conn = sqlite3.connect(self.db_fn)
-                            self.conn.executemany('insert into wdb(ds_id, net, sta, loc, cha, st, et, tag) values '
-                                                  '(?, ?, ?, ?, ?, ?, ?, ?)', data)
-                            print(('\tInserted %d entries on rank %d'%(len(data),
-                                                                       self.rank)))
-                            tagsCount += len(data)
-                            self.conn.commit()
-                            self.conn.close()
-                        # end if
-                    # end if
 
-                    self.comm.Barrier()
-                # end for
-            # end for
-
-            if(self.rank==0):
                 print('Creating table indices..')
-                self.conn = sqlite3.connect(self.db_fn)
-                self.conn.execute('create index allindex on wdb(net, sta, loc, cha, st, et)')
-                self.conn.execute('create index netstaindex on netsta(ds_id, net, sta)')
-                self.conn.commit()
+                self._create_indices(self.conn)
+
+                # revert to a rollback journal, since the shared-memory file used in wal mode is not
+                # supported on network file-systems, and the index is read-only hereafter
+                self.conn.execute('pragma journal_mode=delete')
                 self.conn.close()
+                os.replace(tmp_fn, self.db_fn)
+
+                self._remove_stale_shards()
                 print('Done..')
             # end if
             self.comm.Barrier()
-            self.conn = sqlite3.connect(self.db_fn)
+            self.conn = self._connect_readonly()
+        # end if
+
+        # Load channel ids for R*Tree queries
+        self.has_rtree = self.conn.execute("select count(*) from sqlite_master "
+                                           "where name='wdb_rtree'").fetchall()[0][0] > 0
+        if(self.has_rtree):
+            for cid, net, sta, loc, cha in self.conn.execute('select cid, net, sta, loc, cha from wchan'):
+                self.channel_ids[(net, sta, loc, cha)] = cid
+            # end for
         # end if
 
         # Load metadata
@@ -426,42 +716,70 @@ class _FederatedASDFDataSetImpl():
         self.masterinv = cPickle.loads(row[0][0])
     # end func
 
+    @synchronized
     def get_global_time_range(self, network, station, location=None, channel=None):
-        query = "select min(st), max(et) from wdb where net='%s' and sta='%s' "%(network, station)
+        query = 'select min(st), max(et) from wdb where net=? and sta=? '
+        params = [network, station]
 
         if (location):
-            query += "and loc='%s' "%(location)
+            query += 'and loc=? '
+            params.append(location)
         if (channel):
-            query += "and cha='%s' "%(channel)
+            query += 'and cha=? '
+            params.append(channel)
 
-        row = self.conn.execute(query).fetchall()[0]
+        row = self.conn.execute(query, params).fetchall()[0]
 
         min = UTCDateTime(row[0]) if row[0] else MAX_DATE
         max = UTCDateTime(row[1]) if row[1] else MIN_DATE
         return min, max
     # end func
 
+    @synchronized
+    def get_recording_spans(self, network_list=[], station_list=[]):
+        clauses = []
+        params = []
+        for col, vals in (('net', network_list), ('sta', station_list)):
+            if (len(vals)):
+                vals = list(dict.fromkeys(vals))
+                clauses.append('%s in (%s)'%(col, ', '.join(['?'] * len(vals))))
+                params += vals
+            # end if
+        # end for
+
+        query = 'select net, sta, st, et from wdb'
+        if (len(clauses)): query += ' where ' + ' and '.join(clauses)
+        query += ' order by net, sta, st'
+
+        rows = self.conn.execute(query, params).fetchall()
+
+        results = defaultdict(list)
+        for net, sta, st, et in rows:
+            results[(net, sta)].append((st, et))
+        # end for
+
+        return dict([(k, np.array(v, dtype=np.float64)) for k, v in iteritems(results)])
+    # end func
+
+    @synchronized
     def get_stations(self, starttime, endtime, network=None, station=None, location=None, channel=None):
         starttime = UTCDateTime(starttime).timestamp
         endtime = UTCDateTime(endtime).timestamp
 
-        query = 'select * from wdb where '
-        if (network): query += " net='%s' "%(network)
-        if (station):
-            if(network): query += "and sta='%s' "%(station)
-            else: query += "sta='%s' "%(station)
-        if (location):
-            if(network or station): query += "and loc='%s' "%(location)
-            else: query += "loc='%s' "%(location)
-        if (channel):
-            if(network or station or location): query += "and cha='%s' "%(channel)
-            else: query += "cha='%s' "%(channel)
-        if (network or station or location or channel): query += ' and '
-        query += ' et>=%f and st<=%f' \
-                 % (starttime, endtime)
-        query += ' group by net, sta, loc, cha'
-
-        rows = self.conn.execute(query).fetchall()
+        clauses = []
+        params = []
+        for col, val in (('net', network), ('sta', station), ('loc', location), ('cha', channel)):
+            if (val):
+                clauses.append('%s=?'%(col))
+                params.append(val)
+            # end if
+        # end for
+        clauses.append('et>=? and st<=?')
+        params += [starttime, endtime]
+
+        query = 'select * from wdb where ' + ' and '.join(clauses) + ' group by net, sta, loc, cha'
+
+        rows = self.conn.execute(query, params).fetchall()
         results = set()
         for row in rows:
             ds_id, net, sta, loc, cha, st, et, tag = row
@@ -475,35 +793,137 @@ class _FederatedASDFDataSetImpl():
         return list(results)
     # end func
 
+    def _get_waveform_rows(self, network, station, location, channel, starttime, endtime, count=False):
+        """
+        Fetches rows from wdb for a given channel that overlap the time-range [starttime, endtime].
+        The R*Tree index is used when available.
+
+        :param starttime: start-time (timestamp)
+        :param endtime: end-time (timestamp)
+        :param count: return the number of matching rows instead
+        :return: list of rows, ordered by start-time, or the number of rows if count is True
+        """
+        columns = 'count(*)' if count else 'w.ds_id, w.net, w.sta, w.loc, w.cha, w.st, w.et, w.tag'
+
+        if (self.has_rtree):
+            cid = self.channel_ids.get((network, station, location, channel))
+            if (cid is None): return 0 if count else []
+
+            query = 'select %s from wdb_rtree as r join wdb as w on w.rowid=r.id ' \
+                    'where r.cid_min<=? and r.cid_max>=? and r.et>=? and r.st<=? ' \
+                    'and w.et>=? and w.st<=?'%(columns)
+            params = (cid, cid, starttime, endtime, starttime, endtime)
+        else:
+            query = 'select %s from wdb as w where w.net=? and w.sta=? and w.loc=? and w.cha=? ' \
+                    'and w.et>=? and w.st<=?'%(columns)
+            params = (network, station, location, channel, starttime, endtime)
+        # end if
+
+        if (count): return self.conn.execute(query, params).fetchall()[0][0]
+
+        return self.conn.execute(query + ' order by w.st, w.et', params).fetchall()
+    # end func
+
+    @synchronized
     def get_waveform_count(self, network, station, location, channel, starttime, endtime):
 
         starttime = UTCDateTime(starttime).timestamp
         endtime = UTCDateTime(endtime).timestamp
 
-        query = "select count(*) from wdb where net='%s' and sta='%s' and loc='%s' and cha='%s' " \
-                %(network, station, location, channel) + \
-                "and et>=%f and st<=%f" \
-                 % (starttime, endtime)
-
-        num_traces = self.conn.execute(query).fetchall()[0][0]
+        num_traces = self._get_waveform_rows(network, station, location, channel,
+                                             starttime, endtime, count=True)
 
         return num_traces
     # end func
 
+    def _read_item(self, ds_id, net, sta, tag, starttime, endtime):
+        station_data = self.asdf_datasets[ds_id].waveforms['%s.%s'%(net, sta)]
+
+        '''
+        Obspy currently reads all data for a given 'tag' and then trims them as needed. However,
+        the read operation fails if data for a given 'tag' exceeds 'single_item_read_limit_in_mb',
+        regardless of the timespan indicated by starttime and endtime, if provided. In such 
+        instances, we retry reading the data by expanding the read-buffer in each attempt. The 
+        current max retry attempts is set to 2 and 'single_item_read_limit_in_mb' is finally reset
+        to its original value.
+        '''
+        s = Stream()
+        numAttempts = 0
+        while(1):
+            try:
+                s = station_data.get_item(tag, starttime, endtime)
+                break
+            except Exception as e:
+                if(isinstance(e, ASDFValueError)): # read failed due to the data buffer being too small
+                    self.asdf_datasets[ds_id].single_item_read_limit_in_mb *= 2
+                    numAttempts += 1
+                    if self.logger:
+                        self.logger.warning("Failed to get data between {} -- {} for {}.{} due to:\n{}. "
+                                            "Retrying with expanded data buffer."
+                                            .format(str(starttime), str(endtime), net, sta, str(e)))
+                    # end if
+                    if(numAttempts > 2):
+                        self.logger.error("Failed to get data between {} -- {} for {}.{} with error:\n{}"
+                                          .format(str(starttime), str(endtime), net, sta, str(e)))
+                        break
+                    # end if
+                else:
+                    if self.logger:
+                        self.logger.error("Failed to get data between {} -- {} for {}.{} with error:\n{}"
+                                          .format(str(starttime), str(endtime), net, sta, str(e)))
+                    # end if
+                    break
+                # end if
+            # end try
+        # end while
+        if (numAttempts>0):
+            self.asdf_datasets[ds_id].single_item_read_limit_in_mb /= 2**numAttempts
+        # end if
+
+        return s
+    # end func
+
+    def _read_cached_item(self, ds_id, net, sta, tag, starttime, endtime):
+        '''
+        Data for an entire 'tag' are read and cached on a cache-miss, and the time-window requested
+        is served as a view into the cached samples. Tags too large to fit within the cache budget
+        are read directly.
+        '''
+        key = (ds_id, tag)
+        block = self.waveform_cache.get(key)
+        if(block is None):
+            try:
+                dset = self.asdf_datasets[ds_id]._waveform_group['%s.%s'%(net, sta)][tag]
+                nbytes = dset.shape[0] * dset.dtype.itemsize
+            except Exception:
+                # let _read_item report the failure
+                return self._read_item(ds_id, net, sta, tag, starttime, endtime)
+            # end try
+
+            if(not self.waveform_cache.admits(nbytes)):
+                self.waveform_cache.bypasses += 1
+                return self._read_item(ds_id, net, sta, tag, starttime, endtime)
+            # end if
+
+            s = self._read_item(ds_id, net, sta, tag, None, None)
+            if(len(s) != 1): return s
+
+            block = (s[0].stats, s[0].data)
+            self.waveform_cache.put(key, *block)
+        # end if
+
+        return Stream([slice_block(*block, starttime=starttime, endtime=endtime)])
+    # end func
+
+    @synchronized
     def get_waveforms(self, network, station, location, channel, starttime,
                       endtime, trace_count_threshold=200):
 
         starttime = UTCDateTime(starttime)
         endtime = UTCDateTime(endtime)
 
-        query = "select * from wdb where net='%s' and sta='%s' and loc='%s' and cha='%s' " \
-                %(network, station, location, channel) + \
-                "and et>=%f and st<=%f" \
-                 % (starttime.timestamp, endtime.timestamp)
-
-        #print(query)
-
-        rows = self.conn.execute(query).fetchall()
+        rows = self._get_waveform_rows(network, station, location, channel,
+                                       starttime.timestamp, endtime.timestamp)
         s = Stream()
 
         if(len(rows) > trace_count_threshold):
@@ -512,47 +932,11 @@ class _FederatedASDFDataSetImpl():
 
         for row in rows:
             ds_id, net, sta, loc, cha, st, et, tag = row
-            station_data = self.asdf_datasets[ds_id].waveforms['%s.%s'%(net, sta)]
-
-            '''
-            Obspy currently reads all data for a given 'tag' and then trims them as needed. However,
-            the read operation fails if data for a given 'tag' exceeds 'single_item_read_limit_in_mb',
-            regardless of the timespan indicated by starttime and endtime, if provided. In such 
-            instances, we retry reading the data by expanding the read-buffer in each attempt. The 
-            current max retry attempts is set to 2 and 'single_item_read_limit_in_mb' is finally reset
-            to its original value.
-            '''
-            numAttempts = 0
-            while(1):
-                try:
-                    data_segment = station_data.get_item(tag, starttime, endtime)
-                    s += data_segment
-                    break
-                except Exception as e:
-                    if(isinstance(e, ASDFValueError)): # read failed due to the data buffer being too small
-                        self.asdf_datasets[ds_id].single_item_read_limit_in_mb *= 2
-                        numAttempts += 1
-                        if self.logger:
-                            self.logger.warning("Failed to get data between {} -- {} for {}.{} due to:\n{}. "
-                                                "Retrying with expanded data buffer."
-                                                .format(str(starttime), str(endtime), net, sta, str(e)))
-                        # end if
-                        if(numAttempts > 2):
-                            self.logger.error("Failed to get data between {} -- {} for {}.{} with error:\n{}"
-                                              .format(str(starttime), str(endtime), net, sta, str(e)))
-                            break
-                        # end if
-                    else:
-                        if self.logger:
-                            self.logger.error("Failed to get data between {} -- {} for {}.{} with error:\n{}"
-                                              .format(str(starttime), str(endtime), net, sta, str(e)))
-                        # end if
-                        break
-                    # end if
-                # end try
-            # end while
-            if (numAttempts>0):
-                self.asdf_datasets[ds_id].single_item_read_limit_in_mb /= 2**numAttempts
+
+            if(self.waveform_cache is not None):
+                s += self._read_cached_item(ds_id, net, sta, tag, starttime, endtime)
+            else:
+                s += self._read_item(ds_id, net, sta, tag, starttime, endtime)
             # end if
         # end for
 
@@ -570,6 +954,55 @@ class _FederatedASDFDataSetImpl():
         return s
     # end func
 
+    @synchronized
+    def get_waveform_arrays(self, network, station, location, channel, starttime,
+                            endtime, trace_count_threshold=200):
+
+        starttime = UTCDateTime(starttime)
+        endtime = UTCDateTime(endtime)
+
+        rows = self._get_waveform_rows(network, station, location, channel,
+                                       starttime.timestamp, endtime.timestamp)
+
+        if(len(rows) > trace_count_threshold):
+            print("Trace Count exceeds threshold", len(rows))
+            return None, None, None
+        # end if
+
+        segments = []
+        if(self.corrections_enabled):
+            # clock-corrections are applied on Streams
+            for tr in self.get_waveforms(network, station, location, channel, starttime, endtime,
+                                         trace_count_threshold=trace_count_threshold):
+                segments.append((tr.stats.starttime.ns, tr.stats.sampling_rate, tr.data))
+            # end for
+        else:
+            for row in rows:
+                ds_id, net, sta, loc, cha, st, et, tag = row
+                try:
+                    dset = self.asdf_datasets[ds_id]._waveform_group['%s.%s'%(net, sta)][tag]
+                    segments.append((int(dset.attrs['starttime']), float(dset.attrs['sampling_rate']), dset))
+                except Exception as e:
+                    if self.logger:
+                        self.logger.error("Failed to get data between {} -- {} for {}.{} with error:\n{}"
+                                          .format(str(starttime), str(endtime), net, sta, str(e)))
+                    # end if
+                # end try
+            # end for
+        # end if
+
+        if(len(set([seg[1] for seg in segments])) > 1 and self.logger):
+            self.logger.warning("Found mixed sampling rates for {}.{}.{}.{}; discarding segments with "
+                                "sampling rates that differ from that of the first segment"
+                                .format(network, station, location, channel))
+        # end if
+
+        data, data_starttime, sampling_rate = assemble_segments(segments, starttime.ns, endtime.ns)
+        if(data is None): return None, None, None
+
+        return data, UTCDateTime(ns=data_starttime), sampling_rate
+    # end func
+
     def stations_iterator(self, network_list=[], station_list=[]):
         workload = None
         if(self.rank==0):
@@ -585,7 +1018,7 @@ class _FederatedASDFDataSetImpl():
 
             for net in nets:
                 net = net[0]
-                stas = self.conn.execute("select distinct sta from wdb where net='%s'"%(net)).fetchall()
+                stas = self.conn.execute('select distinct sta from wdb where net=?', (net,)).fetchall()
 
                 if (len(station_list)):  # filter stations
                     stas = [sta for sta in stas if sta[0] in station_list]
@@ -594,8 +1027,8 @@ class _FederatedASDFDataSetImpl():
                 for sta in stas:
                     sta = sta[0]
 
-                    tbounds = self.conn.execute("select st, et from wdb where net='%s' and sta='%s' order by et"
-                                                %(net, sta)).fetchall()
+                    tbounds = self.conn.execute('select st, et from wdb where net=? and sta=? order by et',
+                                                (net, sta)).fetchall()
 
                     if(len(tbounds)==0): continue
                     #tbounds = np.array(tbounds)
@@ -632,6 +1065,17 @@ class _FederatedASDFDataSetImpl():
         # end for
     # end func
 
+    @synchronized
+    def get_waveform_cache_stats(self):
+        return self.waveform_cache.stats() if self.waveform_cache is not None else None
+    # end func
+
+    @synchronized
+    def clear_waveform_cache(self):
+        if(self.waveform_cache is not None): self.waveform_cache.clear()
+    # end func
+
+    @synchronized
     def get_inventory(self, network=None, station=None):
         inv = self.masterinv.select(network=network, station=station)
 
@@ -10,6 +10,7 @@ Developer:      rakib.hassan@ga.gov.au
 
 Revision History:
     LastUpdate:     12/06/21   RH
+    LastUpdate:     17/10/26   agent    P arrivals are interpolated from a cached travel-time table
     LastUpdate:     dd/mm/yyyy  Who     Optional description
 """
 
@@ -19,7 +20,7 @@ import re
 from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
 from obspy import Stream, UTCDateTime, read_events
 from obspy.geodetics.base import locations2degrees
-from obspy.taup import TauPyModel
+from seismic.travel_time_table import TravelTimeTable
 import click
 
 def split_list(lst, npartitions):
@@ -28,7 +29,7 @@ def split_list(lst, npartitions):
 # end func
 
 def dump_traces(fds, events_xml, sn_list, start_date, end_date, min_dist, max_dist,
-                time_before_p, time_after_p, output_folder):
+                time_before_p, time_after_p, output_folder, model=None):
     """
     :param fds: FederatedASDFDataset
     :param events_xml: events catalogue
@@ -38,9 +39,11 @@ def dump_traces(fds, events_xml, sn_list, start_date, end_date, min_dist, max_di
     :param min_dist: minimum angular distance from event to station
     :param max_dist: maximum angular distance from event to station
     :param output_folder: output folder
+    :param model: TravelTimeTable (or TauPyModel) used for predicting P arrivals; an iasp91 table is
+                  loaded if not provided
     """
 
-    model = TauPyModel(model="iasp91")
+    if(model is None): model = TravelTimeTable(model='iasp91', phase_list=('P',))
     events = read_events(events_xml)
     meta = fds.unique_coordinates
 
@@ -182,8 +185,11 @@ def process(asdf_source, input_events, output_folder, network_list, station_list
     # broadcast workload to all procs
     proc_stations = comm.bcast(proc_stations, root=0)
 
+    # all ranks share the computation of the travel-time table, if not already cached
+    model = TravelTimeTable(model='iasp91', phase_list=('P',), comm=comm)
+
     dump_traces(fds, input_events, proc_stations[rank], start_date, end_date, min_dist, max_dist,
-                time_before_p, time_after_p, output_folder)
+                time_before_p, time_after_p, output_folder, model=model)
 # end func
 
 if (__name__ == '__main__'):
@@ -16,6 +16,7 @@ Developer:      rakib.hassan@ga.gov.au
 
 Revision History:
     LastUpdate:     18/07/19   RH
+    LastUpdate:     17/10/26   agent    Instrument response spectra are now cached
     LastUpdate:     dd/mm/yyyy  Who     Optional description
 """
 
@@ -29,6 +30,7 @@ from collections import defaultdict
 from obspy.core.util.misc import get_window_times
 import gc
 from obspy.core.util.misc import limit_numpy_fft_cache
+from seismic.response_cache import response_spectrum_cache
 
 def split_list(lst, npartitions):
     k, m = divmod(len(lst), npartitions)
@@ -113,8 +115,11 @@ def create_station_asdf(input_asdf, output_folder, resample_rate,
                 for tr in dayst:
                     limit_numpy_fft_cache(max_size_in_mb_per_cache=10)
                     try:
-                        tr.remove_response(sinv, output=instrument_response_output.upper(),
-                                           water_level=water_level)
+                        # inverted response spectra are cached and reused for all day-traces
+                        # of a given length from a channel-epoch
+                        response_spectrum_cache.remove_response(tr, sinv,
+                                                                output=instrument_response_output.upper(),
+                                                                water_level=water_level)
                     except Exception as e:
                         print (e)
                     # end try
@@ -163,6 +168,8 @@ def create_station_asdf(input_asdf, output_folder, resample_rate,
         #break
     # end for
     del ids
+
+    print ('Rank %d: response-spectrum cache stats: %s' % (rank, str(response_spectrum_cache.stats())))
 # end func
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
@@ -0,0 +1,129 @@
+#!/bin/env python
+"""
+Description:
+    Micro-benchmark for GPS clock-corrections applied by FederatedASDFDataSet. Reports throughput
+    of get_waveforms, in queries and samples per second, with clock-corrections turned off and on.
+    Corrections found in the '.corrections' folder alongside the list of ASDF files are used if
+    available; otherwise, synthetic day-long corrections are generated for all stations.
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import os
+import time
+import click
+import numpy as np
+import pandas as pd
+from obspy import UTCDateTime
+from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
+
+
+def synthetic_corrections(fds, seed=0):
+    """
+    Generates day-long clock-corrections, drawn uniformly from [-5, 5] s, for every day of data
+    of every station; a tenth of the days are left uncorrected
+
+    :param fds: FederatedASDFDataSet instance
+    :param seed: seed for the random number generator
+    :return: pandas DataFrame of clock-corrections
+    """
+    rs = np.random.RandomState(seed)
+    rows = fds.fds.conn.execute('select net, sta, min(st), max(et) from wdb group by net, sta').fetchall()
+
+    dfs = []
+    for net, sta, st, et in rows:
+        days = np.arange(np.floor(st / 86400.), np.ceil(et / 86400.)) * 86400.
+        corrs = rs.uniform(-5, 5, len(days)).astype(str)
+        corrs[rs.random_sample(len(days)) < 0.1] = 'NOXCOR'
+        dfs.append(pd.DataFrame({'net': net, 'sta': sta,
+                                 'date': [UTCDateTime(d).strftime('%Y-%m-%d') for d in days],
+                                 'clock_correction': corrs}))
+    # end for
+
+    return pd.concat(dfs, ignore_index=True)
+# end func
+
+
+def run_benchmark(fds, nqueries=100, buffer_days=10, seed=0):
+    """
+    Times get_waveforms over random time-windows within the data-range of randomly chosen channels,
+    with clock-corrections turned off and on
+
+    :param fds: FederatedASDFDataSet instance, with clock-corrections loaded
+    :param nqueries: number of queries to time in each mode
+    :param buffer_days: length of query time-windows (days)
+    :param seed: seed for the random number generator
+    :return: dict of (queries per second, samples per second), keyed by mode
+    """
+    channels = fds.fds.conn.execute('select net, sta, loc, cha, min(st), max(et) from wdb '
+                                    'group by net, sta, loc, cha').fetchall()
+    assert len(channels), 'No channels found in index'
+
+    window_seconds = buffer_days * 86400
+    rs = np.random.RandomState(seed)
+    queries = []
+    for ic in rs.randint(0, len(channels), nqueries):
+        net, sta, loc, cha, st, et = channels[ic]
+        t0 = st + rs.random_sample() * max(et - st - window_seconds, 0)
+        queries.append((net, sta, loc, cha, UTCDateTime(t0), UTCDateTime(t0 + window_seconds)))
+    # end for
+
+    results = {}
+    corrections_enabled = fds.fds.corrections_enabled
+    for mode, enabled in [('off', False), ('on', True)]:
+        fds.fds.corrections_enabled = enabled
+        fds.clear_waveform_cache()
+
+        nsamples = 0
+        t = time.perf_counter()
+        for q in queries:
+            nsamples += np.sum([tr.stats.npts for tr in fds.get_waveforms(*q)])
+        # end for
+        elapsed = time.perf_counter() - t
+
+        results[mode] = (nqueries / elapsed, nsamples / elapsed)
+    # end for
+    fds.fds.corrections_enabled = corrections_enabled
+
+    return results
+# end func
+
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('asdf-source', required=True,
+                type=click.Path(exists=True))
+@click.option('--nqueries', default=100, show_default=True, help="Number of queries timed in each mode")
+@click.option('--buffer-days', default=10, show_default=True, help="Length of query time-windows (days)")
+@click.option('--seed', default=0, show_default=True, help="Seed for random number generator")
+def process(asdf_source, nqueries, buffer_days, seed):
+    """
+    ASDF_SOURCE: Text file containing a list of paths to ASDF files
+    """
+    os.environ['GPS_CLOCK_CORRECTION'] = '1'
+    fds = FederatedASDFDataSet(asdf_source)
+
+    if (len(fds.fds.correction_map) == 0):
+        print('No clock-corrections found; using synthetic corrections..')
+        fds.fds._set_corrections(synthetic_corrections(fds, seed=seed))
+    # end if
+
+    results = run_benchmark(fds, nqueries=nqueries, buffer_days=buffer_days, seed=seed)
+
+    for mode in ['off', 'on']:
+        qps, sps = results[mode]
+        print('corrections %3s: %8.2f queries/s, %12.1f samples/s' % (mode, qps, sps))
+    # end for
+    print('relative throughput with corrections on: %.2f' % (results['on'][0] / results['off'][0]))
+# end func
+
+if (__name__ == '__main__'):
+    process()
+# end if
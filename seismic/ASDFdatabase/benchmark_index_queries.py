@@ -0,0 +1,113 @@
+#!/bin/env python
+"""
+Description:
+    Micro-benchmark for queries against the sqlite index of a FederatedASDFDataSet. Reports
+    queries per second for the legacy string-formatted queries, which rely on the composite
+    index alone, and for the parameterised queries against the R*Tree index now in use.
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import time
+import click
+import numpy as np
+from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
+
+
+def legacy_waveform_rows(conn, network, station, location, channel, starttime, endtime):
+    query = "select * from wdb where net='%s' and sta='%s' and loc='%s' and cha='%s' " \
+            %(network, station, location, channel) + \
+            "and et>=%f and st<=%f" \
+            % (starttime, endtime)
+    return conn.execute(query).fetchall()
+# end func
+
+
+def legacy_waveform_count(conn, network, station, location, channel, starttime, endtime):
+    query = "select count(*) from wdb where net='%s' and sta='%s' and loc='%s' and cha='%s' " \
+            %(network, station, location, channel) + \
+            "and et>=%f and st<=%f" \
+            % (starttime, endtime)
+    return conn.execute(query).fetchall()[0][0]
+# end func
+
+
+def run_benchmark(fds, nqueries=10000, window_seconds=86400, seed=0):
+    """
+    Times lookups of waveform rows and waveform counts over random time-windows within the
+    data-range of randomly chosen channels
+
+    :param fds: FederatedASDFDataSet instance
+    :param nqueries: number of queries to time for each approach
+    :param window_seconds: length of query time-windows (s)
+    :param seed: seed for the random number generator
+    :return: dict of queries per second, keyed by (approach, query-type)
+    """
+    impl = fds.fds
+    conn = impl.conn
+    channels = conn.execute('select net, sta, loc, cha, min(st), max(et) from wdb '
+                            'group by net, sta, loc, cha').fetchall()
+    assert len(channels), 'No channels found in index'
+
+    rs = np.random.RandomState(seed)
+    queries = []
+    for ic in rs.randint(0, len(channels), nqueries):
+        net, sta, loc, cha, st, et = channels[ic]
+        t0 = st + rs.random_sample() * max(et - st - window_seconds, 0)
+        queries.append((net, sta, loc, cha, t0, t0 + window_seconds))
+    # end for
+
+    approaches = {('legacy', 'rows'): lambda q: legacy_waveform_rows(conn, *q),
+                  ('legacy', 'count'): lambda q: legacy_waveform_count(conn, *q),
+                  ('parameterised', 'rows'): lambda q: impl._get_waveform_rows(*q),
+                  ('parameterised', 'count'): lambda q: impl._get_waveform_rows(*q, count=True)}
+
+    # check that results are consistent
+    for q in queries[:100]:
+        assert approaches[('legacy', 'count')](q) == approaches[('parameterised', 'count')](q)
+    # end for
+
+    results = {}
+    for key, func in approaches.items():
+        t = time.perf_counter()
+        for q in queries: func(q)
+        results[key] = nqueries / (time.perf_counter() - t)
+    # end for
+
+    return results
+# end func
+
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('asdf-source', required=True,
+                type=click.Path(exists=True))
+@click.option('--nqueries', default=10000, show_default=True, help="Number of queries timed per approach")
+@click.option('--window-seconds', default=86400, show_default=True, help="Length of query time-windows (s)")
+@click.option('--seed', default=0, show_default=True, help="Seed for random number generator")
+def process(asdf_source, nqueries, window_seconds, seed):
+    """
+    ASDF_SOURCE: Text file containing a list of paths to ASDF files
+    """
+    fds = FederatedASDFDataSet(asdf_source)
+    results = run_benchmark(fds, nqueries=nqueries, window_seconds=window_seconds, seed=seed)
+
+    print('R*Tree index available: %s' % (fds.fds.has_rtree))
+    for qtype in ['rows', 'count']:
+        before = results[('legacy', qtype)]
+        after = results[('parameterised', qtype)]
+        print('%6s queries: legacy %10.1f qps, parameterised %10.1f qps (%.2fx)' %
+              (qtype, before, after, after / before))
+    # end for
+# end func
+
+if (__name__ == '__main__'):
+    process()
+# end if
@@ -10,6 +10,7 @@ Developer:      rakib.hassan@ga.gov.au
 
 Revision History:
     LastUpdate:     10/01/22   RH
+    LastUpdate:     17/10/26   agent    Parameterised query
     LastUpdate:     dd/mm/yyyy  Who     Optional description
 """
 
@@ -26,13 +27,15 @@ def dump_gaps(asdf_source, network, start_date, end_date, min_gap_length, output
     ds = FederatedASDFDataSet(asdf_source)
     conn = ds.fds.conn
 
-    query = 'select st, et, net, sta, loc, cha from wdb where net="{}"'.format(network)
+    query = 'select st, et, net, sta, loc, cha from wdb where net=?'
+    params = [network]
     if(start_date and end_date):
-        query += ' and st>={} and et<={}'.format(start_date, end_date)
+        query += ' and st>=? and et<=?'
+        params += [start_date, end_date]
     # end if
     query += ' order by st, et'
 
-    rows = conn.execute(query).fetchall()
+    rows = conn.execute(query, params).fetchall()
     rows = np.array(rows, dtype=[('st', 'float'), ('et', 'float'),
                                 ('net', 'object'),
                                 ('sta', 'object'),
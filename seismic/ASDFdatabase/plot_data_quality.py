@@ -20,6 +20,7 @@ Developer:      rakib.hassan@ga.gov.au
 Revision History:
     LastUpdate:     19/09/2019   RH
     LastUpdate:     27/05/2020   FZ     Refactoring and docs run examples etc.
+    LastUpdate:     17/10/26     agent  Daily means computed from arrays returned by get_waveform_arrays
 
 Todo:
     The script currently have a low pylint score 4.3/10.
@@ -115,17 +116,13 @@ def process_data(rank, fds, stations, start_time, end_time):
 
             debug = False
             if not debug:
-                stream = fds.get_waveforms(s[0], s[1], s[2], s[3],
-                                           ct, ct + day,
-                                           trace_count_threshold=200)
-                if len(stream):
-                    try:
-                        tr = stream.merge()
-                        means.append(np.mean(tr[0].data))
-                    except:
-                        # empty or streams that cannot be merged are marked by nans
-                        means.append(np.nan)
+                data, _, _ = fds.get_waveform_arrays(s[0], s[1], s[2], s[3],
+                                                     ct, ct + day,
+                                                     trace_count_threshold=200)
+                if data is not None and data.count():
+                    means.append(np.mean(data))
                 else:
+                    # days without data are marked by nans
                     means.append(np.nan)
                 # end if
             else:
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Description:
+    LRU cache of decoded waveform blocks for FederatedASDFDataSet.
+
+    Each waveform in an ASDF file is stored under a 'tag', typically spanning hours to days of data.
+    Workflows such as pick-harvesting request many short, often overlapping, time-windows from
+    the same tag, each of which would otherwise result in a fresh read from the HDF5 file. The cache
+    here holds decoded samples of entire tags, keyed by (ds_id, tag), within a byte budget, and
+    serves time-windows as read-only views into cached arrays.
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+from collections import OrderedDict
+
+from obspy import Trace
+
+
+def slice_block(stats, data, starttime=None, endtime=None):
+    """
+    Extracts a time-window from a cached waveform block, without copying samples. Sample indices
+    are computed exactly as in pyasdf, so that results are identical to those from
+    pyasdf's get_item(tag, starttime, endtime)
+
+    :param stats: obspy Stats of the waveform block
+    :param data: samples of the waveform block
+    :param starttime: UTCDateTime; start of time-window (optional)
+    :param endtime: UTCDateTime; end of time-window (optional)
+    :return: obspy Trace, with its data being a view into 'data'
+    """
+    idx_start = 0
+    idx_end = data.shape[0]
+    dt = 1.0 / stats.sampling_rate
+
+    data_starttime = stats.starttime
+    data_endtime = data_starttime + float((idx_end - 1) * dt)
+
+    if starttime is not None and starttime > data_starttime:
+        offset = max(0, int((starttime - data_starttime) // dt))
+        idx_start = offset
+        data_starttime += offset * dt
+    # end if
+    if endtime is not None and endtime < data_endtime:
+        offset = max(0, int((data_endtime - endtime) // dt))
+        idx_end -= offset
+    # end if
+
+    tr = Trace(data=data[idx_start:idx_end], header=stats)
+    tr.stats.npts = len(tr.data)
+    tr.stats.starttime = data_starttime
+
+    return tr
+# end func
+
+
+class WaveformBlockCache:
+    """
+    Bounded LRU cache of decoded waveform blocks, keyed by (ds_id, tag). Cached arrays are flagged
+    read-only, since traces served from the cache share memory with it; callers that need to
+    modify samples in place must copy traces first (e.g. Trace.copy()), as obspy processing
+    routines that work in place would otherwise fail.
+    """
+    def __init__(self, max_size_mb=1024):
+        """
+        :param max_size_mb: maximum size (MB) of cached waveform blocks; least recently used \
+                            blocks are evicted once exceeded
+        """
+        self.max_size_mb = max_size_mb
+        self._cache = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bypasses = 0
+    # end func
+
+    def __len__(self):
+        return len(self._cache)
+    # end func
+
+    def admits(self, nbytes):
+        """
+        :param nbytes: size of a waveform block in bytes
+        :return: True if a block of the given size fits within the byte budget
+        """
+        return nbytes <= self.max_size_mb * 1024 * 1024
+    # end func
+
+    def get(self, key):
+        """
+        :param key: (ds_id, tag)
+        :return: tuple of (Stats, data) or None on a cache-miss
+        """
+        block = self._cache.get(key)
+        if block is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+        else:
+            self.misses += 1
+        # end if
+
+        return block
+    # end func
+
+    def put(self, key, stats, data):
+        """
+        Adds a waveform block to the cache, evicting least recently used blocks as needed
+
+        :param key: (ds_id, tag)
+        :param stats: obspy Stats of the waveform block
+        :param data: samples of the waveform block; flagged read-only
+        """
+        data.flags.writeable = False
+        if key in self._cache: self.nbytes -= self._cache.pop(key)[1].nbytes
+
+        self._cache[key] = (stats, data)
+        self.nbytes += data.nbytes
+
+        while self.nbytes > self.max_size_mb * 1024 * 1024 and len(self._cache) > 1:
+            _, (_, evicted) = self._cache.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+        # end while
+    # end func
+
+    def stats(self):
+        """
+        :return: dict of cache statistics
+        """
+        return {'entries': len(self._cache), 'size_mb': self.nbytes / 1024. / 1024.,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'bypasses': self.bypasses}
+    # end func
+
+    def clear(self):
+        self._cache.clear()
+        self.nbytes = 0
+    # end func
+# end class
@@ -26,11 +26,11 @@ from seismic.stream_processing import zne_order
 from seismic.stream_io import write_h5_event_stream
 import obspy.core.util.version
 from obspy.core.inventory import Inventory
-from obspy.taup import TauPyModel
 
 from PhasePApy.phasepapy.phasepicker import aicdpicker
 from seismic.pick_harvester.utils import Event, Origin
 from seismic.pick_harvester.pick import extract_p
+from seismic.travel_time_table import TravelTimeTable
 
 logging.basicConfig()
 
@@ -268,7 +268,7 @@ def trim_inventory(inventory, network_list, station_list):
 
 class PPicker():
     def __init__(self, taup_model_name):
-        self._taup_model = TauPyModel(model=taup_model_name)
+        self._taup_model = TravelTimeTable(model=taup_model_name, phase_list=('P',))
         self._picker_list = None
 
         sigmalist = np.arange(8, 3, -1)
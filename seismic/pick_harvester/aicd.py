@@ -0,0 +1,247 @@
+"""
+Description:
+    A native implementation of the AIC-derivative (AICD) picker of PhasePApy
+    (phasepapy.phasepicker.aicdpicker.AICDPicker), which evaluates a list of detection
+    thresholds (nsigma values) in one pass.
+
+    PhasePApy computes the AIC function by evaluating the variances of all prefixes and
+    suffixes of a trace explicitly, at O(n^2) cost, and repeats that computation for each
+    picker instance, i.e. for each nsigma value. Here, the AIC function is computed in O(n)
+    from cumulative sums and the characteristic function and the rolling-rms base threshold
+    are shared by all nsigma values. Trigger identification, clean-up of close and noisy
+    triggers, pick refinement and SNR estimates follow PhasePApy. Pick polarities and
+    uncertainties, which are not used by the pick harvester, are not computed.
+
+References:
+    Chen, C., and A. A. Holland (2016). PhasePApy: A Robust Pure Python Package for Automatic
+    Identification of Seismic Phases, Seismological Research Letters 87(6)
+
+CreationDate:   17/10/26
+
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     17/10/26   agent    AIC derivative is padded at the front, as in PhasePApy
+    LastUpdate:     17/10/26   agent    Rolling windows are built with as_strided, which is available in numpy 1.19
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from obspy import UTCDateTime
+
+
+def _prefix_variances(x):
+    """
+    Variances of x[:k], for k = 1..n, computed from cumulative sums; variances of
+    constant prefixes are exactly 0
+
+    :param x: 1D array
+    :return: 1D array of length n
+    """
+    k = np.arange(1, len(x) + 1, dtype=np.float64)
+    s1 = np.cumsum(x)
+    s2 = np.cumsum(x * x)
+    var = np.maximum(s2 / k - (s1 / k) ** 2, 0)
+    var[np.maximum.accumulate(x) == np.minimum.accumulate(x)] = 0
+
+    return var
+# end func
+
+def aic(data):
+    """
+    AIC function, as computed by PhasePApy's AicDeriv characteristic function:
+    AIC[k] = k log10(var(x[:k])) + (n - k - 1) log10(var(x[k:]))
+
+    :param data: 1D array
+    :return: 1D array
+    """
+    x = np.asarray(data, dtype=np.float64)
+    n = len(x)
+    x = x - np.mean(x)
+
+    k = np.arange(1, n)
+    lv = _prefix_variances(x)[:-1]              # var(x[:k])
+    rv = _prefix_variances(x[::-1])[::-1][1:]   # var(x[k:])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = k * np.log10(lv) + (n - k - 1) * np.log10(rv)
+    # end with
+
+    result = np.zeros(n)
+    result[1:] = a
+
+    # PhasePApy replaces -inf values, resulting from constant segments, with the next value
+    # to the right, sweeping from right to left
+    bad = np.isneginf(result)
+    bad[0] = False
+    if (np.any(bad)):
+        idx = np.where(bad, n - 1, np.arange(n))
+        idx = np.minimum.accumulate(idx[::-1])[::-1]
+        result[bad] = result[np.minimum(idx[bad], n - 1)]
+    # end if
+
+    result[0] = result[1]
+    result[-1] = result[-2]
+
+    return result
+# end func
+
+def aic_deriv(data):
+    """
+    AIC-derivative characteristic function, as computed by PhasePApy's AicDeriv: |AIC[i] - AIC[i-1]|,
+    padded at the front with its first value, so that element i holds the change in AIC up to
+    sample i
+
+    :param data: 1D array, of at least 2 samples
+    :return: 1D array
+    """
+    d = np.abs(np.diff(aic(data)))
+    return np.concatenate((d[:1], d))
+# end func
+
+def _rms(x, axis=None):
+    return np.sqrt(np.mean(x ** 2, axis=axis))
+# end func
+
+def _rolling_windows(x, window):
+    """
+    Read-only view of all windows of a given length in a 1D array
+
+    :param x: 1D array
+    :param window: window length
+    :return: 2D array of shape (len(x) - window + 1, window)
+    """
+    x = np.ascontiguousarray(x)
+    return as_strided(x, shape=(len(x) - window + 1, window), strides=(x.strides[0], x.strides[0]),
+                      writeable=False)
+# end func
+
+class MultiSigmaAICDPicker():
+    def __init__(self, nsigmas, t_ma=3, t_up=0.2, nr_len=2, nr_coeff=2):
+        """
+        :param nsigmas: list of detection thresholds, in units of the rolling rms of the
+                        characteristic function, in the order they are to be evaluated
+        :param t_ma: length (s) of the moving window for computing the rolling rms
+        :param t_up: minimum time (s) between consecutive triggers
+        :param nr_len: length (s) of windows for rejecting noisy triggers
+        :param nr_coeff: coefficient for rejecting noisy triggers
+        """
+        self.nsigmas = list(nsigmas)
+        self.t_ma = t_ma
+        self.t_up = t_up
+        self.nr_len = nr_len
+        self.nr_coeff = nr_coeff
+    # end func
+
+    def __len__(self):
+        return len(self.nsigmas)
+    # end func
+
+    @staticmethod
+    def _winlen(i, trigger, filter_length, t, dt):
+        """
+        Window lengths (in samples) before and after trigger i, limited by the neighbouring
+        triggers and the extents of the trace
+        """
+        lower = t[0] if i == 0 else trigger[i - 1]
+        upper = t[-1] if i == len(trigger) - 1 else trigger[i + 1]
+
+        if (trigger[i] - filter_length < lower):
+            r = int(round((trigger[i] - lower) / dt, 0))
+        else:
+            r = int(round(filter_length / dt, 0))
+        # end if
+        if (trigger[i] + filter_length > upper):
+            R = int(round((upper - trigger[i]) / dt, 0))
+        else:
+            R = int(round(filter_length / dt, 0))
+        # end if
+
+        return r, R
+    # end func
+
+    def iter_picks(self, tr):
+        """
+        Evaluates nsigma values in order, yielding picks for each; nsigma values for which
+        PhasePApy's picker would raise an error are skipped
+
+        :param tr: obspy trace
+        :return: generator of tuples containing the index of the nsigma value, a list of
+                 picks (UTCDateTime) and an array of their SNRs
+        """
+        stats = tr.stats
+        data = tr.data
+        dt = stats.delta
+        LEN = stats.npts
+        npts_Tma = int(round(self.t_ma / dt, 0))
+        t = np.arange(0, stats.npts / stats.sampling_rate, dt)
+
+        # no triggers are found on traces no longer than the rolling-rms window
+        if (LEN <= npts_Tma):
+            for isigma in range(len(self.nsigmas)): yield isigma, [], np.array([])
+            return
+        # end if
+
+        summary = aic_deriv(data)
+        base = np.zeros(LEN)
+        base[npts_Tma:LEN] = _rms(_rolling_windows(summary[0:LEN - 1], npts_Tma), -1)
+
+        window_t_up = int(round(self.t_up / dt, 0))
+        for isigma, nsigma in enumerate(self.nsigmas):
+            try:
+                threshold = base * nsigma
+
+                # trigger
+                trigger_ptnl_index = np.where(summary[npts_Tma:LEN] > threshold[npts_Tma:LEN])[0] + npts_Tma
+                trigger_ptnl = t[trigger_ptnl_index]
+
+                # clean close triggers
+                keep = np.ones(len(trigger_ptnl), dtype=bool)
+                keep[1:] = ~((trigger_ptnl[1:] - trigger_ptnl[:-1]) <= window_t_up * dt)
+                trigger_ptnl = trigger_ptnl[keep]
+
+                # clean noisy triggers
+                remove = []
+                for i in range(len(trigger_ptnl)):
+                    r, R = self._winlen(i, trigger_ptnl, self.nr_len, t, dt)
+                    M = min(r, R)
+                    index = int(round(trigger_ptnl[i] / dt, 0))
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        if (self.nr_coeff * np.std(data[index - M:index]) >= np.std(data[index:index + M])):
+                            remove.append(i)
+                        # end if
+                    # end with
+                # end for
+                trigger = np.delete(trigger_ptnl, remove)
+
+                # roll back to picks
+                picks = []
+                for i in range(len(trigger)):
+                    index = int(round(trigger[i] / dt, 0))
+                    while (summary[index] > summary[index - 1]): index -= 1
+                    picks.append(UTCDateTime(stats.starttime + round(t[index], 3)))
+                # end for
+
+                # roll forward to maxima and compute SNRs
+                snr = np.array(trigger, copy=True)
+                for i in range(len(trigger)):
+                    index = int(round(trigger[i] / dt, 0))
+                    while (summary[index] < summary[index + 1]): index += 1
+                    maxval = round(summary[index], 3)
+
+                    index = int(round(trigger[i] / dt, 0))
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        noise = _rms(summary[index - npts_Tma:index])
+                        snr[i] = round(maxval / noise, 1)
+                    # end with
+                # end for
+            except Exception:
+                continue
+            # end try
+
+            yield isigma, picks, snr
+        # end for
+    # end func
+# end class
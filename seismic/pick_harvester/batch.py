@@ -0,0 +1,215 @@
+"""
+Description:
+    Vectorised equivalents of the obspy trace-processing steps applied to waveform windows
+    around theoretical arrivals in the pick harvester. Windows of equal length are stacked
+    into 2D arrays (one window per row) and processed together, so that filter design and
+    FFT-plan overheads are amortised over all events recorded by a station on a given day.
+    Each routine reproduces, row-wise, the output of the corresponding obspy operation.
+
+References:
+
+CreationDate:   17/10/26
+
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+from collections import defaultdict
+from functools import lru_cache
+
+import numpy as np
+from scipy.fftpack import rfft, irfft
+from scipy.signal import get_window, iirfilter, zpk2sos, sosfilt, detrend
+from obspy import Trace
+
+
+def cut_windows(trace, starttimes, endtimes):
+    """
+    Cuts windows out of a (day-long) trace, as obspy.Trace.slice would, without copying data
+
+    :param trace: obspy trace; data can be a masked array, with gaps masked
+    :param starttimes: list of window start-times (UTCDateTime)
+    :param endtimes: list of window end-times (UTCDateTime)
+    :return: list of obspy traces, with None in place of windows that do not overlap the trace
+    """
+    result = []
+    for t1, t2 in zip(starttimes, endtimes):
+        if (t2 < trace.stats.starttime or t1 > trace.stats.endtime):
+            result.append(None)
+            continue
+        # end if
+
+        w = trace.slice(t1, t2)
+        result.append(w if w.stats.npts else None)
+    # end for
+
+    return result
+# end func
+
+def has_gaps(trace):
+    """
+    :param trace: obspy trace
+    :return: True if the trace data contain masked samples
+    """
+    return bool(np.ma.is_masked(trace.data) and np.ma.getmaskarray(trace.data).any())
+# end func
+
+def group_by_length(windows):
+    """
+    Groups windows by their number of samples
+
+    :param windows: list of obspy traces or None
+    :return: dict mapping npts to lists of indices into windows
+    """
+    groups = defaultdict(list)
+    for i, w in enumerate(windows):
+        if (w is None): continue
+        groups[w.stats.npts].append(i)
+    # end for
+
+    return groups
+# end func
+
+def resample_windows(data, sampling_rate, new_sampling_rate, window='hann'):
+    """
+    Row-wise equivalent of obspy.Trace.resample (with no_filter=True)
+
+    :param data: 2D array of windows of equal length
+    :param sampling_rate: sampling rate of data
+    :param new_sampling_rate: target sampling rate
+    :param window: frequency-domain window, as in obspy.Trace.resample
+    :return: 2D array of resampled windows
+    """
+    data = np.atleast_2d(data)
+    npts = data.shape[1]
+    factor = sampling_rate / float(new_sampling_rate)
+
+    x = rfft(data, axis=-1)
+    x = np.insert(x, 1, 0, axis=-1)
+    if (npts % 2 == 0): x = np.pad(x, ((0, 0), (0, 1)))
+    x_r = x[:, ::2]
+    x_i = x[:, 1::2]
+
+    if (window is not None):
+        large_w = np.fft.ifftshift(get_window(window, npts))
+        x_r = x_r * large_w[:npts // 2 + 1]
+        x_i = x_i * large_w[:npts // 2 + 1]
+    # end if
+
+    num = max(int(npts / factor), 1)
+    df = 1.0 / (npts * (1.0 / sampling_rate))
+    d_large_f = 1.0 / num * new_sampling_rate
+    f = df * np.arange(0, npts // 2 + 1, dtype=np.int32)
+    n_large_f = num // 2 + 1
+    large_f = d_large_f * np.arange(0, n_large_f, dtype=np.int32)
+
+    # linear interpolation weights are shared by all rows
+    idx = np.clip(np.searchsorted(f, large_f, side='right') - 1, 0, max(len(f) - 2, 0))
+    if (len(f) > 1):
+        w = np.clip((large_f - f[idx]) / (f[idx + 1] - f[idx]), 0, 1)
+        interp = lambda y: y[:, idx] + w * (y[:, idx + 1] - y[:, idx])
+    else:
+        interp = lambda y: np.repeat(y[:, :1], n_large_f, axis=1)
+    # end if
+
+    large_y = np.zeros((data.shape[0], 2 * n_large_f))
+    large_y[:, ::2] = interp(x_r)
+    large_y[:, 1::2] = interp(x_i)
+
+    large_y = np.delete(large_y, 1, axis=-1)
+    if (num % 2 == 0): large_y = large_y[:, :-1]
+
+    return irfft(large_y, axis=-1) * (float(num) / float(npts))
+# end func
+
+def detrend_windows(data):
+    """
+    Row-wise equivalent of obspy.Trace.detrend('linear')
+
+    :param data: 2D array of windows
+    :return: 2D array of detrended windows
+    """
+    return detrend(data, type='linear', axis=-1)
+# end func
+
+@lru_cache(maxsize=64)
+def taper_weights(npts, sampling_rate, max_percentage, type='hann'):
+    """
+    Weights applied by obspy.Trace.taper to a trace with npts samples
+
+    :param npts: number of samples
+    :param sampling_rate: sampling rate
+    :param max_percentage: see obspy.Trace.taper
+    :param type: see obspy.Trace.taper
+    :return: 1D array of weights
+    """
+    tr = Trace(data=np.ones(npts), header={'sampling_rate': sampling_rate})
+    tr.taper(max_percentage=max_percentage, type=type)
+    tr.data.flags.writeable = False
+
+    return tr.data
+# end func
+
+@lru_cache(maxsize=64)
+def bandpass_sos(freqmin, freqmax, df, corners=4):
+    """
+    Second-order sections of the Butterworth filter designed by obspy.signal.filter.bandpass,
+    which falls back to a highpass filter if freqmax is at or above the Nyquist frequency
+
+    :param freqmin: pass band low corner frequency
+    :param freqmax: pass band high corner frequency
+    :param df: sampling rate
+    :param corners: filter order
+    :return: sos array
+    """
+    fe = 0.5 * df
+    low = freqmin / fe
+    high = freqmax / fe
+    if (high - 1.0 > -1e-6):
+        if (low > 1): raise ValueError('Selected corner frequency is above Nyquist.')
+        z, p, k = iirfilter(corners, low, btype='highpass', ftype='butter', output='zpk')
+    else:
+        if (low > 1): raise ValueError('Selected low corner frequency is above Nyquist.')
+        z, p, k = iirfilter(corners, [low, high], btype='band', ftype='butter', output='zpk')
+    # end if
+
+    return zpk2sos(z, p, k)
+# end func
+
+def bandpass_windows(data, freqmin, freqmax, df, corners=4, zerophase=True):
+    """
+    Row-wise equivalent of obspy.Trace.filter('bandpass', ...)
+
+    :param data: 2D array of windows
+    :param freqmin: pass band low corner frequency
+    :param freqmax: pass band high corner frequency
+    :param df: sampling rate
+    :param corners: filter order
+    :param zerophase: if True, the filter is applied forwards and backwards
+    :return: 2D array of filtered windows
+    """
+    sos = bandpass_sos(freqmin, freqmax, df, corners)
+    result = sosfilt(sos, data, axis=-1)
+    if (zerophase): result = sosfilt(sos, result[:, ::-1], axis=-1)[:, ::-1]
+
+    return np.ascontiguousarray(result)
+# end func
+
+def rotate_ne_rt_windows(n, e, ba):
+    """
+    Row-wise equivalent of obspy.signal.rotate.rotate_ne_rt
+
+    :param n: 2D array of north-component windows
+    :param e: 2D array of east-component windows
+    :param ba: 1D array of back-azimuths (degrees), one per row
+    :return: radial and transverse components
+    """
+    ba = np.radians(np.asarray(ba, dtype=float))[:, None]
+    r = - e * np.sin(ba) - n * np.cos(ba)
+    t = - e * np.cos(ba) + n * np.sin(ba)
+
+    return r, t
+# end func
@@ -11,6 +11,7 @@ Developer:      rakib.hassan@ga.gov.au
 
 Revision History:
     LastUpdate:     20/11/18   RH
+    LastUpdate:     17/10/26   agent    Theoretical arrivals are interpolated from cached travel-time tables
 
 """
 
@@ -22,7 +23,6 @@ from obspy.taup.taup_geo import calc_dist
 from obspy.clients.iris import Client as IrisClient
 from obspy.clients.fdsn import Client
 from obspy.taup import utils
-from obspy.taup import TauPyModel
 from obspy.signal.trigger import trigger_onset, z_detect, classic_sta_lta, recursive_sta_lta, ar_pick
 from obspy.signal.rotate import rotate_ne_rt
 from obspy.core.event import Pick as OPick, \
@@ -38,6 +38,7 @@ import numpy as np
 import scipy
 from scipy.spatial import cKDTree
 from mpi4py import MPI
+from seismic.travel_time_table import TravelTimeTable
 from collections import defaultdict
 from pykml import parser
 import copy
@@ -375,8 +376,8 @@ class Catalog():
         oEvents = []
         missingStations = defaultdict(int)
         lines = []
-        taupyModel = TauPyModel(model='iasp91')
         phase_set = set(utils.get_phase_names('ttp') + utils.get_phase_names('tts'))
+        taupyModel = TravelTimeTable(model='iasp91', phase_list=sorted(phase_set), comm=self.comm)
         for e in tqdm(self.eventList, desc='Rank %d'%(self.rank)):
             if(e.preferred_origin and len(e.preferred_origin.arrival_list)):
                 cullList = []
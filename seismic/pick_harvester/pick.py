@@ -10,6 +10,14 @@ Developer:      rakib.hassan@ga.gov.au
 
 Revision History:
     LastUpdate:     13/09/18   RH
+    LastUpdate:     17/10/26   agent    Waveform data are served from an LRU cache of decoded waveform blocks
+    LastUpdate:     17/10/26   agent    Theoretical arrivals are interpolated from cached travel-time tables
+    LastUpdate:     17/10/26   agent    Added a batched mode, in which all events on a channel-day are processed together
+    LastUpdate:     17/10/26   agent    Added a native multi-sigma AICD picker
+    LastUpdate:     17/10/26   agent    Quality measures of picks are computed in batches in batched mode
+    LastUpdate:     17/10/26   agent    Station day-ranges are scheduled dynamically, in order of estimated cost,
+                                        and completed day-ranges are recorded in journals
+    LastUpdate:     17/10/26   agent    Precision and threads of batched quality measures are set on the command line
     LastUpdate:     dd/mm/yyyy  Who     Optional description
 """
 
@@ -19,21 +27,124 @@ import re
 
 from ordered_set import OrderedSet as set
 import numpy as np
-from obspy import Trace
+from obspy import Trace, Stream, UTCDateTime
 from datetime import datetime
 from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
 
 import click
-from obspy.taup import TauPyModel
 from obspy.signal.rotate import rotate_ne_rt
 from obspy.geodetics.base import gps2dist_azimuth, kilometers2degrees
 from PhasePApy.phasepapy.phasepicker import aicdpicker
 
-from seismic.pick_harvester.utils import CatalogCSV, ProgressTracker, recursive_glob
+from seismic.pick_harvester.utils import CatalogCSV, recursive_glob, build_work_units, work_unit_key
+from seismic.xcorqc.utils import CompletionJournal, DynamicWorkQueue
 import psutil
 import gc
 
-from seismic.pick_harvester.quality import compute_quality_measures
+from seismic.pick_harvester.quality import compute_quality_measures, compute_quality_measures_batch
+from seismic.travel_time_table import TravelTimeTable
+from seismic.pick_harvester.batch import cut_windows, has_gaps, group_by_length, resample_windows, \
+    detrend_windows, taper_weights, bandpass_windows, rotate_ne_rt_windows
+
+# scales for computing continuous wavelet transforms in quality estimates of p- and s-picks
+P_QUALITY_SCALES = np.logspace(0.15, 1.5, 30)
+S_QUALITY_SCALES = np.logspace(0.01, 4, 30)
+
+def candidate_picks(pickerlist, trc):
+    """
+    Runs pickers, in order, on a filtered trace; pickers that fail are skipped
+
+    :param pickerlist: list of PhasePApy pickers, or a MultiSigmaAICDPicker
+    :param trc: filtered trace
+    :return: generator of tuples containing the index of the picker, a list of picks and
+             their SNRs
+    """
+    if (hasattr(pickerlist, 'iter_picks')):
+        for ipicker, picks, snr in pickerlist.iter_picks(trc): yield ipicker, picks, snr
+    else:
+        for ipicker, picker in enumerate(pickerlist):
+            try:
+                scnl, picks, polarity, snr, uncert = picker.picks(trc)
+            except:
+                continue
+            # end try
+            yield ipicker, picks, snr
+        # end for
+    # end if
+# end func
+
+def run_pickers(pickerlist, event, tat, snrtr, trc, phase, scales, margin=None, plot_output_folder=None,
+                compute_quality=True):
+    """
+    Runs pickers, in order, on a filtered trace, until a picker produces picks within the margin
+    of the theoretical arrival time
+
+    :param pickerlist: list of PhasePApy pickers, or a MultiSigmaAICDPicker
+    :param event: event
+    :param tat: theoretical arrival time (s), relative to the origin time of the event
+    :param snrtr: unfiltered trace, used for computing quality measures
+    :param trc: filtered trace, trimmed to the picking window
+    :param phase: 'p' or 's'
+    :param scales: scales for computing continuous wavelet transforms
+    :param margin: maximum travel-time residual of accepted picks; all picks are accepted if None
+    :param plot_output_folder: output folder for plots of quality estimates
+    :param compute_quality: quality measures, other than picker SNRs, are set to -1 if False, to
+                            be computed in batches subsequently
+    :return: lists of picks, travel-time residuals and quality measures, and the index of the
+             picker that produced the picks
+    """
+    po = event.preferred_origin
+    pickslist = []
+    snrlist = []
+    residuallist = []
+    pickerindex = -1
+
+    foundpicks = False
+    for ipicker, picks, snr in candidate_picks(pickerlist, trc):
+        try:
+            for ipick, pick in enumerate(picks):
+                actualArrival = pick - po.utctime
+                residual = actualArrival - tat
+
+                if ((margin and np.fabs(residual) < margin) or (margin == None)):
+                    pickslist.append(pick)
+
+                    plotinfo = None
+                    if (plot_output_folder):
+                        plotinfo = {'eventid': event.public_id,
+                                    'origintime': po.utctime,
+                                    'mag': event.preferred_magnitude.magnitude_value,
+                                    'net': trc.stats.network,
+                                    'sta': trc.stats.station,
+                                    'phase': phase,
+                                    'ppsnr': snr[ipick],
+                                    'pickid': ipick,
+                                    'outputfolder': plot_output_folder}
+                    # end if
+
+                    cwtsnr = dom_freq = slope_ratio = -1
+                    if (compute_quality):
+                        wab = snrtr.slice(pick - 10, pick + 10)
+                        wab_filtered = trc.slice(pick - 10, pick + 10)
+                        cwtsnr, dom_freq, slope_ratio = compute_quality_measures(wab, wab_filtered, scales,
+                                                                                 plotinfo)
+                    # end if
+                    snrlist.append([snr[ipick], cwtsnr, dom_freq, slope_ratio])
+
+                    residuallist.append(residual)
+                    pickerindex = ipicker
+
+                    foundpicks = True
+                # end if
+            # end for
+        except:
+            continue
+        # end try
+        if (foundpicks): break
+    # end for
+
+    return pickslist, residuallist, snrlist, pickerindex
+# end func
 
 def extract_p(taupy_model, pickerlist, event, station_longitude, station_latitude,
               st, win_start=-50, win_end=50, resample_hz=20,
@@ -76,13 +187,9 @@ def extract_p(taupy_model, pickerlist, event, station_longitude, station_latitud
         if (np.max(snrtr.data) > max_amplitude): return None
 
         pickslist = []
-        snrlist = []
-        residuallist = []
         bandindex = -1
-        pickerindex = -1
         taper_percentage = float(buffer_end) / float(win_end + buffer_end - (win_start + buffer_start))
 
-        foundpicks = False
         for i in range(len(bp_freqmins)):
             trc = snrtr.copy()
             trc.taper(max_percentage=taper_percentage, type='hann')
@@ -91,50 +198,13 @@ def extract_p(taupy_model, pickerlist, event, station_longitude, station_latitud
                        zerophase=True)
             trc = trc.slice(po.utctime + tat + win_start, po.utctime + tat + win_end)
 
-            for ipicker, picker in enumerate(pickerlist):
-                try:
-                    scnl, picks, polarity, snr, uncert = picker.picks(trc)
-
-                    for ipick, pick in enumerate(picks):
-                        actualArrival = pick - po.utctime
-                        residual = actualArrival - tat
-
-                        if ((margin and np.fabs(residual) < margin) or (margin == None)):
-                            pickslist.append(pick)
-
-                            plotinfo = None
-                            if (plot_output_folder):
-                                plotinfo = {'eventid': event.public_id,
-                                            'origintime': po.utctime,
-                                            'mag': event.preferred_magnitude.magnitude_value,
-                                            'net': trc.stats.network,
-                                            'sta': trc.stats.station,
-                                            'phase': 'p',
-                                            'ppsnr': snr[ipick],
-                                            'pickid': ipick,
-                                            'outputfolder': plot_output_folder}
-                            # end if
-
-                            wab = snrtr.slice(pick - 10, pick + 10)
-                            wab_filtered = trc.slice(pick - 10, pick + 10)
-                            scales = np.logspace(0.15, 1.5, 30)
-                            cwtsnr, dom_freq, slope_ratio = compute_quality_measures(wab, wab_filtered, scales,
-                                                                                     plotinfo)
-                            snrlist.append([snr[ipick], cwtsnr, dom_freq, slope_ratio])
-
-                            residuallist.append(residual)
-                            bandindex = i
-                            pickerindex = ipicker
-
-                            foundpicks = True
-                        # end if
-                    # end for
-                except:
-                    continue
-                # end try
-                if (foundpicks): break
-            # end for
-            if (foundpicks): break
+            pickslist, residuallist, snrlist, pickerindex = \
+                run_pickers(pickerlist, event, tat, snrtr, trc, 'p', P_QUALITY_SCALES,
+                            margin=margin, plot_output_folder=plot_output_folder)
+            if (len(pickslist)):
+                bandindex = i
+                break
+            # end if
         # end for
 
         if (len(pickslist)):
@@ -206,13 +276,9 @@ def extract_s(taupy_model, pickerlist, event, station_longitude, station_latitud
         if (np.max(snrtr.data) > max_amplitude): return None
 
         pickslist = []
-        snrlist = []
-        residuallist = []
         bandindex = -1
-        pickerindex = -1
         taper_percentage = float(buffer_end) / float(win_end + buffer_end - (win_start + buffer_start))
 
-        foundpicks = False
         for i in range(len(bp_freqmins)):
             trc = snrtr.copy()
             trc.taper(max_percentage=taper_percentage)
@@ -221,50 +287,13 @@ def extract_s(taupy_model, pickerlist, event, station_longitude, station_latitud
                        zerophase=True)
             trc = trc.slice(po.utctime + tat + win_start, po.utctime + tat + win_end)
 
-            for ipicker, picker in enumerate(pickerlist):
-                try:
-                    scnl, picks, polarity, snr, uncert = picker.picks(trc)
-
-                    for ipick, pick in enumerate(picks):
-                        actualArrival = pick - po.utctime
-                        residual = actualArrival - tat
-
-                        if ((margin and np.fabs(residual) < margin) or (margin == None)):
-                            pickslist.append(pick)
-
-                            plotinfo = None
-                            if (plot_output_folder):
-                                plotinfo = {'eventid': event.public_id,
-                                            'origintime': po.utctime,
-                                            'mag': event.preferred_magnitude.magnitude_value,
-                                            'net': trc.stats.network,
-                                            'sta': trc.stats.station,
-                                            'phase': 's',
-                                            'ppsnr': snr[ipick],
-                                            'pickid': ipick,
-                                            'outputfolder': plot_output_folder}
-                            # end if
-
-                            wab = snrtr.slice(pick - 10, pick + 10)
-                            wab_filtered = trc.slice(pick - 10, pick + 10)
-                            scales = np.logspace(0.01, 4, 30)
-                            cwtsnr, dom_freq, slope_ratio = compute_quality_measures(wab, wab_filtered, scales,
-                                                                                     plotinfo)
-                            snrlist.append([snr[ipick], cwtsnr, dom_freq, slope_ratio])
-
-                            residuallist.append(residual)
-                            bandindex = i
-                            pickerindex = ipicker
-
-                            foundpicks = True
-                        # end if
-                    # end for
-                except:
-                    continue
-                # end try
-                if (foundpicks): break
-            # end for
-            if (foundpicks): break
+            pickslist, residuallist, snrlist, pickerindex = \
+                run_pickers(pickerlist, event, tat, snrtr, trc, 's', S_QUALITY_SCALES,
+                            margin=margin, plot_output_folder=plot_output_folder)
+            if (len(pickslist)):
+                bandindex = i
+                break
+            # end if
         # end for
 
         if (len(pickslist)):
@@ -278,29 +307,268 @@ def extract_s(taupy_model, pickerlist, event, station_longitude, station_latitud
 
 # end func
 
-def getWorkloadEstimate(fds, originTimestamps, network_list=[], station_list=[]):
-    totalTraceCount = 0
-    for nc, sc, start_time, end_time in fds.stations_iterator(network_list=network_list,
-                                                              station_list=station_list):
+def predict_arrivals(taupy_model, phase, events, station_longitude, station_latitude):
+    """
+    Computes theoretical arrival times of a phase for a list of events, through vectorised
+    queries when taupy_model is a TravelTimeTable
+
+    :param taupy_model: TravelTimeTable or obspy.taup.TauPyModel
+    :param phase: phase name
+    :param events: list of events
+    :param station_longitude: station longitude
+    :param station_latitude: station latitude
+    :return: array of travel times (s), holding NaNs where no arrivals are found
+    """
+    tats = np.full(len(events), np.nan)
+    ids = [i for i, e in enumerate(events) if e.preferred_origin]
+    if (len(ids) == 0): return tats
+
+    pos = [events[i].preferred_origin for i in ids]
+    if (isinstance(taupy_model, TravelTimeTable)):
+        tats[ids] = taupy_model.query_geo(phase, [po.depthkm for po in pos], [po.lat for po in pos],
+                                          [po.lon for po in pos], station_latitude, station_longitude)[0]
+    else:
+        for i, po in zip(ids, pos):
+            try:
+                atimes = taupy_model.get_travel_times_geo(po.depthkm, po.lat, po.lon, station_latitude,
+                                                          station_longitude, phase_list=(phase,))
+                if (len(atimes)): tats[i] = atimes[0].time
+            except:
+                continue
+            # end try
+        # end for
+    # end if
 
-        day = 24 * 3600
-        curr = start_time
-        step = day
-        while (curr < end_time):
-            if (curr + step > end_time):
-                step = end_time - curr
-            # end if
+    return tats
+# end func
 
-            eventIndices = (np.where((originTimestamps >= curr.timestamp) & \
-                                     (originTimestamps <= (curr + day).timestamp)))[0]
+def _preprocess_windows(windows, resample_hz):
+    """
+    Resamples and detrends windows, processing windows of equal length together
 
-            if (eventIndices.shape[0] > 0): totalTraceCount += 1
-            curr += step
-        # wend
+    :param windows: list of obspy traces (or None), cut out of the same trace
+    :param resample_hz: target sampling rate
+    :return: list of processed obspy traces (or None)
+    """
+    result = [None] * len(windows)
+    for npts, ids in group_by_length(windows).items():
+        sr = windows[ids[0]].stats.sampling_rate
+        data = np.array([np.ma.getdata(windows[i].data) for i in ids])
+        data = detrend_windows(resample_windows(data, sr, resample_hz))
+
+        for row, i in enumerate(ids):
+            header = windows[i].stats.copy()
+            header.sampling_rate = resample_hz
+            header.npts = data.shape[1]
+            result[i] = Trace(data=data[row], header=header)
+        # end for
+    # end for
+
+    return result
+# end func
+
+def _pick_windows(pickerlist, events, tats, snrtrs, results, phase, scales, win_start, win_end,
+                  buffer_start, buffer_end, bp_freqmins, bp_freqmaxs, margin, plot_output_folder,
+                  quality_dtype=np.float64, quality_threads=1):
+    """
+    Batched equivalent of the band-filtering and picking stages of extract_p and extract_s. For
+    each frequency band, all windows that have not yet produced picks are tapered and filtered
+    together, before pickers are run on each of them. Quality measures of all picks are then
+    computed together, unless plots of quality estimates are to be saved.
+
+    :param results: list of results, one per event, populated in place
+    :param quality_dtype: floating point type of wavelet transforms in quality measures
+    :param quality_threads: number of threads used for computing FFTs in quality measures
+    """
+    taper_percentage = float(buffer_end) / float(win_end + buffer_end - (win_start + buffer_start))
+
+    remaining = [i for i, snrtr in enumerate(snrtrs) if snrtr is not None]
+    for iband in range(len(bp_freqmins)):
+        picked = set()
+        for npts, ids in group_by_length([snrtrs[i] for i in remaining]).items():
+            ids = [remaining[i] for i in ids]
+            sr = snrtrs[ids[0]].stats.sampling_rate
+
+            data = np.array([snrtrs[i].data for i in ids]) * taper_weights(npts, sr, taper_percentage)
+            data = bandpass_windows(data, bp_freqmins[iband], bp_freqmaxs[iband], sr, corners=4, zerophase=True)
+
+            for row, i in enumerate(ids):
+                po = events[i].preferred_origin
+                trc = Trace(data=data[row], header=snrtrs[i].stats)
+                trc = trc.slice(po.utctime + tats[i] + win_start, po.utctime + tats[i] + win_end)
+
+                pickslist, residuallist, snrlist, pickerindex = \
+                    run_pickers(pickerlist, events[i], tats[i], snrtrs[i], trc, phase, scales,
+                                margin=margin, plot_output_folder=plot_output_folder,
+                                compute_quality=plot_output_folder is not None)
+                if (len(pickslist)):
+                    results[i] = pickslist, residuallist, np.array(snrlist), iband, pickerindex
+                    picked.add(i)
+                # end if
+            # end for
+        # end for
+
+        remaining = [i for i in remaining if i not in picked]
+        if (len(remaining) == 0): break
+    # end for
+
+    if (plot_output_folder is None):
+        ids = [i for i, result in enumerate(results) if result is not None and snrtrs[i] is not None]
+        wabs = [snrtrs[i].slice(pick - 10, pick + 10) for i in ids for pick in results[i][0]]
+        if (len(wabs)):
+            measures = compute_quality_measures_batch(wabs, scales, dtype=quality_dtype, workers=quality_threads)
+            row = 0
+            for i in ids:
+                snrlist = results[i][2]
+                snrlist[:, 1:] = measures[row:row + len(snrlist)]
+                row += len(snrlist)
+            # end for
+        # end if
+    # end if
+# end func
+
+def extract_p_batch(taupy_model, pickerlist, events, station_longitude, station_latitude,
+                    trace, win_start=-50, win_end=50, resample_hz=20,
+                    bp_freqmins=[0.5, 2., 5.],
+                    bp_freqmaxs=[5., 10., 10.],
+                    margin=None,
+                    max_amplitude=1e8,
+                    plot_output_folder=None,
+                    quality_dtype=np.float64,
+                    quality_threads=1):
+    """
+    Batched equivalent of extract_p, for all events recorded on a day-long trace. Windows around
+    theoretical arrivals are cut out of the trace, resampled, filtered and picked together;
+    windows that straddle data gaps are processed through extract_p.
+
+    :param trace: obspy trace, with gaps masked, e.g. as assembled from the output of
+                  FederatedASDFDataSet.get_waveform_arrays
+    :param quality_dtype: floating point type of wavelet transforms in quality measures
+    :param quality_threads: number of threads used for computing FFTs in quality measures
+    :return: list of results, one per event, as returned by extract_p
+    """
+    results = [None] * len(events)
+    tats = predict_arrivals(taupy_model, 'P', events, station_longitude, station_latitude)
+
+    buffer_start = -10
+    buffer_end = 10
+    ids = np.where(np.isfinite(tats))[0]
+    windows = [None] * len(events)
+    for i, w in zip(ids, cut_windows(trace,
+                                     [events[i].preferred_origin.utctime + tats[i] + win_start + buffer_start
+                                      for i in ids],
+                                     [events[i].preferred_origin.utctime + tats[i] + win_end + buffer_end
+                                      for i in ids])):
+        windows[i] = w
+    # end for
+
+    segments = None
+    for i, w in enumerate(windows):
+        if (w is None or not has_gaps(w)): continue
+
+        if (segments is None): segments = Stream(traces=trace.split())
+        results[i] = extract_p(taupy_model, pickerlist, events[i], station_longitude, station_latitude,
+                               segments, win_start=win_start, win_end=win_end, resample_hz=resample_hz,
+                               bp_freqmins=bp_freqmins, bp_freqmaxs=bp_freqmaxs, margin=margin,
+                               max_amplitude=max_amplitude, plot_output_folder=plot_output_folder)
+        windows[i] = None
+    # end for
+
+    snrtrs = _preprocess_windows(windows, resample_hz)
+    snrtrs = [snrtr if (snrtr is not None and np.max(snrtr.data) <= max_amplitude) else None
+              for snrtr in snrtrs]
+
+    _pick_windows(pickerlist, events, tats, snrtrs, results, 'p', P_QUALITY_SCALES, win_start, win_end,
+                  buffer_start, buffer_end, bp_freqmins, bp_freqmaxs, margin, plot_output_folder,
+                  quality_dtype=quality_dtype, quality_threads=quality_threads)
+
+    return results
+# end func
+
+def extract_s_batch(taupy_model, pickerlist, events, station_longitude, station_latitude,
+                    trn, tre, bas, win_start=-50, win_end=50, resample_hz=20,
+                    bp_freqmins=[0.01, 0.01, 0.5],
+                    bp_freqmaxs=[1, 2., 5.],
+                    margin=None,
+                    max_amplitude=1e8,
+                    plot_output_folder=None,
+                    quality_dtype=np.float64,
+                    quality_threads=1):
+    """
+    Batched equivalent of extract_s, for all events recorded on day-long traces. See
+    extract_p_batch.
+
+    :param trn: obspy trace of the north (or vertical) component, with gaps masked
+    :param tre: obspy trace of the east component, with gaps masked; can be None, in which
+                case trn is picked directly
+    :param bas: back-azimuths, one per event
+    :param quality_dtype: see extract_p_batch
+    :param quality_threads: see extract_p_batch
+    :return: list of results, one per event, as returned by extract_s
+    """
+    results = [None] * len(events)
+    tats = predict_arrivals(taupy_model, 'S', events, station_longitude, station_latitude)
+
+    buffer_start = -10
+    buffer_end = 10
+    ids = np.where(np.isfinite(tats))[0]
+    starttimes = [events[i].preferred_origin.utctime + tats[i] + win_start + buffer_start for i in ids]
+    endtimes = [events[i].preferred_origin.utctime + tats[i] + win_end + buffer_end for i in ids]
+
+    windows_n = [None] * len(events)
+    windows_e = [None] * len(events)
+    for i, w in zip(ids, cut_windows(trn, starttimes, endtimes)): windows_n[i] = w
+    if (tre is not None):
+        for i, w in zip(ids, cut_windows(tre, starttimes, endtimes)): windows_e[i] = w
+    # end if
+
+    segments_n = segments_e = None
+    for i in range(len(events)):
+        if (windows_n[i] is None): continue
+        if (tre is not None and windows_e[i] is None):
+            windows_n[i] = None
+            continue
+        # end if
+        if (not has_gaps(windows_n[i]) and (tre is None or not has_gaps(windows_e[i]))): continue
+
+        if (segments_n is None):
+            segments_n = Stream(traces=trn.split())
+            if (tre is not None): segments_e = Stream(traces=tre.split())
+        # end if
+        results[i] = extract_s(taupy_model, pickerlist, events[i], station_longitude, station_latitude,
+                               segments_n, segments_e, bas[i], win_start=win_start, win_end=win_end,
+                               resample_hz=resample_hz, bp_freqmins=bp_freqmins, bp_freqmaxs=bp_freqmaxs,
+                               margin=margin, max_amplitude=max_amplitude, plot_output_folder=plot_output_folder)
+        windows_n[i] = windows_e[i] = None
     # end for
-    return totalTraceCount
 
+    snrtrs = _preprocess_windows(windows_n, resample_hz)
+    if (tre is not None):
+        snrtrs_e = _preprocess_windows(windows_e, resample_hz)
+
+        # rotate to the transverse component; components of unequal lengths are discarded
+        rotated = [None] * len(events)
+        for npts, ids in group_by_length(snrtrs).items():
+            ids = [i for i in ids if snrtrs_e[i] is not None and snrtrs_e[i].stats.npts == npts]
+            if (len(ids) == 0): continue
+
+            _, tc = rotate_ne_rt_windows(np.array([snrtrs[i].data for i in ids]),
+                                         np.array([snrtrs_e[i].data for i in ids]),
+                                         [bas[i] for i in ids])
+            tc = detrend_windows(tc)
+            for row, i in enumerate(ids): rotated[i] = Trace(data=tc[row], header=snrtrs[i].stats)
+        # end for
+        snrtrs = rotated
+    # end if
+
+    snrtrs = [snrtr if (snrtr is not None and np.max(snrtr.data) <= max_amplitude) else None
+              for snrtr in snrtrs]
+
+    _pick_windows(pickerlist, events, tats, snrtrs, results, 's', S_QUALITY_SCALES, win_start, win_end,
+                  buffer_start, buffer_end, bp_freqmins, bp_freqmaxs, margin, plot_output_folder,
+                  quality_dtype=quality_dtype, quality_threads=quality_threads)
 
+    return results
 # end func
 
 def dropBogusTraces(st, sampling_rate_cutoff=5):
@@ -311,6 +579,107 @@ def dropBogusTraces(st, sampling_rate_cutoff=5):
 
 # end func
 
+def get_magnitude(event):
+    """
+    :param event: event
+    :return: preferred magnitude of the event, or the first magnitude of its preferred origin;
+             NaN if neither is available
+    """
+    po = event.preferred_origin
+    mag = None
+    if (event.preferred_magnitude):
+        mag = event.preferred_magnitude.magnitude_value
+    elif (len(po.magnitude_list)):
+        mag = po.magnitude_list[0].magnitude_value
+    if (mag == None): mag = np.NaN
+
+    return mag
+# end func
+
+def get_batch_events(events, eventIndices, slon, slat, min_magnitude):
+    """
+    Selects events to be processed in batches
+
+    :param events: list of events
+    :param eventIndices: indices of events within the current time-range
+    :param slon: station longitude
+    :param slat: station latitude
+    :param min_magnitude: minimum magnitude
+    :return: lists of events, their magnitudes and their distances, azimuths and back-azimuths
+             from the station, as returned by gps2dist_azimuth
+    """
+    batch_events = []
+    batch_mags = []
+    batch_das = []
+    for ei in eventIndices:
+        event = events[ei]
+        mag = get_magnitude(event)
+        if (np.isnan(mag) or mag < min_magnitude): continue
+
+        po = event.preferred_origin
+        batch_events.append(event)
+        batch_mags.append(mag)
+        batch_das.append(gps2dist_azimuth(po.lat, po.lon, slat, slon))
+    # end for
+
+    return batch_events, batch_mags, batch_das
+# end func
+
+def write_picks(of, event, mag, net, sta, cha, slon, slat, da, result, sigmalist):
+    """
+    Writes picks, as returned by extract_p/extract_s, to an output file
+
+    :param of: output file
+    :param event: event
+    :param mag: event magnitude
+    :param net: network code
+    :param sta: station code
+    :param cha: channel code
+    :param slon: station longitude
+    :param slat: station latitude
+    :param da: distance (m), azimuth and back-azimuth, as returned by gps2dist_azimuth
+    :param result: output of extract_p/extract_s
+    :param sigmalist: sigma values of pickers
+    """
+    po = event.preferred_origin
+    picklist, residuallist, snrlist, bandindex, pickerindex = result
+
+    arcdistance = kilometers2degrees(da[0] / 1e3)
+    for ip, pick in enumerate(picklist):
+        line = '%s %f %f %f %f %f ' \
+               '%s %s %s %f %f %f ' \
+               '%f %f %f ' \
+               '%f %f %f %f %f ' \
+               '%d %d\n' % (
+               event.public_id, po.utctime.timestamp, mag, po.lon, po.lat, po.depthkm,
+               net, sta, cha, pick.timestamp, slon, slat,
+               da[1], da[2], arcdistance,
+               residuallist[ip], snrlist[ip, 0], snrlist[ip, 1], snrlist[ip, 2], snrlist[ip, 3],
+               bandindex, sigmalist[pickerindex])
+        of.write(line)
+    # end for
+    of.flush()
+# end func
+
+def get_day_trace(fds, codes, starttime, endtime, sampling_rate_cutoff=5):
+    """
+    Reads a contiguous block of data for a channel, with gaps masked
+
+    :param fds: FederatedASDFDataSet
+    :param codes: network, station, location and channel codes
+    :param starttime: start time
+    :param endtime: end time
+    :param sampling_rate_cutoff: data with sampling rates below this value are discarded
+    :return: obspy trace, or None if no data are found
+    """
+    data, t0, sr = fds.get_waveform_arrays(codes[0], codes[1], codes[2], codes[3],
+                                           starttime, endtime, trace_count_threshold=200)
+    if (data is None or sr < sampling_rate_cutoff): return None
+
+    return Trace(data=data, header={'network': codes[0], 'station': codes[1], 'location': codes[2],
+                                    'channel': codes[3], 'starttime': t0, 'sampling_rate': sr})
+# end func
+
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 
@@ -335,8 +704,40 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
               show_default=True)
 @click.option('--save-quality-plots', default=False, is_flag=True, help='Save plots of quality estimates',
               show_default='True')
+@click.option('--waveform-cache-size-mb', default=512, type=int,
+              help='Size (MB) of the per-process cache of decoded waveform blocks, which avoids repeated reads '
+                   'of the same data from ASDF files; set to 0 to disable caching',
+              show_default=True)
+@click.option('--batched', default=False, is_flag=True,
+              help='Process all events recorded by a channel on a given day together: each day-long block of '
+                   'data is read once and windows around theoretical arrivals are resampled and filtered '
+                   'as 2D arrays, before pickers are run on them',
+              show_default=True)
+@click.option('--native-picker', default=False, is_flag=True,
+              help='Use a native implementation of the AICD picker, which computes the characteristic function '
+                   'once per frequency band and evaluates all nsigma values in one pass, instead of PhasePApy\'s '
+                   'AICDPicker',
+              show_default=True)
+@click.option('--schedule', type=click.Choice(['dynamic', 'static']), default='dynamic', show_default=True,
+              help="Scheduling of work-units, each spanning a range of days of data recorded at a station, "
+                   "across processes. 'dynamic' orders work-units by decreasing cost, estimated from the number "
+                   "of events and the amount of data recorded in each, as per the index of the data-source, and "
+                   "hands them out to processes on demand, so that processes finish around the same time; "
+                   "'static' assigns work-units to processes upfront, in a round-robin fashion. Completed "
+                   "work-units are recorded in journal files (completed.*.txt) in OUTPUT_PATH, which allows "
+                   "restarting jobs with '--restart', with either scheduling and any number of processes")
+@click.option('--days-per-unit', default=30, type=click.IntRange(1), show_default=True,
+              help="Number of days spanned by each work-unit. Jobs must be restarted with the same value for "
+                   "completed work-units to be recognised")
+@click.option('--quality-dtype', type=click.Choice(['float64', 'float32']), default='float64', show_default=True,
+              help="Floating point type of the wavelet transforms used in quality measures of picks, in batched "
+                   "mode; 'float32' halves memory usage and is faster, at a relative precision of ~1e-4")
+@click.option('--quality-threads', default=1, type=click.IntRange(1), show_default=True,
+              help="Number of threads used by FFTs in quality measures of picks, in batched mode. Note that the "
+                   "total number of threads used is this value times the number of processes")
 def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude, network_list, station_list,
-            restart, save_quality_plots):
+            restart, save_quality_plots, waveform_cache_size_mb, batched, native_picker, schedule, days_per_unit,
+            quality_dtype, quality_threads):
     """
     ASDF_SOURCE: Text file containing a list of paths to ASDF files
     EVENT_FOLDER: Path to folder containing event files\n
@@ -385,6 +786,13 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
             f.write('%25s\t\t: %s\n' % ('STATION_LIST', station_list))
             f.write('%25s\t\t: %s\n' % ('RESTART_MODE', 'TRUE' if restart else 'FALSE'))
             f.write('%25s\t\t: %s\n' % ('SAVE_PLOTS', 'TRUE' if save_quality_plots else 'FALSE'))
+            f.write('%25s\t\t: %s\n' % ('WAVEFORM_CACHE_SIZE_MB', waveform_cache_size_mb))
+            f.write('%25s\t\t: %s\n' % ('BATCHED', 'TRUE' if batched else 'FALSE'))
+            f.write('%25s\t\t: %s\n' % ('NATIVE_PICKER', 'TRUE' if native_picker else 'FALSE'))
+            f.write('%25s\t\t: %s\n' % ('SCHEDULE', schedule))
+            f.write('%25s\t\t: %s\n' % ('DAYS_PER_UNIT', days_per_unit))
+            f.write('%25s\t\t: %s\n' % ('QUALITY_DTYPE', quality_dtype))
+            f.write('%25s\t\t: %s\n' % ('QUALITY_THREADS', quality_threads))
             f.close()
 
         # end func
@@ -392,6 +800,8 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
         outputConfigParameters()
     # end if
 
+    quality_dtype = np.dtype(quality_dtype).type
+
     # ==================================================
     # Create output-folder for snr-plots
     # ==================================================
@@ -428,14 +838,55 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
         pickerlist_s.append(picker_s)
     # end for
 
+    if (native_picker):
+        from seismic.pick_harvester.aicd import MultiSigmaAICDPicker
+
+        pickerlist_p = MultiSigmaAICDPicker(sigmalist, t_ma=10, t_up=1, nr_len=5, nr_coeff=2)
+        pickerlist_s = MultiSigmaAICDPicker(sigmalist, t_ma=15, t_up=1, nr_len=5, nr_coeff=2)
+    # end if
+
     # ==================================================
     # Define theoretical model
     # Instantiate data-access object
-    # Retrieve estimated workload
     # ==================================================
-    taupyModel = TauPyModel(model='iasp91')
-    fds = FederatedASDFDataSet(asdf_source, logger=None)
-    workload = getWorkloadEstimate(fds, originTimestamps, network_list=network_list, station_list=station_list)
+    taupyModel = TravelTimeTable(model='iasp91', phase_list=('P', 'S'), comm=comm)
+    fds = FederatedASDFDataSet(asdf_source, logger=None, waveform_cache_size_mb=waveform_cache_size_mb)
+
+    # ==================================================
+    # Create work-units, each spanning a range of days
+    # of data recorded at a station, and drop work-units
+    # completed in a previous run
+    # ==================================================
+    # instantiation is collective: in fresh runs, rank 0 removes the journals of all ranks of a
+    # previous run before any rank proceeds
+    journal = CompletionJournal(output_folder=output_path, restart_mode=restart)
+    units = None
+    if (rank == 0):
+        spans = fds.get_recording_spans(network_list=network_list, station_list=station_list)
+        units, costs = build_work_units(spans, originTimestamps, days_per_unit=days_per_unit)
+
+        if (restart):
+            nunits = len(units)
+            keep = [i for i, unit in enumerate(units) if not journal.is_complete(work_unit_key(unit))]
+            units = [units[i] for i in keep]
+            costs = costs[keep]
+            print('Found results for %d of %d work-units. Moving along..' % (nunits - len(units), nunits))
+        # end if
+
+        # order work-units by decreasing cost, so that the most expensive units are processed first
+        # and ranks finish around the same time
+        order = sorted(range(len(units)), key=lambda i: (-costs[i], units[i]))
+        units = [units[i] for i in order]
+    # end if
+    units = comm.bcast(units, root=0)
+
+    workQueue = None
+    if (schedule == 'static'):
+        proc_unit_indices = range(rank, len(units), nproc)
+    else:
+        workQueue = DynamicWorkQueue(len(units), comm=comm)
+        proc_unit_indices = workQueue
+    # end if
 
     # ==================================================
     # Define output header and open output files
@@ -449,16 +900,20 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
     if (restart == False):
         ofp = open(ofnp, 'w+')
         ofs = open(ofns, 'w+')
-        ofp.write(header)
-        ofs.write(header)
     else:
         ofp = open(ofnp, 'a+')
         ofs = open(ofns, 'a+')
     # end if
+    # restarted jobs may run on more ranks than before
+    if (ofp.tell() == 0): ofp.write(header)
+    if (ofs.tell() == 0): ofs.write(header)
+
+    unitCount = 0
+    for iunit in proc_unit_indices:
+        nc, sc, start_time, end_time = units[iunit]
+        start_time = UTCDateTime(start_time)
+        end_time = UTCDateTime(end_time)
 
-    progTracker = ProgressTracker(output_folder=output_path, restart_mode=restart)
-    totalTraceCount = 0
-    for nc, sc, start_time, end_time in fds.stations_iterator(network_list=network_list, station_list=station_list):
         day = 24 * 3600
         dayCount = 0
         curr = start_time
@@ -477,17 +932,51 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
                                      (originTimestamps <= (curr + day).timestamp)))[0]
 
             if (eventIndices.shape[0] > 0):
-                totalTraceCount += 1
                 stations = fds.get_stations(curr, curr + day, network=nc, station=sc)
                 stations_zch = [s for s in stations if 'Z' == s[3][-1].upper()]  # only Z channels
                 stations_nch = [s for s in stations if 'N' == s[3][-1].upper() or '1' == s[3][-1]]  # only N channels
                 stations_ech = [s for s in stations if 'E' == s[3][-1].upper() or '2' == s[3][-1]]  # only E channels
 
                 for codes in stations_zch:
-                    if (progTracker.increment()):
-                        pass
-                    else:
+                    if (batched):
+                        trz = get_day_trace(fds, codes, curr, curr + step)
+                        if (trz is None): continue
+
+                        slon, slat = codes[4], codes[5]
+                        batch_events, batch_mags, batch_das = get_batch_events(events, eventIndices, slon, slat,
+                                                                               min_magnitude)
+
+                        results_p = extract_p_batch(taupyModel, pickerlist_p, batch_events, slon, slat, trz,
+                                                    max_amplitude=max_amplitude,
+                                                    plot_output_folder=plot_output_folder,
+                                                    quality_dtype=quality_dtype, quality_threads=quality_threads)
+                        results_s = [None] * len(batch_events)
+                        if (len(stations_nch) == 0 and len(stations_ech) == 0):
+                            results_s = extract_s_batch(taupyModel, pickerlist_s, batch_events, slon, slat, trz,
+                                                        None, [da[2] for da in batch_das],
+                                                        max_amplitude=max_amplitude,
+                                                        plot_output_folder=plot_output_folder,
+                                                        quality_dtype=quality_dtype,
+                                                        quality_threads=quality_threads)
+                        # end if
+
+                        for event, mag, da, result_p, result_s in zip(batch_events, batch_mags, batch_das,
+                                                                      results_p, results_s):
+                            if (result_p):
+                                write_picks(ofp, event, mag, codes[0], codes[1], codes[3], slon, slat, da,
+                                            result_p, sigmalist)
+                                pickCountP += 1
+                            # end if
+                            if (result_s):
+                                write_picks(ofs, event, mag, codes[0], codes[1], codes[3], slon, slat, da,
+                                            result_s, sigmalist)
+                                pickCountS += 1
+                            # end if
+                        # end for
+
+                        traceCountP += 1
                         continue
+                    # end if
 
                     st = fds.get_waveforms(codes[0], codes[1], codes[2], codes[3],
                                            curr,
@@ -509,12 +998,7 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
                         event = events[ei]
                         po = event.preferred_origin
                         da = gps2dist_azimuth(po.lat, po.lon, slat, slon)
-                        mag = None
-                        if (event.preferred_magnitude):
-                            mag = event.preferred_magnitude.magnitude_value
-                        elif (len(po.magnitude_list)):
-                            mag = po.magnitude_list[0].magnitude_value
-                        if (mag == None): mag = np.NaN
+                        mag = get_magnitude(event)
 
                         if (np.isnan(mag) or mag < min_magnitude): continue
 
@@ -522,23 +1006,8 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
                                            max_amplitude=max_amplitude,
                                            plot_output_folder=plot_output_folder)
                         if (result):
-                            picklist, residuallist, snrlist, bandindex, pickerindex = result
-
-                            arcdistance = kilometers2degrees(da[0] / 1e3)
-                            for ip, pick in enumerate(picklist):
-                                line = '%s %f %f %f %f %f ' \
-                                       '%s %s %s %f %f %f ' \
-                                       '%f %f %f ' \
-                                       '%f %f %f %f %f ' \
-                                       '%d %d\n' % (
-                                       event.public_id, po.utctime.timestamp, mag, po.lon, po.lat, po.depthkm,
-                                       codes[0], codes[1], codes[3], pick.timestamp, slon, slat,
-                                       da[1], da[2], arcdistance,
-                                       residuallist[ip], snrlist[ip, 0], snrlist[ip, 1], snrlist[ip, 2], snrlist[ip, 3],
-                                       bandindex, sigmalist[pickerindex])
-                                ofp.write(line)
-                            # end for
-                            ofp.flush()
+                            write_picks(ofp, event, mag, codes[0], codes[1], codes[3], slon, slat, da, result,
+                                        sigmalist)
                             pickCountP += 1
                         # end if
 
@@ -547,24 +1016,8 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
                                                max_amplitude=max_amplitude,
                                                plot_output_folder=plot_output_folder)
                             if (result):
-                                picklist, residuallist, snrlist, bandindex, pickerindex = result
-
-                                arcdistance = kilometers2degrees(da[0] / 1e3)
-                                for ip, pick in enumerate(picklist):
-                                    line = '%s %f %f %f %f %f ' \
-                                           '%s %s %s %f %f %f ' \
-                                           '%f %f %f ' \
-                                           '%f %f %f %f %f ' \
-                                           '%d %d\n' % (
-                                           event.public_id, po.utctime.timestamp, mag, po.lon, po.lat, po.depthkm,
-                                           codes[0], codes[1], codes[3], pick.timestamp, slon, slat,
-                                           da[1], da[2], arcdistance,
-                                           residuallist[ip], snrlist[ip, 0], snrlist[ip, 1], snrlist[ip, 2],
-                                           snrlist[ip, 3],
-                                           bandindex, sigmalist[pickerindex])
-                                    ofs.write(line)
-                                # end for
-                                ofs.flush()
+                                write_picks(ofs, event, mag, codes[0], codes[1], codes[3], slon, slat, da, result,
+                                            sigmalist)
                                 pickCountS += 1
                             # end if
                         # end if
@@ -575,10 +1028,32 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
 
                 if (len(stations_nch) > 0 and len(stations_nch) == len(stations_ech)):
                     for codesn, codese in zip(stations_nch, stations_ech):
-                        if (progTracker.increment()):
-                            pass
-                        else:
+                        if (batched):
+                            trn = get_day_trace(fds, codesn, curr, curr + step)
+                            tre = get_day_trace(fds, codese, curr, curr + step)
+                            if (trn is None or tre is None): continue
+
+                            slon, slat = codesn[4], codesn[5]
+                            batch_events, batch_mags, batch_das = get_batch_events(events, eventIndices, slon, slat,
+                                                                                   min_magnitude)
+
+                            results_s = extract_s_batch(taupyModel, pickerlist_s, batch_events, slon, slat, trn,
+                                                        tre, [da[2] for da in batch_das],
+                                                        plot_output_folder=plot_output_folder,
+                                                        quality_dtype=quality_dtype,
+                                                        quality_threads=quality_threads)
+
+                            for event, mag, da, result in zip(batch_events, batch_mags, batch_das, results_s):
+                                if (result):
+                                    write_picks(ofs, event, mag, codesn[0], codesn[1], '00T', slon, slat, da,
+                                                result, sigmalist)
+                                    pickCountS += 1
+                                # end if
+                            # end for
+
+                            traceCountS += 2
                             continue
+                        # end if
 
                         stn = fds.get_waveforms(codesn[0], codesn[1], codesn[2], codesn[3],
                                                 curr,
@@ -609,37 +1084,15 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
                             event = events[ei]
                             po = event.preferred_origin
                             da = gps2dist_azimuth(po.lat, po.lon, slat, slon)
-
-                            mag = None
-                            if (event.preferred_magnitude):
-                                mag = event.preferred_magnitude.magnitude_value
-                            elif (len(po.magnitude_list)):
-                                mag = po.magnitude_list[0].magnitude_value
-                            if (mag == None): mag = np.NaN
+                            mag = get_magnitude(event)
 
                             if (np.isnan(mag) or mag < min_magnitude): continue
 
                             result = extract_s(taupyModel, pickerlist_s, event, slon, slat, stn, ste, da[2],
                                                plot_output_folder=plot_output_folder)
                             if (result):
-                                picklist, residuallist, snrlist, bandindex, pickerindex = result
-
-                                arcdistance = kilometers2degrees(da[0] / 1e3)
-                                for ip, pick in enumerate(picklist):
-                                    line = '%s %f %f %f %f %f ' \
-                                           '%s %s %s %f %f %f ' \
-                                           '%f %f %f ' \
-                                           '%f %f %f %f %f ' \
-                                           '%d %d\n' % (
-                                           event.public_id, po.utctime.timestamp, mag, po.lon, po.lat, po.depthkm,
-                                           codesn[0], codesn[1], '00T', pick.timestamp, slon, slat,
-                                           da[1], da[2], arcdistance,
-                                           residuallist[ip], snrlist[ip, 0], snrlist[ip, 1], snrlist[ip, 2],
-                                           snrlist[ip, 3],
-                                           bandindex, sigmalist[pickerindex])
-                                    ofs.write(line)
-                                # end for
-                                ofs.flush()
+                                write_picks(ofs, event, mag, codesn[0], codesn[1], '00T', slon, slat, da, result,
+                                            sigmalist)
                                 pickCountS += 1
                             # end if
                         # end for
@@ -651,21 +1104,41 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
             curr += step
             dayCount += 1
         # wend
+
+        # picks for a work-unit must be on disk before the work-unit is marked as complete;
+        # picks repeated after a crash in between are dropped when results are merged
+        for of in [ofp, ofs]:
+            of.flush()
+            os.fsync(of.fileno())
+        # end for
+        journal.mark_complete(work_unit_key(units[iunit]))
+
         sw_stop = datetime.now()
         totalTime = (sw_stop - sw_start).total_seconds()
 
         gc.collect()
-        print(('(Rank %d: %5.2f%%, %d/%d) Processed %d traces and found %d p-arrivals and %d s-arrivals for ' \
-               'network %s station %s in %f s. Memory usage: %5.2f MB.' % \
-               (rank, (float(totalTraceCount) / float(workload) * 100) if workload > 0 else 100, totalTraceCount,
-                workload,
-                traceCountP + traceCountS, pickCountP, pickCountS, nc, sc, totalTime,
+        unitCount += 1
+        if (workQueue is None):
+            progress = '%5.2f%%, %d/%d' % (float(unitCount) / float(len(proc_unit_indices)) * 100, unitCount,
+                                           len(proc_unit_indices))
+        else:
+            # work-units are handed out in order, so that iunit + 1 work-units have been claimed by all ranks
+            progress = '%d work-units processed; %d/%d claimed by all ranks' % (unitCount, iunit + 1, len(units))
+        # end if
+        print(('(Rank %d: %s) Processed %d traces and found %d p-arrivals and %d s-arrivals for ' \
+               'network %s station %s (%s - %s) in %f s. Memory usage: %5.2f MB.' % \
+               (rank, progress, traceCountP + traceCountS, pickCountP, pickCountS, nc, sc,
+                start_time.strftime('%Y-%m-%d'), end_time.strftime('%Y-%m-%d'), totalTime,
                 round(psutil.Process().memory_info().rss / 1024. / 1024., 2))))
     # end for
     ofp.close()
     ofs.close()
+    if (workQueue is not None): workQueue.close()
 
     print(('Processing complete on rank %d' % (rank)))
+    if (waveform_cache_size_mb > 0):
+        print(('Rank %d: waveform cache stats: %s' % (rank, fds.get_waveform_cache_stats())))
+    # end if
 
     del fds
 
@@ -688,21 +1161,21 @@ def merge_results(output_path):
         files = recursive_glob(output_path, ss)
         ofn = open('%s/%s' % (output_path, ofn), 'w+')
 
+        header = None
         data = set()
-        for i, fn in enumerate(files):
-            lines = open(fn, 'r').readlines()
-
-            if (i == 0):
-                ofn.write(lines[0])
-            # end if
-
-            for j in range(1, len(lines)):
-                data.add(lines[j])
+        for fn in files:
+            for line in open(fn, 'r').readlines():
+                if (line[0] == '#'):
+                    if (header is None): header = line
+                else:
+                    data.add(line)
+                # end if
             # end for
 
             os.system('rm %s' % (fn))
         # end for
 
+        if (header is not None): ofn.write(header)
         for l in data:
             ofn.write(l)
         # end for
@@ -10,18 +10,23 @@ Developer:      rakib.hassan@ga.gov.au
 
 Revision History:
     LastUpdate:     24/01/19   RH
+    LastUpdate:     17/10/26   agent    Added batched computation of quality measures
     LastUpdate:     dd/mm/yyyy  Who     Optional description
 """
 
 import os
+from functools import lru_cache
+from math import floor
 
 import pywt
 from scipy.optimize import curve_fit
+from scipy import fft as sp_fft
 import matplotlib.pyplot as plt
 # from numpy import unravel_index
 import numpy as np
 # import traceback
 import heapq
+from collections import defaultdict
 
 
 def compute_quality_measures(trc, trc_filtered, scales, plotinfo=None):
@@ -154,3 +159,157 @@ def compute_quality_measures(trc, trc_filtered, scales, plotinfo=None):
 
     return cwtsnr, dom_freq, slope_ratio
 # end func
+
+@lru_cache(maxsize=16)
+def _cwt_kernels(wavelet_name, scales, npts, precision=12, dtype=np.float64):
+    """
+    Frequency-domain kernels for computing continuous wavelet transforms, as computed by
+    pywt.cwt, of signals of length npts. pywt.cwt differentiates the convolution of a signal
+    with the integrated wavelet; here, the kernels are differentiated instead, which avoids
+    cancellation errors at large scales. Only the central npts samples of the transform are
+    retained by pywt.cwt, which depend on a segment, of length at most 2 * npts, of a kernel;
+    transforms are thus computed through short FFTs, even for large scales.
+
+    :return: 1. FFT length
+             2. 2D array of kernel spectra, one row per scale
+             3. 1D array of offsets into the convolution output, one per scale
+             4. frequencies corresponding to scales, for a unit sampling period
+    """
+    wavelet = pywt.ContinuousWavelet(wavelet_name)
+    if (wavelet.complex_cwt): raise ValueError('Only real continuous wavelets are supported')
+
+    int_psi, x = pywt.integrate_wavelet(wavelet, precision=precision)
+
+    segments = []
+    offsets = []
+    for scale in scales:
+        step = x[1] - x[0]
+        j = np.arange(scale * (x[-1] - x[0]) + 1) / (scale * step)
+        j = j.astype(int)
+        if j[-1] >= int_psi.size:
+            j = np.extract(j < int_psi.size, j)
+        kernel = int_psi[j][::-1]
+
+        if (kernel.size < 2): raise ValueError('Selected scale of {} too small.'.format(scale))
+
+        # samples [m0 + 1, m0 + npts] of the convolution of data with the differentiated
+        # kernel are needed
+        dkernel = np.diff(kernel, prepend=0, append=0)
+        m0 = floor((kernel.size - 2) / 2.)
+        lo = max(m0 - npts + 2, 0)
+        hi = min(m0 + npts, dkernel.size - 1)
+        segments.append(-np.sqrt(scale) * dkernel[lo:hi + 1])
+        offsets.append(m0 + 1 - lo)
+    # end for
+
+    nfft = sp_fft.next_fast_len(npts + max(len(seg) for seg in segments) - 1, real=True)
+    spectra = np.array([sp_fft.rfft(seg, nfft) for seg in segments]).astype(np.result_type(dtype, np.complex64))
+    freqs = pywt.scale2frequency(wavelet, np.array(scales), precision)
+
+    return nfft, spectra, np.array(offsets), np.atleast_1d(freqs)
+# end func
+
+def cwt_batch(data, scales, wavelet, sampling_period=1., dtype=np.float64, workers=1):
+    """
+    Continuous wavelet transforms of a stack of equal-length signals, identical to those
+    computed by pywt.cwt, up to rounding errors, but evaluated through FFT-domain convolutions
+    with cached per-scale kernels
+
+    :param data: 2D array of signals, one per row
+    :param scales: scales
+    :param wavelet: name of a real continuous wavelet
+    :param sampling_period: sampling period of signals
+    :param dtype: floating point type of computations (np.float64 or np.float32)
+    :param workers: number of threads used for computing FFTs
+    :return: 1. 3D array of coefficients, of shape (signals, scales, samples)
+             2. frequencies corresponding to scales
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=dtype))
+    scales = np.atleast_1d(scales)
+    npts = data.shape[1]
+
+    nfft, spectra, offsets, freqs = _cwt_kernels(wavelet, tuple(scales.tolist()), npts, dtype=np.dtype(dtype).type)
+
+    conv = sp_fft.irfft(sp_fft.rfft(data, nfft, axis=-1, workers=workers)[:, None, :] * spectra[None, :, :],
+                        nfft, axis=-1, workers=workers)
+    idx = offsets[:, None] + np.arange(npts)[None, :]
+    coefs = conv[:, np.arange(len(scales))[:, None], idx]
+
+    return coefs, freqs / sampling_period
+# end func
+
+def compute_quality_measures_batch(trcs, scales, dtype=np.float64, workers=1, chunk_size=64):
+    """
+    Batched equivalent of compute_quality_measures, without plotting. Traces of equal length
+    and sampling rate are processed together.
+
+    :param trcs: list of raw obspy traces, each centred on a pick-time
+    :param scales: scales for computing continuous wavelet transforms
+    :param dtype: floating point type of wavelet transforms (np.float64 or np.float32)
+    :param workers: number of threads used for computing FFTs
+    :param chunk_size: maximum number of traces processed together, which limits memory usage
+    :return: 2D array with columns cwtsnr, dom_freq and slope_ratio (see
+             compute_quality_measures), one row per trace; measures that cannot be computed
+             are set to -1
+    """
+    result = np.full((len(trcs), 3), -1.)
+
+    groups = defaultdict(list)
+    for i, trc in enumerate(trcs):
+        groups[(trc.stats.npts, trc.stats.sampling_rate)].append(i)
+    # end for
+
+    for (npts, _), group in groups.items():
+        delta = trcs[group[0]].stats.delta
+        times = trcs[group[0]].times()
+        times = times - times.max() / 2
+        mid = npts // 2
+
+        for c in range(0, len(group), chunk_size):
+            ids = group[c:c + chunk_size]
+            data = np.array([trcs[i].data for i in ids], dtype=np.float64)
+
+            # =======================================
+            # Compute wavelets-based quality estimate
+            # =======================================
+            cwt, freqs = cwt_batch(data, scales, 'gaus8', delta, dtype=dtype, workers=workers)
+            ps = np.fabs(cwt) ** 2
+            ps = pywt.threshold(ps, np.std(ps, axis=(1, 2))[:, None, None], mode='soft', substitute=1)
+
+            psbefore = ps[:, :, :mid]
+            psafter = ps[:, :, mid:]
+            before = np.amax(psbefore, axis=1)
+            after = np.amax(psafter, axis=1)
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mask = after > np.std(after, axis=1)[:, None]
+                cwtsnr = np.sum(after * mask, axis=1) / np.sum(mask, axis=1) / np.mean(before, axis=1)
+
+                argAfter = np.argmax(psafter, axis=1)
+                topDecile = np.argsort(-after, axis=1, kind='stable')[:, :after.shape[1] // 10]
+                dom_freq = np.mean(freqs[np.take_along_axis(argAfter, topDecile, axis=1)], axis=1)
+            # end with
+
+            result[ids, 0] = cwtsnr
+            result[ids, 1] = dom_freq
+
+            # =======================================
+            # Compute slope-based quality estimate
+            # =======================================
+            if (mid < 2 or npts - mid < 2): continue
+
+            ab = np.cumsum(np.fabs(data), axis=1)
+            slopes = []
+            for t, y in ((times[mid:], ab[:, mid:]), (times[:mid], ab[:, :mid])):
+                tc = t - np.mean(t)
+                slopes.append(np.dot(y, tc) / np.dot(tc, tc))
+            # end for
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result[ids, 2] = slopes[0] / slopes[1]
+            # end with
+        # end for
+    # end for
+
+    return result
+# end func
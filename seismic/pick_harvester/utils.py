@@ -403,4 +403,83 @@ class ProgressTracker:
             return True
         # end if
     # end func
-# end class
\ No newline at end of file
+# end class
+
+def _recorded_seconds(spans, times):
+    """
+    Cumulative amount of data recorded up to each time in times
+
+    :param spans: numpy array containing start- and end-times (timestamps) of traces in each row
+    :param times: numpy array of timestamps
+    :return: numpy array containing the total length (s) of traces, clipped at each time in times
+    """
+    t0 = np.min(spans[:, 0])
+    times = np.asarray(times, dtype=np.float64) - t0
+    st = np.sort(spans[:, 0] - t0)
+    et = np.sort(spans[:, 1] - t0)
+    cst = np.concatenate([[0.], np.cumsum(st)])
+    cet = np.concatenate([[0.], np.cumsum(et)])
+
+    ns = np.searchsorted(st, times)
+    ne = np.searchsorted(et, times)
+
+    return (ns * times - cst[ns]) - (ne * times - cet[ne])
+# end func
+
+def build_work_units(spans, origin_timestamps, days_per_unit=30):
+    """
+    Splits the recording time-span of each station into work-units, each spanning a range of
+    days_per_unit days. Days are counted from the start of the recording time-span of a station
+    and units that contain no events are dropped. The cost of processing a unit is estimated as
+    the number of events on each day, weighted by the amount of data recorded on that day in
+    channel-days, summed over all days in the unit.
+
+    :param spans: dictionary, indexed by (net, sta), of numpy arrays containing start- and end-times
+                  (timestamps) of traces in each row, as returned by
+                  FederatedASDFDataSet.get_recording_spans
+    :param origin_timestamps: numpy array of origin timestamps of events
+    :param days_per_unit: number of days spanned by each work-unit
+    :return: a list of (net, sta, start-timestamp, end-timestamp) tuples and a numpy array of
+             estimated costs, one for each work-unit
+    """
+    assert days_per_unit > 0, 'days_per_unit must be > 0'
+
+    day = 24 * 3600
+    ots = np.sort(np.asarray(origin_timestamps, dtype=np.float64))
+
+    units = []
+    costs = []
+    for (net, sta) in sorted(spans.keys()):
+        sspans = spans[(net, sta)]
+        if (len(sspans) == 0): continue
+
+        start_time = np.min(sspans[:, 0])
+        end_time = np.max(sspans[:, 1])
+        ndays = int(np.ceil((end_time - start_time) / day))
+        if (ndays == 0): continue
+
+        day_starts = start_time + np.arange(ndays) * day
+        event_counts = np.searchsorted(ots, day_starts + day, side='right') - \
+                       np.searchsorted(ots, day_starts, side='left')
+        channel_days = np.diff(_recorded_seconds(sspans, np.append(day_starts, day_starts[-1] + day))) / day
+        day_costs = event_counts * channel_days
+
+        for i in range(0, ndays, days_per_unit):
+            if (np.sum(event_counts[i:i + days_per_unit]) == 0): continue
+
+            units.append((net, sta, day_starts[i], min(start_time + (i + days_per_unit) * day, end_time)))
+            costs.append(np.sum(day_costs[i:i + days_per_unit]))
+        # end for
+    # end for
+
+    return units, np.array(costs)
+# end func
+
+def work_unit_key(unit):
+    """
+    :param unit: (net, sta, start-timestamp, end-timestamp) tuple
+    :return: key identifying the work-unit in completion journals
+    """
+    net, sta, start_time, end_time = unit
+    return '%s.%s %s %s' % (net, sta, UTCDateTime(start_time), UTCDateTime(end_time))
+# end func
@@ -276,7 +276,7 @@ def main(input_file, output_file, network_list='*', station_list='*', event_mask
     sediment_station_coords = dict()
 
     for proc_hdfkey in proc_hdfkeys[rank]:
-        data_all = rf.read_rf(input_file, format='h5', group='waveforms/%s'%(proc_hdfkey))
+        data_all = rf_util.read_hdf_key(input_file, proc_hdfkey)
         # Convert to hierarchical dictionary format
         data_dict = rf_util.rf_to_dict(data_all)
 
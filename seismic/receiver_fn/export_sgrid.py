@@ -7,6 +7,7 @@ Developer:      rakib.hassan@ga.gov.au
 
 Revision History:
     LastUpdate:     01/11/21   RH
+    LastUpdate:     17/10/26   agent    Vectorised IDW interpolation
     LastUpdate:     dd/mm/yyyy  Who     Optional description
 """
 
@@ -204,51 +205,10 @@ def process(rf_h5_file, output_sgrid_file, start, end, epsg_code, extend, dx, dy
     xyz = comm.scatter(xyz, root=0)
     z = comm.scatter(z, root=0)
 
-    tree = vol._tree
-    data = vol._data
-
     if(rank == 0): log.info('Computing CCP amplitudes..')
 
-    # iterate over local nodes and compute CCP amplitude
-    vals = np.zeros(xyz.shape[0])
-    for i in np.arange(xyz.shape[0]):
-
-        indices = np.array(tree.query_ball_point(xyz[i, :], r=cell_radius))
-
-        if (len(indices) == 0): continue
-
-        # filter out all but nodes within a disc of dz thickness
-        indices = np.array(indices)
-        indices = indices[np.fabs(data[indices, 3] -
-                                  np.fabs((z[i] - ER))) < dz]
-
-        if (len(indices) == 0): continue
-        d = np.zeros(len(indices))
-
-        # compute distance of kdtree nodes from current node in swath
-        d[:] = np.sqrt(np.sum(np.power(xyz[i] - data[indices, :3], 2), axis=1))
-
-        # filter out nodes outside a cone, defined as current_radius = current depth;
-        # this is done to avoid lateral smearing at shallow depths, where piercing
-        # points are sparse, except immediately under stations
-        indices = indices[d < np.fabs((z[i] - ER))]
-        d = d[d < np.fabs((z[i] - ER))]
-
-        if (len(indices) == 0): continue
-
-        # compute IDW weights
-        idwIndices = indices
-        idw = np.zeros(d.shape)
-        idw = 1. / np.power(d, idw_exponent)
-
-        # compute mean instantaneous phase weight
-        pw = np.mean(data[idwIndices, 5] + 1j * data[idwIndices, 6])
-
-        # compute grid values
-        v = np.sum(idw * data[idwIndices, 4]) / np.sum(idw)
-
-        vals[i] = v * np.power(np.abs(pw), pw_exponent)
-    # end for
+    # compute CCP amplitudes for local nodes
+    vals = vol.interpolate(xyz, np.fabs(z - ER), cell_radius, dz, idw_exponent, pw_exponent, cone=True)
 
     vals = comm.gather(vals, root=0)
 
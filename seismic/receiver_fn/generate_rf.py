@@ -12,7 +12,7 @@ import click
 import os
 import tqdm.auto as tqdm
 from seismic.receiver_fn.rf_corrections import Corrections
-from seismic.receiver_fn import rf_util
+from seismic.receiver_fn import rf_util, rf_columnar
 from seismic.receiver_fn.generate_rf_helper import transform_stream_to_rf
 from seismic.analyze_station_orientations import analyze_station_orientations
 from seismic.network_event_dataset import NetworkEventDataset
@@ -24,7 +24,8 @@ from collections import defaultdict
 
 logging.basicConfig()
 
-def event_waveforms_to_rf(input_file, output_file, config, network_list='*', station_list='*', only_corrections=False):
+def event_waveforms_to_rf(input_file, output_file, config, network_list='*', station_list='*', only_corrections=False,
+                          columnar=False):
     """
     Main entry point for generating RFs from event traces.
 
@@ -80,6 +81,8 @@ def event_waveforms_to_rf(input_file, output_file, config, network_list='*', sta
     :type output_file: str or pathlib.Path
     :param config: Dictionary containing job configuration parameters
     :type config: dict
+    :param columnar: Write RFs in the columnar layout (see rf_columnar.py) instead of one dataset per trace
+    :type columnar: bool
     :return: None
     """
 
@@ -246,7 +249,11 @@ def event_waveforms_to_rf(input_file, output_file, config, network_list='*', sta
                     logger.info("Writing RF stream(s) for {} on rank {}...".format(hdf_key, rank))
                 # end for
 
-                proc_rf_stream.write(output_file, format='H5', mode='a')
+                if(columnar):
+                    rf_columnar.write_rf_columnar(proc_rf_stream, output_file, mode='a')
+                else:
+                    proc_rf_stream.write(output_file, format='H5', mode='a')
+                # end if
             # end if
         # end if
         comm.Barrier()
@@ -272,7 +279,11 @@ def event_waveforms_to_rf(input_file, output_file, config, network_list='*', sta
                    "input json config file -- all other stations are ignored. Note that "
                    "preexisting data (for relevant channels, if present) are deleted before "
                    "saving the corrections")
-def _main(input_file, output_file, network_list, station_list, config_file, only_corrections):
+@click.option('--columnar', is_flag=True, default=False, show_default=True,
+              help="Write RFs in a columnar layout, with one 2D array of traces per station and channel, "
+                   "which is much faster to load than the default layout of one dataset per trace. "
+                   "Use rf_columnar.py to convert between layouts")
+def _main(input_file, output_file, network_list, station_list, config_file, only_corrections, columnar):
     """
     INPUT_FILE : Input waveforms in H5 format\n
                  (output of extract_event_traces.py)\n
@@ -293,7 +304,7 @@ def _main(input_file, output_file, network_list, station_list, config_file, only
 
     # Dispatch call to worker function. See worker function for documentation.
     event_waveforms_to_rf(input_file, output_file, config, network_list=network_list, station_list=station_list,
-                          only_corrections=only_corrections)
+                          only_corrections=only_corrections, columnar=columnar)
 # end main
 
 if __name__ == "__main__":
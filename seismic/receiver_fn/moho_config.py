@@ -5,9 +5,11 @@ the Moho workflow config.
 import os
 import json
 import math
+import itertools
 
 import numpy as np
 from obspy import read_inventory
+from scipy.spatial import cKDTree
 
 import seismic.receiver_fn.ccp_correction
 
@@ -63,6 +65,66 @@ def _haversine(s, r, **kwargs):
 DIST_METRIC = _kennett_dist if K_DIST else _haversine
 
 
+def _kennett_dist_pairwise(lon1, lat1, lon2, lat2):
+    """
+    Spherical distance between corresponding points in arrays.
+    Requires 'kennett_dist' f2py module.
+    """
+    return np.array([kennett_dist.ydiz(clats, clons, clatr, clonr)[0]
+                     for clons, clats, clonr, clatr in zip(lon1, lat1, lon2, lat2)], dtype=float)
+
+
+def _haversine_pairwise(lon1, lat1, lon2, lat2):
+    """
+    Haversine distance between corresponding points in arrays.
+    """
+    lon1, lat1, lon2, lat2 = (np.radians(x) for x in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(a, 0, 1))))
+
+
+PAIRWISE_DIST_METRIC = _kennett_dist_pairwise if K_DIST else _haversine_pairwise
+
+# Allowance (degrees) for neighbour searches on a sphere, since Kennett distances
+# include corrections for the ellipticity of the Earth
+SEARCH_MARGIN = 0.2 if K_DIST else 1e-6
+
+
+def lonlat_to_xyz(lon, lat):
+    """
+    Cartesian coordinates of points on a unit sphere.
+    """
+    lon, lat = np.radians(lon), np.radians(lat)
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+def neighbour_pairs(lon1, lat1, lon2, lat2, max_dist):
+    """
+    Find all pairs of points from two sets that lie within max_dist (degrees) of each
+    other. Candidates are found through a KD-tree search in 3-D Cartesian coordinates,
+    and distances are then computed for candidates only.
+
+    Returns indices into the first and second sets, ordered by the former and then the
+    latter, and distances between them.
+    """
+    lon1, lat1, lon2, lat2 = (np.atleast_1d(np.asarray(x, dtype=float)) for x in (lon1, lat1, lon2, lat2))
+    if lon1.size == 0 or lon2.size == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+
+    # chord length subtended by the search distance
+    radius = 2 * np.sin(np.radians(min(max_dist + SEARCH_MARGIN, 180.)) / 2)
+    tree = cKDTree(lonlat_to_xyz(lon2, lat2))
+    neighbours = tree.query_ball_point(lonlat_to_xyz(lon1, lat1), r=radius * (1 + 1e-9), return_sorted=True)
+
+    counts = np.array([len(n) for n in neighbours], dtype=int)
+    i1 = np.repeat(np.arange(lon1.size), counts)
+    i2 = np.fromiter(itertools.chain.from_iterable(neighbours), dtype=int, count=np.sum(counts))
+
+    dist = PAIRWISE_DIST_METRIC(lon1[i1], lat1[i1], lon2[i2], lat2[i2])
+    keep = dist <= max_dist
+    return i1[keep], i2[keep], dist[keep]
+
+
 class ConfigConstants:
     # Field names
     METHODS = 'methods'
@@ -388,11 +450,9 @@ class WorkflowParameters:
         for net, sta in set(zip(m1.net, m1.sta)):
             m1_station = np.where(np.logical_and(m1.net == net, m1.sta == sta))
             m2_station = np.where(np.logical_and(m2.net == net, m2.sta == sta))
-            for lat_1, lon_1 in zip(m1.lat[m1_station], m1.lon[m1_station]):
-                for i, (lat_2, lon_2) in enumerate(zip(m2.lat[m2_station], m2.lon[m2_station])):
-                    dist = DIST_METRIC((lon_1, lat_1), (lon_2, lat_2))
-                    if dist <= 0.018:
-                        to_remove.append(m2_station[0][i])
+            _, i2, _ = neighbour_pairs(m1.lon[m1_station], m1.lat[m1_station],
+                                       m2.lon[m2_station], m2.lat[m2_station], 0.018)
+            to_remove.extend(m2_station[0][i2].tolist())
         print(f'{len(to_remove)} samples from {m1.name} are being '
               f'prioritised over samples from {m2.name}')
         m2.remove(to_remove)
@@ -404,12 +464,8 @@ class WorkflowParameters:
         within 2km of each other, then the higher priority dataset
         (m1) is prioritised (m2 point is removed).
         """
-        to_remove = []
-        for lat_1, lon_1 in zip(m1.lat, m1.lon):
-            for i, (lat_2, lon_2) in enumerate(zip(m2.lat, m2.lon)):
-                dist = DIST_METRIC((lon_1, lat_1), (lon_2, lat_2))
-                if dist <= 0.018:
-                    to_remove.append(i)
+        _, i2, _ = neighbour_pairs(m1.lon, m1.lat, m2.lon, m2.lat, 0.018)
+        to_remove = i2.tolist()
         print(f'{len(to_remove)} samples from {m1.name} are being '
               f'prioritised over samples from {m2.name}')
         m2.remove(to_remove)
@@ -32,12 +32,13 @@ Requires:
 import os
 
 import numpy as np
-from scipy.spatial.distance import cdist
+from scipy.sparse import csr_matrix
 
-from seismic.receiver_fn.moho_config import DIST_METRIC
+from seismic.receiver_fn.moho_config import neighbour_pairs
 from collections import defaultdict
 
 DEFAULT_CUTOFF = 3.6
+GRID_CHUNK_SIZE = 65536
 
 def _grid(bb_min, bb_max, spacing):
     if bb_min[0] >= bb_max[0]:
@@ -63,6 +64,20 @@ def _bounds(xy_mins, xy_maxs, bounds=None):
     return bb_min, bb_max
 
 
+def _distance_weights(grid_map, xy_map, max_dist, sigma, interpolation):
+    """
+    Sparse matrix of distance weights between grid points and samples. Samples beyond
+    max_dist from a grid point have a weight of 0.
+    """
+    rows, cols, dist = neighbour_pairs(grid_map[:, 0], grid_map[:, 1], xy_map[:, 0], xy_map[:, 1], max_dist)
+    if(interpolation == 'gaussian'):
+        weights = np.exp(-np.power(dist/sigma, 2.))
+    else:
+        weights = np.exp(-dist/sigma)
+    # end if
+    return csr_matrix((weights, (rows, cols)), shape=(grid_map.shape[0], xy_map.shape[0]))
+
+
 def make_grid(params):
     """
     Run multi point dataset weighted averaging over Gaussian interpolation functions
@@ -87,7 +102,6 @@ def make_grid(params):
     denom_agg = np.zeros(grid_map.shape[0], dtype=float)[:, np.newaxis]
     z_agg = np.zeros_like(denom_agg)
     s_agg = np.zeros_like(denom_agg)
-    print("Distance matrix calculation may take several minutes for large datasets")
     all_pt_data = []
     for data in params.method_datasets:
         if(len(data.sta)==0): continue
@@ -97,37 +111,26 @@ def make_grid(params):
             for i in np.arange(len(data.lon)): all_pt_data.append([data.lon[i], data.lat[i], data.val[i]])
         else:
             sigma = data.scale_length
-            sig_sq = np.square(sigma)
             cutoff = DEFAULT_CUTOFF
             max_dist = cutoff*sigma
             pt_data = np.array((data.lon, data.lat, data.val)).T
             xy_map = pt_data[:, :2]
             print(f"{xy_map.shape[0]} samples")
-            print(f"Calculating distance matrix...")
-            kwargs = {'max_dist': max_dist}
-            dist_matrix = cdist(grid_map, xy_map, metric=DIST_METRIC, **kwargs)
-            dist_weighting = None
-            if(params.interpolation == 'gaussian'):
-                dist_weighting = np.exp(-np.power(dist_matrix/sigma, 2.))
-            else:
-                dist_weighting = np.exp(-dist_matrix/sigma)
-            # end if
-
-            # We return nan instead of 0 from distance functions if beyond max distance, because
-            # theoretically a sample exactly on the grid point will have a dist of 0, and the weighting
-            # will be exp(0) == 1. After calculating exp, set NaNs to 0 so samples beyond max distance
-            # have a weight of 0, rather than NaN which will propagate.
-            dist_weighting[np.isnan(dist_weighting)] = 0
-            z = (pt_data[:, 2][:, np.newaxis])
-            zw = data.total_weight[:, np.newaxis]
-
-            denom = np.matmul(dist_weighting, zw)
-            denom_agg += denom
-
-            z_numer = np.matmul(dist_weighting, (z * zw))
-            s_numer = np.matmul(dist_weighting, (z*z * zw))
-            z_agg += z_numer
-            s_agg += s_numer
+            print(f"Calculating distance weights...")
+            z = pt_data[:, 2]
+            zw = data.total_weight
+
+            # Weights are only computed for samples within max distance of each grid point, and are
+            # assembled as sparse matrices over chunks of grid points to limit memory usage.
+            for start in np.arange(0, grid_map.shape[0], GRID_CHUNK_SIZE):
+                end = start + GRID_CHUNK_SIZE
+                dist_weighting = _distance_weights(grid_map[start:end], xy_map, max_dist, sigma,
+                                                   params.interpolation)
+
+                denom_agg[start:end, 0] += dist_weighting.dot(zw)
+                z_agg[start:end, 0] += dist_weighting.dot(z * zw)
+                s_agg[start:end, 0] += dist_weighting.dot(z*z * zw)
+            # end for
         # end if
     # end for
 
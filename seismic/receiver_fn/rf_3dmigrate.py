@@ -38,7 +38,13 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.option('--fmax', type=float, default=None, show_default=True,
               help="Highest frequency for bandpass filter; default is None."
                    "If only --fmax is provided, a lowpass filter is applied.")
-def main(rf_h5_file, output_h5_file, fmin, fmax, min_slope_ratio):
+@click.option('--slowness-bin', type=float, default=0.01, show_default=True,
+              help="Width of slowness bins (s/deg) for caching ray-path profiles; ray-paths are computed "
+                   "for each unique slowness if <= 0")
+@click.option('--depth-bin', type=float, default=10, show_default=True,
+              help="Width of source depth bins (km) for caching ray-path profiles; source depths are not "
+                   "binned if <= 0")
+def main(rf_h5_file, output_h5_file, fmin, fmax, min_slope_ratio, slowness_bin, depth_bin):
     """Perform 3D migration of RFs
     RF_H5_FILE : Path to RFs in H5 format
     OUTPUT_H5_FILE: H5 output file name
@@ -49,7 +55,7 @@ def main(rf_h5_file, output_h5_file, fmin, fmax, min_slope_ratio):
     log.setLevel(logging.DEBUG)
 
     m = Migrate(rf_filename=rf_h5_file, min_slope_ratio=min_slope_ratio, logger=log)
-    m.process_streams(output_h5_file, fmin=fmin, fmax=fmax)
+    m.process_streams(output_h5_file, fmin=fmin, fmax=fmax, slowness_bin=slowness_bin, depth_bin=depth_bin)
 # end
 
 if __name__ == "__main__":
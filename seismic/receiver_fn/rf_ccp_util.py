@@ -11,10 +11,14 @@ Developer:      rakib.hassan@ga.gov.au
 
 Revision History:
     LastUpdate:     03/09/21   RH
+    LastUpdate:     17/10/26   agent    Support RF files in the columnar layout
+    LastUpdate:     17/10/26   agent    Cache ray-path profiles for migration
+    LastUpdate:     17/10/26   agent    Vectorised IDW interpolation of CCP volumes
     LastUpdate:     dd/mm/yyyy  Who     Optional description
 """
 
 from collections import defaultdict
+from itertools import chain
 from seismic.receiver_fn import rf_util, rf_corrections
 import numpy as np
 from rf import read_rf, RFStream
@@ -27,6 +31,7 @@ from scipy.integrate import simps as simpson
 from scipy.signal import hilbert
 from mpi4py import MPI
 from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
 from pyproj import Geod
 from shapely.geometry import Point, LineString, Polygon
 import gdal
@@ -34,6 +39,8 @@ from osgeo.gdalconst import *
 from affine import Affine
 import struct
 
+CCP_INTERP_CHUNK_SIZE = 4096
+
 # define utility functions
 def rtp2xyz(r, theta, phi):
     """Convert spherical to cartesian coordinates
@@ -55,6 +62,150 @@ def rtp2xyz(r, theta, phi):
     return xout
 # end func
 
+def cumulative_simpson(y, x):
+    """Cumulative integral of y over uniformly spaced samples x, through the composite Simpson's rule,
+    which is exact for odd numbers of samples; for even numbers of samples, the last interval is
+    integrated through the trapezoidal rule
+
+    :param y: samples of integrand
+    :type y: numpy.array [1D]
+    :param x: uniformly spaced sample locations
+    :type x: numpy.array [1D]
+    :return: cumulative integral, with a leading zero
+    :rtype: numpy.array [1D]
+    """
+    h = x[1] - x[0]
+    result = np.zeros(y.shape)
+    result[2::2] = np.cumsum(h / 3. * (y[:-2:2] + 4 * y[1:-1:2] + y[2::2]))
+    result[1::2] = result[0:-1:2] + 0.5 * h * (y[0:-1:2] + y[1::2])
+    return result
+# end func
+
+def sphere_direct(lat, lon, azimuth, delta):
+    """Locations on a sphere at given angular distances from a starting point along a given azimuth
+
+    :param lat: latitude of starting point (degrees)
+    :type lat: float
+    :param lon: longitude of starting point (degrees)
+    :type lon: float
+    :param azimuth: azimuth (degrees)
+    :type azimuth: float
+    :param delta: angular distances (radians)
+    :type delta: numpy.array [1D]
+    :return: latitudes and longitudes (degrees)
+    :rtype: numpy.array [1D], numpy.array [1D]
+    """
+    phi1, lam1, az = np.radians(lat), np.radians(lon), np.radians(azimuth)
+    sin_phi2 = np.sin(phi1) * np.cos(delta) + np.cos(phi1) * np.sin(delta) * np.cos(az)
+    phi2 = np.arcsin(np.clip(sin_phi2, -1, 1))
+    lam2 = lam1 + np.arctan2(np.sin(az) * np.sin(delta) * np.cos(phi1), np.cos(delta) - np.sin(phi1) * sin_phi2)
+    return np.degrees(phi2), (np.degrees(lam2) + 180) % 360 - 180
+# end func
+
+def sphere_azimuth(lat1, lon1, lat2, lon2):
+    """Azimuth of the great-circle from point 1 to point 2 on a sphere
+
+    :return: azimuth (degrees)
+    :rtype: float
+    """
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    dlam = np.radians(lon2 - lon1)
+    return np.degrees(np.arctan2(np.sin(dlam) * np.cos(phi2),
+                                 np.cos(phi1) * np.sin(phi2) - np.sin(phi1) * np.cos(phi2) * np.cos(dlam)))
+# end func
+
+class RayPathTable:
+    """Lookup table of receiver-side ray-path profiles, as functions of depth, for CCP migration.
+
+    Beneath a station, a ray-path is determined by its ray parameter, so profiles of depth and
+    angular offset from the station are computed once, from a TauP ray-path, for each bin of
+    slowness and source depth. Piercing points for a trace are then obtained by rotating the cached
+    offsets along the great-circle from the station towards the event. Ps delay times are computed
+    for each trace as a cumulative integral over depth.
+    """
+    def __init__(self, taup_model, phase='P', earth_radius=6371, zmax=150, nz=1500,
+                 slowness_bin=0.01, depth_bin=10):
+        """
+        :param taup_model: obspy.taup.TauPyModel instance
+        :param phase: seismic phase
+        :param earth_radius: earth radius (km)
+        :param zmax: maximum depth (km)
+        :param nz: number of depth samples
+        :param slowness_bin: width of slowness bins (s/deg); slowness is not binned if <= 0
+        :param depth_bin: width of source depth bins (km); source depth is not binned if <= 0
+        """
+        self._taup_model = taup_model
+        self._phase = phase
+        self._earth_radius = earth_radius
+        self._slowness_bin = slowness_bin
+        self._depth_bin = depth_bin
+
+        vmodel = taup_model.model.s_mod.v_mod
+        self.depths = np.linspace(1e-5, zmax, nz)
+        self._vp_inv2 = np.power(vmodel.evaluate_above(self.depths, 'p'), -2.)
+        self._vs_inv2 = np.power(vmodel.evaluate_above(self.depths, 's'), -2.)
+        self._profiles = {}
+    # end func
+
+    def _key(self, stats):
+        s = stats.slowness if self._slowness_bin <= 0 else int(np.round(stats.slowness / self._slowness_bin))
+        d = stats.event_depth if self._depth_bin <= 0 else int(np.round(stats.event_depth / self._depth_bin))
+        return s, d
+    # end func
+
+    def _compute_profiles(self, stats):
+        arrivals = self._taup_model.get_ray_paths_geo(source_depth_in_km=stats.event_depth,
+                                                      source_latitude_in_deg=stats.event_latitude,
+                                                      source_longitude_in_deg=stats.event_longitude,
+                                                      receiver_latitude_in_deg=stats.station_latitude,
+                                                      receiver_longitude_in_deg=stats.station_longitude,
+                                                      phase_list=[self._phase], resample=True)
+        arr = arrivals[0]
+
+        times   = (arr.path['time'][-1] - arr.path['time'])[::-1]
+        depths  = arr.path['depth'][::-1]
+        offsets = (arr.path['dist'][-1] - arr.path['dist'])[::-1]
+
+        # invert depth to time
+        tck = splrep(times, depths, k=3, s=0)
+        tnew = np.array([sproot((tck[0], tck[1] - d, tck[2]))[0] for d in self.depths])
+
+        return np.interp(tnew, times, depths), np.interp(tnew, times, offsets)
+    # end func
+
+    def piercing_points(self, stats):
+        """
+        :param stats: trace stats, with event and station locations and slowness
+        :return: cartesian coordinates [2D] (nz x 3) and depths [1D] of piercing points
+        :rtype: numpy.array [2D], numpy.array [1D]
+        """
+        key = self._key(stats)
+        if key not in self._profiles: self._profiles[key] = self._compute_profiles(stats)
+        depths, offsets = self._profiles[key]
+
+        azimuth = sphere_azimuth(stats.station_latitude, stats.station_longitude,
+                                 stats.event_latitude, stats.event_longitude)
+        lats, lons = sphere_direct(stats.station_latitude, stats.station_longitude, azimuth, offsets)
+
+        xyzs = rtp2xyz(self._earth_radius - depths, np.radians(90 - lats), np.radians(lons))
+        return xyzs, depths
+    # end func
+
+    def ps_times(self, slowness):
+        """
+        :param slowness: slowness (s/deg)
+        :return: Ps delay times at each depth
+        :rtype: numpy.array [1D]
+        """
+        p = slowness / DEG2KM
+        return cumulative_simpson(np.sqrt(self._vs_inv2 - p * p) - np.sqrt(self._vp_inv2 - p * p), self.depths)
+    # end func
+
+    def __len__(self):
+        return len(self._profiles)
+    # end func
+# end class
+
 class Gravity:
     def __init__(self, gravity_grid_fn):
         self._fn = gravity_grid_fn
@@ -122,7 +273,24 @@ class Migrate:
         self._stations = defaultdict(list)
     # end func
 
-    def process_streams(self, output_file, fmin=None, fmax=None, primary_component='R', model='iasp91', phase='P'):
+    def process_streams(self, output_file, fmin=None, fmax=None, primary_component='R', model='iasp91', phase='P',
+                        slowness_bin=0.01, depth_bin=10):
+        """
+        Migrates RF traces, computing piercing points and amplitudes (with instantaneous phases) at depths
+        down to ZMAX beneath each station
+
+        :param output_file: output h5 file name
+        :param fmin: lowest frequency for bandpass filter
+        :param fmax: highest frequency for bandpass filter
+        :param primary_component: RF component to migrate
+        :param model: name of 1D velocity model
+        :param phase: seismic phase
+        :param slowness_bin: width of slowness bins (s/deg) for caching ray-path profiles (see RayPathTable)
+        :param depth_bin: width of source depth bins (km) for caching ray-path profiles (see RayPathTable)
+        """
+        NZ = 1500
+        ZMAX = 150 # km
+
         proc_hkeys = None
         if(self._rank == 0):
             hkeys = rf_util.get_hdf_keys(self._rf_filename)
@@ -140,7 +308,7 @@ class Migrate:
         for hkey in proc_hkeys[self._rank]:
             if(self._logger): self._logger.info('rank {}: loading {}..'.format(self._rank, hkey))
 
-            traces = read_rf(self._rf_filename, format='h5', group='waveforms/%s'%(hkey))
+            traces = rf_util.read_hdf_key(self._rf_filename, hkey)
 
             # select primary component only
             p_traces = traces.select(component=primary_component)
@@ -204,79 +372,29 @@ class Migrate:
             t.data = iphase
         #end for
 
-        # compute ray-paths
-        taup_model = TauPyModel(model=model)
-        vmodel = taup_model.model.s_mod.v_mod
+        # compute piercing points from cached ray-path profiles
+        ray_table = RayPathTable(TauPyModel(model=model), phase=phase, earth_radius=self._earth_radius,
+                                 zmax=ZMAX, nz=NZ, slowness_bin=slowness_bin, depth_bin=depth_bin)
 
-        point_data_array = None
+        point_data_array = np.zeros((len(self._p_traces), NZ, 7))
         for it, (t, ipt) in enumerate(zip(self._p_traces, self._iphase_traces)):
-            arrivals = taup_model.get_ray_paths_geo(source_depth_in_km=t.stats.event_depth,
-                                                    source_latitude_in_deg=t.stats.event_latitude,
-                                                    source_longitude_in_deg=t.stats.event_longitude,
-                                                    receiver_latitude_in_deg=t.stats.station_latitude,
-                                                    receiver_longitude_in_deg=t.stats.station_longitude,
-                                                    phase_list=[phase], resample=True)
-            arr = arrivals[0]
-
-            times  = (arr.path['time'][-1] - arr.path['time'])[::-1]
-            depths = arr.path['depth'][::-1]
-            lats   = arr.path['lat'][::-1]
-            lons   = arr.path['lon'][::-1]
-
-            rs     = self._earth_radius - depths
-            thetas = np.radians(90 - lats)
-            phis   = np.radians(lons)
-
-            xyzs   = rtp2xyz(rs, thetas, phis)
-
-            t2dio  = interp1d(times, depths)
-            t2xio  = interp1d(times, xyzs[:,0])
-            t2yio  = interp1d(times, xyzs[:,1])
-            t2zio  = interp1d(times, xyzs[:,2])
-
-            tck = splrep(times, depths, k=3, s=0)
-
-            NZ = 1500
-            ZMAX = 150 # km
-            dnew = np.linspace(1e-5, ZMAX, NZ)
-            tnew = np.zeros(dnew.shape)
-            for idx in np.arange(dnew.shape[0]):
-                tck_mod = (tck[0], tck[1] - dnew[idx], tck[2])
-                tnew[idx] = sproot(tck_mod)[0]
-            #end for
-
-            d2tio = interp1d(np.concatenate(([0], dnew)), np.concatenate(([0], tnew)))
-            vp = vmodel.evaluate_above(dnew, 'p')
-            vs = vmodel.evaluate_above(dnew, 's')
-
-            tps = np.zeros(dnew.shape)
-            p = t.stats.slowness / DEG2KM
-            for idx in np.arange(1, dnew.shape[0]+1):
-                tps[idx-1] = simpson(np.sqrt( np.power(vs[:idx], -2.) - p*p) -
-                                     np.sqrt( np.power(vp[:idx], -2.) - p*p), dnew[:idx])
-            #end for
-
+            xyzs, depths = ray_table.piercing_points(t.stats)
+            tps = ray_table.ps_times(t.stats.slowness)
 
             t.trim(starttime=t.stats.onset, endtime=t.stats.endtime)
             ipt.trim(starttime=ipt.stats.onset, endtime=ipt.stats.endtime)
 
-            t2aio = interp1d(t.times(), t.data, bounds_error=False, fill_value=0)
-            t2irio = interp1d(ipt.times(), np.real(ipt.data), bounds_error=False, fill_value=0)
-            t2icio = interp1d(ipt.times(), np.imag(ipt.data), bounds_error=False, fill_value=0)
-
-            if(point_data_array is None):
-                point_data_array = np.zeros((len(self._p_traces), NZ, 7))
-            # end if
+            point_data_array[it, :, 0:3] = xyzs
+            point_data_array[it, :, 3] = depths
 
-            point_data_array[it, :, 0] = np.squeeze(t2xio(d2tio(dnew)))
-            point_data_array[it, :, 1] = np.squeeze(t2yio(d2tio(dnew)))
-            point_data_array[it, :, 2] = np.squeeze(t2zio(d2tio(dnew)))
-            point_data_array[it, :, 3] = np.squeeze(t2dio(d2tio(dnew)))
-
-            point_data_array[it, :, 4] = np.squeeze(t2aio(tps))
-            point_data_array[it, :, 5] = np.squeeze(t2irio(tps))
-            point_data_array[it, :, 6] = np.squeeze(t2icio(tps))
+            point_data_array[it, :, 4] = np.interp(tps, t.times(), t.data, left=0, right=0)
+            point_data_array[it, :, 5] = np.interp(tps, ipt.times(), np.real(ipt.data), left=0, right=0)
+            point_data_array[it, :, 6] = np.interp(tps, ipt.times(), np.imag(ipt.data), left=0, right=0)
         # end for
+        if(self._logger):
+            self._logger.info('rank {}: computed {} ray-path profiles for {} traces'.format(self._rank, len(ray_table),
+                                                                                          len(self._p_traces)))
+        # end if
 
         # serialize writing of rf_streams to disk
         for irank in np.arange(self._nproc):
@@ -318,6 +436,8 @@ class CCPVolume():
         self._earth_radius = None
         self._data = None
         self._tree = None
+        self._depth_order = None
+        self._sorted_depths = None
 
         hf = None
         try:
@@ -349,9 +469,144 @@ class CCPVolume():
         self._data = np.vstack(self._data)
 
         self._tree = cKDTree(self._data[:, :3], balanced_tree=False)
+        self._depth_order = np.argsort(self._data[:, 3], kind='stable')
+        self._sorted_depths = self._data[self._depth_order, 3]
 
         hf.close()
     # end func
+
+    def _query_slabs(self, xyz, depths, cell_radius, dz):
+        """Batched neighbour queries of grid nodes. Grid nodes commonly share a few depth levels, in
+        which case each level is queried against a kd-tree of CCP values within a slab of 2*dz
+        thickness, rather than the whole CCP volume.
+
+        :return: node indices and indices of CCP values within cell_radius of them
+        :rtype: numpy.array [1D], numpy.array [1D]
+        """
+        def flatten(neighbours, nodes, subset=None):
+            counts = np.array([len(item) for item in neighbours], dtype=np.int64)
+            cols = np.fromiter(chain.from_iterable(neighbours), dtype=np.int64, count=np.sum(counts))
+            if(subset is not None): cols = subset[cols]
+            return np.repeat(nodes, counts), cols
+        # end func
+
+        levels, inverse = np.unique(depths, return_inverse=True)
+        if(levels.shape[0] * 16 > depths.shape[0]):
+            return flatten(self._tree.query_ball_point(xyz, r=cell_radius), np.arange(xyz.shape[0]))
+        # end if
+
+        node_order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[node_order], np.arange(levels.shape[0] + 1))
+
+        # slabs are padded slightly; exact disc bounds are applied by the caller
+        lo = np.searchsorted(self._sorted_depths, levels - dz * (1 + 1e-6), side='left')
+        hi = np.searchsorted(self._sorted_depths, levels + dz * (1 + 1e-6), side='right')
+
+        rows, cols = [], []
+        for i in np.arange(levels.shape[0]):
+            if(hi[i] <= lo[i]): continue
+
+            nodes = node_order[bounds[i]:bounds[i + 1]]
+            subset = self._depth_order[lo[i]:hi[i]]
+            tree = cKDTree(self._data[subset, :3])
+
+            r, c = flatten(tree.query_ball_point(xyz[nodes], r=cell_radius), nodes, subset)
+            rows.append(r)
+            cols.append(c)
+        # end for
+
+        if(len(rows) == 0): return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(rows), np.concatenate(cols)
+    # end func
+
+    def idw_weights(self, xyz, depths, cell_radius, dz, idw_exponent, cone=True):
+        """Assembles a sparse matrix of inverse-distance weights of CCP values for each grid node.
+        Contributing CCP values lie within cell_radius of a node and within a disc of thickness dz
+        around the node depth.
+
+        :param xyz: cartesian coordinates of grid nodes (km)
+        :type xyz: numpy.array [2D]
+        :param depths: depths of grid nodes (km)
+        :type depths: numpy.array [1D]
+        :param cell_radius: search radius (km)
+        :type cell_radius: float
+        :param dz: half-thickness of disc (km)
+        :type dz: float
+        :param idw_exponent: exponent of inverse-distance weighting
+        :type idw_exponent: float
+        :param cone: also discard CCP values farther from a node than its depth, to avoid lateral
+            smearing at shallow depths, where piercing points are sparse, except immediately under stations
+        :type cone: bool
+        :return: weights of shape (number of nodes, number of CCP values)
+        :rtype: scipy.sparse.csr_matrix
+        """
+        data = self._data
+
+        rows, cols = self._query_slabs(xyz, depths, cell_radius, dz)
+
+        # filter out all but CCP values within a disc of dz thickness
+        keep = np.fabs(data[cols, 3] - depths[rows]) < dz
+        rows, cols = rows[keep], cols[keep]
+
+        d = np.sqrt(np.sum(np.power(xyz[rows] - data[cols, :3], 2), axis=1))
+        if(cone):
+            keep = d < depths[rows]
+            rows, cols, d = rows[keep], cols[keep], d[keep]
+        # end if
+
+        return csr_matrix((1. / np.power(d, idw_exponent), (rows, cols)),
+                          shape=(xyz.shape[0], data.shape[0]))
+    # end func
+
+    def interpolate(self, xyz, depths, cell_radius, dz, idw_exponent, pw_exponent, cone=True,
+                    chunk_size=CCP_INTERP_CHUNK_SIZE):
+        """Computes phase-weighted CCP amplitudes at grid nodes through inverse-distance-weighted
+        interpolation. Nodes are processed in chunks to limit memory usage.
+
+        :param xyz: cartesian coordinates of grid nodes (km)
+        :type xyz: numpy.array [2D]
+        :param depths: depths of grid nodes (km)
+        :type depths: numpy.array [1D]
+        :param cell_radius: search radius (km)
+        :type cell_radius: float
+        :param dz: half-thickness of disc (km)
+        :type dz: float
+        :param idw_exponent: exponent of inverse-distance weighting
+        :type idw_exponent: float
+        :param pw_exponent: exponent of instantaneous phase-weighting
+        :type pw_exponent: float
+        :param cone: see idw_weights
+        :type cone: bool
+        :param chunk_size: number of nodes processed at a time
+        :type chunk_size: int
+        :return: CCP amplitudes; zero at nodes without contributing CCP values
+        :rtype: numpy.array [1D]
+        """
+        amps = self._data[:, 4]
+        iphase = self._data[:, 5] + 1j * self._data[:, 6]
+
+        # chunks of nodes sorted by depth span few depth levels
+        node_order = np.argsort(depths, kind='stable')
+
+        result = np.zeros(xyz.shape[0])
+        for start in np.arange(0, xyz.shape[0], chunk_size):
+            nodes = node_order[start:start + chunk_size]
+            w = self.idw_weights(xyz[nodes], depths[nodes], cell_radius, dz, idw_exponent, cone=cone)
+
+            # the same sparsity pattern yields mean instantaneous phase weights
+            counts = np.diff(w.indptr)
+            indicator = csr_matrix((np.ones(w.nnz), w.indices, w.indptr), shape=w.shape)
+
+            valid = counts > 0
+            wsum = np.asarray(w.sum(axis=1)).ravel()
+            v = w.dot(amps)[valid] / wsum[valid]
+            pw = indicator.dot(iphase)[valid] / counts[valid]
+
+            result[nodes[valid]] = v * np.power(np.abs(pw), pw_exponent)
+        # end for
+
+        return result
+    # end func
 # end class
 
 class CCP_VerticalProfile():
@@ -500,14 +755,8 @@ class CCP_VerticalProfile():
 
         # Assemble lon-lat nodes for profile
         self._grid = np.zeros((self._nLateralNodes * self._nDepthNodes, 3))
-        for i in np.arange(self._nDepthNodes):
-            for j in np.arange(self._nLateralNodes):
-                idx = i * self._nLateralNodes + j
-                self._grid[idx, :] = np.array([self._depthNodes[i],
-                                               self._lateralNodes[j, 0],
-                                               self._lateralNodes[j, 1]])
-            # end for
-        # end for
+        self._grid[:, 0] = np.repeat(self._depthNodes, self._nLateralNodes)
+        self._grid[:, 1:] = np.tile(self._lateralNodes, (self._nDepthNodes, 1))
 
         self._gx = np.linspace(0, self._profileLength, self._nLateralNodes)
         self._gd = np.linspace(self._r2 - self._r1, 0, self._nDepthNodes)
@@ -519,81 +768,24 @@ class CCP_VerticalProfile():
         gxyz = rtp2xyz(self._grid[:, 0],
                        np.radians(90 - self._grid[:, 2]),
                        np.radians(self._grid[:, 1]))
+        depths = np.fabs(self._grid[:, 0] - ER)
 
-        # iterate over swath node
-        swath_grid_vals = []
-        swath_grid_iphase_weights = []
-        for s in self._gs:
-            # compute swath-grid (profile nodes are simply shifted along swath)
-            a = gxyz[0]
-            b = gxyz[(self._gd.shape[0] - 1) * self._gx.shape[0]]
-            c = gxyz[-1]
-            ab = b - a
-            ac = c - a
-            normal = np.cross(ab, ac)
-            normal /= np.linalg.norm(normal)
-
-            sxyz = gxyz + normal * s
+        # swath-grids: profile nodes are simply shifted along the normal to the profile plane
+        a = gxyz[0]
+        b = gxyz[(self._gd.shape[0] - 1) * self._gx.shape[0]]
+        c = gxyz[-1]
+        normal = np.cross(b - a, c - a)
+        normal /= np.linalg.norm(normal)
 
-            # temporary arrays
-            grid_vals = np.zeros(sxyz.shape[0])
-            grid_iphase_weights = np.zeros(sxyz.shape[0], dtype=np.complex)
+        sxyz = (gxyz[None, :, :] + self._gs[:, None, None] * normal).reshape(-1, 3)
+        sdepths = np.tile(depths, self._gs.shape[0])
 
-            p = self._idw_exponent
-            r = self._cell_radius
-            tree = self._ccpVolume._tree
-            data = self._ccpVolume._data
+        v = self._ccpVolume.interpolate(sxyz, sdepths, self._cell_radius, self._dz,
+                                        self._idw_exponent, self._pw_exponent, cone=True)
 
-            # iterate over nodes in each swath
-            for i in np.arange(sxyz.shape[0]):
-
-                indices = np.array(tree.query_ball_point(sxyz[i, :], r=r))
-
-                if (len(indices) == 0): continue
-
-                # filter out all but nodes within a disc of dz thickness
-                indices = np.array(indices)
-                indices = indices[np.fabs(data[indices, 3] -
-                                          np.fabs((self._grid[i, 0] - ER))) < self._dz]
-
-                if (len(indices) == 0): continue
-                d = np.zeros(len(indices))
-
-                # compute distance of kdtree nodes from current node in swath
-                d[:] = np.sqrt(np.sum(np.power(sxyz[i] - data[indices, :3], 2), axis=1))
-
-                # filter out nodes outside a cone, defined as current_radius = current depth;
-                # this is done to avoid lateral smearing at shallow depths, where piercing
-                # points are sparse, except immediately under stations
-                indices = indices[d < np.fabs((self._grid[i, 0] - ER))]
-                d = d[d < np.fabs((self._grid[i, 0] - ER))]
-
-                if (len(indices) == 0): continue
-
-                # compute IDW weights
-                idwIndices = indices
-                idw = np.zeros(d.shape)
-                idw = 1. / np.power(d, p)
-
-                # compute mean instantaneous phase weight
-                grid_iphase_weights[i] = np.mean(data[idwIndices, 5] + 1j * data[idwIndices, 6])
-
-                # compute grid values
-                grid_vals[i] = np.sum(idw * data[idwIndices, 4]) / np.sum(idw)
-            # end for
-
-            swath_grid_iphase_weights.append(grid_iphase_weights)
-            swath_grid_vals.append(grid_vals)
-        # end for
-
-        # sum grid values across swath
-        v = np.reshape(np.array(swath_grid_vals),
-                       (self._gs.shape[0], self._gd.shape[0], self._gx.shape[0]))
-        pw = np.reshape(np.array(swath_grid_iphase_weights),
-                       (self._gs.shape[0], self._gd.shape[0], self._gx.shape[0]))
-
-        self._grid_vals = np.mean(v * np.power(np.abs(pw), self._pw_exponent), axis=0)
-        #print(self._grid_vals)
+        # average grid values across swath
+        v = np.reshape(v, (self._gs.shape[0], self._gd.shape[0], self._gx.shape[0]))
+        self._grid_vals = np.mean(v, axis=0)
     # end func
 
     def plot(self, ax, amp_min=-0.2, amp_max=0.2, gax=None, gravity=None):
@@ -742,10 +934,8 @@ class CCP_DepthProfile():
                                 np.array(geod.npts(startLon, startLat, endLon, endLat, self._nx - 2)),
                                 np.array([endLon, endLat])])
 
-            for j in np.arange(self._nx):
-                idx = i * self._nx + j
-                self._grid[idx, :] = np.array([r, xnodes[j, 0], xnodes[j, 1]])
-            # end for
+            self._grid[i * self._nx:(i + 1) * self._nx, 0] = r
+            self._grid[i * self._nx:(i + 1) * self._nx, 1:] = xnodes
         # end for
 
         self._gx = np.linspace(0, self._length_x, self._nx)
@@ -777,38 +967,9 @@ class CCP_DepthProfile():
                        np.radians(90 - self._grid[:, 2]),
                        np.radians(self._grid[:, 1]))
 
-        grid_vals = np.zeros(gxyz.shape[0])
-        grid_iphase_weights = np.zeros(len(gxyz), dtype=np.complex)
-
-        p = self._idw_exponent
-        r = self._cell_radius
-        tree = self._ccpVolume._tree
-        data = self._ccpVolume._data
-
-        for i in np.arange(gxyz.shape[0]):
-            indices = np.array(tree.query_ball_point(gxyz[i, :], r=r))
-
-            if (len(indices) == 0): continue
-
-            indices = np.array(indices)
-
-            indices = indices[np.fabs(data[indices, 3] - (ER - self._grid[i, 0])) < self._dz]
-            if (len(indices) == 0): continue
-
-            d = np.zeros(len(indices))
-            d[:] = np.sqrt(np.sum(np.power(gxyz[i] - data[indices, :3], 2), axis=1))
-
-            idwIndices = indices
-            idw = np.zeros(d.shape)
-            idw = 1. / np.power(d, p)
-
-            grid_iphase_weights[i] = np.mean(data[idwIndices, 5] + 1j * data[idwIndices, 6])
-            grid_vals[i] = np.sum(idw * data[idwIndices, 4]) / np.sum(idw) * \
-                           np.power(np.abs(grid_iphase_weights[i]), self._pw_exponent)
-        # end for
-
-        self._grid_vals = grid_vals
-
+        self._grid_vals = self._ccpVolume.interpolate(gxyz, np.fabs(ER - self._grid[:, 0]),
+                                                      self._cell_radius, self._dz,
+                                                      self._idw_exponent, self._pw_exponent, cone=False)
     # end func
 
     def plot(self, ax, amp_min=-0.2, amp_max=0.2):
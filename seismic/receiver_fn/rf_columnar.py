@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+"""
+Description:
+    Columnar HDF5 store for receiver functions (RFs).
+
+    Files written by RFStream.write(format='H5') hold each trace in its own HDF5 dataset, with
+    stats stored as attributes, which makes loading large RF files dominated by per-object
+    metadata access. In the columnar layout, traces are grouped by station and channel:
+        /stations/<NET.STA.LOC>/<CHANNEL>/data  : 2D float32 array (traces x samples), NaN-padded
+        /stations/<NET.STA.LOC>/<CHANNEL>/stats : structured array, one row per trace
+    Scalar stats that have a consistent type across traces are stored in typed columns (with
+    UTCDateTimes stored as int64 nanoseconds); all other stats are stored as JSON in a single
+    variable-length string column.
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import json
+import logging
+from collections import defaultdict
+
+import click
+import h5py
+import numpy as np
+from obspy import UTCDateTime
+from obspy.core.util import AttribDict
+from rf import RFStream
+from rf.rfstream import RFTrace
+
+logging.basicConfig()
+
+# pylint: disable=invalid-name, logging-format-interpolation
+
+FILE_FORMAT = 'rf_columnar'
+ROOT = 'stations'
+JSON_FIELD = '_json'
+
+# stats that are derived from others or are specific to the source file-format, as in obspyh5
+_IGNORE = ('endtime', 'sampling_rate', 'npts', '_format')
+_MISSING = object()
+
+
+def is_rf_columnar(h5fn):
+    """
+    :param h5fn: HDF5 file name
+    :return: True if the file is in the columnar RF layout
+    """
+    with h5py.File(h5fn, 'r') as fh:
+        return fh.attrs.get('file_format', None) == FILE_FORMAT
+    # end with
+# end func
+
+
+def _json_default(o):
+    if isinstance(o, UTCDateTime): return {'__utc_ns__': o.ns}
+    if isinstance(o, AttribDict): return dict(o)
+    if isinstance(o, np.generic): return o.item()
+    if isinstance(o, np.ndarray): return o.tolist()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(o).__name__))
+# end func
+
+
+def _json_object_hook(d):
+    if len(d) == 1 and '__utc_ns__' in d: return UTCDateTime(ns=d['__utc_ns__'])
+    return d
+# end func
+
+
+def _column_dtype(values):
+    """
+    :param values: list of values of a given stats key across traces
+    :return: dtype of a typed column, 'utc' for UTCDateTimes, or None if values are stored as JSON
+    """
+    if all(isinstance(v, UTCDateTime) for v in values): return 'utc'
+    if all(isinstance(v, (bool, np.bool_)) for v in values): return np.dtype(bool)
+    if all(isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_)) for v in values):
+        return np.dtype(np.int64)
+    # end if
+    if all(isinstance(v, (float, np.floating)) for v in values): return np.dtype(np.float64)
+    if all(isinstance(v, str) for v in values):
+        return np.dtype('S%d' % max([1] + [len(v.encode('utf-8')) for v in values]))
+    # end if
+
+    return None
+# end func
+
+
+def _trace_header(tr):
+    st = tr.stats
+    ignore = _IGNORE
+    if '_format' in st: ignore = ignore + (st._format.lower(),)
+
+    return {k: v for k, v in st.items() if k not in ignore}
+# end func
+
+
+def _stats_table(traces):
+    """
+    Builds a structured array of stats for the given traces
+
+    :param traces: list of traces
+    :return: 1: structured array
+             2: list of names of UTCDateTime columns
+    """
+    headers = [_trace_header(tr) for tr in traces]
+    keys = sorted(set().union(*[h.keys() for h in headers]))
+
+    fields = [('npts', np.int64)]
+    utc_fields = []
+    json_keys = []
+    for k in keys:
+        dt = _column_dtype([h.get(k, _MISSING) for h in headers])
+        if dt is None:
+            json_keys.append(k)
+        elif dt == 'utc':
+            fields.append((k, np.int64))
+            utc_fields.append(k)
+        else:
+            fields.append((k, dt))
+        # end if
+    # end for
+    fields.append((JSON_FIELD, h5py.string_dtype()))
+
+    table = np.zeros(len(traces), dtype=fields)
+    table['npts'] = [tr.stats.npts for tr in traces]
+    for name, _ in fields[1:-1]:
+        values = [h[name] for h in headers]
+        if name in utc_fields:
+            table[name] = [v.ns for v in values]
+        elif table.dtype[name].kind == 'S':
+            table[name] = [v.encode('utf-8') for v in values]
+        else:
+            table[name] = values
+        # end if
+    # end for
+    table[JSON_FIELD] = [json.dumps({k: h[k] for k in json_keys if k in h}, default=_json_default)
+                         for h in headers]
+
+    return table, utc_fields
+# end func
+
+
+def _write_channel(grp, traces, chunk_rows=256, compression=None):
+    table, utc_fields = _stats_table(traces)
+
+    ncols = max(1, int(np.max(table['npts'])))
+    data = np.full((len(traces), ncols), np.nan, dtype=np.float32)
+    for i, tr in enumerate(traces): data[i, :tr.stats.npts] = tr.data
+
+    # balance rows across chunks, so that the last chunk is not mostly empty
+    nchunks = int(np.ceil(len(traces) / float(chunk_rows)))
+    chunk_rows = int(np.ceil(len(traces) / float(nchunks)))
+
+    grp.create_dataset('data', data=data, maxshape=(None, None), chunks=(chunk_rows, ncols),
+                       compression=compression)
+    ds = grp.create_dataset('stats', data=table, maxshape=(None,), chunks=(chunk_rows,),
+                            compression=compression)
+    ds.attrs['utc_fields'] = utc_fields
+# end func
+
+
+def _read_channel(grp):
+    """
+    :param grp: channel group
+    :return: list of RFTraces
+    """
+    table = grp['stats'][...]
+    data = grp['data'][...]
+    utc_fields = set(grp['stats'].attrs['utc_fields'])
+    names = [n for n in table.dtype.names if n not in ('npts', JSON_FIELD)]
+
+    traces = []
+    for row, d in zip(table, data):
+        header = {}
+        for n in names:
+            v = row[n]
+            if n in utc_fields: header[n] = UTCDateTime(ns=int(v))
+            elif isinstance(v, bytes): header[n] = v.decode('utf-8')
+            else: header[n] = v.item()
+        # end for
+        js = row[JSON_FIELD]
+        if isinstance(js, bytes): js = js.decode('utf-8')
+        header.update(json.loads(js, object_hook=_json_object_hook))
+
+        traces.append(RFTrace(data=d[:row['npts']].copy(), header=header))
+    # end for
+
+    return traces
+# end func
+
+
+def get_station_keys(h5fn):
+    """
+    :param h5fn: file in columnar RF layout
+    :return: list of station keys (NET.STA.LOC)
+    """
+    with h5py.File(h5fn, 'r') as fh:
+        return list(fh[ROOT].keys()) if ROOT in fh else []
+    # end with
+# end func
+
+
+def write_rf_columnar(stream, h5fn, mode='a', chunk_rows=256, compression=None):
+    """
+    Writes an RFStream in the columnar RF layout. Traces are appended to existing data
+    for the same station and channel.
+
+    :param stream: RFStream or list of traces
+    :param h5fn: output file name
+    :param mode: h5py file mode; 'a' to append, 'w' to overwrite
+    :param chunk_rows: number of traces per HDF5 chunk
+    :param compression: HDF5 compression filter, e.g. 'gzip' or None
+    """
+    groups = defaultdict(list)
+    for tr in stream:
+        st = tr.stats
+        groups[('{}.{}.{}'.format(st.network, st.station, st.location), st.channel)].append(tr)
+    # end for
+
+    with h5py.File(h5fn, mode) as fh:
+        if len(fh.keys()) and fh.attrs.get('file_format', None) != FILE_FORMAT:
+            raise IOError('File {} exists, but is not in the columnar RF layout'.format(h5fn))
+        # end if
+        fh.attrs['file_format'] = FILE_FORMAT
+        root = fh.require_group(ROOT)
+
+        for (key, cha), traces in groups.items():
+            path = '{}/{}'.format(key, cha)
+            if path in root:
+                traces = _read_channel(root[path]) + traces
+                del root[path]
+            # end if
+            _write_channel(root.create_group(path), traces, chunk_rows=chunk_rows,
+                           compression=compression)
+        # end for
+    # end with
+# end func
+
+
+def read_rf_columnar(h5fn, station_key=None, channel=None):
+    """
+    Reads traces from a file in the columnar RF layout
+
+    :param h5fn: file name
+    :param station_key: station key (NET.STA.LOC); all stations are read if None
+    :param channel: channel code; all channels are read if None
+    :return: RFStream
+    """
+    traces = []
+    with h5py.File(h5fn, 'r') as fh:
+        root = fh[ROOT]
+        keys = [station_key] if station_key is not None else list(root.keys())
+        for key in keys:
+            if key not in root: continue
+            for cha in root[key]:
+                if channel is not None and cha != channel: continue
+                traces += _read_channel(root[key][cha])
+            # end for
+        # end for
+    # end with
+
+    return RFStream(traces=traces)
+# end func
+
+
+def read_station_arrays(h5fn, station_key, channel):
+    """
+    Reads raw arrays for a station and channel, e.g. for vectorised processing
+
+    :param h5fn: file name
+    :param station_key: station key (NET.STA.LOC)
+    :param channel: channel code
+    :return: 1: 2D float32 array of traces (traces x samples), NaN-padded beyond each trace's npts
+             2: structured array of stats, with UTCDateTimes stored as int64 nanoseconds
+    """
+    with h5py.File(h5fn, 'r') as fh:
+        grp = fh[ROOT][station_key][channel]
+        return grp['data'][...], grp['stats'][...]
+    # end with
+# end func
+
+
+def remove_station(h5fn, station_key):
+    """
+    Removes all data for a station from a file in the columnar RF layout
+
+    :param h5fn: file name
+    :param station_key: station key (NET.STA.LOC)
+    """
+    with h5py.File(h5fn, 'a') as fh:
+        if station_key in fh[ROOT]: del fh[ROOT][station_key]
+    # end with
+# end func
+
+
+def iter_rf_columnar(h5fn):
+    """
+    Iterates over stations in a file in the columnar RF layout, loading one station at a time
+
+    :param h5fn: file name
+    :return: generator of (station key, RFStream)
+    """
+    for key in get_station_keys(h5fn):
+        yield key, read_rf_columnar(h5fn, station_key=key)
+    # end for
+# end func
+
+
+def h5_to_columnar(src_h5fn, dst_h5fn, chunk_rows=256, compression=None, logger=None):
+    """
+    Converts an RF file written by RFStream.write(format='H5') to the columnar RF layout,
+    one station at a time
+
+    :param src_h5fn: source file name
+    :param dst_h5fn: output file name, which is overwritten
+    :param chunk_rows: number of traces per HDF5 chunk
+    :param compression: HDF5 compression filter, e.g. 'gzip' or None
+    :param logger: optional logger
+    """
+    from rf import read_rf
+    from seismic.receiver_fn.rf_util import get_hdf_keys
+
+    with h5py.File(dst_h5fn, 'w') as fh: fh.attrs['file_format'] = FILE_FORMAT
+
+    for key in get_hdf_keys(src_h5fn):
+        if logger: logger.info('Converting {}..'.format(key))
+        stream = read_rf(src_h5fn, format='h5', group='waveforms/%s' % key)
+        write_rf_columnar(stream, dst_h5fn, mode='a', chunk_rows=chunk_rows, compression=compression)
+    # end for
+# end func
+
+
+def columnar_to_h5(src_h5fn, dst_h5fn, logger=None):
+    """
+    Converts a file in the columnar RF layout to the layout written by RFStream.write(format='H5'),
+    one station at a time
+
+    :param src_h5fn: source file name
+    :param dst_h5fn: output file name; traces are appended if it exists
+    :param logger: optional logger
+    """
+    for key, stream in iter_rf_columnar(src_h5fn):
+        if logger: logger.info('Converting {}..'.format(key))
+        stream.write(dst_h5fn, format='H5', mode='a')
+    # end for
+# end func
+
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('input-file', type=click.Path(exists=True, dir_okay=False), required=True)
+@click.argument('output-file', type=click.Path(dir_okay=False), required=True)
+@click.option('--chunk-rows', default=256, show_default=True,
+              help='Number of traces per HDF5 chunk in columnar output')
+@click.option('--compression', type=click.Choice(['none', 'gzip', 'lzf']), default='none',
+              show_default=True, help='HDF5 compression filter for columnar output')
+def main(input_file, output_file, chunk_rows, compression):
+    """
+    Converts RF files between the layout written by RFStream.write(format='H5') and the columnar
+    layout; the direction of conversion is determined by the layout of INPUT_FILE.
+
+    INPUT_FILE : Input RFs in H5 format\n
+    OUTPUT_FILE : Output H5 file name
+    """
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+
+    if is_rf_columnar(input_file):
+        columnar_to_h5(input_file, output_file, logger=logger)
+    else:
+        h5_to_columnar(input_file, output_file, chunk_rows=chunk_rows,
+                       compression=None if compression == 'none' else compression, logger=logger)
+    # end if
+# end func
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
+# end if
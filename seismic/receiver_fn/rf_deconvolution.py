@@ -6,6 +6,7 @@ import logging
 
 import numpy as np
 import scipy
+import scipy.fft
 import scipy.signal
 
 # pylint: disable=invalid-name,too-many-locals
@@ -49,13 +50,14 @@ def _get_residual(x, y):
 
 def _gauss_filter(x, gwidth_factor, dt):
     """
-    Apply low-pass filter to input x using Gaussian function in freq domain.
+    Apply low-pass filter to input x using Gaussian function in freq domain. If x is 2D, each row
+    is filtered.
     """
-    n = len(x)
+    n = x.shape[-1]
     two_pi = 2 * np.pi
 
-    fft_x = np.fft.rfft(x)  # complex array
-    n2 = len(fft_x)
+    fft_x = np.fft.rfft(x, axis=-1)  # complex array
+    n2 = fft_x.shape[-1]
 
     df = 1.0 / (float(n) * dt)
     d_omega = two_pi * df
@@ -66,7 +68,7 @@ def _gauss_filter(x, gwidth_factor, dt):
     # Note: normalization factor to correct RF amplitude for inversion is 2*df*np.sum(gauss)
     fft_x = fft_x * gauss
 
-    x_filt = np.fft.irfft(fft_x, n)  # real_array
+    x_filt = np.fft.irfft(fft_x, n, axis=-1)  # real_array
 
     return x_filt
 # end func
@@ -99,23 +101,95 @@ def _convolve(x, y, leadin):
 # end func
 
 
-def iter_deconv_pulsetrain(numerator, denominator, sampling_rate, time_shift, max_pulses=1000,
-                           tol=1.0e-3, gwidth=2.5, only_positive=False, log=None):
+class _PulseResponses(object):
     """
-    Iterative deconvolution of source and response signal to generate seismic receiver function.
-    Adapted to Python by Andrew Medlin, Geoscience Australia (2019), from Chuck Ammon's
-    (Saint Louis University) `iterdeconfd` Fortran code, version 1.04.
+    Predicted (filtered) response signals to unit pulses, i.e. signals that _convolve(_build_decon([1], [shift],
+    ...)[0], g, leadin) would produce, for a batch of source signals g.
+
+    The Gaussian filter is applied in the frequency domain and is therefore circular, but its impulse response
+    decays to below machine precision well within half the signal length. Responses to pulses whose filtered
+    support lies within the signal are thus shifted copies of the convolution of the (truncated) impulse
+    response with the source signal, which is computed once upfront. Responses to pulses close to the ends of
+    signals are computed exactly.
+    """
+    def __init__(self, g, gwidth, dt, leadin):
+        """
+        :param g: 2D array of source signals (nsignals x npts)
+        :param gwidth: Gaussian filter width in the normalized frequency domain
+        :param dt: Sampling interval (s)
+        :param leadin: Number of samples before P-wave onset
+        """
+        self.g = g
+        self.gwidth = gwidth
+        self.dt = dt
+        self.leadin = leadin
+        nsig, npts = g.shape
+        self.npts = npts
+
+        # Impulse response of the Gaussian filter and its support
+        impulse = np.zeros(npts)
+        impulse[0] = 1
+        h = _gauss_filter(impulse, gwidth, dt)
+        lags = np.minimum(np.arange(npts), npts - np.arange(npts))
+        self.half_width = np.max(lags[np.fabs(h) > np.finfo(float).eps * np.max(np.fabs(h))])
+
+        self.table = None
+        if 2 * self.half_width + 1 < npts // 2:
+            W = self.half_width
+            kernel = h[np.arange(-W, W + 1) % npts]
+            response = scipy.signal.fftconvolve(kernel[None, :], g, axes=-1)
+
+            # Zero-padded on either side, so that responses can be sliced for any pulse-shift
+            self.table = np.zeros((nsig, 3 * npts + 2 * W))
+            self.table[:, npts:npts + response.shape[1]] = response
+        # end if
+    # end func
+
+    def __call__(self, rows, shifts):
+        """
+        :param rows: 1D array of indices of source signals
+        :param shifts: 1D array of pulse-shifts (samples), one for each row
+        :return: 2D array of predicted responses (len(rows) x npts)
+        """
+        npts = self.npts
+        W = self.half_width
+        exact = np.ones(len(rows), dtype=bool)
+        result = np.zeros((len(rows), npts))
+
+        if self.table is not None:
+            exact = (shifts - W < 0) | (shifts + W >= npts)
+            idx = np.arange(npts)[None, :] + (self.leadin + W + npts - shifts)[:, None]
+            result[~exact] = np.take_along_axis(self.table[rows[~exact]], idx[~exact], axis=-1)
+        # end if
 
-    Note this is not really a frequency-domain deconvolution method, since the deconvolution is
-    based on generating a time-domain pulse train which is filtered and convolved with source
-    signal in time domain in order to try to replicate observation. Results should be the same
-    even if some of the spectral techniques used in functions (such as `gauss_filter`) were replaced
-    by non-spectral equivalents.
+        for i in np.flatnonzero(exact):
+            p, _ = _build_decon([1.], [shifts[i]], npts, self.gwidth, self.dt)
+            result[i] = _convolve(p, self.g[rows[i]], self.leadin)
+        # end for
 
-    :param numerator: The observed response signal (e.g. R, Q or T component)
-    :type numerator: numpy.array(float)
-    :param denominator: The source signal (e.g. L or Z component)
-    :type denominator: numpy.array(float)
+        return result
+    # end func
+# end class
+
+
+def iter_deconv_pulsetrain_batch(numerators, denominators, sampling_rate, time_shift, max_pulses=1000,
+                                 tol=1.0e-3, gwidth=2.5, only_positive=False, log=None):
+    """
+    Batched iterative deconvolution, e.g. of signals for many events at a station, with results equivalent to
+    those of iter_deconv_pulsetrain for each pair of numerator and denominator signals.
+
+    Since one pulse is added per iteration, residuals are updated incrementally by subtracting the scaled,
+    predicted response to the new pulse, which is a shifted copy of the filtered source signal convolved with
+    the impulse response of the Gaussian filter (see _PulseResponses), rather than rebuilding, filtering and
+    convolving the whole pulse train. Cross-correlations of residuals against filtered source signals are
+    computed in batches through FFTs, with spectra of the source signals computed upfront. Signals are iterated
+    in lockstep until each converges or reaches the maximum number of pulses.
+
+    :param numerators: Observed response signals (e.g. R, Q or T component)
+    :type numerators: numpy.array(float) [2D] (nsignals x npts)
+    :param denominators: Source signals (e.g. L or Z component), either one for each numerator or a single signal
+        shared by all numerators
+    :type denominators: numpy.array(float) [2D] (nsignals x npts) or [1D] (npts)
     :param sampling_rate: The sampling rate in Hz of the numerator and denominator signals
     :type sampling_rate: float
     :param time_shift: Time shift (sec) from start of input signals until expected P-wave arrival onset.
@@ -128,149 +202,181 @@ def iter_deconv_pulsetrain(numerator, denominator, sampling_rate, time_shift, ma
     :type gwidth: float
     :param only_positive: If true, only use positive pulses in the RF.
     :type only_positive: bool
-    :param log: Log instance to log messages to.
+    :param log: Log instance to log messages to. Progress of iterations is only logged for a single signal.
     :type log: logging.Logger
-    :return: RF trace, pulse train, expected response signal, predicted response signal, quality of fit statistic
-    :rtype: numpy.array(float), numpy.array(float), numpy.array(float), numpy.array(float), float
+    :return: RF traces, pulse trains, expected response signals, predicted response signals, quality of fit
+        statistics
+    :rtype: numpy.array(float) [2D], numpy.array(float) [2D], numpy.array(float) [2D], numpy.array(float) [2D],
+        numpy.array(float) [1D]
     """
 
     MAXPTS = 100000
-    assert len(denominator) <= MAXPTS  # Sanity check input size
-    assert len(numerator) <= MAXPTS
     MAX_PULSES = 1000  # Maximum number of pulses to synthesize in p
     MIN_POWER = 1.0e-8
 
-    amps = []
-    shifts = []
+    # Clone numerator data
+    f = np.array(numerators, dtype=float, ndmin=2)
+    nsig, npts = f.shape
+    assert npts <= MAXPTS  # Sanity check input size
+
+    # Clone denominator data
+    g = np.array(np.broadcast_to(np.asarray(denominators, dtype=float), f.shape))
 
     if max_pulses > MAX_PULSES:
-        log.warning('Maximum Number of pulses is %d, clipping input value', MAX_PULSES)
+        if log: log.warning('Maximum Number of pulses is %d, clipping input value', MAX_PULSES)
         max_pulses = MAX_PULSES
     # end if
 
-    # Clone numerator data
-    f = numerator.copy()
-    npts = len(f)
-
-    # Clone denominator data
-    g = denominator.copy()
-    assert len(g) == npts, "g should be same length as f"
-
     dt = 1.0 / sampling_rate
 
-    # Now begin the cross-correlation procedure
-
     # Put the filter in the signals
     f_hat = _gauss_filter(f, gwidth, dt)
     g_hat = _gauss_filter(g, gwidth, dt)
 
     # compute the power in the "numerator" for error scaling
-    power = np.dot(f_hat, f_hat)
-
-    # correlate the signals
-    xc = _xcorrelate(f_hat, g_hat)
+    power = np.sum(f_hat * f_hat, axis=-1)
 
     # Exclude non-causal offsets from being added to the pulse locations.
     non_causal_leadin = int(np.ceil(time_shift/dt))
     max_causal_idx = npts - non_causal_leadin
     assert max_causal_idx > 0
-    if only_positive:
-        shift_index = np.argmax(xc[:max_causal_idx])
-    else:
-        xc_abs = np.abs(xc)
-        shift_index = np.argmax(xc_abs[:max_causal_idx])
-    # end if
-    shifts.append(shift_index + non_causal_leadin)
-    amps.append(xc[shift_index])
-
-    num_pulses = 1
-
-    # compute the predicted deconvolution result
-    p, pulses = _build_decon(amps, shifts, npts, gwidth, dt)
 
-    # convolve the prediction with the denominator signal
-    f_hat_predicted = _convolve(p, g, non_causal_leadin)
+    # Spectra for correlating residuals against filtered source signals, normalized by the zero-lag
+    # autocorrelation of the latter, as in _xcorrelate
+    nfft = scipy.fft.next_fast_len(2 * npts - 1, real=True)
+    g_hat_spec = np.conj(scipy.fft.rfft(g_hat, nfft, axis=-1))
+    g_hat_spec /= np.sum(g_hat * g_hat, axis=-1)[:, None]
 
-    # compute the residual (initial error is 1.0)
-    resid, sumsq_ip1 = _get_residual(f_hat, f_hat_predicted)
-
-    # Early exit for case when data is all close to zero
-    if power < MIN_POWER:
-        rf_trace = p
-        fit = 100.0
-        return rf_trace, pulses, f_hat, f_hat_predicted, fit
-    # end if
+    pulse_responses = _PulseResponses(g, gwidth, dt, non_causal_leadin)
 
-    sumsq_i = 1.0
-    sumsq_ip1 = sumsq_ip1 / power
-    d_error = 100 * (sumsq_i - sumsq_ip1)
+    amps = [[] for _ in range(nsig)]
+    shifts = [[] for _ in range(nsig)]
+    resid = f_hat.copy()
+    sumsq = np.ones(nsig)  # initial error is 1.0
+    d_error = np.zeros(nsig)
+    active = np.ones(nsig, dtype=bool)
 
-    if log:
+    if log and nsig == 1:
         log.info('%11s %s', 'Iteration', '  Spike amplitude  Spike delay   Misfit   Improvement')
-        log.info('%10d  %16.9e  %10.3f   %7.2f%%   %9.4f%%', num_pulses, dt * amps[-1], (shifts[-1] - 1) * dt,
-                 100 * sumsq_ip1, d_error)
-    # endf if
+    # end if
 
     # *************************************************************************
-    while (np.abs(d_error) > tol) and (num_pulses < max_pulses):
-
+    num_pulses = 0
+    while np.any(active):
         num_pulses += 1
-        sumsq_i = sumsq_ip1
-
-        xc = _xcorrelate(resid, g_hat)
+        rows = np.flatnonzero(active)
 
+        # correlate the residuals with the filtered source signals
+        xc = scipy.fft.irfft(scipy.fft.rfft(resid[rows], nfft, axis=-1) * g_hat_spec[rows], nfft,
+                             axis=-1)[:, :max_causal_idx]
         if only_positive:
-            shift_index = np.argmax(xc[:max_causal_idx])
+            shift_index = np.argmax(xc, axis=-1)
         else:
-            xc_abs = np.abs(xc)
-            shift_index = np.argmax(xc_abs[:max_causal_idx])
+            shift_index = np.argmax(np.abs(xc), axis=-1)
+        # end if
+        amp = xc[np.arange(len(rows)), shift_index]
+        shift = shift_index + non_causal_leadin
+
+        # update the residuals with predicted responses to the new pulses
+        resid[rows] -= amp[:, None] * pulse_responses(rows, shift)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sumsq_ip1 = np.sum(resid[rows] * resid[rows], axis=-1) / power[rows]
+        # end with
+        d_error[rows] = 100 * (sumsq[rows] - sumsq_ip1)
+        sumsq[rows] = sumsq_ip1
+
+        for i, row in enumerate(rows):
+            amps[row].append(amp[i])
+            shifts[row].append(shift[i])
+        # end for
+
+        if log and nsig == 1:
+            log.info('%10d  %16.9e  %10.3f   %7.2f%%   %9.4f%%', num_pulses, dt * amp[0], shift[0] * dt,
+                     100 * sumsq[0], d_error[0])
         # end if
-        shifts.append(shift_index + non_causal_leadin)
-        amps.append(xc[shift_index])
-
-        p, pulses = _build_decon(amps, shifts, npts, gwidth, dt)
-
-        f_hat_predicted = _convolve(p, g, non_causal_leadin)
-
-        resid, sumsq_ip1 = _get_residual(f_hat, f_hat_predicted)
-        sumsq_ip1 = sumsq_ip1 / power
-        d_error = 100 * (sumsq_i - sumsq_ip1)
 
-        if log:
-            log.info('%10d  %16.9e  %10.3f   %7.2f%%   %9.4f%%', num_pulses, dt * amps[-1], shifts[-1] * dt,
-                     100 * sumsq_ip1, d_error)
+        done = (np.abs(d_error[rows]) <= tol) | (num_pulses >= max_pulses)
+        if num_pulses == 1:
+            # Early exit for case when data is all close to zero
+            done |= power[rows] < MIN_POWER
         # end if
+        active[rows[done]] = False
     # end while
 
     # *************************************************************************
 
-    if log:
-        log.info('Last Error Change = %9.4f%%', d_error)
-    # end if
-
     # Compute final fit
-    fit = 100 - 100 * sumsq_ip1
+    fit = 100 - 100 * sumsq
+    fit[power < MIN_POWER] = 100.0
+
+    # compute the final predictions
+    rf_traces = np.zeros((nsig, npts))
+    pulses = np.zeros((nsig, npts))
+    f_hat_predicted = np.zeros((nsig, npts))
+    for i in np.arange(nsig):
+        rf_traces[i], pulses[i] = _build_decon(amps[i], shifts[i], npts, gwidth, dt)
+        f_hat_predicted[i] = _convolve(rf_traces[i], g[i], non_causal_leadin)
+
+        if log and power[i] >= MIN_POWER:
+            log.info('Last Error Change = %9.4f%%', d_error[i])
+            if (len(shifts[i]) >= max_pulses) and (np.abs(d_error[i]) > tol):
+                log.warning('Hit the max number of pulses - not halting due to convergence.')
+            # end if
+            log.info('Number of pulses in final result: %d', len(set(shifts[i])))
+            log.info('The final deconvolution reproduces %5.1f%% of the signal.', fit[i])
+        # end if
+    # end for
 
-    if log and (num_pulses >= max_pulses) and (np.abs(d_error) > tol):
-        log.warning('Hit the max number of pulses - not halting due to convergence.')
-    # end if
+    return rf_traces, pulses, f_hat, f_hat_predicted, fit
+# end func
 
-    num_unique_pulses = len(set(shifts))
-    if log:
-        log.info('Number of pulses in final result: %d', num_unique_pulses)
-        log.info('The final deconvolution reproduces %5.1f%% of the signal.', fit)
-    # end if
 
-    # *************************************************************************
+def iter_deconv_pulsetrain(numerator, denominator, sampling_rate, time_shift, max_pulses=1000,
+                           tol=1.0e-3, gwidth=2.5, only_positive=False, log=None):
+    """
+    Iterative deconvolution of source and response signal to generate seismic receiver function.
+    Adapted to Python by Andrew Medlin, Geoscience Australia (2019), from Chuck Ammon's
+    (Saint Louis University) `iterdeconfd` Fortran code, version 1.04.
+
+    Note this is not really a frequency-domain deconvolution method, since the deconvolution is
+    based on generating a time-domain pulse train which is filtered and convolved with source
+    signal in time domain in order to try to replicate observation. Results should be the same
+    even if some of the spectral techniques used in functions (such as `gauss_filter`) were replaced
+    by non-spectral equivalents.
 
-    # compute the final prediction
-    p, pulses = _build_decon(amps, shifts, npts, gwidth, dt)
+    Residuals are updated incrementally as pulses are added; see iter_deconv_pulsetrain_batch, which
+    deconvolves many signals at once.
 
-    f_hat_predicted = _convolve(p, g, non_causal_leadin)
-    rf_trace = p
+    :param numerator: The observed response signal (e.g. R, Q or T component)
+    :type numerator: numpy.array(float)
+    :param denominator: The source signal (e.g. L or Z component)
+    :type denominator: numpy.array(float)
+    :param sampling_rate: The sampling rate in Hz of the numerator and denominator signals
+    :type sampling_rate: float
+    :param time_shift: Time shift (sec) from start of input signals until expected P-wave arrival onset.
+    :type time_shift: float
+    :param max_pulses: Maximum number of delta function pulses to synthesize in the unfiltered RF (up to 1000)
+    :type max_pulses: int
+    :param tol: Convergence tolerance, iteration stops if change in error falls below this value
+    :type tol: float
+    :param gwidth: Gaussian filter width in the normalized frequency domain.
+    :type gwidth: float
+    :param only_positive: If true, only use positive pulses in the RF.
+    :type only_positive: bool
+    :param log: Log instance to log messages to.
+    :type log: logging.Logger
+    :return: RF trace, pulse train, expected response signal, predicted response signal, quality of fit statistic
+    :rtype: numpy.array(float), numpy.array(float), numpy.array(float), numpy.array(float), float
+    """
+    assert len(denominator) == len(numerator), "g should be same length as f"
 
-    return rf_trace, pulses, f_hat, f_hat_predicted, fit
+    rf_trace, pulses, f_hat, f_hat_predicted, fit = \
+        iter_deconv_pulsetrain_batch(numerator[None, :], denominator, sampling_rate, time_shift,
+                                     max_pulses=max_pulses, tol=tol, gwidth=gwidth,
+                                     only_positive=only_positive, log=log)
 
+    return rf_trace[0], pulses[0], f_hat[0], f_hat_predicted[0], fit[0]
 # end func
 
 
@@ -301,9 +407,10 @@ def rf_iter_deconv(response_data, source_data, sr, tshift, min_fit_threshold=80.
     receiver_fns = []
     log = logging.getLogger(__name__)
     log.setLevel(logging.INFO)
-    for numerator in response_data:
-        # Any non-default parameters of deconvolution should be packed into kwargs
-        rf_trace, _, _, _, fit = iter_deconv_pulsetrain(numerator, denominator, sampling_rate, time_shift, **kwargs)
+    # Any non-default parameters of deconvolution should be packed into kwargs
+    rf_traces, _, _, _, fits = iter_deconv_pulsetrain_batch(np.array(response_data), denominator, sampling_rate,
+                                                            time_shift, **kwargs)
+    for rf_trace, fit in zip(rf_traces, fits):
         # TODO:
         # - store the fit percentage in output RF metadata
         # - store boolean indicating whether deconvolution converged
@@ -9,6 +9,8 @@ import h5py
 from obspyh5 import dataset2trace
 from rf import RFStream
 
+from seismic.receiver_fn import rf_columnar
+
 logging.basicConfig()
 
 # pylint: disable=invalid-name, logging-format-interpolation
@@ -21,6 +23,9 @@ class IterRfH5StationEvents(object):
        This class yields 3-channel traces per station per event.
 
        Data yielded per station can easily be many MB in size.
+
+       Files in the columnar layout (see rf_columnar.py) are also supported, in which case traces
+       are grouped into events by their event_time (or event_id) stats.
     """
 
     def __init__(self, h5_filename, memmap=False):
@@ -52,6 +57,11 @@ class IterRfH5StationEvents(object):
         logger = logging.getLogger(__name__)
         logger.setLevel(logging.INFO)
         logger.info("Scanning station groups from file {}".format(self.h5_filename))
+        if rf_columnar.is_rf_columnar(self.h5_filename):
+            yield from self._iter_columnar(logger)
+            return
+        # end if
+
         with self._open_source_file() as f:
             wf_data = f['waveforms']
             num_stations = len(wf_data)
@@ -85,3 +95,25 @@ class IterRfH5StationEvents(object):
         # end with
         logger.info("Yielded {} event traces to process".format(event_count))
     # end func
+
+    def _iter_columnar(self, logger):
+        station_keys = rf_columnar.get_station_keys(self.h5_filename)
+        event_count = 0
+
+        for count, station_id in enumerate(station_keys):
+            logger.info("Station {} {}/{}".format(station_id, count + 1, len(station_keys)))
+            stream = rf_columnar.read_rf_columnar(self.h5_filename, station_key=station_id)
+
+            events = {}
+            for trace in stream:
+                st = trace.stats
+                key = str(st.get('event_time', st.get('event_id', st.starttime)))
+                events.setdefault(key, []).append(trace)
+            # end for
+            station_stream3c = [RFStream(traces=events[key]).sort() for key in sorted(events.keys())]
+            event_count += len(station_stream3c)
+
+            yield station_id, station_stream3c
+        # end for
+        logger.info("Yielded {} event traces to process".format(event_count))
+    # end func
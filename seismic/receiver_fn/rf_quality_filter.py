@@ -8,7 +8,6 @@ of each trace.
 from builtins import range  # pylint: disable=redefined-builtin
 
 import logging
-import itertools
 import traceback
 from multiprocessing import Process, Manager
 
@@ -34,22 +33,21 @@ logging.basicConfig()
 
 
 def _crossSpectrum(x, y, num_subsegs=32):
+    # Cross spectra are computed along the last axis, so that x and y can hold multiple
+    # signals, with leading dimensions broadcast against each other.
     # -------------------Remove mean-------------------
     # nperseg chosen arbitrary based on 126 samples RF signal, experiment to get best results
-    nperseg = int(np.floor(x.size/num_subsegs))
-    cross = np.zeros(nperseg, dtype='complex128')
-    max_ind = int(nperseg * np.floor(x.size / nperseg))
-    for ind in range(0, max_ind, nperseg):
-        xp = x[ind: ind + nperseg]
-        yp = y[ind: ind + nperseg]
-        xp = xp - np.mean(xp)
-        yp = yp - np.mean(xp)
-        # Do FFT
-        cfx = np.fft.fft(xp)
-        cfy = np.fft.fft(yp)
-        # Get cross spectrum
-        cross += cfx.conj()*cfy
-    # end for
+    nperseg = int(np.floor(x.shape[-1]/num_subsegs))
+    max_ind = int(nperseg * np.floor(x.shape[-1] / nperseg))
+    xp = x[..., :max_ind].reshape(x.shape[:-1] + (-1, nperseg))
+    yp = y[..., :max_ind].reshape(y.shape[:-1] + (-1, nperseg))
+    xp = xp - np.mean(xp, axis=-1, keepdims=True)
+    yp = yp - np.mean(xp, axis=-1, keepdims=True)
+    # Do FFT on all sub-segments
+    cfx = np.fft.fft(xp, axis=-1)
+    cfy = np.fft.fft(yp, axis=-1)
+    # Get cross spectrum
+    cross = np.sum(cfx.conj()*cfy, axis=-2)
     freq = np.fft.fftfreq(nperseg)
     return cross, freq
 
@@ -64,34 +62,62 @@ def _coh(y, y2):
                       out=np.zeros_like(np.abs(p12)**2), where=p11.real != 0)
     coh = np.divide(part1, p22.real, out=np.zeros_like(part1), where=p22.real != 0)
 
-    return freq[freq > 0], coh[freq > 0]
+    return freq[freq > 0], coh[..., freq > 0]
+
+
+def rms_distance_matrix(swipe, dtype=np.float64):
+    """Pairwise RMS distances between waveforms. NaN samples are ignored, so that the distance
+    between two waveforms is computed over samples where both are defined.
+
+    :param swipe: Numpy array of RF rowwise
+    :type swipe: numpy.array
+    :param dtype: Floating point type used in the computation. np.float32 halves memory usage.
+    :type dtype: numpy.dtype
+    :return: Symmetric matrix of RMS distances; NaN for pairs without common samples.
+    :rtype: numpy.array
+    """
+    data = np.asarray(swipe, dtype=dtype)
+    valid = ~np.isnan(data)
+    data = np.where(valid, data, 0)
+    valid = valid.astype(dtype)
+    data_sq = np.square(data)
+
+    # sum((x_i - x_j)^2) over samples valid in both rows, as matrix products
+    count = np.matmul(valid, valid.T)
+    sum_sq = np.matmul(data_sq, valid.T)
+    sum_sq += sum_sq.T
+    sum_sq -= 2 * np.matmul(data, data.T)
+    np.maximum(sum_sq, 0, out=sum_sq)
+
+    prior_settings = np.seterr(divide='ignore', invalid='ignore')
+    distance = np.sqrt(sum_sq / count)
+    np.seterr(**prior_settings)
+    np.fill_diagonal(distance, 0)
+    distance[count == 0] = np.nan
+
+    return distance
 
 
-def rf_group_by_similarity(swipe, similarity_eps):
+def rf_group_by_similarity(swipe, similarity_eps, dtype=np.float64):
     """Cluster waveforms by similarity
 
     :param swipe: Numpy array of RF rowwise
     :type swipe: numpy.array
     :param similarity_eps: Tolerance on similarity between traced to be considered in the same group.
     :type similarity_eps: float
+    :param dtype: Floating point type used in computing distances between waveforms
+    :type dtype: numpy.dtype
     :return: Index of the group for each trace. -1 if no group is found for a given trace.
     :rtype: numpy.array
     """
 
-    def _compare_pairs_rmsdist(data):
-        rms_dist = np.sqrt(np.nanmean(np.square(data[0] - data[1])))
-        return rms_dist
-    # end func
+    distance = rms_distance_matrix(swipe, dtype=dtype)
 
-    distance = list(map(_compare_pairs_rmsdist, itertools.combinations(swipe, 2)))
-    index = list((i, j) for ((i, _), (j, _)) in itertools.combinations(enumerate(swipe), 2))
-
-    # First check that distance between points
-    index = np.array(index)
-    distance = np.array(distance)
-    matrix = np.zeros((np.amax(index) + 1, 1 + np.amax(index))) + np.amax(distance)
-
-    matrix[index[:, 0], index[:, 1]] = distance[:]
+    # Distances between pairs (i, j), i < j, fill the upper triangle; remaining elements are set to the
+    # maximum distance.
+    upper = np.triu_indices(distance.shape[0], k=1)
+    matrix = np.zeros(distance.shape) + np.amax(distance[upper])
+    matrix[upper] = distance[upper]
     clustering = DBSCAN(eps=similarity_eps, min_samples=5, metric='precomputed', n_jobs=-3).fit_predict(matrix)
 
     return clustering
@@ -120,14 +146,10 @@ def compute_max_coherence(orig_stream, f1, f2):
     median = np.median(data, axis=0)
     assert len(median) == data.shape[1]
 
-    max_coh = []
-    # TODO: Vectorize this loop
-    for i in range(data.shape[0]):
-        f, c = _coh(median, data[i, :])
-        max_coh.append(np.amax(c[(f >= f1) & (f <= f2)]))
-    # end for
+    f, c = _coh(median, data)
+    max_coh = np.amax(c[:, (f >= f1) & (f <= f2)], axis=1)
 
-    return np.array(max_coh)
+    return max_coh
 
 
 # def knive(swipe, k_level1, sn_level2):
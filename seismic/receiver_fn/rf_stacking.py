@@ -29,10 +29,142 @@ DEFAULT_WEIGHTS = np.array([0.5, 0.4, 0.1])
 DEFAULT_SED_H_RANGE = tuple(np.linspace(0.01, 6, 21))
 DEFAULT_SED_k_RANGE = tuple(np.linspace(1.0, 5.0, 21))
 
+# upper limit on the number of grid-values evaluated at once, across traces, in H-k stacking
+HK_BATCH_SIZE = 2 ** 18
+
+def _sample_traces(data, npts, t0, delta, times, fill_value=0.):
+    """Linearly interpolates uniformly sampled traces at given times, through direct index arithmetic.
+    Results match those of scipy.interpolate.interp1d(trace_times, trace_data, bounds_error=False,
+    fill_value=fill_value) for each trace.
+
+    :param data: Trace samples, zero-padded to at least one sample beyond the longest trace
+    :type data: numpy.array [2D] (ntraces x nsamples)
+    :param npts: Number of samples in each trace
+    :type npts: numpy.array [1D]
+    :param t0: Time of first sample of each trace
+    :type t0: numpy.array [1D]
+    :param delta: Sampling interval of each trace
+    :type delta: numpy.array [1D]
+    :param times: Times at which to sample each trace, with traces along the first axis
+    :type times: numpy.array [ND]
+    :param fill_value: Value for times outside the time-range of each trace, defaults to 0
+    :type fill_value: float, optional
+    :return: Sampled values of the same shape as times
+    :rtype: numpy.array [ND]
+    """
+    ntrc, nsamp = data.shape
+    shape = (ntrc,) + (1,) * (times.ndim - 1)
+
+    x = times - np.reshape(t0, shape)
+    x /= np.reshape(delta, shape)
+    outside = (x < 0) | (x > np.reshape(npts - 1, shape))
+
+    idx = np.floor(x)
+    np.clip(idx, 0, nsamp - 2, out=idx)
+    x -= idx
+    idx = idx.astype(np.intp)
+    idx += np.reshape(np.arange(ntrc) * nsamp, shape)
+
+    flat = data.ravel()
+    lo = flat[idx]
+    result = flat[idx + 1]
+    result -= lo
+    result *= x
+    result += lo
+    result[outside] = fill_value
+
+    return result
+# end func
+
+def _nth_root(a, root_order):
+    """Computes sign(a) * |a|^(1/root_order) in place
+
+    :param a: Input array
+    :type a: numpy.array
+    :param root_order: Root order
+    :type root_order: int
+    """
+    if(root_order == 3):
+        np.cbrt(a, out=a)
+    else:
+        sign = a.copy()
+        np.fabs(a, out=a)
+        if(root_order == 2): np.sqrt(a, out=a)
+        else: np.power(a, 1. / root_order, out=a)
+        np.copysign(a, sign, out=a)
+    # end if
+# end func
+
+def _trace_arrays(cha_data):
+    """Gathers uniformly sampled RF traces into arrays for vectorised evaluation
+
+    :param cha_data: List or iterable of RF traces
+    :type cha_data: Iterable(rf.RFTrace)
+    :return: zero-padded trace samples [2D], number of samples [1D], time of first sample relative to onset [1D], \
+        sampling intervals [1D]
+    :rtype: numpy.array [2D], numpy.array [1D], numpy.array [1D], numpy.array [1D]
+    """
+    npts = np.array([trc.stats.npts for trc in cha_data], dtype=int)
+    t0 = np.array([trc.stats.starttime - trc.stats.onset for trc in cha_data], dtype=float)
+    delta = np.array([trc.stats.delta for trc in cha_data], dtype=float)
+
+    data = np.zeros((len(npts), np.max(npts) + 1))
+    for i, trc in enumerate(cha_data): data[i, :npts[i]] = trc.data
+
+    return data, npts, t0, delta
+# end func
+
+def _phase_time_offsets(trc):
+    """Offsets applied to times of the Ps, PpPs and PpSs+PsPs phases, e.g. by sediment corrections
+
+    :param trc: RF trace
+    :type trc: rf.RFTrace
+    :return: offsets for the three phases
+    :rtype: list
+    """
+    offsets = [0., 0., 0.]
+    for i, key in enumerate(['t1_offset', 't2_offset', 't3_offset']):
+        if key not in trc.stats: break
+        offsets[i] = trc.stats[key]
+    # end for
+
+    return offsets
+# end func
+
+def hk_moveout_table(slowness, inclination, k_range):
+    """Precomputes moveout factors for H-k stacking, for each unique pair of slowness and inclination.
+    Times of the Ps, PpPs and PpSs+PsPs phases, relative to P, are given by h * factor(k).
+
+    :param slowness: Slowness of each trace (s/deg)
+    :type slowness: numpy.array [1D]
+    :param inclination: Inclination of each trace (deg)
+    :type inclination: numpy.array [1D]
+    :param k_range: Range of k values
+    :type k_range: numpy.array [1D]
+    :return: moveout factors for each unique pair [3D] (npairs x 3 x len(k_range)), index of pair for each \
+        trace [1D]
+    :rtype: numpy.array [3D], numpy.array [1D]
+    """
+    pairs, inverse = np.unique(np.column_stack((slowness, inclination)), axis=0, return_inverse=True)
+
+    p = pairs[:, 0:1] / DEG2KM
+    Vp_inv = p / np.sin(np.deg2rad(pairs[:, 1:2]))
+    Vs_inv = k_range[None, :] * Vp_inv
+
+    term1 = np.sqrt(Vs_inv ** 2 - p ** 2)
+    term2 = np.sqrt(Vp_inv ** 2 - p ** 2)
+
+    return np.stack((term1 - term2, term1 + term2, 2 * term1), axis=1), np.reshape(inverse, -1)
+# end func
+
 def compute_hk_stack(cha_data, h_range=None, k_range=None,
                      weights=DEFAULT_WEIGHTS, root_order=1):
     """Compute H-k stacking array on a dataset of receiver functions.
 
+    Phase times are computed from a table of moveout factors, precomputed for each unique pair of slowness
+    and inclination, and traces are evaluated in batches through index arithmetic on uniformly sampled
+    trace arrays.
+
     :param cha_data: List or iterable of RF traces to use for H-k stacking.
     :type cha_data: Iterable(rf.RFTrace)
     :param h_range: Range of h values (Moho depth) values to cover, defaults to np.linspace(20.0, 70.0, 251)
@@ -55,57 +187,46 @@ def compute_hk_stack(cha_data, h_range=None, k_range=None,
     if k_range is None:
         k_range = DEFAULT_k_RANGE
     # end if
+    h_range = np.asarray(h_range, dtype=float)
+    k_range = np.asarray(k_range, dtype=float)
 
     # Pre-compute grid quantities
     k_grid, h_grid = np.meshgrid(k_range, h_range)
 
-    tphase_amps = []
-    for itrc, trc in enumerate(cha_data):
-        lead_time = trc.stats.onset - trc.stats.starttime
-        p = trc.stats.slowness / DEG2KM
-        incl_deg = trc.stats.inclination
-        incl_rad = np.deg2rad(incl_deg)
-        Vp_inv = p / np.sin(incl_rad)
-        Vs_inv = k_grid * Vp_inv
-
-        term1 = np.sqrt(Vs_inv ** 2 - p ** 2)
-        term2 = np.sqrt(Vp_inv ** 2 - p ** 2)
-
-        t1 = h_grid * (term1 - term2)
-        t2 = h_grid * (term1 + term2)
-        t3 = h_grid * 2 * term1
-
-        try:
-            t1 += trc.stats.t1_offset
-            t2 += trc.stats.t2_offset
-            t3 += trc.stats.t3_offset
-        except:
-            pass
-        # end try
-
-        times = trc.times() - lead_time
-        times_min = np.min(times)
-        times_max = np.max(times)
-        if(np.min(t1) < times_min or \
-           np.max(t1) > times_max or \
-           np.min(t2) < times_min or \
-           np.max(t2) > times_max or \
-           np.min(t3) < times_min or \
-           np.max(t3) > times_max):
-
-            nsl = '.'.join([trc.stats.network, trc.stats.station, trc.stats.location])
-            log.warning('\nCorrected times for a trace in {} fall outside the available time-range'.format(nsl))
-        # end if
-
-        tio = interp1d(times, trc.data, fill_value=0, bounds_error=False)
-
-        a, b, c = tio(t1), tio(t2), -tio(t3)
-        tphase_amps.append([np.sign(a) * np.power(np.fabs(a), 1. / root_order),
-                            np.sign(b) * np.power(np.fabs(b), 1. / root_order),
-                            np.sign(c) * np.power(np.fabs(c), 1. / root_order)])
+    cha_data = list(cha_data)
+    data, npts, t0, delta = _trace_arrays(cha_data)
+    offsets = np.array([_phase_time_offsets(trc) for trc in cha_data])
+    table, table_idx = hk_moveout_table([trc.stats.slowness for trc in cha_data],
+                                        [trc.stats.inclination for trc in cha_data], k_range)
+
+    # Check ranges of phase times, which are linear in h, against time-ranges of traces
+    h_ext = np.array([np.min(h_range), np.max(h_range)])
+    t_ext = h_ext[None, None, :, None] * table[table_idx][:, :, None, :] + offsets[:, :, None, None]
+    out_of_range = (np.min(t_ext, axis=(1, 2, 3)) < t0) | \
+                   (np.max(t_ext, axis=(1, 2, 3)) > t0 + (npts - 1) * delta)
+    for itrc in np.flatnonzero(out_of_range):
+        trc = cha_data[itrc]
+        nsl = '.'.join([trc.stats.network, trc.stats.station, trc.stats.location])
+        log.warning('\nCorrected times for a trace in {} fall outside the available time-range'.format(nsl))
+    # end for
+
+    # Amplitudes of the PpSs + PsPs phase are negated
+    phase_weights = np.array(weights, dtype=float) * np.array([1, 1, -1])
+
+    hk_stack = np.zeros(h_grid.shape)
+    batch_size = max(1, HK_BATCH_SIZE // h_grid.size)
+    for b in np.arange(0, len(cha_data), batch_size):
+        batch = slice(b, b + batch_size)
+        for iphase in np.arange(3):
+            times = h_range[None, :, None] * table[table_idx[batch], iphase][:, None, :]
+            times += offsets[batch, iphase][:, None, None]
+
+            amps = _sample_traces(data[batch], npts[batch], t0[batch], delta[batch], times)
+            if(root_order != 1): _nth_root(amps, root_order)
+
+            hk_stack += phase_weights[iphase] * np.sum(amps, axis=0)
+        # end for
     # end for
-    tphase_amps = np.array(tphase_amps)
-    hk_stack = np.sum(np.dot(np.moveaxis(tphase_amps, 1, -1), weights), axis=0)
     hk_stack = np.sign(hk_stack) * np.power(np.fabs(hk_stack), root_order)
 
     return k_grid, h_grid, hk_stack
@@ -150,46 +271,38 @@ def compute_sediment_hk_stack(cha_data, H_c, k_c, h_range=None, k_range=None, ro
     vfunc = interp1d(d, v)
 
     # Pre-compute grid quantities
+    h_range = np.asarray(h_range, dtype=float)
+    k_range = np.asarray(k_range, dtype=float)
     k_grid, h_grid = np.meshgrid(k_range, h_range)
 
-    tphase_amps = []
-    for itrc, trc in enumerate(cha_data):
-        lead_time = trc.stats.onset - trc.stats.starttime
-        p = trc.stats.slowness / DEG2KM
-        incl_deg = trc.stats.inclination
-        incl_rad = np.deg2rad(incl_deg)
-        Vp_inv = p / np.sin(incl_rad)
-
-        t4 = np.zeros(h_grid.shape)
-        t2 = np.zeros(h_grid.shape)
-        t3 = np.zeros(h_grid.shape)
-
-        for i in np.arange(h_grid.shape[0]):
-            interval1 = np.linspace(-h_grid[i, 0], 0, 50)
-            interval2 = np.linspace(-(h_grid[i, 0] + H_c), -h_grid[i, 0], 50)
-            v_interval1 = vfunc(interval1)
-            v_interval2 = vfunc(interval2)
-
-            for j in np.arange(h_grid.shape[1]):
-                A = simpson(np.sqrt(np.power(v_interval1 / k_grid[i, j], -2.) - p ** 2), interval1)
-                B = simpson(np.sqrt(np.power(v_interval1, -2.) - p ** 2), interval1)
-                C = simpson(np.sqrt(np.power(v_interval2 / k_c, -2.) - p ** 2), interval2)
-                D = simpson(np.sqrt(np.power(v_interval2, -2.) - p ** 2), interval2)
-
-                t4[i, j] = A - B
-                t2[i, j] = A + B + C + D
-                t3[i, j] = 2 * A + 2 * C
-            # end for
-        # end for
-
-        tio = interp1d(trc.times() - lead_time, trc.data)
-
-        a, b, c = tio(t4), tio(t2), -tio(t3)
-        tphase_amps.append([np.sign(a) * np.power(np.fabs(a), 1. / root_order),
-                            np.sign(b) * np.power(np.fabs(b), 1. / root_order),
-                            np.sign(c) * np.power(np.fabs(c), 1. / root_order)])
+    interval1 = np.linspace(-h_range, 0, 50, axis=-1)
+    interval2 = np.linspace(-(h_range + H_c), -h_range, 50, axis=-1)
+    v_interval1 = vfunc(interval1)
+    v_interval2 = vfunc(interval2)
+
+    # Phase times are computed once for each unique slowness
+    cha_data = list(cha_data)
+    slowness, slowness_idx = np.unique([trc.stats.slowness for trc in cha_data], return_inverse=True)
+    phase_times = []
+    for p in slowness / DEG2KM:
+        A = simpson(np.sqrt(np.power(v_interval1[:, None, :] / k_range[None, :, None], -2.) - p ** 2),
+                    np.broadcast_to(interval1[:, None, :], (len(h_range), len(k_range), interval1.shape[-1])))
+        B = simpson(np.sqrt(np.power(v_interval1, -2.) - p ** 2), interval1)[:, None]
+        C = simpson(np.sqrt(np.power(v_interval2 / k_c, -2.) - p ** 2), interval2)[:, None]
+        D = simpson(np.sqrt(np.power(v_interval2, -2.) - p ** 2), interval2)[:, None]
+
+        phase_times.append([A - B, A + B + C + D, 2 * A + 2 * C])
     # end for
-    tphase_amps = np.array(tphase_amps)
+    phase_times = np.array(phase_times)[np.reshape(slowness_idx, -1)]
+
+    data, npts, t0, delta = _trace_arrays(cha_data)
+    if(np.any(np.min(phase_times, axis=(1, 2, 3)) < t0) or
+       np.any(np.max(phase_times, axis=(1, 2, 3)) > t0 + (npts - 1) * delta)):
+        raise ValueError('Phase times for a trace fall outside the available time-range')
+    # end if
+    tphase_amps = _sample_traces(data, npts, t0, delta, phase_times)
+    tphase_amps[:, 2] *= -1
+    _nth_root(tphase_amps, root_order)
 
     bounds = Bounds(np.zeros(3) + 0.01, np.array([0.3, 1, 1]))
     constraints = [{'type': 'ineq', 'fun': lambda x: x},
@@ -16,6 +16,7 @@ import h5py
 
 from seismic.stream_processing import assert_homogenous_stream
 from seismic.receiver_fn.rf_network_dict import NetworkRFDict
+from seismic.receiver_fn import rf_columnar
 
 # pylint: disable=invalid-name, logging-format-interpolation
 
@@ -34,6 +35,13 @@ def get_hdf_keys(h5fn):
         raise IOError('Invalid file/path {}..'%(h5fn))
     # end try
 
+    if(fh.attrs.get('file_format', None) == rf_columnar.FILE_FORMAT):
+        result = list(fh[rf_columnar.ROOT].keys()) if rf_columnar.ROOT in fh else []
+        del fh
+
+        return result
+    # end if
+
     if('waveforms' not in fh.keys()):
         raise IOError('Invalid file/path {}. "waveforms" group not found..' % (h5fn))
     # end if
@@ -102,7 +110,10 @@ def remove_group(hdf_fn, net_sta_loc, logger=None):
         if(os.path.exists(hdf_fn)):
             hdf_keys = get_hdf_keys(hdf_fn)
 
-            if(net_sta_loc in hdf_keys):
+            if(net_sta_loc in hdf_keys and rf_columnar.is_rf_columnar(hdf_fn)):
+                rf_columnar.remove_station(hdf_fn, net_sta_loc)
+                if(logger): logger.info('Removing group {}'.format(net_sta_loc))
+            elif(net_sta_loc in hdf_keys):
                 del_key = 'waveforms/%s' % net_sta_loc
 
                 with h5py.File(hdf_fn, "a") as fh:
@@ -181,26 +192,52 @@ def read_h5_rf(src_file, network=None, station=None, loc='', root='/waveforms'):
     :type network: str, optional
     :param station: Specific station to load, defaults to None
     :type station: str, optional
-    :param root: Root path in hdf5 file where to start looking for data, defaults to '/waveforms'
+    :param root: Root path in hdf5 file where to start looking for data, defaults to '/waveforms'. \
+        Ignored for files in the columnar layout (see rf_columnar.py)
     :type root: str, optional
     :return: All the loaded data in a rf.RFStream container.
     :rtype: rf.RFStream
     """
     logger = logging.getLogger(__name__)
+    station_key = None
     if (network is None and station is not None) or (network is not None and station is None):
         logger.warning("network and station should both be specified - IGNORING incomplete specification")
         group = root
     elif network and station:
-        group = root + '/{}.{}.{}'.format(network.upper(), station.upper(), loc.upper())
+        station_key = '{}.{}.{}'.format(network.upper(), station.upper(), loc.upper())
+        group = root + '/' + station_key
     else:
         group = root
     # end if
 
+    if rf_columnar.is_rf_columnar(src_file):
+        return rf_columnar.read_rf_columnar(src_file, station_key=station_key)
+    # end if
+
     rf_data = rf.read_rf(src_file, format='h5', group=group)
     return rf_data
 # end func
 
 
+def read_hdf_key(src_file, hdf_key):
+    """Loads RF traces for an hdf_key (NET.STA.LOC), as returned by get_hdf_keys, from a file generated
+    by rf library or in the columnar layout (see rf_columnar.py).
+
+    :param src_file: File from which to load data
+    :type src_file: str or Path
+    :param hdf_key: Station key of the form NET.STA.LOC
+    :type hdf_key: str
+    :return: Loaded data in a rf.RFStream container.
+    :rtype: rf.RFStream
+    """
+    if rf_columnar.is_rf_columnar(src_file):
+        return rf_columnar.read_rf_columnar(src_file, station_key=hdf_key)
+    # end if
+
+    return rf.read_rf(src_file, format='h5', group='waveforms/%s' % hdf_key)
+# end func
+
+
 def rf_to_dict(rf_data):
     """Convert RF data loaded from function read_h5_rf() into a dict format for easier addressing
     of selected station and channel RF traces.
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+"""
+Description:
+    Cache of inverted instrument-response spectra for instrument response correction.
+
+    obspy.Trace.remove_response evaluates all response stages and inverts the resulting spectrum,
+    applying a water-level, every time it is called. In workflows that correct a large number of
+    traces of identical length from the same channel (e.g. windows in the ambient-noise
+    correlator or day-traces in asdf_preprocess.py), the same spectrum is recomputed over and over.
+    The cache here holds inverted, water-levelled spectra keyed by channel-epoch, a fingerprint of
+    the response contents, number of samples, sampling rate, output units and water-level, so that the correction reduces to a single
+    multiplication in the frequency domain.
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from obspy.core.inventory import PolynomialResponseStage, PolesZerosResponseStage, \
+    CoefficientsTypeResponseStage, FIRResponseStage, ResponseListResponseStage
+from obspy.signal.invsim import cosine_taper, invert_spectrum
+from obspy.signal.util import _npts2nfft
+
+
+def get_channel_epoch(inventory, seed_id, datetime):
+    """
+    Finds the channel-epoch in an inventory that contains the response for a given channel and time.
+    Matching follows obspy.Inventory.get_response, i.e. the first match is returned.
+
+    :param inventory: obspy Inventory
+    :param seed_id: NET.STA.LOC.CHA
+    :param datetime: UTCDateTime
+    :return: tuple of (channel start-date, channel end-date, Response)
+    """
+    net, sta, loc, cha = seed_id.split('.')
+    for n in inventory.networks:
+        if n.code != net: continue
+        for s in n.stations:
+            if s.code != sta: continue
+            for c in s.channels:
+                if c.code != cha or c.location_code != loc: continue
+                if c.start_date is not None and c.start_date > datetime: continue
+                if c.end_date is not None and c.end_date < datetime: continue
+                if c.response is None: continue
+
+                return c.start_date, c.end_date, c.response
+            # end for
+        # end for
+    # end for
+
+    raise Exception('No matching response information found.')
+# end func
+
+
+def is_polynomial_response(response):
+    """
+    :param response: obspy Response
+    :return: True if response is a polynomial response, which obspy applies in the time domain
+    """
+    return (not response.response_stages and response.instrument_polynomial) or \
+           (len(response.response_stages) == 1 and
+            isinstance(response.response_stages[0], PolynomialResponseStage))
+# end func
+
+
+def get_response_fingerprint(response):
+    """
+    Computes a digest of the contents of a response, i.e. stage gains, units, decimation and the
+    stage-specific transfer-function parameters (poles/zeros, coefficients, FIR coefficients and
+    response-list elements), so that responses with identical contents share a fingerprint
+
+    :param response: obspy Response
+    :return: hex digest
+    """
+    def floats(values):
+        return tuple(float(v) for v in values) if values is not None else None
+    # end func
+
+    def complexes(values):
+        return tuple(complex(v) for v in values) if values is not None else None
+    # end func
+
+    items = []
+    sensitivity = response.instrument_sensitivity
+    if sensitivity is not None:
+        items.append((sensitivity.value, sensitivity.frequency,
+                      sensitivity.input_units, sensitivity.output_units))
+    # end if
+
+    for stage in response.response_stages:
+        items.append((type(stage).__name__, stage.stage_sequence_number, stage.stage_gain,
+                      stage.stage_gain_frequency, stage.input_units, stage.output_units,
+                      stage.decimation_input_sample_rate, stage.decimation_factor,
+                      stage.decimation_offset, stage.decimation_delay,
+                      stage.decimation_correction))
+
+        if isinstance(stage, PolesZerosResponseStage):
+            items.append((stage.pz_transfer_function_type, stage.normalization_factor,
+                          stage.normalization_frequency, complexes(stage.poles),
+                          complexes(stage.zeros)))
+        elif isinstance(stage, CoefficientsTypeResponseStage):
+            items.append((stage.cf_transfer_function_type, floats(stage.numerator),
+                          floats(stage.denominator)))
+        elif isinstance(stage, FIRResponseStage):
+            items.append((stage.symmetry, floats(stage.coefficients)))
+        elif isinstance(stage, ResponseListResponseStage):
+            items.append(tuple((e.frequency, e.amplitude, e.phase)
+                               for e in stage.response_list_elements))
+        elif isinstance(stage, PolynomialResponseStage):
+            items.append((stage.approximation_type, floats(stage.coefficients)))
+        # end if
+    # end for
+
+    return hashlib.sha1(repr(items).encode()).hexdigest()
+# end func
+
+
+def compute_response_spectrum(response, sampling_rate, npts, output='VEL', water_level=50.):
+    """
+    Computes the inverted, water-levelled frequency-domain transfer function of an instrument
+    response, as applied by obspy.Trace.remove_response to traces of npts samples
+
+    :param response: obspy Response
+    :param sampling_rate: sampling rate
+    :param npts: number of samples in trace
+    :param output: output units, one of 'DISP', 'VEL' or 'ACC'
+    :param water_level: water-level (dB); no water-level is applied if None
+    :return: complex spectrum of length _npts2nfft(npts) // 2 + 1
+    """
+    nfft = _npts2nfft(npts)
+    freq_response, _ = response.get_evalresp_response(1. / sampling_rate, nfft, output=output.upper())
+
+    if water_level is None:
+        freq_response[0] = 0.0
+        freq_response[1:] = 1.0 / freq_response[1:]
+    else:
+        invert_spectrum(freq_response, water_level)
+    # end if
+
+    return freq_response
+# end func
+
+
+def apply_response_spectrum(data, spectrum):
+    """
+    Applies an inverted response spectrum to data, along the last axis, with the same time-domain
+    preprocessing (demeaning and 5% cosine taper) as in obspy.Trace.remove_response
+
+    :param data: 1D array of trace samples or 2D array of traces (ntraces x nsamples)
+    :param spectrum: inverted response spectrum, as returned by compute_response_spectrum
+    :return: corrected data (float64)
+    """
+    data = np.array(data, dtype=np.float64)
+    npts = data.shape[-1]
+
+    data -= np.mean(data, axis=-1, keepdims=True)
+    data *= cosine_taper(npts, 0.05, sactaper=True, halfcosine=False)
+
+    spec = np.fft.rfft(data, n=_npts2nfft(npts), axis=-1)
+    spec *= spectrum
+    spec[..., -1] = np.abs(spec[..., -1]) + 0.0j
+
+    return np.fft.irfft(spec, axis=-1)[..., :npts]
+# end func
+
+
+class ResponseSpectrumCache:
+    """
+    Bounded LRU cache of inverted, water-levelled instrument response spectra, keyed by
+    (channel-epoch, response fingerprint, npts, sampling rate, output units, water-level).
+    Channel-epochs are identified by seed-id along with start- and end-dates of the channel in the
+    inventory; the fingerprint of the response contents distinguishes channel-epochs that differ
+    only in their response across inventories, since the cache is shared process-wide.
+    """
+    def __init__(self, max_size_mb=1024):
+        """
+        :param max_size_mb: maximum size (MB) of cached spectra; least recently used spectra are \
+                            evicted once exceeded
+        """
+        self.max_size_mb = max_size_mb
+        self._cache = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    # end func
+
+    def __len__(self):
+        return len(self._cache)
+    # end func
+
+    def get(self, inventory, seed_id, starttime, sampling_rate, npts, output='VEL', water_level=50.):
+        """
+        Returns the inverted response spectrum for a trace, computing it on a cache-miss
+
+        :param inventory: obspy Inventory
+        :param seed_id: NET.STA.LOC.CHA
+        :param starttime: start-time (UTCDateTime) of trace
+        :param sampling_rate: sampling rate
+        :param npts: number of samples in trace
+        :param output: output units, one of 'DISP', 'VEL' or 'ACC'
+        :param water_level: water-level (dB)
+        :return: tuple of (Response, spectrum); spectrum is None for polynomial responses
+        """
+        start_date, end_date, response = get_channel_epoch(inventory, seed_id, starttime)
+        if is_polynomial_response(response): return response, None
+
+        key = (seed_id, start_date.ns if start_date else None, end_date.ns if end_date else None,
+               get_response_fingerprint(response), float(sampling_rate), int(npts), output.upper(),
+               water_level)
+        spectrum = self._cache.get(key)
+        if spectrum is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+        else:
+            self.misses += 1
+            spectrum = compute_response_spectrum(response, sampling_rate, npts, output=output,
+                                                 water_level=water_level)
+            self._cache[key] = spectrum
+            self.nbytes += spectrum.nbytes
+
+            while self.nbytes > self.max_size_mb * 1024 * 1024 and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+            # end while
+        # end if
+
+        return response, spectrum
+    # end func
+
+    def remove_response(self, tr, inventory, output='VEL', water_level=50.):
+        """
+        Removes instrument response from a trace, in place; equivalent to
+        obspy.Trace.remove_response(inventory, output=output, water_level=water_level)
+
+        :param tr: obspy Trace
+        :param inventory: obspy Inventory
+        :param output: output units, one of 'DISP', 'VEL' or 'ACC'
+        :param water_level: water-level (dB)
+        :return: tr
+        """
+        _, spectrum = self.get(inventory, tr.id, tr.stats.starttime, tr.stats.sampling_rate,
+                               tr.stats.npts, output=output, water_level=water_level)
+        if spectrum is None:
+            tr.remove_response(inventory=inventory, output=output.upper(), water_level=water_level)
+        else:
+            tr.data = apply_response_spectrum(tr.data, spectrum)
+        # end if
+
+        return tr
+    # end func
+
+    def stats(self):
+        """
+        :return: dict of cache statistics
+        """
+        return {'entries': len(self._cache), 'size_mb': self.nbytes / 1024. / 1024.,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+    # end func
+
+    def clear(self):
+        self._cache.clear()
+        self.nbytes = 0
+    # end func
+# end class
+
+
+# process-wide cache shared by instrument response corrections
+response_spectrum_cache = ResponseSpectrumCache()
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+"""
+Description:
+    Lookup tables of TauP travel-time predictions.
+
+    Calls to obspy.taup.TauPyModel.get_travel_times cost milliseconds each, which dominates
+    workflows that predict arrivals for every event-station pair, e.g. the pick-harvester.
+    First-arrival times, ray parameters and incidence angles of each phase are tabulated here
+    on a (distance, source-depth) grid, so that predictions for whole arrays of event-station
+    pairs reduce to bilinear interpolation. Cells whose corners mix arriving and non-arriving
+    phases, i.e. cells straddling the edge of a shadow zone, are always computed exactly through
+    TauP. Elsewhere, the interpolation error is checked against TauP at the centre of each cell,
+    which is a heuristic: it catches most triplications, but errors away from the centre can
+    exceed the tolerances. Queries falling in cells that fail either check, or outside the grid,
+    are computed exactly through TauP.
+
+    Tables are cached on disk, keyed by model, phase list, grid and tolerances.
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     17/10/26   agent    Cells at the edges of shadow zones are computed through TauP
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import os
+import json
+import hashlib
+from collections import namedtuple
+
+import numpy as np
+import click
+from obspy.geodetics import locations2degrees
+from obspy.taup import TauPyModel
+from obspy.taup.taup_geo import calc_dist
+from obspy.taup.taup_time import TauPTime
+from obspy.taup.utils import parse_phase_list
+
+TABLE_VERSION = 2
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.hiperseis', 'travel_time_tables')
+# finer sampling at regional distances, where travel-time curves have triplications
+DEFAULT_DISTANCES = np.concatenate((np.arange(0, 30, 0.5), np.arange(30, 180.1, 1.)))
+DEFAULT_DEPTHS = np.concatenate((np.arange(0, 100, 5.), np.arange(100, 800.1, 25.)))
+FIELDS = ('time', 'ray_param_sec_degree', 'incident_angle')
+
+TableArrival = namedtuple('TableArrival', ('name',) + FIELDS)
+
+
+def split_list(lst, npartitions):
+    k, m = divmod(len(lst), npartitions)
+    return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(npartitions)]
+# end func
+
+
+def first_arrivals(taup_model, phase_names, depth, distances):
+    """
+    Computes first arrivals of each phase through TauP for a given source depth
+
+    :param taup_model: obspy.taup.TauPyModel
+    :param phase_names: list of phase names
+    :param depth: source depth (km)
+    :param distances: distances (degrees)
+    :return: array of shape (len(phase_names), len(FIELDS), len(distances)), holding NaNs where
+             a phase does not arrive
+    """
+    index = dict((name, i) for i, name in enumerate(phase_names))
+    result = np.full((len(phase_names), len(FIELDS), len(distances)), np.nan)
+
+    # phases are computed once for the depth-corrected model and reused for all distances
+    tt = TauPTime(taup_model.model, list(phase_names), depth, distances[0], 0.0)
+    tt.run()
+    for j, distance in enumerate(distances):
+        if j > 0: tt.calc_time(distance)
+        for arr in tt.arrivals:
+            i = index.get(arr.name)
+            if i is None or not np.isnan(result[i, 0, j]): continue
+            result[i, :, j] = [getattr(arr, f) for f in FIELDS]
+        # end for
+    # end for
+
+    return result
+# end func
+
+
+class TravelTimeTable:
+    def __init__(self, model='iasp91', phase_list=('P', 'S'), distances=DEFAULT_DISTANCES, depths=DEFAULT_DEPTHS,
+                 cache_dir=DEFAULT_CACHE_DIR, time_tolerance=0.05, ray_param_tolerance=0.1, comm=None):
+        """
+        Loads a travel-time table from the cache, or computes and caches it
+
+        :param model: name of TauP model
+        :param phase_list: list of phase names or phase groups, e.g. 'ttp', as understood by TauP
+        :param distances: increasing distances (degrees) of grid nodes
+        :param depths: increasing source depths (km) of grid nodes
+        :param cache_dir: folder for cached tables; tables are not cached if None
+        :param time_tolerance: maximum interpolation error (s) of travel-times within a grid cell
+        :param ray_param_tolerance: maximum interpolation error (s/degree) of ray parameters within a grid cell
+        :param comm: optional MPI communicator, over which the computation of a table is distributed.
+                     All ranks in comm must construct the table collectively.
+        """
+        self.model = model
+        self.phase_names = list(dict.fromkeys(parse_phase_list(list(phase_list))))
+        self.distances = np.array(distances, dtype=float)
+        self.depths = np.array(depths, dtype=float)
+        self.time_tolerance = time_tolerance
+        self.ray_param_tolerance = ray_param_tolerance
+        self.taup_model = TauPyModel(model=model)
+
+        self._phase_index = dict((name, i) for i, name in enumerate(self.phase_names))
+        self._values = None # (phases, fields, distances, depths)
+        self._valid = None  # (phases, distance-cells, depth-cells)
+
+        self.cache_file = None
+        if cache_dir is not None:
+            self.cache_file = os.path.join(cache_dir, '{}.{}.npz'.format(model, self._key()))
+        # end if
+
+        rank = 0 if comm is None else comm.Get_rank()
+        if not self._load():
+            self._compute(comm)
+            if self.cache_file is not None and rank == 0: self._save()
+        # end if
+        if comm is not None: comm.Barrier()
+    # end func
+
+    def _key(self):
+        params = [TABLE_VERSION, self.model, self.phase_names, self.distances.tolist(), self.depths.tolist(),
+                  self.time_tolerance, self.ray_param_tolerance]
+        return hashlib.sha1(json.dumps(params).encode()).hexdigest()[:16]
+    # end func
+
+    def _load(self):
+        if self.cache_file is None or not os.path.exists(self.cache_file): return False
+
+        with np.load(self.cache_file) as npz:
+            if int(npz['version']) != TABLE_VERSION or list(npz['phase_names']) != self.phase_names or \
+               not np.array_equal(npz['distances'], self.distances) or \
+               not np.array_equal(npz['depths'], self.depths):
+                return False
+            # end if
+            self._values = npz['values']
+            self._valid = npz['valid']
+        # end with
+        return True
+    # end func
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+
+        # write to a temporary file first, so that concurrent readers never see a partial table
+        tmp_file = '{}.{}.tmp.npz'.format(self.cache_file[:-4], os.getpid())
+        np.savez(tmp_file, version=TABLE_VERSION, model=self.model, phase_names=np.array(self.phase_names),
+                 distances=self.distances, depths=self.depths, values=self._values, valid=self._valid)
+        os.replace(tmp_file, self.cache_file)
+    # end func
+
+    def _compute(self, comm=None):
+        mid_distances = (self.distances[:-1] + self.distances[1:]) / 2.
+        mid_depths = (self.depths[:-1] + self.depths[1:]) / 2.
+
+        # tasks: grid nodes at each depth, and cell centres at each mid-depth
+        tasks = [(0, i) for i in range(len(self.depths))] + [(1, i) for i in range(len(mid_depths))]
+        if comm is not None: tasks = split_list(tasks, comm.Get_size())[comm.Get_rank()]
+
+        results = []
+        for kind, i in tasks:
+            if kind == 0:
+                results.append((kind, i, first_arrivals(self.taup_model, self.phase_names,
+                                                        self.depths[i], self.distances)))
+            else:
+                results.append((kind, i, first_arrivals(self.taup_model, self.phase_names,
+                                                        mid_depths[i], mid_distances)))
+            # end if
+        # end for
+
+        if comm is not None: results = [item for items in comm.allgather(results) for item in items]
+
+        nphases = len(self.phase_names)
+        self._values = np.zeros((nphases, len(FIELDS), len(self.distances), len(self.depths)))
+        exact = np.zeros((nphases, len(FIELDS), len(mid_distances), len(mid_depths)))
+        for kind, i, values in results:
+            if kind == 0: self._values[..., i] = values
+            else: exact[..., i] = values
+        # end for
+
+        # cells whose corners mix NaN and finite travel-times straddle the edge of a shadow zone,
+        # where interpolated values are NaN, or extrapolated, over parts of the cell
+        nan = np.isnan(self._values[:, 0])
+        corners = [nan[:, :-1, :-1], nan[:, 1:, :-1], nan[:, :-1, 1:], nan[:, 1:, 1:]]
+        self._valid = np.logical_and.reduce(corners) | ~np.logical_or.reduce(corners)
+
+        # check interpolated values at cell centres against TauP
+        dd, zz = np.meshgrid(mid_distances, mid_depths, indexing='ij')
+        for p in range(nphases):
+            interpolated = self._interpolate(p, dd.flatten(), zz.flatten())[0].reshape((len(FIELDS),) + dd.shape)
+            for f, tol in [(0, self.time_tolerance), (1, self.ray_param_tolerance)]:
+                a, b = interpolated[f], exact[p, f]
+                both_nan = np.isnan(a) & np.isnan(b)
+                with np.errstate(invalid='ignore'):
+                    self._valid[p] &= both_nan | (np.fabs(a - b) <= tol)
+                # end with
+            # end for
+        # end for
+    # end func
+
+    def _interpolate(self, p, distances, depths):
+        """
+        Bilinear interpolation of table values for phase index p
+
+        :return: values of shape (len(FIELDS), len(distances)) and a boolean mask flagging queries
+                 that lie outside the grid or in cells that failed the error check
+        """
+        nd, nz = len(self.distances), len(self.depths)
+        i = np.clip(np.searchsorted(self.distances, distances, side='right') - 1, 0, nd - 2)
+        j = np.clip(np.searchsorted(self.depths, depths, side='right') - 1, 0, nz - 2)
+        wx = (distances - self.distances[i]) / (self.distances[i + 1] - self.distances[i])
+        wz = (depths - self.depths[j]) / (self.depths[j + 1] - self.depths[j])
+
+        v = self._values[p]
+        values = (1 - wx) * (1 - wz) * v[:, i, j] + wx * (1 - wz) * v[:, i + 1, j] + \
+                 (1 - wx) * wz * v[:, i, j + 1] + wx * wz * v[:, i + 1, j + 1]
+
+        outside = (distances < self.distances[0]) | (distances > self.distances[-1]) | \
+                  (depths < self.depths[0]) | (depths > self.depths[-1])
+        inexact = outside
+        if self._valid is not None: inexact = outside | ~self._valid[p, i, j]
+
+        return values, inexact
+    # end func
+
+    def query(self, phase, distance_in_degree, source_depth_in_km):
+        """
+        Predicts first arrivals of a phase for arrays of distances and source depths
+
+        :param phase: phase name
+        :param distance_in_degree: distances (degrees)
+        :param source_depth_in_km: source depths (km); broadcast against distance_in_degree
+        :return: tuple of arrays of travel-times (s), ray parameters (s/degree) and incidence
+                 angles (degrees), holding NaNs where the phase does not arrive
+        """
+        distances, depths = np.broadcast_arrays(np.asarray(distance_in_degree, dtype=float),
+                                                np.asarray(source_depth_in_km, dtype=float))
+        shape = distances.shape
+        distances, depths = distances.flatten(), depths.flatten()
+
+        p = self._phase_index.get(phase)
+        if p is None:
+            values = np.zeros((len(FIELDS), len(distances)))
+            inexact = np.ones(len(distances), dtype=bool)
+        else:
+            values, inexact = self._interpolate(p, distances, depths)
+        # end if
+
+        # compute exact values through TauP where necessary
+        for k in np.where(inexact)[0]:
+            values[:, k] = first_arrivals(self.taup_model, [phase], depths[k], [distances[k]])[0, :, 0]
+        # end for
+
+        return tuple(values[f].reshape(shape) for f in range(len(FIELDS)))
+    # end func
+
+    def query_geo(self, phase, source_depth_in_km, source_latitude_in_deg, source_longitude_in_deg,
+                  receiver_latitude_in_deg, receiver_longitude_in_deg):
+        """
+        Predicts first arrivals of a phase for arrays of source and receiver locations.
+        Distances are computed as in obspy.taup.TauPyModel.get_travel_times_geo.
+
+        :return: see query
+        """
+        args = np.broadcast_arrays(*[np.asarray(x, dtype=float)
+                                     for x in (source_depth_in_km, source_latitude_in_deg, source_longitude_in_deg,
+                                               receiver_latitude_in_deg, receiver_longitude_in_deg)])
+        depths, slat, slon, rlat, rlon = args
+
+        flattening = getattr(self.taup_model, 'planet_flattening', 0.)
+        if flattening == 0:
+            distances = locations2degrees(slat, slon, rlat, rlon)
+        else:
+            distances = np.array([calc_dist(a, b, c, d, self.taup_model.model.radius_of_planet, flattening)
+                                  for a, b, c, d in zip(slat.flat, slon.flat, rlat.flat, rlon.flat)])
+            distances = distances.reshape(depths.shape)
+        # end if
+
+        return self.query(phase, distances, depths)
+    # end func
+
+    def get_travel_times_geo(self, source_depth_in_km, source_latitude_in_deg, source_longitude_in_deg,
+                             receiver_latitude_in_deg, receiver_longitude_in_deg, phase_list=('P',)):
+        """
+        Drop-in replacement for obspy.taup.TauPyModel.get_travel_times_geo, for a single
+        source-receiver pair, returning first arrivals of the given phases sorted by time.
+        Phases not found in the table are computed through TauP.
+
+        :return: list of TableArrival
+        """
+        names = list(dict.fromkeys(parse_phase_list(list(phase_list))))
+        if any(name not in self._phase_index for name in names):
+            return self.taup_model.get_travel_times_geo(source_depth_in_km, source_latitude_in_deg,
+                                                        source_longitude_in_deg, receiver_latitude_in_deg,
+                                                        receiver_longitude_in_deg, phase_list=phase_list)
+        # end if
+
+        arrivals = []
+        for name in names:
+            values = self.query_geo(name, source_depth_in_km, source_latitude_in_deg, source_longitude_in_deg,
+                                    receiver_latitude_in_deg, receiver_longitude_in_deg)
+            if np.isnan(values[0]): continue
+            arrivals.append(TableArrival(name, *[float(v) for v in values]))
+        # end for
+
+        return sorted(arrivals, key=lambda arr: arr.time)
+    # end func
+# end class
+
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--model', default='iasp91', type=str, show_default=True, help='TauP model')
+@click.option('--phase-list', default='P S', type=str, show_default=True,
+              help='A space-separated list of phases or phase groups (e.g. "ttp tts")')
+@click.option('--cache-dir', default=DEFAULT_CACHE_DIR, type=click.Path(file_okay=False), show_default=True,
+              help='Folder for cached tables')
+def process(model, phase_list, cache_dir):
+    """
+    Precomputes a travel-time table with default grid settings, in parallel over MPI ranks.
+    """
+    from mpi4py import MPI
+
+    comm = MPI.COMM_WORLD
+    table = TravelTimeTable(model=model, phase_list=phase_list.split(), cache_dir=cache_dir, comm=comm)
+    if comm.Get_rank() == 0:
+        print('Travel-time table for phases {} cached in {}'.format(table.phase_names, table.cache_file))
+    # end if
+# end func
+
+
+if __name__ == "__main__":
+    process()
+# end if
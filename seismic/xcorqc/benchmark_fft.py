@@ -0,0 +1,116 @@
+#!/bin/env python
+"""
+Description:
+    Micro-benchmark for FFT backends used in cross-correlations. Cross-correlates pairs of random
+    windows, as in xcorr2, and reports the time taken per window-pair for each available backend,
+    alongside that for the legacy approach of complex FFTs of freshly zero-padded arrays.
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import time
+import click
+import numpy as np
+import scipy.fftpack
+from seismic.xcorqc import fft
+
+
+def legacy_xcorr(a, b, fftlen):
+    """
+    Cross-correlates windows a and b as previously done in xcorr2
+    """
+    def zeropad(tr, padlen):
+        padded = np.zeros(padlen)
+        padded[0:tr.shape[0]] = tr
+        return padded
+    # end func
+
+    rf = scipy.fftpack.fftn(zeropad(a, fftlen), shape=[fftlen]) * \
+         scipy.fftpack.fftn(zeropad(fft.ndflip(b), fftlen), shape=[fftlen])
+    return scipy.fftpack.ifftn(rf).real
+# end func
+
+
+def backend_xcorr(a, b, fftlen):
+    """
+    Cross-correlates windows a and b through real FFTs of the active backend, as done in xcorr2
+    """
+    rf = fft.get_rfft_plan(fftlen, 0)(a) * fft.get_rfft_plan(fftlen, 1)(b, reverse=True)
+    return fft.irfft(rf, n=fftlen)
+# end func
+
+
+def run_benchmark(window_seconds=3600, sampling_rate=100, nwindows=10, threads=1, seed=0):
+    """
+    :param window_seconds: length of cross-correlation windows (s)
+    :param sampling_rate: sampling rate (Hz)
+    :param nwindows: number of window-pairs cross-correlated for each backend
+    :param threads: number of threads used by each FFT
+    :param seed: seed for the random number generator
+    :return: dict of (seconds per window-pair, max. absolute deviation from legacy results), keyed by \
+             backend name
+    """
+    npts = int(window_seconds * sampling_rate)
+    xcorlen = int(2 * window_seconds * sampling_rate - 1)
+    fftlen = 2 ** (int(np.log2(xcorlen)) + 1)
+
+    rs = np.random.RandomState(seed)
+    windows = [(rs.standard_normal(npts), rs.standard_normal(npts)) for _ in range(nwindows)]
+
+    def time_xcorr(func):
+        func(*windows[0], fftlen) # warm-up, e.g. for planning
+
+        results = []
+        t = time.perf_counter()
+        for a, b in windows: results.append(func(a, b, fftlen)[:xcorlen])
+        return (time.perf_counter() - t) / nwindows, results
+    # end func
+
+    elapsed, expected = time_xcorr(legacy_xcorr)
+    timings = {'legacy': (elapsed, 0.)}
+
+    name, nthreads = fft.get_backend()
+    for backend in fft.BACKENDS:
+        try:
+            fft.set_backend(backend, threads=threads)
+        except ImportError as e:
+            print(str(e))
+            continue
+        # end try
+
+        elapsed, results = time_xcorr(backend_xcorr)
+        timings[backend] = (elapsed, np.max([np.max(np.fabs(r - e)) for r, e in zip(results, expected)]))
+    # end for
+    fft.set_backend(name, threads=nthreads)
+
+    return timings
+# end func
+
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--window-seconds', default=3600, show_default=True, help="Length of cross-correlation windows (s)")
+@click.option('--sampling-rate', default=100., show_default=True, help="Sampling rate (Hz)")
+@click.option('--nwindows', default=10, show_default=True, help="Number of window-pairs cross-correlated "
+                                                                 "for each backend")
+@click.option('--threads', default=1, show_default=True, help="Number of threads used by each FFT")
+def process(window_seconds, sampling_rate, nwindows, threads):
+    timings = run_benchmark(window_seconds=window_seconds, sampling_rate=sampling_rate,
+                            nwindows=nwindows, threads=threads)
+
+    for name, (elapsed, maxdev) in timings.items():
+        print('%8s: %9.2f ms per window-pair, speed-up: %5.2f, max. abs. deviation: %.2e' %
+              (name, elapsed * 1e3, timings['legacy'][0] / elapsed, maxdev))
+    # end for
+# end func
+
+if (__name__ == '__main__'):
+    process()
+# end if
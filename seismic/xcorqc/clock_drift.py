@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+Description:
+    Vectorised engine for estimating clock corrections from time-series of cross-correlation
+    functions (CCFs), as used by XcorrClockAnalyzer in xcorr_station_clock_analysis.py.
+
+    All CCFs are correlated against the reference correlation function (RCF) through a single batched
+    FFT, Pearson correlation coefficients are computed in matrix form and clustering of corrections
+    is performed on pre-scaled features with a Euclidean metric, which allows sklearn to use a
+    tree-index for neighbourhood queries.
+
+References:
+    Hable, S., Sigloch, K., Barruol, G., Stähler, S. C., & Hadziioannou, C. (2018). Clock errors in land
+    and ocean bottom seismograms: high-accuracy estimates from multiple-component noise cross-correlations.
+    Geophysical Journal International, 214(3), 2014-2034.
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import numpy as np
+import scipy.fft
+from sklearn.cluster import dbscan
+
+SEC_PER_WEEK = 7 * 24 * 3600
+
+
+def correlate_rows(ref, rows):
+    """
+    Correlates a reference function against each row of a 2D array, through a single batched FFT.
+    Results are equivalent to scipy.signal.correlate(ref, row, mode='same') for each row.
+
+    :param ref: 1D array of length N
+    :param rows: 2D array of shape (nrows, N)
+    :return: 2D array of shape (nrows, N)
+    """
+    n = ref.shape[-1]
+    assert rows.shape[-1] == n, 'Reference function and rows must be of the same length'
+
+    fftlen = scipy.fft.next_fast_len(2 * n - 1, real=True)
+    full = scipy.fft.irfft(scipy.fft.rfft(ref, fftlen)[None, :] *
+                           scipy.fft.rfft(rows[:, ::-1], fftlen, axis=-1), fftlen, axis=-1)
+
+    # centre 'same'-sized portion of the full correlation, as in scipy.signal.correlate
+    s = (n - 1) // 2
+    return full[:, s:s + n]
+# end func
+
+
+def pearson_rows(ref, rows):
+    """
+    Computes Pearson correlation coefficients between a reference function and each row of a 2D array,
+    as scipy.stats.pearsonr would for each row; coefficients are NaN for constant rows.
+
+    :param ref: 1D array of length N
+    :param rows: 2D array of shape (nrows, N)
+    :return: 1D array of length nrows
+    """
+    ref = ref - np.mean(ref)
+    rows = rows - np.mean(rows, axis=-1, keepdims=True)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = rows.dot(ref) / np.sqrt(np.sum(rows * rows, axis=-1) * ref.dot(ref))
+    # end with
+
+    return np.clip(r, -1, 1)
+# end func
+
+
+def shift_rows(rows, shifts):
+    """
+    Shifts each row of a 2D array by a given number of samples, as np.roll would, while zeroing
+    samples rolled in from the other end
+
+    :param rows: 2D array of shape (nrows, N)
+    :param shifts: 1D integer array of length nrows
+    :return: 2D array of shifted rows
+    """
+    n = rows.shape[-1]
+    idx = np.arange(n)[None, :] - shifts[:, None]
+    inside = (idx >= 0) & (idx < n)
+
+    return np.where(inside, np.take_along_axis(rows, np.clip(idx, 0, n - 1), axis=-1), 0.)
+# end func
+
+
+def estimate_clock_corrections(ccf, valid, rcf, snr_mask, lag, pcf_cutoff_threshold):
+    """
+    Estimates clock corrections, following Hable et al. (2018), from rows of CCFs. First order corrections
+    are estimated from lags of peaks in correlations of each CCF against the RCF. CCFs, shifted by first order
+    corrections, are then stacked into a corrected RCF. Rows with a Pearson correlation coefficient below
+    the given threshold, between the corrected RCF and the shifted CCF, are rejected; corrections for the
+    remaining rows are estimated from lags of peaks in correlations of each CCF against the corrected RCF.
+
+    :param ccf: 2D array of CCFs (nrows x nlags)
+    :param valid: 1D boolean array; rows that are not valid, e.g. those with no data, are ignored
+    :param rcf: 1D array; reference correlation function or None
+    :param snr_mask: 1D boolean array, marking rows that are stacked into the corrected RCF
+    :param lag: 1D array of lags (s)
+    :param pcf_cutoff_threshold: minimum Pearson correlation coefficient (between 0 and 1)
+    :return: 1: 1D array of clock corrections, with NaNs for rejected rows
+             2: 1D array of the corrected RCF or None if rcf is None
+             3: 2D array of normalized correlations of each CCF against the corrected RCF, with NaNs \
+                for rejected rows
+    """
+    nrows, ncols = ccf.shape
+    raw_correction = np.full(nrows, np.nan)
+    row_rcf_crosscorr = np.full((nrows, ncols), np.nan)
+    if rcf is None: return raw_correction, None, row_rcf_crosscorr
+
+    ids = np.flatnonzero(valid)
+    rows = ccf[ids, :]
+
+    # First order corrections
+    c3 = correlate_rows(rcf, rows)
+    c3 /= np.max(c3, axis=-1, keepdims=True)
+    peak_indices = np.argmax(c3, axis=-1)
+    shifts = np.trunc(peak_indices - ncols / 2.).astype(int)
+
+    ccf_shifted = np.full((nrows, ncols), np.nan)
+    ccf_shifted[ids, :] = shift_rows(rows, shifts)
+    raw_correction[ids] = lag[peak_indices]
+
+    # Recompute the RCF with first order clock corrections
+    rcf_corrected = np.nanmean(ccf_shifted[snr_mask, :], axis=0)
+
+    # Reject rows based on the Pearson coefficient between the corrected RCF and shifted CCFs; note that
+    # rows with undefined coefficients are retained
+    pcf_corrected = pearson_rows(rcf_corrected, ccf_shifted[ids, :])
+    rejected = pcf_corrected < pcf_cutoff_threshold
+    raw_correction[ids[rejected]] = np.nan
+    ids = ids[~rejected]
+    rows = rows[~rejected]
+
+    # Second order corrections based on the first order corrected RCF
+    c3 = correlate_rows(rcf_corrected, rows)
+    c3 /= np.max(c3, axis=-1, keepdims=True)
+    raw_correction[ids] = lag[np.argmax(c3, axis=-1)]
+    row_rcf_crosscorr[ids, :] = c3
+
+    return raw_correction, rcf_corrected, row_rcf_crosscorr
+# end func
+
+
+def cluster_corrections(times, corrections, slopes, coeffs, eps=2 * SEC_PER_WEEK, min_samples=7):
+    """
+    DBSCAN clustering of clock corrections. The distance between two points p0 and p1, each comprising
+    (time, correction, slope), is:
+        sqrt((c0 * dt)**2 + (c1 * w * dcorrection)**2 + (c2 * w**2 * dslope)**2),
+    where w is the number of seconds in a week and (c0, c1, c2) are the given coefficients. Since this is
+    the Euclidean distance between features scaled by (c0, c1 * w, c2 * w**2), features are scaled upfront,
+    so that sklearn can use a KD-tree for neighbourhood queries.
+
+    :param times: 1D array of times (s)
+    :param corrections: 1D array of clock corrections (s)
+    :param slopes: 1D array of drift rates
+    :param coeffs: Triplet of distance coefficients, corresponding to the sensitivity of the clustering to point
+        separation along 1) x-axis (time), 2) y-axis (correction) and 3) slope (drift rate)
+    :param eps: neighbourhood radius
+    :param min_samples: minimum number of points in a neighbourhood for a point to be a core point
+    :return: Results of sklearn.cluster.dbscan (refer to third party documentation)
+    """
+    scale = np.array([coeffs[0], coeffs[1] * SEC_PER_WEEK, coeffs[2] * SEC_PER_WEEK * SEC_PER_WEEK])
+    data = np.column_stack((times, corrections, slopes)) * scale
+
+    return dbscan(data, eps=eps, min_samples=min_samples, metric='euclidean', algorithm='kd_tree')
+# end func
@@ -11,6 +11,12 @@ Developer:      rakib.hassan@ga.gov.au
 
 Revision History:
     LastUpdate:     11/07/18   RH
+    LastUpdate:     17/10/26   agent    Added option for station-centric caching of window-spectra
+    LastUpdate:     17/10/26   agent    Added option for batched processing of windows
+    LastUpdate:     17/10/26   agent    Added options for prefetching of read-buffers
+    LastUpdate:     17/10/26   agent    Station-pairs are scheduled dynamically, in order of estimated cost
+    LastUpdate:     17/10/26   agent    Added options for selecting the FFT backend
+    LastUpdate:     17/10/26   agent    Station-pairs are split across ranks by both stations with --spectral-cache
     LastUpdate:     dd/mm/yyyy  Who     Optional description
 """
 
@@ -31,7 +37,11 @@ from obspy import UTCDateTime, read_inventory, Inventory
 from obspy.geodetics.base import gps2dist_azimuth
 
 from seismic.xcorqc.xcorqc import IntervalStackXCorr
-from seismic.xcorqc.utils import ProgressTracker, getStationInventory, rtp2xyz, split_list
+from seismic.xcorqc.spectral_cache import SpectralCacheManager
+from seismic.xcorqc.fft import BACKENDS, set_backend, get_backend
+from seismic.response_cache import response_spectrum_cache
+from seismic.xcorqc.utils import CompletionJournal, DynamicWorkQueue, estimate_pair_costs, \
+    getStationInventory, rtp2xyz, split_list, split_station_pairs
 
 class Dataset:
     def __init__(self, asdf_file_name, netsta_list='*'):
@@ -165,7 +175,8 @@ def process(data_source1, data_source2, output_path,
             ds1_zchan=None, ds1_nchan=None, ds1_echan=None,
             ds2_zchan=None, ds2_nchan=None, ds2_echan=None, corr_chan=None,
             envelope_normalize=False, ensemble_stack=False, restart=False, dry_run=False,
-            no_tracking_tag=False, scratch_folder=None):
+            no_tracking_tag=False, scratch_folder=None, spectral_cache=False, batch_windows=False,
+            prefetch_depth=1, prefetch_max_mb=2048, schedule='dynamic', fft_backend='auto', fft_threads=1):
     """
     :param data_source1: Text file containing paths to ASDF files
     :param data_source2: Text file containing paths to ASDF files
@@ -173,6 +184,16 @@ def process(data_source1, data_source2, output_path,
     :param interval_seconds: Length of time window (s) over which to compute cross-correlations; e.g. 86400 for 1 day
     :param window_seconds: Length of stacking window (s); e.g 3600 for an hour. interval_seconds must be a multiple of \
                     window_seconds; no stacking is performed if they are of the same size.
+    :param spectral_cache: Preprocess and Fourier-transform data-windows for each station once, caching the \
+                    resulting spectra in memory-mapped files within scratch_folder, for reuse across station-pairs
+    :param batch_windows: Preprocess and Fourier-transform all data-windows within an interval at once
+    :param prefetch_depth: Number of read-buffers to prefetch on a background thread; 0 disables prefetching
+    :param prefetch_max_mb: Maximum size (MB) of prefetched data held in memory
+    :param schedule: 'dynamic' hands out station-pairs to ranks on demand, in decreasing order of estimated \
+                    cost; 'static' splits station-pairs evenly across ranks upfront. Scheduling is always \
+                    static when spectral_cache is True
+    :param fft_backend: FFT backend; one of 'fftw', 'scipy', 'numpy' or 'auto' (see seismic.xcorqc.fft)
+    :param fft_threads: Number of threads used by each FFT
     """
     read_buffer_size *= interval_seconds
     if(os.path.exists(netsta_list1)):
@@ -186,9 +207,24 @@ def process(data_source1, data_source2, output_path,
     nproc = comm.Get_size()
     rank = comm.Get_rank()
 
+    set_backend(fft_backend, threads=fft_threads)
+
     ds1 = Dataset(data_source1, netsta_list1)
     ds2 = Dataset(data_source2, netsta_list2)
 
+    startTime = UTCDateTime(start_time)
+    endTime = UTCDateTime(end_time)
+    if(spectral_cache and schedule == 'dynamic'):
+        # cached spectra are only reused when station-pairs sharing a station are processed on the same rank
+        if(rank == 0): print('Using static scheduling of station-pairs, as required by the spectral cache..')
+        schedule = 'static'
+    # end if
+
+    # Completion journal, recording station-pairs processed on each rank
+    journal = None
+    if(not dry_run): journal = CompletionJournal(output_folder=output_path, restart_mode=restart)
+
+    pairs = []
     proc_stations = []
     location_preferences_dict = None
     time_tag = None
@@ -240,6 +276,13 @@ def process(data_source1, data_source2, output_path,
             f.write('%25s\t\t\t: %s\n' % ('--restart', 'TRUE' if restart else 'FALSE'))
             f.write('%25s\t\t\t: %s\n' % ('--no-tracking-tag', 'TRUE' if no_tracking_tag else 'FALSE'))
             f.write('%25s\t\t\t: %s\n' % ('--scratch-folder', scratch_folder))
+            f.write('%25s\t\t\t: %s\n' % ('--spectral-cache', 'TRUE' if spectral_cache else 'FALSE'))
+            f.write('%25s\t\t\t: %s\n' % ('--batch-windows', 'TRUE' if batch_windows else 'FALSE'))
+            f.write('%25s\t\t\t: %s\n' % ('--prefetch-depth', prefetch_depth))
+            f.write('%25s\t\t\t: %s\n' % ('--prefetch-max-mb', prefetch_max_mb))
+            f.write('%25s\t\t\t: %s\n' % ('--schedule', schedule))
+            f.write('%25s\t\t\t: %s\n' % ('--fft-backend', '%s (%s)' % (fft_backend, get_backend()[0])))
+            f.write('%25s\t\t\t: %s\n' % ('--fft-threads', fft_threads))
 
             f.close()
         # end func
@@ -281,17 +324,40 @@ def process(data_source1, data_source2, output_path,
             pairs = cull_pairs(pairs, pairs_to_compute)
         # end if
 
+        # drop station-pairs completed in a previous run
+        if(journal is not None and restart):
+            npairs = len(pairs)
+            pairs = [pair for pair in pairs if not journal.is_complete('.'.join(pair))]
+            print('Found results for %d of %d station-pairs. Moving along..'%(npairs - len(pairs), npairs))
+        # end if
+
+        # order station-pairs by decreasing span of overlapping data, so that the most expensive
+        # pairs are processed first and ranks finish around the same time
+        costs = estimate_pair_costs(pairs, ds1.fds, ds2.fds, startTime, endTime)
+        order = sorted(range(len(pairs)), key=lambda i: (-costs[i], pairs[i]))
+        pairs = [pairs[i] for i in order]
+        costs = costs[order]
+
         # print out station-pairs for dry runs
         if(dry_run):
-            print('Computing %d station-pairs: '%(len(pairs)))
-            for pair in pairs:
-                print('.'.join(pair))
+            print('Computing %d station-pairs, spanning a total of %.1f days of overlapping data: '%
+                  (len(pairs), np.sum(costs) / 86400.))
+            for pair, cost in zip(pairs, costs):
+                print('%s (%.1f days)'%('.'.join(pair), cost / 86400.))
             # end for
         # end if
 
-        random.Random(nproc).shuffle(pairs) # using nproc as seed so that shuffle produces the same
-                                            # ordering when jobs are restarted.
-        proc_stations = split_list(pairs, npartitions=nproc)
+        if(schedule == 'static'):
+            if(spectral_cache):
+                # keep station-pairs sharing a station on as few ranks as possible, so that cached
+                # spectra are reused
+                proc_stations = split_station_pairs(pairs, npartitions=nproc)
+            else:
+                random.Random(nproc).shuffle(pairs) # using nproc as seed so that shuffle produces the same
+                                                    # ordering when jobs are restarted.
+                proc_stations = split_list(pairs, npartitions=nproc)
+            # end if
+        # end if
     # end if
 
     if(dry_run):
@@ -301,7 +367,15 @@ def process(data_source1, data_source2, output_path,
 
     location_preferences_dict = read_location_preferences(location_preferences)
     # broadcast workload to all procs
-    proc_stations = comm.bcast(proc_stations, root=0)
+    if(schedule == 'static'):
+        proc_stations = comm.bcast(proc_stations, root=0)
+        proc_pairs = proc_stations[rank]
+        workQueue = None
+    else:
+        pairs = comm.bcast(pairs, root=0)
+        workQueue = DynamicWorkQueue(len(pairs))
+        proc_pairs = (pairs[i] for i in workQueue)
+    # end if
     time_tag = comm.bcast(time_tag, root=0)
 
     # read inventory
@@ -315,20 +389,27 @@ def process(data_source1, data_source2, output_path,
         # end try
     # end if
 
-    # Progress tracker
-    progTracker = ProgressTracker(output_folder=output_path, restart_mode=restart)
+    # Spectral cache and remaining number of station-pairs featuring each station on this rank
+    cacheManager = None
+    remainingPairCounts = defaultdict(int)
+    if(spectral_cache):
+        cacheManager = SpectralCacheManager(scratch_folder=scratch_folder)
+        for pair in proc_pairs:
+            for netsta in pair: remainingPairCounts[netsta] += 1
+        # end for
+    # end if
 
-    startTime = UTCDateTime(start_time)
-    endTime = UTCDateTime(end_time)
-    for pair in proc_stations[rank]:
-        netsta1, netsta2 = pair
+    def finalize_pair(pair):
+        journal.mark_complete('.'.join(pair))
+        if(cacheManager is None): return
+        for netsta in pair:
+            remainingPairCounts[netsta] -= 1
+            if(remainingPairCounts[netsta] == 0): cacheManager.evict(netsta)
+        # end for
+    # end func
 
-        if (progTracker.increment()):
-            pass
-        else:
-            print (('Found results for station-pair: %s.%s. Moving along..'%(netsta1, netsta2)))
-            continue
-        # end if
+    for pair in proc_pairs:
+        netsta1, netsta2 = pair
 
         netsta1inv, stationInvCache = getStationInventory(inv, stationInvCache, netsta1, location_preferences_dict)
         netsta2inv, stationInvCache = getStationInventory(inv, stationInvCache, netsta2, location_preferences_dict)
@@ -365,6 +446,7 @@ def process(data_source1, data_source2, output_path,
         if(len(corr_chans)<2):
             print(('Either required channels are not found for station %s or %s, '
                    'or no overlapping data exists..')%(netsta1, netsta2))
+            finalize_pair(pair)
             continue
         # end if
 
@@ -378,6 +460,7 @@ def process(data_source1, data_source2, output_path,
             except Exception as e:
                 print (e)
                 print (('Failed to compute back-azimuth for station-pairs; skipping %s.%s; '%(netsta1, netsta2)))
+                finalize_pair(pair)
                 continue
             # end try
         # end if
@@ -391,8 +474,17 @@ def process(data_source1, data_source2, output_path,
                            window_seconds, window_overlap, window_buffer_length,
                            fmin, fmax, clip_to_2std, whitening, whitening_window_frequency,
                            one_bit_normalize, envelope_normalize, ensemble_stack,
-                           output_path, 2, time_tag, scratch_folder)
+                           output_path, 2, time_tag, scratch_folder,
+                           spectral_cache_manager=cacheManager, batch_windows=batch_windows,
+                           prefetch_depth=prefetch_depth, prefetch_max_mb=prefetch_max_mb)
+
+        finalize_pair(pair)
     # end for
+
+    if(workQueue): workQueue.close()
+    if(cacheManager): cacheManager.close()
+
+    if(inv): print('Rank %d: response-spectrum cache stats: %s' % (rank, str(response_spectrum_cache.stats())))
 # end func
 
 
@@ -517,12 +609,48 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.option('--no-tracking-tag', default=False, is_flag=True, help='Do not tag output file names with a time-tag')
 @click.option('--scratch-folder', default=None, help="Scratch folder for large jobs (e.g. $PBS_JOBFS on the NCI); "
                                                      "default is to use the standard temp folder")
+@click.option('--spectral-cache', default=False, is_flag=True,
+              help="Preprocess and Fourier-transform data-windows for each station only once, caching "
+                   "the resulting spectra in memory-mapped files within the scratch folder. Cached "
+                   "spectra are reused for all station-pairs featuring a given station, which "
+                   "substantially reduces I/O and FFT costs, e.g. for nearest-neighbour runs. Note that "
+                   "the cache is only used for station-pairs with matching sampling rates, which is "
+                   "always the case when '--resample-rate' is specified; space required on scratch is "
+                   "~4 * 2**ceil(log2(2 * WINDOW_SECONDS * SAMPLING_RATE)) bytes per window, per station")
+@click.option('--batch-windows', default=False, is_flag=True,
+              help="Gather all gap-free data-windows within an interval into 2D arrays that are detrended, "
+                   "corrected for instrument response, filtered, normalized, whitened and Fourier-transformed "
+                   "at once, as opposed to one window at a time. Instrument transfer functions are computed "
+                   "once per channel-epoch. This is substantially faster, at the cost of higher memory usage")
+@click.option('--prefetch-depth', default=1, type=int, show_default=True,
+              help="Number of read-buffers (see '--read-buffer-size') to read ahead on a background thread, "
+                   "while the current read-buffer is being cross-correlated. Reads are serialised, so that "
+                   "prefetching overlaps I/O with processing at best. Set to 0 to disable prefetching")
+@click.option('--prefetch-max-mb', default=2048, type=float, show_default=True,
+              help="Maximum size (MB) of prefetched data held in memory by each process; data for at least "
+                   "one read-buffer are always prefetched when prefetching is enabled")
+@click.option('--schedule', type=click.Choice(['dynamic', 'static']), default='dynamic', show_default=True,
+              help="Scheduling of station-pairs across processes. 'dynamic' orders station-pairs by decreasing "
+                   "span of overlapping data, as recorded in the indices of the data-sources, and hands them out "
+                   "to processes on demand, so that processes finish around the same time; 'static' splits "
+                   "station-pairs evenly across processes upfront. Scheduling is always static when "
+                   "'--spectral-cache' is used. Completed station-pairs are recorded in journal files "
+                   "(completed.*.txt) in OUTPUT_PATH, which allows restarting jobs with '--restart', "
+                   "with either scheduling and any number of processes")
+@click.option('--fft-backend', type=click.Choice(['auto'] + BACKENDS), default='auto', show_default=True,
+              help="FFT backend: 'fftw' uses pyFFTW with cached plans, 'scipy' uses scipy.fft and 'numpy' uses "
+                   "numpy.fft; 'auto' uses 'fftw' if pyFFTW is available and 'scipy' otherwise. See "
+                   "seismic/xcorqc/benchmark_fft.py for comparing backends on a given machine")
+@click.option('--fft-threads', default=1, type=int, show_default=True,
+              help="Number of threads used by each FFT; has no effect for the 'numpy' backend. Note that "
+                   "the total number of threads used is this value times the number of processes")
 def main(data_source1, data_source2, output_path, interval_seconds, window_seconds, window_overlap,
          window_buffer_length, resample_rate, taper_length, nearest_neighbours, fmin, fmax, station_names1,
          station_names2, pairs_to_compute, start_time, end_time, instrument_response_inventory, instrument_response_output,
          water_level, clip_to_2std, whitening, whitening_window_frequency, one_bit_normalize, read_buffer_size, location_preferences,
          ds1_zchan, ds1_nchan, ds1_echan, ds2_zchan, ds2_nchan, ds2_echan, corr_chan, envelope_normalize,
-         ensemble_stack, restart, dry_run, no_tracking_tag, scratch_folder):
+         ensemble_stack, restart, dry_run, no_tracking_tag, scratch_folder, spectral_cache, batch_windows,
+         prefetch_depth, prefetch_max_mb, schedule, fft_backend, fft_threads):
     """
     DATA_SOURCE1: Text file containing paths to ASDF files \n
     DATA_SOURCE2: Text file containing paths to ASDF files \n
@@ -541,7 +669,8 @@ def main(data_source1, data_source2, output_path, interval_seconds, window_secon
             station_names2, pairs_to_compute, start_time, end_time, instrument_response_inventory, instrument_response_output,
             water_level, clip_to_2std, whitening, whitening_window_frequency, one_bit_normalize, read_buffer_size, location_preferences,
             ds1_zchan, ds1_nchan, ds1_echan, ds2_zchan, ds2_nchan, ds2_echan, corr_chan, envelope_normalize,
-            ensemble_stack, restart, dry_run, no_tracking_tag, scratch_folder)
+            ensemble_stack, restart, dry_run, no_tracking_tag, scratch_folder, spectral_cache, batch_windows,
+            prefetch_depth, prefetch_max_mb, schedule, fft_backend, fft_threads)
 # end func
 
 if __name__ == '__main__':
@@ -1,32 +1,236 @@
+"""
+Description:
+    Pluggable FFT backends for cross-correlation workflows.
+
+    Module-level functions fftn, ifftn, rfft and irfft (with scipy.fftpack-style signatures for
+    fftn/ifftn) dispatch to the active backend, which is one of:
+        'fftw' : pyFFTW, with cached FFTW plans and multiple threads
+        'scipy': scipy.fft, with multiple workers
+        'numpy': numpy.fft
+    The backend is chosen through set_backend; by default, pyFFTW is used if available and scipy.fft
+    otherwise.
+
+    For repeated transforms of the same length, e.g. of windows cross-correlated within a trace,
+    RFFTPlan copies (optionally time-reversed) input into a preallocated, zero-padded buffer, which is
+    SIMD-aligned for pyFFTW, and reuses both the buffer and, for pyFFTW, the FFTW plan across calls.
+    Cached plans share their buffers across callers and are not thread-safe; threads that compute
+    spectra concurrently must not use get_rfft_plan.
+
+References:
+
+Revision History:
+    LastUpdate:     17/10/26   agent    Pluggable FFT backends and reusable real-FFT plans
+    LastUpdate:     17/10/26   agent    Explicit exports; plans are documented as not thread-safe
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
 import numpy
-from functools import partial
+import scipy.fft
 
-# Try and use the faster Fourier transform functions from the pyfft module if
+# Try and use the faster Fourier transform functions from the pyfftw module if
 # available
 try:
     import pyfftw
+    import pyfftw.interfaces.numpy_fft
 
     pyfftw.interfaces.cache.enable()
     pyfftw.interfaces.cache.set_keepalive_time(100)
-    from pyfftw.interfaces.scipy_fftpack import fftn as fftn
-    from pyfftw.interfaces.scipy_fftpack import ifftn as ifftn
+except ImportError:
+    pyfftw = None
+# end try
 
-    from pyfftw.interfaces.numpy_fft import rfft as rfft
-    from pyfftw.interfaces.numpy_fft import irfft as irfft
+__all__ = ['BACKENDS', 'set_backend', 'get_backend', 'fftn', 'ifftn', 'rfft', 'irfft', 'RFFTPlan',
+           'get_rfft_plan', 'ndflip']
 
-    #fftn  = partial(fftn_, planner_effort='FFTW_ESTIMATE')
-    #ifftn = partial(ifftn_, planner_effort='FFTW_ESTIMATE')
+BACKENDS = ['fftw', 'scipy', 'numpy']
 
-    #rfft  = partial(rfft_, planner_effort='FFTW_ESTIMATE')
-    #irfft = partial(irfft_, planner_effort='FFTW_ESTIMATE')
-except ImportError:
-    from scipy.fftpack import fftn, ifftn
-    from numpy.fft import rfft, irfft
-# end try
+class _NumpyBackend:
+    name = 'numpy'
+
+    def __init__(self, threads=1):
+        self.threads = threads
+    # end func
+
+    def fftn(self, x, shape=None, axes=None):
+        return numpy.fft.fftn(x, s=shape, axes=axes)
+    # end func
+
+    def ifftn(self, x, shape=None, axes=None):
+        return numpy.fft.ifftn(x, s=shape, axes=axes)
+    # end func
+
+    def rfft(self, x, n=None, axis=-1):
+        return numpy.fft.rfft(x, n=n, axis=axis)
+    # end func
+
+    def irfft(self, x, n=None, axis=-1):
+        return numpy.fft.irfft(x, n=n, axis=axis)
+    # end func
+
+    def empty(self, shape, dtype):
+        return numpy.empty(shape, dtype=dtype)
+    # end func
+
+    def plan_rfft(self, buf):
+        """
+        :param buf: input buffer
+        :return: function that transforms the current contents of buf along its last axis
+        """
+        return lambda: self.rfft(buf)
+    # end func
+# end class
+
+class _ScipyBackend(_NumpyBackend):
+    name = 'scipy'
+
+    def fftn(self, x, shape=None, axes=None):
+        return scipy.fft.fftn(x, s=shape, axes=axes, workers=self.threads)
+    # end func
+
+    def ifftn(self, x, shape=None, axes=None):
+        return scipy.fft.ifftn(x, s=shape, axes=axes, workers=self.threads)
+    # end func
+
+    def rfft(self, x, n=None, axis=-1):
+        return scipy.fft.rfft(x, n=n, axis=axis, workers=self.threads)
+    # end func
+
+    def irfft(self, x, n=None, axis=-1):
+        return scipy.fft.irfft(x, n=n, axis=axis, workers=self.threads)
+    # end func
+# end class
+
+class _FFTWBackend(_NumpyBackend):
+    name = 'fftw'
+
+    def fftn(self, x, shape=None, axes=None):
+        return pyfftw.interfaces.numpy_fft.fftn(x, s=shape, axes=axes, threads=self.threads)
+    # end func
+
+    def ifftn(self, x, shape=None, axes=None):
+        return pyfftw.interfaces.numpy_fft.ifftn(x, s=shape, axes=axes, threads=self.threads)
+    # end func
+
+    def rfft(self, x, n=None, axis=-1):
+        return pyfftw.interfaces.numpy_fft.rfft(x, n=n, axis=axis, threads=self.threads)
+    # end func
+
+    def irfft(self, x, n=None, axis=-1):
+        return pyfftw.interfaces.numpy_fft.irfft(x, n=n, axis=axis, threads=self.threads)
+    # end func
+
+    def empty(self, shape, dtype):
+        return pyfftw.empty_aligned(shape, dtype=dtype)
+    # end func
+
+    def plan_rfft(self, buf):
+        out = pyfftw.empty_aligned(buf.shape[:-1] + (buf.shape[-1] // 2 + 1,), dtype=numpy.complex128)
+        return pyfftw.FFTW(buf, out, axes=(-1,), threads=self.threads,
+                           flags=('FFTW_ESTIMATE', 'FFTW_DESTROY_INPUT'))
+    # end func
+# end class
+
+_backend = None
+_plans = {}
+
+def set_backend(name='auto', threads=1):
+    """
+    Sets the FFT backend used by functions in this module
+
+    :param name: one of 'fftw', 'scipy', 'numpy' or 'auto', which picks 'fftw' if pyFFTW is \
+                 available and 'scipy' otherwise
+    :param threads: number of threads used by each FFT; has no effect for the 'numpy' backend
+    """
+    global _backend
+
+    if(name == 'auto'): name = 'fftw' if pyfftw is not None else 'scipy'
+    if(name not in BACKENDS):
+        raise ValueError('Invalid FFT backend: %s; must be one of %s'%(name, str(BACKENDS)))
+    # end if
+    if(name == 'fftw' and pyfftw is None):
+        raise ImportError('FFT backend fftw requires pyFFTW, which could not be imported')
+    # end if
+
+    _backend = {'fftw': _FFTWBackend, 'scipy': _ScipyBackend, 'numpy': _NumpyBackend}[name](threads)
+    _plans.clear()
+# end func
+
+def get_backend():
+    """
+    :return: tuple of (name, threads) of the active FFT backend
+    """
+    return _backend.name, _backend.threads
+# end func
+
+def fftn(x, shape=None, axes=None):
+    return _backend.fftn(x, shape=shape, axes=axes)
+# end func
+
+def ifftn(x, shape=None, axes=None):
+    return _backend.ifftn(x, shape=shape, axes=axes)
+# end func
+
+def rfft(x, n=None, axis=-1):
+    return _backend.rfft(x, n=n, axis=axis)
+# end func
+
+def irfft(x, n=None, axis=-1):
+    return _backend.irfft(x, n=n, axis=axis)
+# end func
+
+class RFFTPlan:
+    """
+    Real-input forward FFT of a fixed length, for repeated use. Input is copied into a preallocated
+    buffer, which is zero-padded to the transform length, and is transformed through the active
+    backend. The returned spectrum may be a view into an internal output buffer, which is overwritten
+    by the next call; use get_rfft_plan to obtain plans cached by length. Instances must not be
+    called from more than one thread at a time.
+    """
+    def __init__(self, n):
+        """
+        :param n: transform length
+        """
+        self.n = n
+        self._buf = _backend.empty(n, numpy.float64)
+        self._execute = _backend.plan_rfft(self._buf)
+    # end func
+
+    def __call__(self, a, reverse=False):
+        """
+        :param a: 1D array of real samples, of length <= n
+        :param reverse: transform time-reversed samples
+        :return: one-sided spectrum of length n // 2 + 1
+        """
+        m = a.shape[-1]
+        assert m <= self.n, 'Input is longer than transform length'
+
+        self._buf[:m] = a[::-1] if reverse else a
+        self._buf[m:] = 0
+
+        return self._execute()
+    # end func
+# end class
+
+def get_rfft_plan(n, slot=0):
+    """
+    Returns a cached RFFTPlan for the active backend. The cache is shared by all threads of a process
+    and is not thread-safe; threads that compute spectra concurrently should create their own
+    RFFTPlan instances instead.
+
+    :param n: transform length
+    :param slot: distinguishes plans of the same length whose outputs must coexist, e.g. spectra of two \
+                 traces being cross-correlated
+    :return: RFFTPlan
+    """
+    key = (n, slot)
+    if(key not in _plans): _plans[key] = RFFTPlan(n)
+    return _plans[key]
+# end func
+
+set_backend()
 
 def ndflip(a):
     """Inverts an n-dimensional array along each of its axes"""
     ind = (slice(None,None,-1),)*a.ndim
     return a[ind]
 # end func
-
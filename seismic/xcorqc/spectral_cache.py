@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+"""
+Description:
+    Station-centric cache of preprocessed window spectra for the ambient-noise correlator.
+
+    In the default workflow, every station-pair fetches data for both stations and repeats
+    detrending, response removal, filtering, whitening and FFTs for each window, even though a
+    given station typically features in several station-pairs (e.g. 10-20 in nearest-neighbour
+    runs). The classes here preprocess and Fourier-transform each window of a station once; the
+    resulting spectra are held in memory-mapped files on local scratch and station-pairs are then
+    cross-correlated by multiplying and stacking cached spectra.
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     17/10/26   agent    Spectra are cached in double precision by default; caches are keyed on
+                                        the contents of station inventories
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import os
+import hashlib
+import shutil
+import tempfile
+
+import numpy as np
+from obspy.core import UTCDateTime
+
+from seismic.xcorqc.utils import get_stream, fill_gaps
+
+
+def inventory_key(inv):
+    """
+    :param inv: Inventory or None
+    :return: hashable key identifying the channel epochs in an inventory, i.e. net.sta.loc.cha along
+             with start- and end-dates of each channel
+    """
+    if inv is None: return None
+
+    return tuple(sorted(('%s.%s.%s.%s' % (net.code, sta.code, cha.location_code, cha.code),
+                         str(cha.start_date), str(cha.end_date))
+                        for net in inv for sta in net for cha in sta))
+# end func
+
+
+class SpectralCache:
+    """
+    Memory-mapped cache of spectra of preprocessed windows for a single station-channel. Windows are
+    enumerated with the same interval and window arithmetic as in xcorqc.xcorr2 and are keyed by a
+    global interval-index (interval start-time / interval_seconds) and a window-index within the
+    interval. Windows from different stations are therefore matched, regardless of sub-sample
+    offsets between their start-times. Note that interval indices are consistent across stations
+    when interval_seconds is a factor of a day, as is the case in typical usage.
+
+    Spectra are computed with a real FFT over zero-padded windows and only windows that pass the
+    gap/null/nan checks in xcorr2 are stored.
+    """
+    def __init__(self, fds, net_sta, cha, start_time, end_time, folder, params,
+                 location_preferences_dict, baz=None, sta_inv=None, buffer_seconds=864000,
+                 dtype=np.complex128, logger=None):
+        """
+        :param fds: FederatedASDFDataSet containing station data
+        :param net_sta: Network.Station
+        :param cha: channel name
+        :param start_time: start-time (UTCDateTime)
+        :param end_time: end-time (UTCDateTime)
+        :param folder: folder (ideally on local scratch) where memory-mapped spectra are written
+        :param params: dict of processing parameters, as accepted by xcorqc.preprocess_window, along \
+                       with 'window_seconds', 'window_overlap', 'window_buffer_length' and 'interval_seconds'
+        :param location_preferences_dict: A defaultdict containing location code preferences, keyed by NET.STA
+        :param baz: back-azimuth used for rotating horizontal components when cha is '00T'
+        :param sta_inv: Inventory containing instrument response for station
+        :param buffer_seconds: amount of data (s) fetched per read from fds
+        :param dtype: complex dtype of cached spectra; spectra are computed in double precision, as in \
+                      xcorqc.xcorr2, and np.complex64 halves the size of caches at the cost of precision
+        :param logger: logger instance
+        """
+        self.fds = fds
+        self.net_sta = net_sta
+        self.cha = cha
+        self.start_time = UTCDateTime(start_time)
+        self.end_time = UTCDateTime(end_time)
+        self.params = dict(params)
+        self.location_preferences_dict = location_preferences_dict
+        self.baz = baz
+        self.sta_inv = sta_inv
+        self.buffer_seconds = buffer_seconds
+        self.dtype = np.dtype(dtype)
+        self.logger = logger
+
+        loc = location_preferences_dict[net_sta]
+        self.name = '%s.%s.%s' % (net_sta, loc if loc else '', cha)
+        self.fn = os.path.join(folder, '%s.%s.spec' % (self.name, self.key_hash()))
+
+        self.sampling_rate = None   # sampling rate after resampling, if any
+        self.window_length = None   # number of samples in a processed window
+        self.fftlen = None
+        self.spectra = None
+        self.interval_ids = np.array([], dtype='i8')
+        self.interval_starts = np.array([], dtype='f8')
+        self.interval_ends = np.array([], dtype='f8')
+        self.window_interval_ids = np.array([], dtype='i8')
+        self.window_ids = np.array([], dtype='i8')
+
+        self._build()
+    # end func
+
+    def key_hash(self):
+        key = repr((self.fds.asdf_source, self.name, self.baz, inventory_key(self.sta_inv),
+                    str(self.start_time), str(self.end_time), self.dtype.str,
+                    sorted(self.params.items())))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+    # end func
+
+    @property
+    def nwindows(self):
+        return self.window_ids.shape[0]
+    # end func
+
+    def _build(self):
+        # avoid circular import
+        from seismic.xcorqc.xcorqc import preprocess_window
+        from seismic.xcorqc.fft import rfft
+
+        p = self.params
+        window_seconds = p['window_seconds']
+        window_overlap = p['window_overlap']
+        interval_seconds = p['interval_seconds']
+        resample_rate = p['resample_rate']
+        window_buffer_seconds = p['window_buffer_length'] * window_seconds
+        adjusted_taper_length = p['taper_length']
+        if window_buffer_seconds:
+            adjusted_taper_length = p['taper_length'] / (1. + p['window_buffer_length'] * 2.)
+        # end if
+        step_seconds = window_seconds * (1 - window_overlap)
+
+        interval_ids = []
+        interval_starts = []
+        interval_ends = []
+        window_interval_ids = []
+        window_ids = []
+
+        f = open(self.fn, 'wb')
+        net, sta = self.net_sta.split('.')
+        cTime = self.start_time
+        while cTime < self.end_time:
+            cStep = self.buffer_seconds
+            if (cTime + cStep) > self.end_time: cStep = self.end_time - cTime
+
+            st = None
+            try:
+                st = get_stream(self.fds, net, sta, self.cha, cTime, cTime + cStep,
+                                self.location_preferences_dict, baz=self.baz,
+                                logger=self.logger)
+            except Exception as e:
+                if self.logger:
+                    self.logger.error('\t' + str(e))
+                    self.logger.warning('\tError encountered while fetching data for %s. '
+                                        'Skipping along..' % self.name)
+                # end if
+            # end try
+
+            if st is None or len(st) == 0:
+                cTime += cStep
+                continue
+            # end if
+
+            tr = st[0]
+            sr_orig = tr.stats.sampling_rate
+            sr = resample_rate if resample_rate else sr_orig
+
+            if self.sampling_rate is None:
+                self.sampling_rate = sr
+                self.fftlen = 2 ** (int(np.log2(int(2 * window_seconds * sr - 1))) + 1)
+            elif self.sampling_rate != sr:
+                if self.logger:
+                    self.logger.warning('\tSampling rate of %s changed from %f to %f; skipping data in '
+                                        '[%s - %s]' % (self.name, self.sampling_rate, sr,
+                                                       str(cTime), str(cTime + cStep)))
+                # end if
+                cTime += cStep
+                continue
+            # end if
+
+            tr_d_all = tr.data
+            lentr_all = tr_d_all.shape[0]
+            trStart = tr.stats.starttime
+            window_samples = (window_seconds + 2 * window_buffer_seconds) * sr_orig
+            interval_samples = interval_seconds * sr_orig
+            step_samples = (window_samples - 2 * window_buffer_seconds * sr_orig) - \
+                           (window_samples - 2 * window_buffer_seconds * sr_orig) * window_overlap
+
+            # interval and window arithmetic follows xcorr2
+            dayAlignedStartTime = UTCDateTime(year=trStart.year, month=trStart.month, day=trStart.day)
+            itrs = (dayAlignedStartTime - trStart) * sr_orig
+            while itrs < lentr_all:
+                itre = min(lentr_all, itrs + interval_samples)
+                iStart = trStart + itrs / sr_orig  # start of interval, before adjustments below
+                iid = int(np.round(iStart.timestamp / interval_seconds))
+
+                while itrs < 0: itrs += step_samples
+
+                if (itre - itrs) < sr_orig:
+                    itrs = itre
+                    continue
+                # end if
+
+                wtrs = int(itrs)
+                while wtrs < itre:
+                    wtre = int(min(itre, wtrs + window_samples))
+
+                    # Discard small windows
+                    if (wtre - wtrs < window_samples) or (wtre - wtrs < sr_orig): break
+
+                    # Attempt to fill small gaps (3s or smaller in length)
+                    if np.ma.is_masked(tr_d_all[wtrs:wtre]):
+                        tr_d_all[wtrs:wtre] = fill_gaps(tr_d_all[wtrs:wtre], dt=1. / sr)
+                    # end if
+
+                    if not (np.ma.is_masked(tr_d_all[wtrs:wtre]) or np.sum(tr_d_all[wtrs:wtre]) == 0):
+                        tr_d = preprocess_window(tr_d_all[wtrs:wtre], sr_orig, window_samples, sr,
+                                                 header={'network': tr.stats.network,
+                                                         'station': tr.stats.station,
+                                                         'location': tr.stats.location,
+                                                         'channel': tr.stats.channel,
+                                                         'starttime': trStart + float(wtrs) / sr_orig,
+                                                         'endtime': trStart + float(wtre) / sr_orig},
+                                                 sta_inv=self.sta_inv,
+                                                 instrument_response_output=p['instrument_response_output'],
+                                                 water_level=p['water_level'], resample_rate=resample_rate,
+                                                 taper_length=adjusted_taper_length,
+                                                 window_buffer_seconds=window_buffer_seconds,
+                                                 flo=p['flo'], fhi=p['fhi'], clip_to_2std=p['clip_to_2std'],
+                                                 whitening=p['whitening'],
+                                                 whitening_window_frequency=p['whitening_window_frequency'],
+                                                 one_bit_normalize=p['one_bit_normalize'], logger=self.logger)
+
+                        spec = rfft(tr_d, n=self.fftlen).astype(self.dtype)
+
+                        if not np.isnan(spec).any():
+                            if self.window_length is None: self.window_length = tr_d.shape[0]
+
+                            f.write(spec.tobytes())
+                            window_interval_ids.append(iid)
+                            window_ids.append(int(np.round(((trStart + float(wtrs) / sr_orig) - iStart) /
+                                                           step_seconds)))
+                        # end if
+                    # end if
+
+                    wtrs += int(step_samples)
+                # end while (windows within interval)
+
+                interval_ids.append(iid)
+                interval_starts.append(trStart.timestamp + itrs / sr_orig)
+                interval_ends.append(trStart.timestamp + itre / sr_orig)
+                itrs = itre
+            # end while (iteration over intervals)
+
+            cTime += cStep
+        # wend
+        f.close()
+
+        self.interval_ids = np.array(interval_ids, dtype='i8')
+        self.interval_starts = np.array(interval_starts, dtype='f8')
+        self.interval_ends = np.array(interval_ends, dtype='f8')
+        self.window_interval_ids = np.array(window_interval_ids, dtype='i8')
+        self.window_ids = np.array(window_ids, dtype='i8')
+
+        if self.nwindows:
+            self.spectra = np.memmap(self.fn, dtype=self.dtype, mode='r',
+                                     shape=(self.nwindows, self.fftlen // 2 + 1))
+        # end if
+
+        if self.logger:
+            self.logger.info('\tCached spectra for %d windows of %s' % (self.nwindows, self.name))
+        # end if
+    # end func
+
+    def window_rows(self, interval_id):
+        """
+        :param interval_id: global interval index
+        :return: tuple of (row indices into self.spectra, window-indices) for windows within the interval
+        """
+        rows = np.where(self.window_interval_ids == interval_id)[0]
+        return rows, self.window_ids[rows]
+    # end func
+
+    def close(self):
+        self.spectra = None
+        if os.path.exists(self.fn): os.remove(self.fn)
+    # end func
+# end class
+
+
+class SpectralCacheManager:
+    """
+    Builds and holds SpectralCache instances for a given process. Caches are built lazily, on first
+    request, and are reused for all station-pairs featuring the same station-channel and processing
+    parameters.
+    """
+    def __init__(self, scratch_folder=None, dtype=np.complex128, logger=None):
+        """
+        :param scratch_folder: parent folder for cache files; default is the standard temp folder
+        :param dtype: complex dtype of cached spectra; see SpectralCache
+        :param logger: logger instance
+        """
+        self.folder = tempfile.mkdtemp(prefix='spectral_cache.', dir=scratch_folder)
+        self.dtype = dtype
+        self.logger = logger
+        self._caches = {}
+        self.hits = 0
+        self.misses = 0
+    # end func
+
+    def get(self, fds, net_sta, cha, start_time, end_time, params, location_preferences_dict,
+            baz=None, sta_inv=None, buffer_seconds=864000, logger=None):
+        """
+        Returns a SpectralCache for the given station-channel, building it if required. See
+        SpectralCache for a description of parameters.
+        """
+        key = (fds.asdf_source, net_sta, location_preferences_dict[net_sta], cha,
+               str(UTCDateTime(start_time)), str(UTCDateTime(end_time)), baz, inventory_key(sta_inv),
+               repr(sorted(params.items())))
+
+        if key in self._caches:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._caches[key] = SpectralCache(fds, net_sta, cha, start_time, end_time, self.folder,
+                                              params, location_preferences_dict, baz=baz,
+                                              sta_inv=sta_inv, buffer_seconds=buffer_seconds,
+                                              dtype=self.dtype, logger=logger if logger else self.logger)
+        # end if
+
+        return self._caches[key]
+    # end func
+
+    def evict(self, net_sta):
+        """
+        Removes all caches for a given Network.Station, e.g. once all station-pairs featuring the
+        station have been processed
+
+        :param net_sta: Network.Station
+        """
+        for key in [k for k in self._caches.keys() if k[1] == net_sta]:
+            self._caches.pop(key).close()
+        # end for
+    # end func
+
+    def close(self):
+        for cache in self._caches.values(): cache.close()
+        self._caches = {}
+        shutil.rmtree(self.folder, ignore_errors=True)
+    # end func
+# end class
+
+
+def xcorr_cached(cache1, cache2, start_time, end_time, window_seconds, envelope_normalize=False,
+                 verbose=1, logger=None):
+    """
+    Cross-correlates two stations from their cached window-spectra. Results are equivalent to those
+    from xcorqc.xcorr2 for the same processing parameters, but only require a multiplication and
+    stacking of cached spectra. Both caches must share the same sampling rate, which is always the
+    case when resampling is applied.
+
+    :param cache1: SpectralCache for reference station
+    :param cache2: SpectralCache for temporary station
+    :param start_time: start-time (UTCDateTime) of intervals to be processed
+    :param end_time: end-time (UTCDateTime) of intervals to be processed
+    :param window_seconds: length of cross-correlation window in seconds
+    :param envelope_normalize: envelope via Hilbert transforms and normalize
+    :return: same as xcorr2
+    """
+    from seismic.xcorqc.fft import irfft, ifftn
+
+    assert cache1.sampling_rate == cache2.sampling_rate, 'Sampling rates of cached spectra must match'
+    sr = cache1.sampling_rate
+    if sr is None: return None, None, None, None, sr
+
+    xcorlen = int(2 * window_seconds * sr - 1)
+    fftlen = cache1.fftlen
+
+    # Spectra of time-reversed windows of station 2 are derived from cached spectra as:
+    # FFT(flip(x))[k] = exp(-2*pi*i*k*(N-1)/L) * conj(FFT(x)[k]), for real x of length N zero-padded to L
+    ramp = None
+    if cache2.window_length:
+        ramp = np.exp(-2j * np.pi * np.arange(fftlen // 2 + 1) * (cache2.window_length - 1) / float(fftlen))
+    # end if
+
+    st = UTCDateTime(start_time).timestamp
+    et = UTCDateTime(end_time).timestamp
+    mask = (cache1.interval_starts >= st) & (cache1.interval_starts < et)
+    iids, idx1, idx2 = np.intersect1d(cache1.interval_ids[mask], cache2.interval_ids,
+                                      assume_unique=True, return_indices=True)
+    idx1 = np.where(mask)[0][idx1]
+
+    resultCache = []
+    windowsPerInterval = []
+    intervalStartSeconds = []
+    intervalEndSeconds = []
+    for iid, i1 in zip(iids, idx1):
+        rows1, wids1 = cache1.window_rows(iid)
+        rows2, wids2 = cache2.window_rows(iid)
+        _, r1, r2 = np.intersect1d(wids1, wids2, assume_unique=True, return_indices=True)
+
+        windowCount = len(r1)
+        if windowCount > 0:
+            mean = np.sum(cache1.spectra[rows1[r1]] * np.conj(cache2.spectra[rows2[r2]]),
+                          axis=0, dtype=np.complex128) * ramp / float(windowCount)
+        else:
+            mean = np.zeros(fftlen // 2 + 1, dtype=np.complex128)
+        # end if
+
+        if verbose > 1:
+            if logger: logger.info('\tProcessed %d windows in interval %d' % (windowCount, len(resultCache)))
+        # end if
+
+        if envelope_normalize:
+            # compute analytic signal from one-sided spectrum
+            analytic = np.zeros(fftlen, dtype=np.complex128)
+            analytic[0] = mean[0]
+            analytic[1:fftlen // 2] = 2 * mean[1:fftlen // 2]
+            mean = np.abs(ifftn(analytic))
+
+            normFactor = np.max(mean)
+            if normFactor > 0: mean /= normFactor
+        else:
+            mean = irfft(mean, n=fftlen)
+        # end if
+
+        resultCache.append(mean[:xcorlen])
+        windowsPerInterval.append(windowCount)
+        intervalStartSeconds.append(cache1.interval_starts[i1])
+        intervalEndSeconds.append(cache1.interval_ends[i1])
+    # end for
+
+    if len(resultCache):
+        return np.array(resultCache), np.array(windowsPerInterval), \
+               np.array(intervalStartSeconds, dtype='i8'), \
+               np.array(intervalEndSeconds, dtype='i8'), \
+               sr
+    else:
+        return None, None, None, None, sr
+    # end if
+# end func
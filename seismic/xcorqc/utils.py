@@ -1,11 +1,14 @@
 from mpi4py import MPI
 import os
+import glob
 import numpy as np
 from scipy.spatial import cKDTree
 from collections import defaultdict
 from obspy import UTCDateTime, read_inventory, Inventory, Stream
 from obspy.geodetics.base import gps2dist_azimuth
-from tempfile import SpooledTemporaryFile
+from netCDF4 import Dataset
+import threading
+import queue
 from scipy.interpolate import interp1d
 
 # define utility functions
@@ -53,6 +56,38 @@ def split_list(lst, npartitions):
     return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(npartitions)]
 # end func
 
+def split_station_pairs(pairs, npartitions):
+    """
+    Splits station-pairs into contiguous blocks of near-equal length, ordered such that each
+    station features on as few blocks as possible. Stations are divided into ngroups groups in
+    sorted order, and station-pairs are ordered by the groups of both stations, i.e. in tiles of
+    the station-pair matrix, followed by the stations themselves. Each block then features the
+    stations of a few groups only, and each station features on O(ngroups) blocks, as opposed to
+    O(npartitions) blocks when station-pairs are ordered by the first station alone. The number
+    of groups is chosen to minimize the total number of (station, block) combinations.
+
+    :param pairs: list of station-pairs (netsta1, netsta2)
+    :param npartitions: number of blocks
+    :return: list of npartitions lists of station-pairs
+    """
+    stations = sorted(set([netsta for pair in pairs for netsta in pair]))
+    index = dict([(netsta, i) for i, netsta in enumerate(stations)])
+
+    best = None
+    maxGroups = int(np.ceil(np.sqrt(2 * npartitions)))
+    for ngroups in range(1, min(maxGroups, max(len(stations), 1)) + 1):
+        groups = dict([(netsta, i * ngroups // len(stations)) for netsta, i in index.items()])
+
+        ordered = sorted(pairs, key=lambda pair: (groups[pair[0]], groups[pair[1]], pair))
+        blocks = split_list(ordered, npartitions=npartitions)
+        count = np.sum([len(set([netsta for pair in block for netsta in pair])) for block in blocks])
+
+        if(best is None or count < best[0]): best = (count, blocks)
+    # end for
+
+    return best[1] if best else split_list(pairs, npartitions=npartitions)
+# end func
+
 def drop_bogus_traces(st, sampling_rate_cutoff=1):
     """
     Removes spurious traces with suspect sampling rates.
@@ -232,58 +267,495 @@ class ProgressTracker:
     # end func
 # end class
 
-class SpooledXcorrResults:
+class CompletionJournal:
     """
-    Spooled storage for cross-correlations. Stacked cross-correlations computed were previously
-    gathered in memory, before being written to netCDF4 files at the end. Because we now need to
-    output all cross-correlations, unstacked, the memory requirements have jumped by a factor of
-    ~26. We now write the CCs to a spooled storage as they are being computed.
+    Records completed work-items, e.g. station-pairs, so that jobs can be restarted without
+    repeating completed work. Unlike ProgressTracker, which records the number of items processed
+    on each rank and thus relies on a fixed assignment of work to ranks, each rank here appends
+    keys of completed items to its own journal file. Journals from all ranks are read in restart
+    mode, so that restarted jobs may use a different number of ranks and schedule work
+    dynamically. Journals from all ranks of a previous run, which may have used more ranks, are
+    removed by rank 0 in fresh runs. Instantiation is a collective operation.
     """
-    def __init__(self, ncols, dtype=np.float32, max_size_mb=2048, prefix='', dir=None):
-        self._prefix = prefix
-        self._ncols = ncols
-        self._nrows = 0
-        self._dtype = dtype
-        self._max_size_mb = max_size_mb
+    def __init__(self, output_folder, restart_mode=False):
+        """
+        :param output_folder: folder containing journal files
+        :param restart_mode: read keys of completed items from existing journal files
+        """
+        self.output_folder = output_folder
+        self.restart_mode = restart_mode
+
+        self.comm = MPI.COMM_WORLD
+        self.rank = self.comm.Get_rank()
+
+        self.completed = set()
+        self.proc_fn = os.path.join(output_folder, 'completed.%d.txt' % (self.rank))
+
+        if(self.restart_mode):
+            journal_fns = glob.glob(os.path.join(output_folder, 'completed.*.txt'))
+            if(len(journal_fns) == 0):
+                raise Exception('Journal files (completed.*.txt) not found in %s'%(output_folder))
+            # end if
+
+            for fn in journal_fns:
+                for line in open(fn).readlines():
+                    line = line.strip()
+                    if(len(line)): self.completed.add(line)
+                # end for
+            # end for
+        else:
+            if(self.rank == 0):
+                for fn in glob.glob(os.path.join(output_folder, 'completed.*.txt')): os.remove(fn)
+            # end if
+        # end if
+        self.comm.Barrier()
+    # end func
+
+    def is_complete(self, key):
+        return key in self.completed
+    # end func
+
+    def mark_complete(self, key):
+        with open(self.proc_fn, 'a') as f:
+            f.write('%s\n' % (key))
+            f.flush()
+            os.fsync(f.fileno())
+        # end with
+        self.completed.add(key)
+    # end func
+# end class
+
+class DynamicWorkQueue:
+    """
+    Hands out indices of an ordered list of work-items to MPI ranks on demand, so that ranks that
+    finish their work early go on to pick up remaining work, rather than idling while others
+    work through a fixed share of the workload. Indices are handed out in order, through an
+    atomic counter exposed by rank 0 in an MPI one-sided communication window; all ranks,
+    including rank 0, process work-items. Instantiation and close() are collective operations.
+
+    Depending on the MPI implementation, requests from other ranks may only be serviced while
+    rank 0 makes MPI calls, which it does not while processing work-items. When MPI provides
+    MPI_THREAD_MULTIPLE, as requested by mpi4py by default, rank 0 therefore polls MPI on a helper
+    thread. Otherwise, asynchronous progress should be enabled in the MPI implementation, e.g.
+    through MPICH_ASYNC_PROGRESS=1 for MPICH-based implementations.
+    """
+    def __init__(self, nitems, comm=None, progress_interval=0.01):
+        """
+        :param nitems: number of work-items
+        :param comm: MPI communicator; defaults to MPI.COMM_WORLD
+        :param progress_interval: interval (s) at which the helper thread on rank 0 polls MPI
+        """
+        self.nitems = nitems
+        self.comm = comm if comm is not None else MPI.COMM_WORLD
+        self.rank = self.comm.Get_rank()
+        self.progress_interval = progress_interval
+
+        itemsize = MPI.INT64_T.Get_size()
+        self._win = MPI.Win.Allocate(itemsize if self.rank == 0 else 0, itemsize, comm=self.comm)
+        if(self.rank == 0):
+            self._win.Lock(0)
+            self._win.Put(np.zeros(1, dtype=np.int64), 0)
+            self._win.Unlock(0)
+        # end if
+
+        # helper thread on rank 0 for progressing requests from other ranks
+        self._progress_thread = None
+        self._progress_stop = threading.Event()
+        if(self.comm.Get_size() > 1 and MPI.Query_thread() == MPI.THREAD_MULTIPLE):
+            self._progress_comm = self.comm.Dup()
+            if(self.rank == 0):
+                self._progress_thread = threading.Thread(target=self._progress, daemon=True)
+                self._progress_thread.start()
+            # end if
+        else:
+            self._progress_comm = None
+        # end if
+        self.comm.Barrier()
+    # end func
+
+    def _progress(self):
+        while not self._progress_stop.wait(self.progress_interval):
+            self._progress_comm.Iprobe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG)
+        # end while
+    # end func
+
+    def next(self):
+        """
+        :return: index of the next work-item or None once all work-items have been handed out
+        """
+        one = np.ones(1, dtype=np.int64)
+        result = np.zeros(1, dtype=np.int64)
+
+        self._win.Lock(0, MPI.LOCK_SHARED)
+        self._win.Fetch_and_op(one, result, 0, 0, MPI.SUM)
+        self._win.Unlock(0)
+
+        idx = int(result[0])
+        return idx if idx < self.nitems else None
+    # end func
+
+    def __iter__(self):
+        while True:
+            idx = self.next()
+            if(idx is None): break
+            yield idx
+        # end while
+    # end func
+
+    def close(self):
+        if(self._win is not None):
+            if(self._progress_thread is not None):
+                self._progress_stop.set()
+                self._progress_thread.join()
+                self._progress_thread = None
+            # end if
+            self._win.Free()
+            self._win = None
+
+            if(self._progress_comm is not None):
+                self._progress_comm.Free()
+                self._progress_comm = None
+            # end if
+        # end if
+    # end func
+# end class
+
+def estimate_pair_costs(pairs, fds1, fds2, start_time, end_time):
+    """
+    Estimates relative costs of cross-correlating station-pairs from the span of overlapping
+    data, as recorded in the indices of the federated ASDF data-sets
+
+    :param pairs: list of (NET.STA, NET.STA) tuples
+    :param fds1: FederatedASDFDataSet instance for stations in the first column of pairs
+    :param fds2: FederatedASDFDataSet instance for stations in the second column of pairs
+    :param start_time: UTCDateTime; start of time-range of interest
+    :param end_time: UTCDateTime; end of time-range of interest
+    :return: numpy array of overlapping data-spans (s), one for each pair
+    """
+    def time_ranges(fds, netstas):
+        result = {}
+        for netsta in netstas:
+            net, sta = netsta.split('.')
+            result[netsta] = fds.get_global_time_range(net, sta)
+        # end for
+        return result
+    # end func
+
+    ranges1 = time_ranges(fds1, set([p[0] for p in pairs]))
+    ranges2 = time_ranges(fds2, set([p[1] for p in pairs]))
+
+    costs = np.zeros(len(pairs))
+    for i, (netsta1, netsta2) in enumerate(pairs):
+        st1, et1 = ranges1[netsta1]
+        st2, et2 = ranges2[netsta2]
+
+        costs[i] = max(min(et1, et2, end_time) - max(st1, st2, start_time), 0)
+    # end for
+
+    return costs
+# end func
+
+class BufferPrefetcher:
+    """
+    Reads data for a sequence of time-ranges on a background thread, so that data for the next
+    time-range are read while those for the current one are being processed. Data for each
+    time-range are read through a list of fetch-functions, e.g. one each for the reference and
+    temporary stations, which are called in order; as in the sequential workflow, the remaining
+    fetch-functions are skipped once one of them fails or returns no data. Note that reads through
+    FederatedASDFDataSet are serialised, both by its own lock and by that of h5py, so that
+    prefetching can at best overlap I/O with processing. Prefetched data are held in a bounded queue,
+    with the total size of queued data being capped; data for at least one time-range are always
+    prefetched, regardless of the cap.
+    """
+    def __init__(self, fetchers, time_ranges, depth=1, max_size_mb=2048):
+        """
+        :param fetchers: list of functions with signature f(start_time, end_time) that return Streams
+        :param time_ranges: list of (start_time, end_time) tuples
+        :param depth: maximum number of time-ranges to read ahead; data are read on the calling
+                      thread when set to 0
+        :param max_size_mb: maximum size (MB) of prefetched data held in the queue
+        """
+        self._fetchers = fetchers
+        self._time_ranges = time_ranges
+        self._depth = depth
+        self._max_nbytes = max_size_mb * 1024**2
+
+        self._nbytes = 0
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._thread = None
+    # end func
+
+    @staticmethod
+    def _size(streams):
+        return sum([tr.data.nbytes for st in streams if st is not None for tr in st])
+    # end func
+
+    def _fetch(self, t0, t1):
+        """
+        :return: list of (Stream, Exception) tuples, one for each fetch-function; both are None for
+                 fetch-functions that were skipped
+        """
+        results = []
+        for f in self._fetchers:
+            if len(results) and (results[-1][0] is None or len(results[-1][0]) == 0):
+                results.append((None, None))
+                continue
+            # end if
+
+            try:
+                results.append((f(t0, t1), None))
+            except Exception as e:
+                results.append((None, e))
+            # end try
+        # end for
+
+        return results
+    # end func
+
+    def _produce(self):
+        for t0, t1 in self._time_ranges:
+            if self._stop.is_set(): break
+
+            results = self._fetch(t0, t1)
+            nbytes = self._size([st for st, _ in results])
+
+            # wait for queued data to drain if the cap would be exceeded
+            with self._cond:
+                while not self._stop.is_set() and self._nbytes > 0 and \
+                        self._nbytes + nbytes > self._max_nbytes:
+                    self._cond.wait(0.1)
+                # end while
+                self._nbytes += nbytes
+            # end with
+
+            while not self._stop.is_set():
+                try:
+                    self._queue.put((t0, t1, results, nbytes), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+                # end try
+            # end while
+        # end for
+    # end func
 
-        self._file = SpooledTemporaryFile(prefix = self._prefix, mode = 'w+b', max_size = max_size_mb * 1024**2, dir=dir)
+    def __iter__(self):
+        """
+        :return: generator of (start_time, end_time, results) tuples, where results is a list of
+                 (Stream, Exception) tuples, one for each fetch-function; Stream is None if the
+                 corresponding fetch-function raised an Exception or was skipped
+        """
+        if self._depth < 1:
+            for t0, t1 in self._time_ranges:
+                yield t0, t1, self._fetch(t0, t1)
+            # end for
+            return
+        # end if
+
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+        try:
+            for _ in self._time_ranges:
+                while True:
+                    try:
+                        t0, t1, results, nbytes = self._queue.get(timeout=0.1)
+                        break
+                    except queue.Empty:
+                        if not self._thread.is_alive() and self._queue.empty():
+                            raise RuntimeError('Prefetching thread terminated unexpectedly')
+                        # end if
+                    # end try
+                # end while
+
+                with self._cond:
+                    self._nbytes -= nbytes
+                    self._cond.notify_all()
+                # end with
+
+                yield t0, t1, results
+            # end for
+        finally:
+            self._stop.set()
+            self._thread.join()
+        # end try
+    # end func
+# end class
+
+class XcorrNetCDFWriter:
+    """
+    Incremental writer for cross-correlation results. Rows of cross-correlations computed for each
+    interval are buffered in memory and written out, a chunk at a time, to a chunked, compressed
+    NetCDF4 variable with an unlimited 'interval' dimension. For ensemble stacks, only a running
+    sum of rows is maintained, in memory. Results are written to a temporary file, which is moved
+    into place when the writer is closed.
+    """
+    def __init__(self, fn, description='', ensemble_stack=False, chunk_rows=32):
+        """
+        :param fn: output file name
+        :param description: description attribute of output file
+        :param ensemble_stack: only a stack of all rows is written out when set
+        :param chunk_rows: number of rows per chunk of the 'xcorr' variable
+        """
+        self._fn = fn
+        self._tmp_fn = fn + '.tmp'
+        self._description = description
+        self._ensemble_stack = ensemble_stack
+        self._chunk_rows = chunk_rows
+
+        self._root_grp = None
+        self._ncols = 0
+        self._nrows = 0 # rows written out
+        self._buffer = [] # rows buffered in memory, along with corresponding metadata
+        self._nbuffered = 0
+
+        # ensemble-stack accumulators
+        self._stack = None
+        self._window_count = 0
+        self._interval_count = 0
+        self._sum_positive_window_counts = 0
+        self._start_time = None
+        self._end_time = None
     # end func
-    
+
     @property
     def ncols(self):
         return self._ncols
     # end func
-    
+
     @property
     def nrows(self):
-        return self._nrows
+        return self._nrows + self._nbuffered
+    # end func
+
+    @property
+    def root_grp(self):
+        """
+        :return: the underlying netCDF4 Dataset, which can be used to add further variables or \
+                 attributes before the writer is closed; None if no rows have been written
+        """
+        return self._root_grp
+    # end func
+
+    def _open(self, ncols):
+        self._ncols = ncols
+        self._root_grp = Dataset(self._tmp_fn, 'w', format='NETCDF4')
+        self._root_grp.description = self._description
+
+        self._root_grp.createDimension('lag', ncols)
+        self._root_grp.createDimension('nchar', 10)
+
+        if not self._ensemble_stack:
+            self._root_grp.createDimension('interval', None)
+            self._root_grp.createVariable('interval', 'f4', ('interval',))
+            self._root_grp.createVariable('NumStackedWindows', 'f4', ('interval',))
+            self._root_grp.createVariable('IntervalStartTimes', 'i8', ('interval',))
+            self._root_grp.createVariable('IntervalEndTimes', 'i8', ('interval',))
+            self._root_grp.createVariable('xcorr', 'f4', ('interval', 'lag',),
+                                          chunksizes=(self._chunk_rows, ncols),
+                                          zlib=True)
+        # end if
     # end func
 
-    def write_row(self, row_array):
-        assert(row_array.dtype == self._dtype) 
-        assert(len(row_array.shape) == 1)
-        assert(row_array.shape[0] == self._ncols)
+    def _flush(self):
+        if self._nbuffered == 0: return
+
+        rows, counts, starts, ends = [np.concatenate(items) for items in zip(*self._buffer)]
+        a, b = self._nrows, self._nrows + self._nbuffered
+
+        self._root_grp.variables['interval'][a:b] = np.arange(a, b)
+        self._root_grp.variables['NumStackedWindows'][a:b] = counts
+        self._root_grp.variables['IntervalStartTimes'][a:b] = starts
+        self._root_grp.variables['IntervalEndTimes'][a:b] = ends
+        self._root_grp.variables['xcorr'][a:b, :] = rows
 
-        self._file.write(row_array.data)
-        
-        self._nrows += 1
+        self._nrows = b
+        self._buffer = []
+        self._nbuffered = 0
     # end func
 
-    def read_row(self, row_idx):
-        if(row_idx < self._nrows):
-            seek_loc = row_idx * self._ncols * np.dtype(self._dtype).itemsize
-            self._file.seek(seek_loc)
+    def write(self, xcorr, window_counts, interval_start_times, interval_end_times):
+        """
+        :param xcorr: 2D array of cross-correlations (nintervals x nlags)
+        :param window_counts: 1D array of number of windows stacked in each interval
+        :param interval_start_times: 1D array of interval start-times (s)
+        :param interval_end_times: 1D array of interval end-times (s)
+        """
+        if self._root_grp is None: self._open(xcorr.shape[1])
+        assert xcorr.shape[1] == self._ncols
+
+        window_counts = np.asarray(window_counts).ravel()
+        interval_start_times = np.asarray(interval_start_times).ravel()
+        interval_end_times = np.asarray(interval_end_times).ravel()
+
+        if self._ensemble_stack:
+            if self._stack is None: self._stack = np.zeros(self._ncols)
+            self._stack += np.sum(xcorr, axis=0)
+            self._nbuffered += xcorr.shape[0]
+
+            self._window_count += int(np.sum(window_counts))
+            self._interval_count += int(np.sum(window_counts > 0))
+            self._sum_positive_window_counts += np.sum(window_counts[window_counts > 0])
+
+            st, et = int(np.min(interval_start_times)), int(np.max(interval_end_times))
+            self._start_time = st if self._start_time is None else min(self._start_time, st)
+            self._end_time = et if self._end_time is None else max(self._end_time, et)
+        else:
+            self._buffer.append((np.asarray(xcorr), window_counts,
+                                 interval_start_times, interval_end_times))
+            self._nbuffered += xcorr.shape[0]
+
+            if self._nbuffered >= self._chunk_rows: self._flush()
+        # end if
+    # end func
 
-            nbytes = self._ncols * np.dtype(self._dtype).itemsize
-            row = np.frombuffer(self._file.read(nbytes), dtype=self._dtype)
-        
-            return row
+    def close(self):
+        """
+        Writes out remaining results and moves the output file into place; nothing is written
+        out if no rows have been written
+        """
+        if self._root_grp is None: return
+
+        if self._ensemble_stack:
+            nsw = self._root_grp.createVariable('NumStackedWindows', 'i8')
+            avgnsw = self._root_grp.createVariable('AvgNumStackedWindowsPerInterval', 'f4')
+            ist = self._root_grp.createVariable('IntervalStartTime', 'i8')
+            iet = self._root_grp.createVariable('IntervalEndTime', 'i8')
+            xc = self._root_grp.createVariable('xcorr', 'f4', ('lag',))
+
+            nsw[:] = self._window_count
+            avgnsw[:] = self._sum_positive_window_counts / float(self._interval_count) \
+                        if self._interval_count > 0 else np.nan
+            ist[:] = self._start_time
+            iet[:] = self._end_time
+
+            if self._interval_count > 0:
+                xc[:] = self._stack / float(self._interval_count)
+            else:
+                xc[:] = self._stack
+            # end if
+            self._nrows += self._nbuffered
+            self._nbuffered = 0
         else:
-            return None
+            self._flush()
+        # end if
+
+        self._root_grp.close()
+        self._root_grp = None
+        os.replace(self._tmp_fn, self._fn)
     # end func
 
     def __del__(self):
-        self._file.close()
+        # discard incomplete results
+        if self._root_grp is not None:
+            try:
+                self._root_grp.close()
+                os.remove(self._tmp_fn)
+            except Exception:
+                pass
+            # end try
+        # end if
     # end func
 # end class
 
@@ -16,6 +16,12 @@ Revision History:
     LastUpdate:     11/07/18   RH       Implemented parallel cross-correlator
     LastUpdate:     19/07/18   RH       Implemented cross-correlation approaches described in Habel et al. 2018
     LastUpdate:     05/05/21   RH       Implemented spooling for computed x-correlations
+    LastUpdate:     17/10/26   agent    Added support for station-centric caches of window-spectra
+    LastUpdate:     17/10/26   agent    Added batched processing of windows within intervals
+    LastUpdate:     17/10/26   agent    Instrument response spectra are now cached
+    LastUpdate:     17/10/26   agent    Data buffers are prefetched on a background thread
+    LastUpdate:     17/10/26   agent    Results are written incrementally to NetCDF, replacing spooling
+    LastUpdate:     17/10/26   agent    Windows are cross-correlated via real FFTs through reusable plans
 """
 
 import os
@@ -31,13 +37,16 @@ from obspy import Trace
 from obspy.signal.filter import bandpass, highpass, lowpass
 from obspy.geodetics.base import gps2dist_azimuth
 from scipy import signal
+from scipy.ndimage import uniform_filter1d
 
-from seismic.xcorqc.fft import *
+from seismic.xcorqc.fft import fftn, ifftn, rfft, irfft, get_rfft_plan, ndflip
 from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
-from seismic.xcorqc.utils import get_stream, fill_gaps
+from seismic.xcorqc.utils import get_stream, fill_gaps, BufferPrefetcher
 from netCDF4 import Dataset
 from functools import reduce
-from seismic.xcorqc.utils import SpooledXcorrResults 
+from seismic.xcorqc.utils import XcorrNetCDFWriter
+from seismic.xcorqc.spectral_cache import xcorr_cached
+from seismic.response_cache import response_spectrum_cache, apply_response_spectrum
 logging.basicConfig()
 
 
@@ -66,17 +75,17 @@ def zeropad(tr, padlen):
 
 
 def zeropad_ba(tr, padlen):
-    assert (tr.shape[0] < padlen)
-    padded = np.zeros(padlen, dtype=np.complex_)
-    s = int((padlen - tr.shape[0]) / 2)
-    padded[s:(s + tr.shape[0])] = scipy.fftpack.fftshift(tr)
-    return scipy.fftpack.ifftshift(padded)
+    assert (tr.shape[-1] < padlen)
+    padded = np.zeros(tr.shape[:-1] + (padlen,), dtype=np.complex_)
+    s = int((padlen - tr.shape[-1]) / 2)
+    padded[..., s:(s + tr.shape[-1])] = scipy.fftpack.fftshift(tr, axes=-1)
+    return scipy.fftpack.ifftshift(padded, axes=-1)
 # end func
 
 
 def taper(tr, taperlen):
-    tr[0:taperlen] *= 0.5 * (1 + np.cos(np.linspace(-math.pi, 0, taperlen)))
-    tr[-taperlen:] *= 0.5 * (1 + np.cos(np.linspace(0, math.pi, taperlen)))
+    tr[..., 0:taperlen] *= 0.5 * (1 + np.cos(np.linspace(-math.pi, 0, taperlen)))
+    tr[..., -taperlen:] *= 0.5 * (1 + np.cos(np.linspace(0, math.pi, taperlen)))
     return tr
 # end func
 
@@ -88,25 +97,25 @@ def whiten(a, sampling_rate, window_freq=0):
     nonzero, a smoothed amplitude spectrum (smoothing window length is as computed below) is used
     to normalize the frequency bins.
 
-    :param a: trace samples
+    :param a: trace samples; 2D arrays of windows (nwindows x nsamples) are whitened along the last axis
     :param sampling_rate: sampling rate
     :param window_freq: smoothing window length (Hz)
     :return: spectrally whitened samples
     """
 
     def movmean(x, wlen):
-        s = numpy.r_[x[wlen - 1:0:-1], x, x[-2:-wlen - 1:-1]]
+        s = np.r_[x[wlen - 1:0:-1], x, x[-2:-wlen - 1:-1]]
         w = np.ones(wlen) / float(wlen)
-        y = numpy.convolve(s, w, mode='valid')
+        y = np.convolve(s, w, mode='valid')
 
         return y[wlen // 2:-(wlen // 2)]
     # end func
 
     # frequency step
-    npts = a.shape[0]
+    npts = a.shape[-1]
     deltaf = sampling_rate / npts
 
-    ffta = np.fft.rfft(a)
+    ffta = np.fft.rfft(a, axis=-1)
 
     # smooth amplitude spectrum
     halfwindow = int(round(window_freq / deltaf / 2.0))
@@ -114,25 +123,441 @@ def whiten(a, sampling_rate, window_freq=0):
     if halfwindow > 0:
         # moving average
         #weight = np.convolve(np.abs(ffta), np.ones(halfwindow * 2 + 1) / (halfwindow * 2 + 1), mode='same')
-        weight = movmean(np.abs(ffta), halfwindow * 2 + 1)
+        if ffta.ndim == 1:
+            weight = movmean(np.abs(ffta), halfwindow * 2 + 1)
+        else:
+            # same as movmean, applied to all rows at once
+            weight = uniform_filter1d(np.abs(ffta), halfwindow * 2 + 1, axis=-1, mode='mirror')
+        # end if
     else:
         weight = np.abs(ffta)
 
     ss = ffta / weight
 
-    a = np.fft.irfft(ss)
+    a = np.fft.irfft(ss, axis=-1)
 
     return a
 # end func
 
 
+def preprocess_window(data, sampling_rate, window_samples, target_sampling_rate, header=None,
+                      sta_inv=None, instrument_response_output='vel', water_level=50.,
+                      resample_rate=None, taper_length=0.05, window_buffer_seconds=0,
+                      flo=None, fhi=None, clip_to_2std=False, whitening=False,
+                      whitening_window_frequency=0, one_bit_normalize=False, response_cache=None,
+                      logger=None):
+    """
+    Applies the per-window processing steps (detrending through to the final bandpass) that precede
+    cross-correlation. Each trace of a station-pair is processed independently, which allows
+    preprocessed windows to be reused across station-pairs -- see spectral_cache.py.
+
+    :param data: gap-free window samples, including window-buffers, if any
+    :param sampling_rate: original sampling rate of data
+    :param window_samples: number of samples in the buffered window
+    :param target_sampling_rate: sampling rate after resampling; equals sampling_rate if no resampling \
+                                 is to be applied
+    :param header: dict of trace-header values (network, station, location, channel, starttime, endtime) \
+                   required for instrument response removal
+    :param sta_inv: Inventory containing instrument response for station
+    :param taper_length: taper length as a fraction of the buffered window length
+    :param window_buffer_seconds: length of window-buffer (s) to be removed after processing
+    :param response_cache: ResponseSpectrumCache for inverted instrument response spectra; default is the \
+                           process-wide cache
+    :return: processed window samples
+    """
+    tr_d = np.array(data, dtype=np.float32)
+
+    # STEP 1: detrend
+    tr_d = signal.detrend(tr_d)
+
+    # STEP 2: demean
+    tr_d -= np.mean(tr_d)
+
+    # STEP 3: remove response
+    if sta_inv:
+        if response_cache is None: response_cache = response_spectrum_cache
+        hdr = dict(header) if header else {}
+        hdr.update({'sampling_rate': sampling_rate, 'npts': len(tr_d)})
+        resp_tr = Trace(data=tr_d, header=Stats(header=hdr))
+        try:
+            response_cache.remove_response(resp_tr, sta_inv, output=instrument_response_output.upper(),
+                                           water_level=water_level)
+        except Exception as e:
+            if logger: logger.error(str(e))
+        # end try
+
+        tr_d = resp_tr.data
+    # end if
+
+    # STEPS 4, 5: resample after lowpass @ resample_rate/2 Hz
+    if resample_rate:
+        tr_d = lowpass(tr_d, resample_rate/2., sampling_rate, corners=2, zerophase=True)
+
+        tr_d = Trace(data=tr_d,
+                     header=Stats(header={'sampling_rate': sampling_rate,
+                                          'npts': window_samples})).resample(resample_rate,
+                                                                             no_filter=True).data
+    # end if
+
+    # STEP 6: Bandpass
+    if flo and fhi:
+        tr_d = bandpass(tr_d, flo, fhi, target_sampling_rate, corners=2, zerophase=True)
+    # end if
+
+    # STEP 7: time-domain normalization
+    # clip to +/- 2*std
+    if clip_to_2std:
+        std_tr = np.std(tr_d)
+        clip_indices_tr = np.fabs(tr_d) > 2 * std_tr
+
+        tr_d[clip_indices_tr] = 2 * std_tr * np.sign(tr_d[clip_indices_tr])
+    # end if
+
+    # 1-bit normalization
+    if one_bit_normalize:
+        tr_d = np.sign(tr_d)
+    # end if
+
+    # Apply Rhys Hawkins-style default time domain normalization
+    if (clip_to_2std == 0) and (one_bit_normalize == 0):
+        # 0-mean
+        tr_d -= np.mean(tr_d)
+
+        # unit-std
+        tr_d /= np.std(tr_d)
+    # end if
+
+    # STEP 8: taper
+    if taper_length > 0:
+        tr_d = taper(tr_d, int(np.round(taper_length*tr_d.shape[0])))
+    # end if
+
+    # STEP 9: spectral whitening
+    if whitening:
+        tr_d = whiten(tr_d, target_sampling_rate, window_freq=whitening_window_frequency)
+
+        # STEP 10: taper
+        if taper_length > 0:
+            tr_d = taper(tr_d, int(np.round(taper_length*tr_d.shape[0])))
+        # end if
+    # end if
+
+    # STEP 11: Final bandpass
+    # apply zero-phase bandpass
+    if flo and fhi:
+        tr_d = bandpass(tr_d, flo, fhi, target_sampling_rate, corners=2, zerophase=True)
+    # end if
+
+    if window_buffer_seconds:
+        # extract window of interest from buffered window
+        tr_d = tr_d[int(window_buffer_seconds*target_sampling_rate):-int(window_buffer_seconds*target_sampling_rate)]
+    # end if
+
+    return tr_d
+# end func
+
+
+def _zerophase_sosfilt(sos, data):
+    """
+    Applies a filter, in second-order sections, forwards and backwards along the last axis, as in
+    obspy.signal.filter with zerophase=True
+    """
+    firstpass = signal.sosfilt(sos, data, axis=-1)
+    return signal.sosfilt(sos, firstpass[..., ::-1], axis=-1)[..., ::-1]
+# end func
+
+
+def lowpass_windows(data, freq, df, corners=4):
+    """
+    Zero-phase Butterworth lowpass filter applied along the last axis of a 2D array of windows;
+    equivalent to obspy.signal.filter.lowpass with zerophase=True, applied to each row.
+    """
+    f = min(freq / (0.5 * df), 1.0)
+    z, p, k = signal.iirfilter(corners, f, btype='lowpass', ftype='butter', output='zpk')
+    return _zerophase_sosfilt(signal.zpk2sos(z, p, k), data)
+# end func
+
+
+def bandpass_windows(data, freqmin, freqmax, df, corners=4):
+    """
+    Zero-phase Butterworth bandpass filter applied along the last axis of a 2D array of windows;
+    equivalent to obspy.signal.filter.bandpass with zerophase=True, applied to each row.
+    """
+    fe = 0.5 * df
+    low = freqmin / fe
+    high = freqmax / fe
+    if high - 1.0 > -1e-6:
+        # high corner at or above Nyquist: apply a highpass instead, as in obspy
+        z, p, k = signal.iirfilter(corners, low, btype='highpass', ftype='butter', output='zpk')
+    elif low > 1:
+        raise ValueError('Selected low corner frequency is above Nyquist.')
+    else:
+        z, p, k = signal.iirfilter(corners, [low, high], btype='band', ftype='butter', output='zpk')
+    # end if
+    return _zerophase_sosfilt(signal.zpk2sos(z, p, k), data)
+# end func
+
+
+def resample_windows(data, sampling_rate, resample_rate):
+    """
+    Fourier-domain resampling along the last axis of a 2D array of windows; equivalent to
+    obspy.Trace.resample (Hann window, no_filter=True), applied to each row.
+
+    :param data: 2D array of windows (nwindows x nsamples)
+    :param sampling_rate: original sampling rate
+    :param resample_rate: target sampling rate
+    :return: 2D array of resampled windows
+    """
+    npts = data.shape[-1]
+    num = int(npts / (sampling_rate / float(resample_rate)))
+
+    x = rfft(data, axis=-1)
+    x *= np.fft.ifftshift(signal.get_window('hann', npts))[:npts // 2 + 1]
+
+    # linear interpolation weights onto the new frequency grid are shared by all rows
+    df = sampling_rate / float(npts)
+    large_f = resample_rate / float(num) * np.arange(num // 2 + 1) / df
+    lo = np.clip(np.floor(large_f).astype('i8'), 0, npts // 2)
+    hi = np.minimum(lo + 1, npts // 2)
+    w = np.clip(large_f - lo, 0, 1)
+    y = x[..., lo] * (1 - w) + x[..., hi] * w
+
+    return irfft(y, n=num, axis=-1) * (float(num) / float(npts))
+# end func
+
+
+def remove_response_windows(data, sampling_rate, seed_id, starttimes, sta_inv, output='vel',
+                            water_level=50., response_cache=None, logger=None):
+    """
+    Removes instrument response from a 2D array of windows; equivalent to obspy.Trace.remove_response
+    with default parameters, applied to each row. Inverted response spectra are fetched from a
+    ResponseSpectrumCache, so that they are computed only once for each channel-epoch, and are
+    applied to all windows of a channel-epoch with a single multiplication in the frequency domain.
+
+    :param data: 2D array of windows (nwindows x nsamples)
+    :param sampling_rate: sampling rate
+    :param seed_id: NET.STA.LOC.CHA
+    :param starttimes: list of start-times (UTCDateTime) of windows
+    :param sta_inv: Inventory containing instrument response for station
+    :param output: output units, one of 'disp', 'vel' or 'acc'
+    :param water_level: water-level (dB)
+    :param response_cache: ResponseSpectrumCache; default is the process-wide cache
+    :param logger: logger instance
+    :return: 2D array of windows (float64), with instrument response removed. Windows for which no \
+             response could be found are returned unaltered
+    """
+    if response_cache is None: response_cache = response_spectrum_cache
+    result = np.array(data, dtype=np.float64)
+    npts = result.shape[-1]
+
+    # group windows by inverted response spectrum, i.e. by channel-epoch
+    groups = defaultdict(list)
+    spectra = {}
+    for i, t in enumerate(starttimes):
+        try:
+            _, spectrum = response_cache.get(sta_inv, seed_id, t, sampling_rate, npts,
+                                             output=output, water_level=water_level)
+        except Exception as e:
+            if logger: logger.error(str(e))
+            continue
+        # end try
+
+        if spectrum is None:
+            # polynomial responses are applied in the time domain
+            net, sta, loc, cha = seed_id.split('.')
+            tr = Trace(data=result[i], header=Stats(header={'network': net, 'station': sta,
+                                                            'location': loc, 'channel': cha,
+                                                            'sampling_rate': sampling_rate,
+                                                            'npts': npts, 'starttime': t}))
+            tr.remove_response(inventory=sta_inv, output=output.upper(), water_level=water_level)
+            result[i] = tr.data
+            continue
+        # end if
+
+        spectra[id(spectrum)] = spectrum
+        groups[id(spectrum)].append(i)
+    # end for
+
+    for sid, rows in groups.items():
+        rows = np.array(rows)
+        result[rows] = apply_response_spectrum(result[rows], spectra[sid])
+    # end for
+
+    return result
+# end func
+
+
+def preprocess_windows(data, sampling_rate, target_sampling_rate, seed_id=None, starttimes=None,
+                       sta_inv=None, instrument_response_output='vel', water_level=50.,
+                       resample_rate=None, taper_length=0.05, window_buffer_seconds=0,
+                       flo=None, fhi=None, clip_to_2std=False, whitening=False,
+                       whitening_window_frequency=0, one_bit_normalize=False,
+                       response_cache=None, logger=None):
+    """
+    Batched version of preprocess_window: applies the same processing steps to all windows of an
+    interval at once, with each row of data holding a gap-free window.
+
+    :param data: 2D array (nwindows x nsamples) of window samples, including window-buffers, if any
+    :param sampling_rate: original sampling rate of data
+    :param target_sampling_rate: sampling rate after resampling; equals sampling_rate if no resampling \
+                                 is to be applied
+    :param seed_id: NET.STA.LOC.CHA, required for instrument response removal
+    :param starttimes: list of start-times (UTCDateTime) of windows, required for instrument response removal
+    :param sta_inv: Inventory containing instrument response for station
+    :param taper_length: taper length as a fraction of the buffered window length
+    :param window_buffer_seconds: length of window-buffer (s) to be removed after processing
+    :param response_cache: ResponseSpectrumCache for inverted instrument response spectra; default is the \
+                           process-wide cache
+    :return: 2D array of processed windows
+    """
+    tr_d = np.array(data, dtype=np.float32)
+
+    # STEP 1: detrend
+    tr_d = signal.detrend(tr_d, axis=-1)
+
+    # STEP 2: demean
+    tr_d -= np.mean(tr_d, axis=-1, keepdims=True)
+
+    # STEP 3: remove response
+    if sta_inv:
+        tr_d = remove_response_windows(tr_d, sampling_rate, seed_id, starttimes, sta_inv,
+                                       output=instrument_response_output, water_level=water_level,
+                                       response_cache=response_cache, logger=logger)
+    # end if
+
+    # STEPS 4, 5: resample after lowpass @ resample_rate/2 Hz
+    if resample_rate:
+        tr_d = lowpass_windows(tr_d, resample_rate/2., sampling_rate, corners=2)
+        tr_d = resample_windows(tr_d, sampling_rate, resample_rate)
+    # end if
+
+    # STEP 6: Bandpass
+    if flo and fhi:
+        tr_d = bandpass_windows(tr_d, flo, fhi, target_sampling_rate, corners=2)
+    # end if
+
+    # STEP 7: time-domain normalization
+    # clip to +/- 2*std
+    if clip_to_2std:
+        std_tr = 2 * np.std(tr_d, axis=-1, keepdims=True)
+        tr_d = np.where(np.fabs(tr_d) > std_tr, std_tr * np.sign(tr_d), tr_d)
+    # end if
+
+    # 1-bit normalization
+    if one_bit_normalize:
+        tr_d = np.sign(tr_d)
+    # end if
+
+    # Apply Rhys Hawkins-style default time domain normalization
+    if (clip_to_2std == 0) and (one_bit_normalize == 0):
+        # 0-mean
+        tr_d -= np.mean(tr_d, axis=-1, keepdims=True)
+
+        # unit-std
+        tr_d /= np.std(tr_d, axis=-1, keepdims=True)
+    # end if
+
+    # STEP 8: taper
+    if taper_length > 0:
+        tr_d = taper(tr_d, int(np.round(taper_length*tr_d.shape[-1])))
+    # end if
+
+    # STEP 9: spectral whitening
+    if whitening:
+        tr_d = whiten(tr_d, target_sampling_rate, window_freq=whitening_window_frequency)
+
+        # STEP 10: taper
+        if taper_length > 0:
+            tr_d = taper(tr_d, int(np.round(taper_length*tr_d.shape[-1])))
+        # end if
+    # end if
+
+    # STEP 11: Final bandpass
+    # apply zero-phase bandpass
+    if flo and fhi:
+        tr_d = bandpass_windows(tr_d, flo, fhi, target_sampling_rate, corners=2)
+    # end if
+
+    if window_buffer_seconds:
+        # extract window of interest from buffered window
+        tr_d = tr_d[:, int(window_buffer_seconds*target_sampling_rate):-int(window_buffer_seconds*target_sampling_rate)]
+    # end if
+
+    return tr_d
+# end func
+
+
+def _xcorr_window_batch(tr1, tr2, batch1, batch2, sr1_orig, sr2_orig, sr1, sr2, fftlen,
+                        sta1_inv, sta2_inv, instrument_response_output, water_level,
+                        resample_rate, taper_length, window_buffer_seconds, flo, fhi,
+                        clip_to_2std, whitening, whitening_window_frequency, one_bit_normalize,
+                        logger):
+    """
+    Preprocesses and cross-correlates a batch of windows from an interval in xcorr2, returning the
+    mean cross-spectrum along with the number of windows stacked. The mean spectrum is one-sided
+    (length fftlen // 2 + 1) when both traces share the same sampling rate and two-sided otherwise.
+    """
+    def process(tr, batch, sr_orig, sr, sta_inv):
+        data = np.vstack([np.ma.getdata(tr.data[s:e]) for s, e in batch])
+        return preprocess_windows(data, sr_orig, sr, seed_id=tr.id,
+                                  starttimes=[tr.stats.starttime + float(s)/sr_orig for s, _ in batch],
+                                  sta_inv=sta_inv,
+                                  instrument_response_output=instrument_response_output,
+                                  water_level=water_level, resample_rate=resample_rate,
+                                  taper_length=taper_length,
+                                  window_buffer_seconds=window_buffer_seconds,
+                                  flo=flo, fhi=fhi, clip_to_2std=clip_to_2std, whitening=whitening,
+                                  whitening_window_frequency=whitening_window_frequency,
+                                  one_bit_normalize=one_bit_normalize,
+                                  logger=logger)
+    # end func
+
+    tr1_d = process(tr1, batch1, sr1_orig, sr1, sta1_inv)
+    tr2_d = process(tr2, batch2, sr2_orig, sr2, sta2_inv)
+
+    sr = max(sr1, sr2)
+    if sr1 < sr2:
+        fftlen2 = fftlen
+        fftlen1 = int((fftlen2 * 1.0 * sr1) / sr)
+        rf = zeropad_ba(fftn(tr1_d, shape=[fftlen1], axes=[-1]), fftlen2) * \
+             fftn(tr2_d[:, ::-1], shape=[fftlen2], axes=[-1])
+    elif sr1 > sr2:
+        fftlen1 = fftlen
+        fftlen2 = int((fftlen1 * 1.0 * sr2) / sr)
+        rf = fftn(tr1_d, shape=[fftlen1], axes=[-1]) * \
+             zeropad_ba(fftn(tr2_d[:, ::-1], shape=[fftlen2], axes=[-1]), fftlen1)
+    else:
+        rf = rfft(tr1_d, n=fftlen, axis=-1) * rfft(tr2_d[:, ::-1], n=fftlen, axis=-1)
+    # end if
+
+    rf = rf[~np.isnan(rf).any(axis=-1)]
+    windowCount = rf.shape[0]
+    if windowCount == 0: return None, 0
+
+    return np.sum(rf, axis=0) / float(windowCount), windowCount
+# end func
+
+
 def xcorr2(tr1, tr2, sta1_inv=None, sta2_inv=None,
            instrument_response_output='vel', water_level=50.,
            window_seconds=3600, window_overlap=0.1, window_buffer_length=0,
            interval_seconds=86400, taper_length=0.05, resample_rate=None,
            flo=None, fhi=None, clip_to_2std=False, whitening=False,
            whitening_window_frequency=0, one_bit_normalize=False, envelope_normalize=False,
-           verbose=1, logger=None):
+           batch_windows=False, verbose=1, logger=None):
+    """
+    Cross-correlates two traces over windows that are stacked within intervals; see IntervalStackXCorr
+    for a description of parameters.
+
+    :param batch_windows: gather all gap-free windows of an interval into 2D arrays (nwindows x nsamples) \
+                          that are preprocessed and Fourier-transformed at once, as opposed to processing \
+                          one window at a time
+    :return: 1: 2d np.array of interval-stacked cross-correlations
+             2: 1d np.array of number of windows stacked within each interval
+             3: 1d np.array of interval start-times
+             4: 1d np.array of interval end-times
+             5: sampling rate of cross-correlations
+    """
 
     # Length of window_buffer in seconds
     window_buffer_seconds = window_buffer_length * window_seconds
@@ -201,6 +626,8 @@ def xcorr2(tr1, tr2, sta1_inv=None, sta2_inv=None,
         wtr1s = int(itr1s)
         wtr2s = int(itr2s)
         intervalXcorrList = []
+        batch1 = []  # window start/end indices gathered for batched processing
+        batch2 = []
 
         while wtr1s < itr1e and wtr2s < itr2e:
             wtr1e = int(min(itr1e, wtr1s + window_samples_1))
@@ -232,139 +659,47 @@ def xcorr2(tr1, tr2, sta1_inv=None, sta2_inv=None,
                 # logger.info('%s, %s' % (tr1.stats.starttime + wtr1s / 200., tr1.stats.starttime + wtr1e / sr1_orig))
                 # logger.info('%s, %s' % (tr2.stats.starttime + wtr2s / 200., tr2.stats.starttime + wtr2e / sr2_orig))
 
-                tr1_d = np.array(tr1_d_all[wtr1s:wtr1e], dtype=np.float32)
-                tr2_d = np.array(tr2_d_all[wtr2s:wtr2e], dtype=np.float32)
-
-                # STEP 1: detrend
-                tr1_d = signal.detrend(tr1_d)
-                tr2_d = signal.detrend(tr2_d)
-
-                # STEP 2: demean
-                tr1_d -= np.mean(tr1_d)
-                tr2_d -= np.mean(tr2_d)
-
-                # STEP 3: remove response
-                if sta1_inv:
-                    resp_tr1 = Trace(data=tr1_d,
-                                     header=Stats(header={'sampling_rate': sr1_orig,
-                                                          'npts': len(tr1_d),
-                                                          'network': tr1.stats.network,
-                                                          'station': tr1.stats.station,
-                                                          'location': tr1.stats.location,
-                                                          'channel': tr1.stats.channel,
-                                                          'starttime': tr1.stats.starttime + float(wtr1s)/sr1_orig,
-                                                          'endtime': tr1.stats.starttime + float(wtr1e)/sr1_orig}))
-                    try:
-                        resp_tr1.remove_response(inventory=sta1_inv, output=instrument_response_output.upper(),
-                                                 water_level=water_level)
-                    except Exception as e:
-                        logger.error(str(e))
-                    # end try
-
-                    tr1_d = resp_tr1.data
-                # end if
-
-                # remove response
-                if sta2_inv:
-                    resp_tr2 = Trace(data=tr2_d,
-                                     header=Stats(header={'sampling_rate': sr2_orig,
-                                                          'npts': len(tr2_d),
-                                                          'network': tr2.stats.network,
-                                                          'station': tr2.stats.station,
-                                                          'location': tr2.stats.location,
-                                                          'channel': tr2.stats.channel,
-                                                          'starttime': tr2.stats.starttime + float(wtr2s)/sr2_orig,
-                                                          'endtime': tr2.stats.starttime + float(wtr2e)/sr2_orig}))
-                    try:
-                        resp_tr2.remove_response(inventory=sta2_inv, output=instrument_response_output.upper(),
-                                                 water_level=water_level)
-                    except Exception as e:
-                        logger.error(str(e))
-                    # end try
-
-                    tr2_d = resp_tr2.data
-                # end if
-
-                # STEPS 4, 5: resample after lowpass @ resample_rate/2 Hz
-                if resample_rate:
-                    tr1_d = lowpass(tr1_d, resample_rate/2., sr1_orig, corners=2, zerophase=True)
-                    tr2_d = lowpass(tr2_d, resample_rate/2., sr2_orig, corners=2, zerophase=True)
-
-                    tr1_d = Trace(data=tr1_d,
-                                  header=Stats(header={'sampling_rate': sr1_orig,
-                                                       'npts': window_samples_1})).resample(resample_rate,
-                                                                                           no_filter=True).data
-                    tr2_d = Trace(data=tr2_d,
-                                  header=Stats(header={'sampling_rate': sr2_orig,
-                                                       'npts': window_samples_2})).resample(resample_rate,
-                                                                                           no_filter=True).data
-                # end if
-
-                # STEP 6: Bandpass
-                if flo and fhi:
-                    tr1_d = bandpass(tr1_d, flo, fhi, sr1, corners=2, zerophase=True)
-                    tr2_d = bandpass(tr2_d, flo, fhi, sr2, corners=2, zerophase=True)
-                # end if
-
-                # STEP 7: time-domain normalization
-                # clip to +/- 2*std
-                if clip_to_2std:
-                    std_tr1 = np.std(tr1_d)
-                    std_tr2 = np.std(tr2_d)
-                    clip_indices_tr1 = np.fabs(tr1_d) > 2 * std_tr1
-                    clip_indices_tr2 = np.fabs(tr2_d) > 2 * std_tr2
-
-                    tr1_d[clip_indices_tr1] = 2 * std_tr1 * np.sign(tr1_d[clip_indices_tr1])
-                    tr2_d[clip_indices_tr2] = 2 * std_tr2 * np.sign(tr2_d[clip_indices_tr2])
-                # end if
-
-                # 1-bit normalization
-                if one_bit_normalize:
-                    tr1_d = np.sign(tr1_d)
-                    tr2_d = np.sign(tr2_d)
-                # end if
-
-                # Apply Rhys Hawkins-style default time domain normalization
-                if (clip_to_2std == 0) and (one_bit_normalize == 0):
-                    # 0-mean
-                    tr1_d -= np.mean(tr1_d)
-                    tr2_d -= np.mean(tr2_d)
+                if batch_windows:
+                    batch1.append((wtr1s, wtr1e))
+                    batch2.append((wtr2s, wtr2e))
 
-                    # unit-std
-                    tr1_d /= np.std(tr1_d)
-                    tr2_d /= np.std(tr2_d)
+                    wtr1s += int((window_samples_1 - 2*window_buffer_seconds*sr1_orig) -
+                                 (window_samples_1 - 2*window_buffer_seconds*sr1_orig) * window_overlap)
+                    wtr2s += int((window_samples_2 - 2*window_buffer_seconds*sr2_orig) -
+                                 (window_samples_2 - 2*window_buffer_seconds*sr2_orig) * window_overlap)
+                    continue
                 # end if
 
-                # STEP 8: taper
-                if adjusted_taper_length > 0:
-                    tr1_d = taper(tr1_d, int(np.round(adjusted_taper_length*tr1_d.shape[0])))
-                    tr2_d = taper(tr2_d, int(np.round(adjusted_taper_length*tr2_d.shape[0])))
-                # end if
-
-                # STEP 9: spectral whitening
-                if whitening:
-                    tr1_d = whiten(tr1_d, sr1, window_freq=whitening_window_frequency)
-                    tr2_d = whiten(tr2_d, sr2, window_freq=whitening_window_frequency)
-
-                    # STEP 10: taper
-                    if adjusted_taper_length > 0:
-                        tr1_d = taper(tr1_d, int(np.round(adjusted_taper_length*tr1_d.shape[0])))
-                        tr2_d = taper(tr2_d, int(np.round(adjusted_taper_length*tr2_d.shape[0])))
-                    # end if
-                # end if
-
-                # STEP 11: Final bandpass
-                # apply zero-phase bandpass
-                if flo and fhi:
-                    tr1_d = bandpass(tr1_d, flo, fhi, sr1, corners=2, zerophase=True)
-                    tr2_d = bandpass(tr2_d, flo, fhi, sr2, corners=2, zerophase=True)
-                # end if
-
-                if window_buffer_seconds:
-                    # extract window of interest from buffered window
-                    tr1_d = tr1_d[int(window_buffer_seconds*sr1):-int(window_buffer_seconds*sr1)]
-                    tr2_d = tr2_d[int(window_buffer_seconds*sr2):-int(window_buffer_seconds*sr2)]
-                # end if
+                tr1_d = preprocess_window(tr1_d_all[wtr1s:wtr1e], sr1_orig, window_samples_1, sr1,
+                                          header={'network': tr1.stats.network,
+                                                  'station': tr1.stats.station,
+                                                  'location': tr1.stats.location,
+                                                  'channel': tr1.stats.channel,
+                                                  'starttime': tr1.stats.starttime + float(wtr1s)/sr1_orig,
+                                                  'endtime': tr1.stats.starttime + float(wtr1e)/sr1_orig},
+                                          sta_inv=sta1_inv,
+                                          instrument_response_output=instrument_response_output,
+                                          water_level=water_level, resample_rate=resample_rate,
+                                          taper_length=adjusted_taper_length,
+                                          window_buffer_seconds=window_buffer_seconds,
+                                          flo=flo, fhi=fhi, clip_to_2std=clip_to_2std, whitening=whitening,
+                                          whitening_window_frequency=whitening_window_frequency,
+                                          one_bit_normalize=one_bit_normalize, logger=logger)
+                tr2_d = preprocess_window(tr2_d_all[wtr2s:wtr2e], sr2_orig, window_samples_2, sr2,
+                                          header={'network': tr2.stats.network,
+                                                  'station': tr2.stats.station,
+                                                  'location': tr2.stats.location,
+                                                  'channel': tr2.stats.channel,
+                                                  'starttime': tr2.stats.starttime + float(wtr2s)/sr2_orig,
+                                                  'endtime': tr2.stats.starttime + float(wtr2e)/sr2_orig},
+                                          sta_inv=sta2_inv,
+                                          instrument_response_output=instrument_response_output,
+                                          water_level=water_level, resample_rate=resample_rate,
+                                          taper_length=adjusted_taper_length,
+                                          window_buffer_seconds=window_buffer_seconds,
+                                          flo=flo, fhi=fhi, clip_to_2std=clip_to_2std, whitening=whitening,
+                                          whitening_window_frequency=whitening_window_frequency,
+                                          one_bit_normalize=one_bit_normalize, logger=logger)
 
                 # cross-correlate waveforms
                 if sr1 < sr2:
@@ -378,8 +713,8 @@ def xcorr2(tr1, tr2, sta1_inv=None, sta2_inv=None,
                     rf = fftn(zeropad(tr1_d, fftlen1), shape=[fftlen1]) * zeropad_ba(
                         fftn(zeropad(ndflip(tr2_d), fftlen2), shape=[fftlen2]), fftlen1)
                 else:
-                    rf = fftn(zeropad(tr1_d, fftlen), shape=[fftlen]) * fftn(zeropad(ndflip(tr2_d), fftlen),
-                                                                             shape=[fftlen])
+                    # one-sided cross-spectrum from real FFTs, computed through reusable plans and buffers
+                    rf = get_rfft_plan(fftlen, 0)(tr1_d) * get_rfft_plan(fftlen, 1)(tr2_d, reverse=True)
                 # end if
 
                 if not np.isnan(rf).any():
@@ -394,6 +729,17 @@ def xcorr2(tr1, tr2, sta1_inv=None, sta2_inv=None,
                          (window_samples_2 - 2*window_buffer_seconds*sr2_orig) * window_overlap)
         # end while (windows within interval)
 
+        meanSpectrum = None
+        if len(batch1):
+            meanSpectrum, windowCount = _xcorr_window_batch(tr1, tr2, batch1, batch2, sr1_orig, sr2_orig,
+                                                            sr1, sr2, fftlen, sta1_inv, sta2_inv,
+                                                            instrument_response_output, water_level,
+                                                            resample_rate, adjusted_taper_length,
+                                                            window_buffer_seconds, flo, fhi, clip_to_2std,
+                                                            whitening, whitening_window_frequency,
+                                                            one_bit_normalize, logger)
+        # end if
+
         if verbose > 1:
             if logger:
                 logger.info('\tProcessed %d windows in interval %d' % (windowCount, intervalCount))
@@ -416,18 +762,37 @@ def xcorr2(tr1, tr2, sta1_inv=None, sta2_inv=None,
 
         windowsPerInterval.append(windowCount)
 
-        if windowCount > 0:
-            mean = reduce((lambda tx, ty: tx + ty), intervalXcorrList) / float(windowCount)
-        else:
-            mean = reduce((lambda tx, ty: tx + ty), intervalXcorrList) 
+        if meanSpectrum is None and windowCount > 0 and intervalXcorrList[0].shape[0] < fftlen:
+            meanSpectrum = reduce((lambda tx, ty: tx + ty), intervalXcorrList) / float(windowCount)
         # end if
 
-        if envelope_normalize:
-            step = np.sign(np.fft.fftfreq(fftlen, 1.0 / sr))
-            mean = mean + step * mean  # compute analytic
-        # end if
+        if meanSpectrum is not None and meanSpectrum.shape[0] < fftlen:
+            # one-sided spectrum from real FFTs
+            if envelope_normalize:
+                # compute analytic from one-sided spectrum
+                mean = np.zeros(fftlen, dtype=np.complex128)
+                mean[0] = meanSpectrum[0]
+                mean[1:fftlen // 2] = 2 * meanSpectrum[1:fftlen // 2]
+                mean = ifftn(mean)
+            else:
+                mean = irfft(meanSpectrum, n=fftlen)
+            # end if
+        else:
+            if meanSpectrum is not None:
+                mean = meanSpectrum
+            elif windowCount > 0:
+                mean = reduce((lambda tx, ty: tx + ty), intervalXcorrList) / float(windowCount)
+            else:
+                mean = reduce((lambda tx, ty: tx + ty), intervalXcorrList)
+            # end if
+
+            if envelope_normalize:
+                step = np.sign(np.fft.fftfreq(fftlen, 1.0 / sr))
+                mean = mean + step * mean  # compute analytic
+            # end if
 
-        mean = ifftn(mean)
+            mean = ifftn(mean)
+        # end if
 
         if envelope_normalize:
             # Compute magnitude of mean
@@ -473,7 +838,9 @@ def IntervalStackXCorr(refds, tempds,
                        clip_to_2std=False, whitening=False, whitening_window_frequency=0,
                        one_bit_normalize=False, envelope_normalize=False,
                        ensemble_stack=False,
-                       outputPath='/tmp', verbose=1, tracking_tag='', scratch_folder=None):
+                       outputPath='/tmp', verbose=1, tracking_tag='', scratch_folder=None,
+                       spectral_cache_manager=None, batch_windows=False,
+                       prefetch_depth=1, prefetch_max_mb=2048):
     """
     This function rolls through two ASDF data sets, over a given time-range and cross-correlates
     waveforms from all possible station-pairs from the two data sets. To allow efficient, random
@@ -562,6 +929,23 @@ def IntervalStackXCorr(refds, tempds,
     :param tracking_tag: File tag to be added to output file names so runtime settings can be tracked
     :type outputPath: str
     :param outputPath: Folder to write results to
+    :type scratch_folder: str
+    :param scratch_folder: Not used; retained for backward compatibility. Results are written incrementally \
+                           to outputPath
+    :type spectral_cache_manager: SpectralCacheManager
+    :param spectral_cache_manager: When provided, preprocessed window-spectra for each station are \
+                                   fetched from (or added to) the cache and reused across station-pairs. \
+                                   The standard workflow is used if sampling rates of the two stations differ
+    :type batch_windows: bool
+    :param batch_windows: Preprocess and Fourier-transform all windows within an interval at once, as 2D \
+                          arrays, as opposed to one window at a time
+    :type prefetch_depth: int
+    :param prefetch_depth: Number of data buffers (of length buffer_seconds) to read ahead on a background \
+                           thread while the current buffer is being cross-correlated; data for the \
+                           temporary station are only read if data for the reference station are found. \
+                           Data are read on the calling thread if set to 0
+    :type prefetch_max_mb: float
+    :param prefetch_max_mb: Maximum size (MB) of prefetched data held in memory
     :return: 1: 1d np.array with time samples spanning [-window_samples+dt:window_samples-dt]
              2: A dictionary of 2d np.arrays containing cross-correlation results for each station-pair. \
                 Rows in each 2d array represent number of interval_seconds processed and columns \
@@ -600,143 +984,157 @@ def IntervalStackXCorr(refds, tempds,
 
     cTime = startTime
 
-    windowCounts = []
-    intervalStartTimes = []
-    intervalEndTimes = []
     sr = 0
-    spooledXcorr = None
+    fn = os.path.join(outputPath, '%s.nc' % (stationPair if not tracking_tag else '.'.join([stationPair, tracking_tag])))
+    xcorrWriter = XcorrNetCDFWriter(fn, description='Cross-correlation results for station-pair: %s' % stationPair,
+                                    ensemble_stack=ensemble_stack)
+
+    refCache = None
+    tempCache = None
+    if spectral_cache_manager is not None:
+        cache_params = {'instrument_response_output': instrument_response_output,
+                        'water_level': water_level,
+                        'resample_rate': resample_rate,
+                        'taper_length': taper_length,
+                        'interval_seconds': interval_seconds,
+                        'window_seconds': window_seconds,
+                        'window_overlap': window_overlap,
+                        'window_buffer_length': window_buffer_length,
+                        'flo': flo, 'fhi': fhi,
+                        'clip_to_2std': clip_to_2std,
+                        'whitening': whitening,
+                        'whitening_window_frequency': whitening_window_frequency,
+                        'one_bit_normalize': one_bit_normalize}
+
+        logger.info('Fetching cached spectra for stations %s and %s..' % (ref_net_sta, temp_net_sta))
+        refCache = spectral_cache_manager.get(refds, ref_net_sta, ref_cha, startTime, endTime, cache_params,
+                                              location_preferences_dict, baz=baz_ref_net_sta,
+                                              sta_inv=ref_sta_inv, buffer_seconds=buffer_seconds,
+                                              logger=logger)
+        tempCache = spectral_cache_manager.get(tempds, temp_net_sta, temp_cha, startTime, endTime, cache_params,
+                                               location_preferences_dict, baz=baz_temp_net_sta,
+                                               sta_inv=temp_sta_inv, buffer_seconds=buffer_seconds,
+                                               logger=logger)
+
+        if refCache.sampling_rate != tempCache.sampling_rate:
+            logger.warning('\tSampling rates of cached spectra differ; reverting to standard workflow..')
+            refCache = None
+            tempCache = None
+        # end if
+    # end if
+
+    # time-ranges of data buffers
+    bufferRanges = []
     while cTime < endTime:
         cStep = buffer_seconds
 
         if (cTime + cStep) > endTime:
             cStep = endTime - cTime
 
-        logger.info('====Time range  [%s - %s]====' % (str(cTime), str(cTime + cStep)))
-        logger.info('Fetching data for station %s..' % ref_net_sta)
+        bufferRanges.append((cTime, cTime + cStep))
+        cTime += cStep
+    # wend
+
+    if refCache is None:
+        rnc, rsc = ref_net_sta.split('.')
+        tnc, tsc = temp_net_sta.split('.')
+
+        def fetch_ref(t0, t1):
+            logger.info('\tFetching data for station %s..' % ref_net_sta)
+            return get_stream(refds, rnc, rsc, ref_cha, t0, t1, location_preferences_dict,
+                              baz=baz_ref_net_sta, logger=logger, verbose=verbose)
+        # end func
+
+        def fetch_temp(t0, t1):
+            logger.info('\tFetching data for station %s..' % temp_net_sta)
+            return get_stream(tempds, tnc, tsc, temp_cha, t0, t1, location_preferences_dict,
+                              baz=baz_temp_net_sta, logger=logger, verbose=verbose)
+        # end func
+
+        # data for the next buffer are read while the current one is being cross-correlated
+        buffers = BufferPrefetcher([fetch_ref, fetch_temp], bufferRanges,
+                                   depth=prefetch_depth, max_size_mb=prefetch_max_mb)
+    else:
+        buffers = [(t0, t1, None) for t0, t1 in bufferRanges]
+    # end if
 
-        refSt = None
-        try:
-            rnc, rsc = ref_net_sta.split('.')
-            refSt = get_stream(refds, rnc, rsc,
-                               ref_cha, cTime, cTime + cStep,
-                               location_preferences_dict,
-                               baz=baz_ref_net_sta,
-                               logger=logger, verbose=verbose)
-        except Exception as e:
-            logger.error('\t'+str(e))
-            logger.warning('\tError encountered while fetching data. Skipping along..')
+    for cTime, cEnd, fetched in buffers:
+        cStep = cEnd - cTime
 
-        if refSt is None:
-            logger.info('Failed to fetch data..')
-            cTime += cStep
-            continue
-        elif len(refSt) == 0:
-            logger.info('Data source exhausted. Skipping time interval [%s - %s]' % (str(cTime), str(cTime + cStep)))
-            cTime += cStep
-            continue
+        logger.info('====Time range  [%s - %s]====' % (str(cTime), str(cTime + cStep)))
+        if refCache is not None:
+            logger.info('\tCross-correlating station-pair from cached spectra: %s' % stationPair)
+            xcl, winsPerInterval, \
+            intervalStartSeconds, intervalEndSeconds, sr = \
+                xcorr_cached(refCache, tempCache, cTime, cTime + cStep, window_seconds,
+                             envelope_normalize=envelope_normalize, verbose=verbose, logger=logger)
         else:
-            pass
-            # print refSt
-        # end if
-
-        logger.info('\tFetching data for station %s..' % temp_net_sta)
-
-        tempSt = None
-        try:
-            tnc, tsc = temp_net_sta.split('.')
-            tempSt = get_stream(tempds, tnc, tsc,
-                                temp_cha, cTime, cTime + cStep,
-                                location_preferences_dict,
-                                baz=baz_temp_net_sta,
-                                logger=logger, verbose=verbose)
-        except Exception as e:
-            logger.error('\t'+str(e))
-            logger.warning('\tError encountered while fetching data. Skipping along..')
-        # end try
+            (refSt, refError), (tempSt, tempError) = fetched
+
+            skip = False
+            for st, error, net_sta in [(refSt, refError, ref_net_sta), (tempSt, tempError, temp_net_sta)]:
+                if error is not None:
+                    logger.error('\t'+str(error))
+                    logger.warning('\tError encountered while fetching data for station %s. '
+                                   'Skipping along..' % net_sta)
+                # end if
 
-        if tempSt is None:
-            logger.info('Failed to fetch data..')
-            cTime += cStep
-            continue
-        elif len(tempSt) == 0:
-            logger.info('Data source exhausted. Skipping time interval [%s - %s]' % (str(cTime), str(cTime + cStep)))
-            cTime += cStep
-            continue
-        else:
-            pass
-            # print tempSt
+                if st is None:
+                    logger.info('Failed to fetch data..')
+                    skip = True
+                    break
+                elif len(st) == 0:
+                    logger.info('Data source exhausted. Skipping time interval [%s - %s]' %
+                                (str(cTime), str(cTime + cStep)))
+                    skip = True
+                    break
+                # end if
+            # end for
+            if skip: continue
+
+            if verbose > 2:
+                logger.debug('\t\tData Gaps:')
+                tempSt.print_gaps() # output sent to stdout; fix this
+                print("\n")
+
+            logger.info('\tCross-correlating station-pair: %s' % stationPair)
+            xcl, winsPerInterval, \
+            intervalStartSeconds, intervalEndSeconds, sr = \
+                xcorr2(refSt[0], tempSt[0], ref_sta_inv, temp_sta_inv,
+                       instrument_response_output=instrument_response_output,
+                       water_level=water_level,
+                       window_seconds=window_seconds,
+                       window_overlap=window_overlap,
+                       window_buffer_length=window_buffer_length,
+                       interval_seconds=interval_seconds,
+                       resample_rate=resample_rate,
+                       taper_length=taper_length,
+                       flo=flo, fhi=fhi,
+                       clip_to_2std=clip_to_2std,
+                       whitening=whitening,
+                       whitening_window_frequency=whitening_window_frequency,
+                       one_bit_normalize=one_bit_normalize,
+                       envelope_normalize=envelope_normalize,
+                       batch_windows=batch_windows,
+                       verbose=verbose, logger=logger)
         # end if
 
-        if verbose > 2:
-            logger.debug('\t\tData Gaps:')
-            tempSt.print_gaps() # output sent to stdout; fix this
-            print("\n")
-
-        logger.info('\tCross-correlating station-pair: %s' % stationPair)
-        xcl, winsPerInterval, \
-        intervalStartSeconds, intervalEndSeconds, sr = \
-            xcorr2(refSt[0], tempSt[0], ref_sta_inv, temp_sta_inv,
-                   instrument_response_output=instrument_response_output,
-                   water_level=water_level,
-                   window_seconds=window_seconds,
-                   window_overlap=window_overlap,
-                   window_buffer_length=window_buffer_length,
-                   interval_seconds=interval_seconds,
-                   resample_rate=resample_rate,
-                   taper_length=taper_length,
-                   flo=flo, fhi=fhi,
-                   clip_to_2std=clip_to_2std,
-                   whitening=whitening,
-                   whitening_window_frequency=whitening_window_frequency,
-                   one_bit_normalize=one_bit_normalize,
-                   envelope_normalize=envelope_normalize,
-                   verbose=verbose, logger=logger)
-
         # Continue if no results were returned due to data-gaps
         if xcl is None:
             logger.warning("\t\tWarning: no cross-correlation results returned for station-pair %s, " %
                   stationPair + " due to gaps in data.")
-            cTime += cStep
             continue
         # end if
 
-        if(spooledXcorr is None):
-            spooledXcorr = SpooledXcorrResults(xcl.shape[1], dtype=xcl.dtype, max_size_mb=2048, prefix=stationPair, dir=scratch_folder)
-        # end if
-        
-        # write xcorr results to spooled buffer
-        for irow in np.arange(xcl.shape[0]):
-            spooledXcorr.write_row(np.array(xcl[irow, :]))
-        # end for
-        windowCounts.append(winsPerInterval)
-        intervalStartTimes.append(intervalStartSeconds)
-        intervalEndTimes.append(intervalEndSeconds)
+        # write xcorr results incrementally
+        xcorrWriter.write(xcl, winsPerInterval, intervalStartSeconds, intervalEndSeconds)
+    # end for (loop over time range)
 
-        cTime += cStep
-    # wend (loop over time range)
+    if(xcorrWriter.nrows):
+        root_grp = xcorrWriter.root_grp
 
-    x = None
-    flattenedWindowCounts = None
-    flattenedIntervalStartTimes = None
-    flattenedIntervalEndTimes = None
-    if(spooledXcorr and spooledXcorr.nrows):
         dt = 1./sr
-        x = np.linspace(-window_seconds + dt, window_seconds - dt, spooledXcorr.ncols)
-                        
-
-        flattenedWindowCounts = np.concatenate(windowCounts).ravel()
-        flattenedIntervalStartTimes = np.concatenate(intervalStartTimes).ravel()
-        flattenedIntervalEndTimes = np.concatenate(intervalEndTimes).ravel()
-
-        # Save Results
-        fn = os.path.join(outputPath, '%s.nc' % (stationPair if not tracking_tag else '.'.join([stationPair, tracking_tag])))
-
-        root_grp = Dataset(fn, 'w', format='NETCDF4')
-        root_grp.description = 'Cross-correlation results for station-pair: %s' % stationPair
-
-        # Dimensions
-        root_grp.createDimension('lag', spooledXcorr.ncols)
-        root_grp.createDimension('nchar', 10)
+        x = np.linspace(-window_seconds + dt, window_seconds - dt, xcorrWriter.ncols)
 
         lag = root_grp.createVariable('lag', 'f4', ('lag',))
 
@@ -757,53 +1155,6 @@ def IntervalStackXCorr(refds, tempds,
             distance[:], _, _ = gps2dist_azimuth(lat1[:], lon1[:], lat2[:], lon2[:])
         # end if
 
-        # Add data
-        if ensemble_stack:
-            nsw = root_grp.createVariable('NumStackedWindows', 'i8')
-            avgnsw = root_grp.createVariable('AvgNumStackedWindowsPerInterval', 'f4')
-            ist = root_grp.createVariable('IntervalStartTime', 'i8')
-            iet = root_grp.createVariable('IntervalEndTime', 'i8')
-            xc = root_grp.createVariable('xcorr', 'f4', ('lag',))
-
-            totalIntervalCount = int(np.sum(flattenedWindowCounts > 0))
-            totalWindowCount = int(np.sum(flattenedWindowCounts))
-            nsw[:] = totalWindowCount
-            avgnsw[:] = np.mean(flattenedWindowCounts[flattenedWindowCounts>0])
-            ist[:] = int(np.min(flattenedIntervalStartTimes))
-            iet[:] = int(np.max(flattenedIntervalEndTimes))
-            
-            es = np.array(spooledXcorr.read_row(0))
-            for irow in np.arange(1, spooledXcorr.nrows):
-                es += spooledXcorr.read_row(irow)
-            # end for
-
-            if totalIntervalCount > 0:
-                xc[:] = es / float(totalIntervalCount)
-            else:
-                xc[:] = es
-            # end if
-        else:
-            root_grp.createDimension('interval', spooledXcorr.nrows)
-            # Variables
-            interval = root_grp.createVariable('interval', 'f4', ('interval',))
-            nsw = root_grp.createVariable('NumStackedWindows', 'f4', ('interval',))
-            ist = root_grp.createVariable('IntervalStartTimes', 'i8', ('interval',))
-            iet = root_grp.createVariable('IntervalEndTimes', 'i8', ('interval',))
-            xc = root_grp.createVariable('xcorr', 'f4', ('interval', 'lag',), 
-                                         chunksizes=(1, spooledXcorr.ncols), 
-                                         zlib=True)
-
-            # Populate variables
-            interval[:] = np.arange(spooledXcorr.nrows)
-            nsw[:] = flattenedWindowCounts
-            ist[:] = flattenedIntervalStartTimes
-            iet[:] = flattenedIntervalEndTimes
-
-            for irow in np.arange(spooledXcorr.nrows):
-                xc[irow, :] = spooledXcorr.read_row(irow)
-            # end for
-        # end if
-
         lag[:] = x
 
         # Add and populate a new group for parameters used
@@ -837,6 +1188,6 @@ def IntervalStackXCorr(refds, tempds,
             setattr(pg, _k, _v)
         # end for
 
-        root_grp.close()
+        xcorrWriter.close()
     # end if
 # end func
@@ -11,8 +11,6 @@ import os
 import sys
 import stat
 import datetime
-import time
-import math
 import gc
 import glob
 
@@ -26,16 +24,18 @@ import matplotlib.dates
 import matplotlib.pyplot as plt
 from dateutil import rrule
 import click
-from sklearn.cluster import dbscan
 from scipy.interpolate import LSQUnivariateSpline
 from pandas.plotting import register_matplotlib_converters, deregister_matplotlib_converters
 
 # import obspy
 from netCDF4 import Dataset as NCDataset
 from tqdm.auto import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from types import SimpleNamespace
 
 from seismic.ASDFdatabase import FederatedASDFDataSet
 from seismic.xcorqc.analytic_plot_utils import distance, timestamps_to_plottable_datetimes
+from seismic.xcorqc.clock_drift import estimate_clock_corrections, cluster_corrections, pearson_rows
 
 
 class XcorrClockAnalyzer:
@@ -119,15 +119,8 @@ class XcorrClockAnalyzer:
         :type coeffs: tuple(float, float, float)
         :return: Results of sklearn.cluster.dbscan (refer to third party documentation)
         """
-        sec_per_week = 7 * 24 * 3600
-        def _temporalDist2DSlope(p0, p1, coeffs):
-            return math.sqrt((coeffs[0] * (p1[0] - p0[0])) ** 2 +
-                             (coeffs[1] * sec_per_week * (p1[1] - p0[1])) ** 2 +
-                             (coeffs[2] * sec_per_week * sec_per_week * (p1[2] - p0[2])) ** 2)
-
-        data = np.column_stack((self.correction_times_clean, self.corrections_clean, self.corrections_slope))
-        ind, ids = dbscan(data, eps=2 * sec_per_week, min_samples=7,
-                          metric=lambda p0, p1: _temporalDist2DSlope(p0, p1, coeffs))
+        ind, ids = cluster_corrections(self.correction_times_clean, self.corrections_clean,
+                                       self.corrections_slope, coeffs)
         return ind, ids
     # end func
 
@@ -234,58 +227,11 @@ class XcorrClockAnalyzer:
         # Make an initial estimate of the shift, and only mask out a row if the Pearson coefficient
         # is less than the threshold AFTER applying the shift. Otherwise we will be masking out
         # some of the most interesting regions where shifts occur.
-        raw_correction = []
-        ccf_shifted = []
-        for row in self.ccf_masked:
-            if np.ma.is_masked(row) or self.rcf is None:
-                raw_correction.append(np.nan)
-                ccf_shifted.append(np.array([np.nan] * self.ccf_masked.shape[1]))
-                continue
-
-            # The logic here needs to be expanded to allow for possible mirroring of the CCF
-            # as well as a shift.
-            c3 = scipy.signal.correlate(self.rcf, row, mode='same')
-            c3 /= np.max(c3)
-            peak_index = np.argmax(c3)
-            shift_size = int(peak_index - len(c3) / 2)
-            row_shifted = np.roll(row, shift_size)
-            # Zero the rolled in values
-            if shift_size > 0:
-                row_shifted[0:shift_size] = 0
-            elif shift_size < 0:
-                row_shifted[shift_size:] = 0
-            ccf_shifted.append(row_shifted)
-            # Store first order corrections.
-            peak_lag = self.lag[peak_index]
-            raw_correction.append(peak_lag)
-        # end for
-        raw_correction = np.array(raw_correction)
-        ccf_shifted = np.array(ccf_shifted)
-        # Recompute the RCF with first order clock corrections.
-        rcf_corrected = np.nanmean(ccf_shifted[self.snr_mask, :], axis=0)
-
-        # For the Pearson coeff threshold, apply it against the CORRECTED RCF after the application
-        # of estimated clock corrections.
-        row_rcf_crosscorr = []
-        for i, row in enumerate(self.ccf_masked):
-            if np.ma.is_masked(row) or self.rcf is None:
-                row_rcf_crosscorr.append([np.nan] * self.ccf_masked.shape[1])
-                continue
-
-            pcf_corrected, _ = scipy.stats.pearsonr(rcf_corrected, ccf_shifted[i, :])
-            if pcf_corrected < self.pcf_cutoff_threshold:
-                raw_correction[i] = np.nan
-                row_rcf_crosscorr.append([np.nan] * self.ccf_masked.shape[1])
-                continue
-            # Compute second order corrections based on first order corrected RCF
-            c3 = scipy.signal.correlate(rcf_corrected, row, mode='same')
-            c3 /= np.max(c3)
-            peak_index = np.argmax(c3)
-            peak_lag = self.lag[peak_index]
-            raw_correction[i] = peak_lag
-            row_rcf_crosscorr.append(c3)
-        # end for
-        row_rcf_crosscorr = np.array(row_rcf_crosscorr)
+        valid = ~np.any(np.ma.getmaskarray(self.ccf_masked), axis=1)
+        snr_mask = np.ma.filled(self.snr_mask, False) if self.snr_mask is not None else None
+        raw_correction, rcf_corrected, row_rcf_crosscorr = \
+            estimate_clock_corrections(np.ma.getdata(self.ccf_masked), valid, self.rcf, snr_mask,
+                                       self.lag, self.pcf_cutoff_threshold)
 
         self.raw_correction = raw_correction
         self.rcf_corrected = rcf_corrected
@@ -488,15 +434,11 @@ def plot_snr_histogram(ax, snr, time_window, nbins=10):
 
 
 def plot_pearson_corr_coeff(ax, rcf, ccf_masked, y_times):
-    cc = []
-    for row in ccf_masked:
-        if np.ma.is_masked(row) or rcf is None:
-            cc.append(np.nan)
-        else:
-            pcf, _ = scipy.stats.pearsonr(rcf, row)
-            cc.append(pcf)
-    # end for
-    pcf = np.array(cc)
+    pcf = np.full(ccf_masked.shape[0], np.nan)
+    if rcf is not None:
+        valid = ~np.any(np.ma.getmaskarray(ccf_masked), axis=1)
+        pcf[valid] = pearson_rows(np.ma.getdata(rcf), np.ma.getdata(ccf_masked)[valid, :])
+    # end if
     # Compute CC mean
     ccav = np.mean(np.ma.masked_array(pcf, mask=np.isnan(pcf)))
 
@@ -683,8 +625,47 @@ def read_correlator_config(nc_file):
     return settings_df, title_tag
 
 
+def _process_xcorr_file(src_file, dataset, time_window, snr_threshold, pearson_cutoff_factor, save_plots,
+                        underlay_rcf_xcorr, force_save):
+    """
+    Processes a single .nc file for batch_process_xcorr; see batch_process_xcorr for a description of parameters.
+
+    :return: Tuple of (status, message), where status is one of 'success', 'skipped' or 'failed'
+    :rtype: tuple(str, str)
+    """
+    if not os.path.exists(src_file):
+        return 'failed', "File not found!"
+
+    # Extract timestamp from nc filename if available
+    settings, title_tag = read_correlator_config(src_file)
+
+    try:
+        if save_plots:
+            basename, _ = os.path.splitext(src_file)
+            png_file = basename + ".png"
+            # If png file already exists and has later timestamp than src_file, then skip it.
+            if os.path.exists(png_file):
+                src_file_time = os.path.getmtime(src_file)
+                png_file_time = os.path.getmtime(png_file)
+                png_file_size = os.stat(png_file).st_size
+                if not force_save and (png_file_time > src_file_time) and (png_file_size > 0):
+                    return 'skipped', "PNG file {} is more recent than source file {}, skipping!".format(
+                        os.path.split(png_file)[1], os.path.split(src_file)[1])
+            plot_xcorr_file_clock_analysis(src_file, dataset, time_window, snr_threshold, pearson_cutoff_factor,
+                                           png_file=png_file, show=False, underlay_rcf_xcorr=underlay_rcf_xcorr,
+                                           title_tag=title_tag, settings=settings)
+        else:
+            plot_xcorr_file_clock_analysis(src_file, dataset, time_window, snr_threshold, pearson_cutoff_factor,
+                                           underlay_rcf_xcorr=underlay_rcf_xcorr, title_tag=title_tag,
+                                           settings=settings)
+    except Exception as e:
+        return 'failed', str(e)
+
+    return 'success', ''
+
+
 def batch_process_xcorr(src_files, dataset, time_window, snr_threshold, pearson_cutoff_factor=0.5, save_plots=True,
-                        underlay_rcf_xcorr=False, force_save=False):
+                        underlay_rcf_xcorr=False, force_save=False, nproc=1):
     """
     Process a batch of .nc files to generate standard visualization graphics. PNG files are output alongside the
     source .nc file. To suppress file output, set save_plots=False.
@@ -702,6 +683,9 @@ def batch_process_xcorr(src_files, dataset, time_window, snr_threshold, pearson_
     :param underlay_rcf_xcorr: Show the individual correlation of row sample with RCF beneath the computed time lag,
         defaults to False
     :param underlay_rcf_xcorr: bool, optional
+    :param nproc: Number of worker processes used to process files in parallel, defaults to 1, in which case
+        files are processed sequentially in the calling process
+    :type nproc: int, optional
     :return: List of files for which processing failed, and associated error.
     :rtype: list(tuple(str, str))
     """
@@ -714,53 +698,48 @@ def batch_process_xcorr(src_files, dataset, time_window, snr_threshold, pearson_
     failed_files = []
     skipped_count = 0
     success_count = 0
-    for src_file in src_files:
-        _, base_file = os.path.split(src_file)
-        pbar.set_description(base_file)
-        # Sleep to ensure progress bar is refreshed
-        time.sleep(0.2)
-
-        if not os.path.exists(src_file):
-            tqdm.write("ERROR! File {} not found!".format(src_file))
-            failed_files.append((src_file, "File not found!"))
-            continue
-
-        # Extract timestamp from nc filename if available
-        settings, title_tag = read_correlator_config(src_file)
-
-        try:
-            if save_plots:
-                basename, _ = os.path.splitext(src_file)
-                png_file = basename + ".png"
-                # If png file already exists and has later timestamp than src_file, then skip it.
-                if os.path.exists(png_file):
-                    src_file_time = os.path.getmtime(src_file)
-                    png_file_time = os.path.getmtime(png_file)
-                    png_file_size = os.stat(png_file).st_size
-                    if not force_save and (png_file_time > src_file_time) and (png_file_size > 0):
-                        tqdm.write("PNG file {} is more recent than source file {}, skipping!".format(
-                            os.path.split(png_file)[1], os.path.split(src_file)[1]))
-                        found_preexisting = True
-                        skipped_count += 1
-                        pbar.update()
-                        continue
-                plot_xcorr_file_clock_analysis(src_file, dataset, time_window, snr_threshold, pearson_cutoff_factor,
-                                               png_file=png_file, show=False, underlay_rcf_xcorr=underlay_rcf_xcorr,
-                                               title_tag=title_tag, settings=settings)
-            else:
-                plot_xcorr_file_clock_analysis(src_file, dataset, time_window, snr_threshold, pearson_cutoff_factor,
-                                               underlay_rcf_xcorr=underlay_rcf_xcorr, title_tag=title_tag,
-                                               settings=settings)
-            success_count += 1
-            pbar.update()
 
-        except Exception as e:
+    def update(src_file, status, message):
+        nonlocal found_preexisting, skipped_count, success_count
+        if status == 'failed':
             tqdm.write("ERROR processing file {}".format(src_file))
-            failed_files.append((src_file, str(e)))
+            failed_files.append((src_file, message))
+        elif status == 'skipped':
+            tqdm.write(message)
+            found_preexisting = True
+            skipped_count += 1
+        else:
+            success_count += 1
+        pbar.update()
+
+    args = (time_window, snr_threshold, pearson_cutoff_factor, save_plots, underlay_rcf_xcorr, force_save)
+    if nproc > 1:
+        # Only station coordinates are required from the dataset, which are passed on to worker
+        # processes in lieu of the dataset itself
+        coords = SimpleNamespace(unique_coordinates=dict(dataset.unique_coordinates))
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            futures = {executor.submit(_process_xcorr_file, src_file, coords, *args): src_file
+                       for src_file in src_files}
+            for future in as_completed(futures):
+                src_file = futures[future]
+                pbar.set_description(os.path.split(src_file)[1])
+                try:
+                    status, message = future.result()
+                except Exception as e:
+                    status, message = 'failed', str(e)
+                update(src_file, status, message)
+    else:
+        for src_file in src_files:
+            _, base_file = os.path.split(src_file)
+            pbar.set_description(base_file)
+            pbar.refresh()
+
+            status, message = _process_xcorr_file(src_file, dataset, *args)
+            update(src_file, status, message)
 
-        # Python 2 does not handle circular references, so it helps to explicitly clean up.
-        if PY2:
-            gc.collect()
+            # Python 2 does not handle circular references, so it helps to explicitly clean up.
+            if PY2:
+                gc.collect()
 
     pbar.close()
 
@@ -773,7 +752,8 @@ def batch_process_xcorr(src_files, dataset, time_window, snr_threshold, pearson_
     return failed_files
 
 
-def batch_process_folder(folder_name, dataset, time_window, snr_threshold, pearson_cutoff_factor=0.5, save_plots=True):
+def batch_process_folder(folder_name, dataset, time_window, snr_threshold, pearson_cutoff_factor=0.5, save_plots=True,
+                         nproc=1):
     """
     Process all the .nc files in a given folder into graphical visualizations.
 
@@ -787,12 +767,15 @@ def batch_process_folder(folder_name, dataset, time_window, snr_threshold, pears
     :type snr_threshold: float
     :param save_plots: Whether to save plots to file, defaults to True
     :param save_plots: bool, optional
+    :param nproc: Number of worker processes used to process files in parallel, defaults to 1
+    :type nproc: int, optional
     """
     src_files = glob.glob(os.path.join(folder_name, '*.nc'))
     print("Found {} .nc files in {}".format(len(src_files), folder_name))
 
     failed_files = batch_process_xcorr(src_files, dataset, time_window=time_window, snr_threshold=snr_threshold,
-                                       pearson_cutoff_factor=pearson_cutoff_factor, save_plots=save_plots)
+                                       pearson_cutoff_factor=pearson_cutoff_factor, save_plots=save_plots,
+                                       nproc=nproc)
     _report_failed_files(failed_files)
 
 
@@ -811,7 +794,9 @@ def _report_failed_files(failed_files):
 @click.option('--time-window', default=300, type=int, show_default=True, help='Duration of time lag window to consider')
 @click.option('--snr-threshold', default=6, type=float, show_default=True,
               help='Minimum sample SNR to include in clock correction estimate')
-def main(paths, dataset, time_window, snr_threshold):
+@click.option('--nproc', default=1, type=int, show_default=True,
+              help='Number of worker processes used to process .nc files in parallel')
+def main(paths, dataset, time_window, snr_threshold, nproc):
     """
     Main entry point for running clock analysis and CCF visualization on batch of station
     cross-correlation results.
@@ -824,6 +809,8 @@ def main(paths, dataset, time_window, snr_threshold):
     :type time_window: int
     :param snr_threshold: Minimum sample SNR to include in clock correction estimate
     :type snr_threshold: float
+    :param nproc: Number of worker processes used to process .nc files in parallel
+    :type nproc: int
     """
 
     # Hardwired default path for now for GA application.
@@ -847,10 +834,10 @@ def main(paths, dataset, time_window, snr_threshold):
             sys.exit(1)
 
     ds = FederatedASDFDataSet.FederatedASDFDataSet(dataset)
-    failed_files = batch_process_xcorr(files, ds, time_window, snr_threshold)
+    failed_files = batch_process_xcorr(files, ds, time_window, snr_threshold, nproc=nproc)
     _report_failed_files(failed_files)
     for d in dirs:
-        batch_process_folder(d, ds, time_window, snr_threshold)
+        batch_process_folder(d, ds, time_window, snr_threshold, nproc=nproc)
 
 
 if __name__ == "__main__":
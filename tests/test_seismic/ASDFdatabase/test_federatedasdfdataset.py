@@ -10,17 +10,27 @@ Developer:      rakib.hassan@ga.gov.au
 
 Revision History:
     LastUpdate:     5/20/19   RH
+    LastUpdate:     17/10/26   agent    Added tests for R*Tree index, tag decoding and incremental index builds
+    LastUpdate:     17/10/26   agent    Added test for waveform cache
+    LastUpdate:     17/10/26   agent    Added test for get_waveform_arrays
+    LastUpdate:     17/10/26   agent    Added test for clock-corrections
+    LastUpdate:     17/10/26   agent    Added test for get_recording_spans
+    LastUpdate:     17/10/26   agent    Added test for R*Tree upgrades of existing databases
+    LastUpdate:     17/10/26   agent    Added test for removal of stale index shards
     LastUpdate:     dd/mm/yyyy  Who     Optional description
 """
 
 from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
+from seismic.ASDFdatabase._FederatedASDFDataSetImpl import decode_tags, assemble_segments
 import os
+import glob
 import pytest
 from ordered_set import OrderedSet as set
 import numpy as np
 import tempfile
 import sqlite3
-from obspy.core import UTCDateTime
+from obspy.core import UTCDateTime, Stream, Trace
+import pandas as pd
 import logging
 
 path = os.path.dirname(os.path.abspath(__file__))
@@ -120,6 +130,31 @@ def test_get_global_time_range():
     assert max == UTCDateTime('2002-01-01T00:00:00.000000Z')
 # end func
 
+def test_get_recording_spans():
+    fds = FederatedASDFDataSet(asdf_file_list)
+
+    spans = fds.get_recording_spans()
+    rows = np.array(fds.get_stations('1900-01-01T00:00:00', '2100-01-01T00:00:00'))
+    assert sorted(spans.keys()) == sorted(set([(n, s) for n, s in rows[:, 0:2]]))
+
+    conn = sqlite3.connect(fds.fds.db_fn)
+    db_waveform_count = conn.execute('select count(*) from wdb;').fetchall()[0][0]
+    assert sum([len(v) for v in spans.values()]) == db_waveform_count
+
+    for (n, s), v in spans.items():
+        assert np.all(np.diff(v[:, 0]) >= 0)
+
+        min, max = fds.get_global_time_range(n, s)
+        assert UTCDateTime(v[:, 0].min()) == min
+        assert UTCDateTime(v[:, 1].max()) == max
+    # end for
+
+    n, s = list(spans.keys())[0]
+    filtered = fds.get_recording_spans(network_list=[n], station_list=[s])
+    assert list(filtered.keys()) == [(n, s)]
+    assert np.array_equal(filtered[(n, s)], spans[(n, s)])
+# end func
+
 
 def test_get_stations():
     fds = FederatedASDFDataSet(asdf_file_list)
@@ -169,3 +204,237 @@ def test_get_waveform(buffer_mb):
     # end for
 # end func
 
+
+def test_rtree_index():
+    fds = FederatedASDFDataSet(asdf_file_list)
+    assert fds.fds.has_rtree
+
+    rows = np.array(fds.get_stations('1900-01-01T00:00:00', '2100-01-01T00:00:00'))
+    rs = np.random.RandomState(0)
+    for n, s, l, c in rows[:, 0:4]:
+        gst, get = fds.get_global_time_range(n, s, l, c)
+        for i in range(20):
+            st = gst.timestamp + rs.random_sample() * (get - gst)
+            et = st + rs.random_sample() * 5 * 86400
+
+            # rows fetched via the R*Tree index should match those via the composite index
+            fds.fds.has_rtree = True
+            rtree_rows = fds.fds._get_waveform_rows(n, s, l, c, st, et)
+            fds.fds.has_rtree = False
+            index_rows = fds.fds._get_waveform_rows(n, s, l, c, st, et)
+
+            assert rtree_rows == index_rows
+        # end for
+    # end for
+# end func
+
+def test_rtree_upgrade():
+    fds = FederatedASDFDataSet(asdf_file_list)
+
+    # a database created by an earlier version, without an R*Tree index, being read by another job
+    conn = sqlite3.connect(fds.fds.db_fn)
+    conn.execute('drop table wdb_rtree')
+    conn.commit()
+    conn.close()
+    reader = fds.fds._connect_readonly()
+    inode = os.stat(fds.fds.db_fn).st_ino
+
+    # the index is added to a copy, which replaces the database
+    fds2 = FederatedASDFDataSet(asdf_file_list)
+    assert fds2.fds.has_rtree
+    assert os.stat(fds.fds.db_fn).st_ino != inode
+    assert not [fn for fn in os.listdir(os.path.dirname(fds.fds.db_fn)) if fn.endswith('.tmp')]
+
+    # readers of the original database are unaffected
+    count = reader.execute('select count(*) from wdb').fetchall()[0][0]
+    assert count == fds2.fds.conn.execute('select count(*) from wdb').fetchall()[0][0]
+    assert reader.execute("select count(*) from sqlite_master where name='wdb_rtree'").fetchall()[0][0] == 0
+    reader.close()
+# end func
+
+def test_decode_tags():
+    tags = ['AU.ABC.00.BHZ__2000-01-01T00:00:00__2000-01-02T00:00:00__raw_recording',
+            'AU.ABC..BHZ__2000-01-01T00:00:00.5__2000-01-02T00:00:00__raw_recording',
+            'AU.ABC.00.BHZ__2000-01-01T00:00:00__2000-01-02T00:00:00__other_tag',
+            'AU.ABC__2000-01-01T00:00:00__2000-01-02T00:00:00__raw_recording']
+    rows = decode_tags(tags)
+
+    # tags of other types and malformed tags are skipped
+    assert len(rows) == 2
+    for (n, s, l, c, st, et, tag) in rows:
+        assert (n, s, c) == ('AU', 'ABC', 'BHZ')
+        assert st == UTCDateTime(tag.split('__')[1]).timestamp
+        assert et == UTCDateTime(tag.split('__')[2]).timestamp
+    # end for
+
+    # time-stamps in formats other than ISO8601 are parsed individually
+    rows = decode_tags(['AU.ABC.00.BHZ__20000101T000000__20000102T000000__raw_recording'])
+    assert rows[0][4:6] == (UTCDateTime('2000-01-01').timestamp, UTCDateTime('2000-01-02').timestamp)
+# end func
+
+def test_incremental_index():
+    fds = FederatedASDFDataSet(asdf_file_list)
+    shard_mtimes = [os.path.getmtime(fn) for fn in fds.fds.shard_fns]
+
+    # a modified list of ASDF files results in a new database, built from existing shards
+    modified_list = os.path.join(tempdir, 'asdf_file_list_modified.txt')
+    f = open(modified_list, 'w+')
+    f.write('# modified list\n%s/asdf_test_data.h5'%(tempdir))
+    f.close()
+
+    fds2 = FederatedASDFDataSet(modified_list)
+    assert fds2.fds.db_fn != fds.fds.db_fn
+    assert fds2.fds.shard_fns == fds.fds.shard_fns
+    assert [os.path.getmtime(fn) for fn in fds2.fds.shard_fns] == shard_mtimes
+
+    count = lambda ds: ds.fds.conn.execute('select count(*) from wdb').fetchall()[0][0]
+    assert count(fds2) == count(fds)
+# end func
+
+def test_stale_shards():
+    # a copy of the ASDF file in its own folder, so that its shard can be made stale
+    folder = tempfile.mkdtemp(dir=tempdir)
+    asdf_fn = os.path.join(folder, 'asdf_test_data.h5')
+    os.system('cp %s/asdf_test_data.h5 %s'%(tempdir, asdf_fn))
+    file_list = os.path.join(folder, 'asdf_file_list.txt')
+    f = open(file_list, 'w+')
+    f.write(asdf_fn)
+    f.close()
+
+    shard_fns = lambda: sorted(glob.glob(os.path.join(folder, '.fds_shards', '*.db')))
+    fds = FederatedASDFDataSet(file_list)
+    assert shard_fns() == fds.fds.shard_fns
+
+    # shards of modified files are replaced
+    os.utime(asdf_fn, ns=(0, os.stat(asdf_fn).st_mtime_ns + 10**9))
+    fds2 = FederatedASDFDataSet(file_list)
+    assert fds2.fds.shard_fns != fds.fds.shard_fns
+    assert shard_fns() == fds2.fds.shard_fns
+# end func
+
+def test_waveform_cache():
+    fds = FederatedASDFDataSet(asdf_file_list)
+    fdsc = FederatedASDFDataSet(asdf_file_list, waveform_cache_size_mb=64)
+
+    rows = fds.get_stations('1900-01-01T00:00:00', '2100-01-01T00:00:00')
+    n, s, l, c, _, _ = rows[0]
+    min, max = fds.get_global_time_range(n, s, l, c)
+
+    # overlapping windows of the same channel
+    step = (max - min) / 20.
+    for i in range(10):
+        t0 = min + i * step
+        t1 = t0 + 3 * step + 0.123
+
+        st = fds.get_waveforms(n, s, l, c, t0, t1)
+        stc = fdsc.get_waveforms(n, s, l, c, t0, t1)
+
+        assert len(st) == len(stc)
+        for tr, trc in zip(st, stc):
+            assert tr.stats.starttime == trc.stats.starttime
+            assert tr.stats.npts == trc.stats.npts
+            assert np.array_equal(tr.data, trc.data)
+
+            # cached samples are served as read-only views
+            assert not trc.data.flags.writeable
+        # end for
+    # end for
+
+    stats = fdsc.get_waveform_cache_stats()
+    assert stats['hits'] > 0 and stats['entries'] == stats['misses']
+    assert fds.get_waveform_cache_stats() is None
+
+    fdsc.clear_waveform_cache()
+    assert fdsc.get_waveform_cache_stats()['entries'] == 0
+# end func
+
+def test_get_waveform_arrays():
+    fds = FederatedASDFDataSet(asdf_file_list)
+
+    rows = fds.get_stations('1900-01-01T00:00:00', '2100-01-01T00:00:00')
+    n, s, l, c, _, _ = rows[0]
+    tmin, tmax = fds.get_global_time_range(n, s, l, c)
+
+    step = (tmax - tmin) / 10.
+    for i in range(8):
+        t0 = tmin + i * step + 0.123
+        t1 = t0 + 2 * step
+
+        st = fds.get_waveforms(n, s, l, c, t0, t1)
+        st.merge()
+        data, starttime, sampling_rate = fds.get_waveform_arrays(n, s, l, c, t0, t1)
+
+        assert sampling_rate == st[0].stats.sampling_rate
+        assert data.shape == data.data.shape and data.data.flags.c_contiguous
+
+        # samples should match those from the Stream-based API, allowing for differences in
+        # nearest-sample selection at either end
+        offset = int(np.round((st[0].stats.starttime - starttime) * sampling_rate))
+        assert abs(offset) <= 1 and abs(len(data) - st[0].stats.npts) <= 2
+        a = max(offset, 0)
+        b = min(len(data), st[0].stats.npts + offset)
+        assert np.array_equal(data[a:b], st[0].data[a - offset:b - offset])
+    # end for
+
+    # no data outside the time-range covered
+    assert fds.get_waveform_arrays(n, s, l, c, tmax + 10, tmax + 20) == (None, None, None)
+# end func
+
+def test_assemble_segments():
+    sr = 10.
+    t0 = UTCDateTime('2000-01-01').ns
+    segments = [(t0, sr, np.arange(10, dtype='i4')),
+                (t0 + int(2e9) + 1000, sr, np.arange(100, 110, dtype='i4')), # 2 s gap, 1 us misalignment
+                (t0 + int(2.5e9), sr, np.arange(200, 205, dtype='i4')),      # overlaps previous segment
+                (t0, 20., np.arange(10, dtype='i4'))]                        # discarded
+
+    data, starttime, sampling_rate = assemble_segments(segments, t0 + int(0.5e9), t0 + int(10e9))
+    assert (starttime, sampling_rate) == (t0 + int(0.5e9), sr)
+    assert len(data) == 25
+    assert np.all(data.mask[5:15]) and not np.any(data.mask[:5]) and not np.any(data.mask[15:])
+    assert np.array_equal(data.compressed(),
+                          np.concatenate([np.arange(5, 10), np.arange(100, 105), np.arange(200, 205)]))
+
+    assert assemble_segments(segments, t0 + int(20e9), t0 + int(30e9)) == (None, None, None)
+# end func
+
+def test_apply_correction():
+    fds = FederatedASDFDataSet(asdf_file_list)
+    fds.fds._set_corrections(pd.DataFrame({'net': ['AU', 'AU', 'AU', 'AU'],
+                                           'sta': ['ABC', 'ABC', 'ABC', 'DEF'],
+                                           'date': ['2000-01-02', '2000-01-01', '2000-01-04', '2000-01-01'],
+                                           'clock_correction': ['1.0', '1.0', '2.0', 'NOXCOR']}))
+    sr = 1.
+    day = 24 * 3600
+
+    # trace covered by a single correction is shifted without altering samples
+    tr = Trace(data=np.arange(3600, dtype='f4'),
+               header={'network': 'AU', 'station': 'ABC', 'sampling_rate': sr,
+                       'starttime': UTCDateTime('2000-01-01T06:00:00.25')})
+    ctr = fds.fds._apply_correction(Stream([tr.copy()]))[0]
+    assert ctr.stats.starttime == tr.stats.starttime - 1.0
+    assert np.array_equal(ctr.data, tr.data)
+
+    # 4-day trace spanning two corrected days, an uncorrected day and a day with a different correction
+    tr = Trace(data=np.arange(4 * day, dtype='f4'),
+               header={'network': 'AU', 'station': 'ABC', 'sampling_rate': sr,
+                       'starttime': UTCDateTime('2000-01-01T00:00:00')})
+    ctr = fds.fds._apply_correction(Stream([tr.copy()]))[0]
+    assert ctr.stats.starttime == tr.stats.starttime - 1.0
+    assert ctr.stats.npts == 4 * day - 1
+
+    # samples of the first two days are shifted back by a second
+    assert np.array_equal(ctr.data[:2 * day], tr.data[:2 * day])
+    # the resulting gap at the start of the third day is masked
+    assert ctr.data.mask[2 * day]
+    assert np.array_equal(ctr.data[2 * day + 1:3 * day - 1], tr.data[2 * day:3 * day - 2])
+    # samples of the fourth day are shifted back by two seconds and overlaps are masked
+    assert np.all(ctr.data.mask[3 * day - 1:3 * day + 1])
+    assert np.array_equal(ctr.data[3 * day + 1:], tr.data[3 * day + 2:])
+    assert ctr.data.count() == 4 * day - 4
+
+    # traces of stations without corrections are left untouched
+    tr.stats.station = 'DEF'
+    ctr = fds.fds._apply_correction(Stream([tr]))[0]
+    assert ctr is tr
+# end func
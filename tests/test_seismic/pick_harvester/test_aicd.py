@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""Unit testing for the native multi-sigma AICD picker
+"""
+
+import copy
+
+import numpy as np
+import pytest
+from obspy import Trace, UTCDateTime
+
+from seismic.pick_harvester.aicd import aic, aic_deriv, MultiSigmaAICDPicker
+
+
+def reference_aic(data):
+    # direct evaluation, as in PhasePApy's AicDeriv characteristic function
+    npts = len(data)
+    AIC = np.zeros(npts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for k in range(npts - 1, 0, -1):
+            a = k * np.log10(np.std(data[:k]) ** 2) + (npts - k - 1) * np.log10(np.std(data[k:]) ** 2)
+            if a == -float('inf'):
+                a = AIC[k + 1]
+            AIC[k] = a
+        # end for
+    # end with
+    AIC[0] = AIC[1]
+    AIC[-1] = AIC[-2]
+    return AIC
+# end func
+
+
+def reference_aic_deriv(data):
+    # PhasePApy's AicDeriv characteristic function, with the derivative padded at the front
+    AIC = reference_aic(data)
+    AIC_deriv = []
+    for i in range(len(data) - 1):
+        AIC_deriv.insert(i, np.abs(AIC[i + 1] - AIC[i]))
+    # end for
+    AIC_deriv.insert(0, AIC_deriv[0])
+    return np.array(AIC_deriv)
+# end func
+
+
+def reference_winlen(index, trigger, filter_length, t, dt):
+    # window lengths (in samples) before and after a trigger, bounded by neighbouring triggers
+    # and the extents of the trace, as in PhasePApy's AICDPicker
+    lower = t[0] if index == 0 else trigger[index - 1]
+    upper = t[-1] if index == len(trigger) - 1 else trigger[index + 1]
+    return int(round(min(filter_length, trigger[index] - lower) / dt, 0)), \
+           int(round(min(filter_length, upper - trigger[index]) / dt, 0))
+# end func
+
+
+def reference_picks(tr, nsigma, t_ma, t_up, nr_len, nr_coeff):
+    # PhasePApy's AICDPicker trigger identification, clean-up and SNR estimates, evaluated one
+    # nsigma value at a time
+    summary = reference_aic_deriv(tr.data)
+    dt = tr.stats.delta
+    LEN = tr.stats.npts
+    npts_Tma = int(round(t_ma / dt, 0))
+    rms = lambda x, axis=None: np.sqrt(np.mean(x ** 2, axis=axis))
+
+    threshold = np.zeros(LEN)
+    for j in range(npts_Tma, LEN):
+        threshold[j] = rms(summary[j - npts_Tma:j]) * nsigma
+    # end for
+
+    t = np.arange(0, tr.stats.npts / tr.stats.sampling_rate, dt)
+    trigger_ptnl = t[np.where(summary[npts_Tma:LEN] > threshold[npts_Tma:LEN])[0] + npts_Tma]
+
+    window_t_up = int(round(t_up / dt, 0))
+    remove = [i + 1 for i in range(len(trigger_ptnl) - 1)
+              if (trigger_ptnl[i + 1] - trigger_ptnl[i]) <= window_t_up * dt]
+    trigger_ptnl = np.delete(trigger_ptnl, remove)
+
+    remove = []
+    for i in range(len(trigger_ptnl)):
+        r, R = reference_winlen(i, trigger_ptnl, nr_len, t, dt)
+        M = min(r, R)
+        index = int(round(trigger_ptnl[i] / dt, 0))
+        if nr_coeff * np.std(tr.data[index - M:index]) >= np.std(tr.data[index:index + M]):
+            remove.append(i)
+    # end for
+    trigger = np.delete(trigger_ptnl, remove)
+
+    picks = []
+    for i in range(len(trigger)):
+        index = int(round(trigger[i] / dt, 0))
+        while summary[index] > summary[index - 1]: index -= 1
+        picks.append(UTCDateTime(tr.stats.starttime + round(t[index], 3)))
+    # end for
+
+    maxes = copy.deepcopy(trigger)
+    for i in range(len(trigger)):
+        index = int(round(trigger[i] / dt, 0))
+        while summary[index] < summary[index + 1]: index += 1
+        maxes[i] = round(summary[index], 3)
+    # end for
+
+    snr = copy.deepcopy(trigger)
+    for i in range(len(picks)):
+        index = int(round(trigger[i] / dt, 0))
+        snr[i] = round(maxes[i] / rms(summary[index - npts_Tma:index]), 1)
+    # end for
+
+    return picks, snr
+# end func
+
+
+@pytest.fixture
+def trace():
+    rs = np.random.RandomState(0)
+    sr = 20.
+    data = rs.standard_normal(2001)
+    for onset, amp in [(700, 12.), (1300, 6.)]:
+        n = np.arange(300)
+        data[onset:onset + 300] += amp * np.sin(2 * np.pi * 1.5 * n / sr) * np.exp(-n / 60.)
+    # end for
+    return Trace(data=data, header={'sampling_rate': sr, 'starttime': UTCDateTime(2020, 1, 1)})
+# end func
+
+
+def test_aic():
+    rs = np.random.RandomState(0)
+    data = rs.standard_normal(500) * 1e3 + 5e4
+    assert np.allclose(aic(data), reference_aic(data), rtol=1e-10)
+
+    # constant segments produce -inf values, which are replaced by values to their right
+    data[:50] = 0
+    expected = reference_aic(data)
+    assert np.all(np.isfinite(expected))
+    assert np.allclose(aic(data), expected, rtol=1e-10)
+
+    data[-20:] = 0
+    assert np.allclose(aic(data), reference_aic(data), rtol=1e-10, equal_nan=True)
+# end func
+
+
+def test_aic_deriv(trace):
+    result = aic_deriv(trace.data)
+    assert len(result) == trace.stats.npts
+    assert result[0] == result[1]
+    assert np.allclose(result, reference_aic_deriv(trace.data), rtol=1e-8)
+# end func
+
+
+@pytest.mark.parametrize('t_ma', [10, 15])
+def test_picks(trace, t_ma):
+    nsigmas = np.arange(8, 3, -1)
+    picker = MultiSigmaAICDPicker(nsigmas, t_ma=t_ma, t_up=1, nr_len=5, nr_coeff=2)
+
+    results = list(picker.iter_picks(trace))
+    assert [r[0] for r in results] == list(range(len(nsigmas)))
+    assert sum(len(r[1]) for r in results) > 0
+
+    for isigma, picks, snr in results:
+        expected_picks, expected_snr = reference_picks(trace, nsigmas[isigma], t_ma, 1, 5, 2)
+        assert picks == expected_picks
+        assert np.array_equal(snr, expected_snr)
+    # end for
+# end func
+
+
+def test_short_trace():
+    picker = MultiSigmaAICDPicker([4, 3], t_ma=10)
+    tr = Trace(data=np.random.RandomState(0).standard_normal(150), header={'sampling_rate': 20.})
+    results = list(picker.iter_picks(tr))
+    assert [r[0] for r in results] == [0, 1]
+    assert all(len(r[1]) == 0 and len(r[2]) == 0 for r in results)
+# end func
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""Unit testing for batched processing of waveform windows in the pick harvester
+"""
+
+import importlib
+import sys
+import types
+from unittest import mock
+
+import numpy as np
+import pytest
+from obspy import Stream, Trace, UTCDateTime
+from obspy.signal.rotate import rotate_ne_rt, rotate_rt_ne
+from obspy.geodetics.base import gps2dist_azimuth
+from obspy.taup import TauPyModel
+
+from seismic.pick_harvester import batch
+from seismic.pick_harvester.utils import Event, Origin, Magnitude
+
+
+@pytest.fixture(params=[(40., 4801), (100., 12000), (20., 2401)])
+def windows(request):
+    sampling_rate, npts = request.param
+    rs = np.random.RandomState(0)
+    return sampling_rate, rs.standard_normal((6, npts)).cumsum(axis=1)
+# end func
+
+
+def test_resample_detrend(windows):
+    sampling_rate, data = windows
+    result = batch.detrend_windows(batch.resample_windows(data, sampling_rate, 20.))
+
+    for row, x in zip(result, data):
+        tr = Trace(data=x.copy(), header={'sampling_rate': sampling_rate})
+        tr.resample(20.)
+        tr.detrend('linear')
+        assert np.allclose(row, tr.data, rtol=0, atol=1e-9 * np.max(np.abs(tr.data)))
+    # end for
+# end func
+
+
+@pytest.mark.filterwarnings('ignore::UserWarning')
+@pytest.mark.parametrize('freqmin, freqmax', [(0.5, 5.), (0.01, 1.), (2., 10.)])  # (2, 10) reverts to highpass
+def test_taper_bandpass(windows, freqmin, freqmax):
+    sampling_rate, data = windows
+    taper_percentage = 10. / 140.
+    result = batch.bandpass_windows(data * batch.taper_weights(data.shape[1], sampling_rate, taper_percentage),
+                                    freqmin, freqmax, sampling_rate)
+
+    for row, x in zip(result, data):
+        tr = Trace(data=x.copy(), header={'sampling_rate': sampling_rate})
+        tr.taper(max_percentage=taper_percentage, type='hann')
+        tr.filter('bandpass', freqmin=freqmin, freqmax=freqmax, corners=4, zerophase=True)
+        assert np.allclose(row, tr.data, rtol=0, atol=1e-9 * np.max(np.abs(tr.data)))
+    # end for
+# end func
+
+
+def test_rotate():
+    rs = np.random.RandomState(0)
+    n, e = rs.standard_normal((2, 4, 100))
+    bas = [0., 45., 200., 359.]
+    r, t = batch.rotate_ne_rt_windows(n, e, bas)
+
+    for i, ba in enumerate(bas):
+        rr, tt = rotate_ne_rt(n[i], e[i], ba)
+        assert np.allclose(r[i], rr) and np.allclose(t[i], tt)
+    # end for
+# end func
+
+
+def test_cut_windows():
+    t0 = UTCDateTime(2020, 1, 1)
+    data = np.ma.masked_array(np.arange(4000.), mask=np.zeros(4000, dtype=bool))
+    data.mask[2000:2100] = True
+    trace = Trace(data=data, header={'sampling_rate': 40., 'starttime': t0})
+
+    starttimes = [t0 + 10.013, t0 + 45, t0 - 2, t0 + 200]
+    endtimes = [t + 5 for t in starttimes]
+    windows = batch.cut_windows(trace, starttimes, endtimes)
+
+    assert windows[3] is None # no overlap
+    for w, t1, t2 in zip(windows[:3], starttimes, endtimes):
+        expected = trace.slice(t1, t2)
+        assert w.stats.starttime == expected.stats.starttime
+        assert np.array_equal(w.data, expected.data)
+    # end for
+    assert [batch.has_gaps(w) for w in windows[:3]] == [False, True, False]
+
+    groups = batch.group_by_length(windows)
+    assert sorted(len(ids) for ids in groups.values()) == [1, 2]
+# end func
+
+
+@pytest.fixture(scope='module')
+def pick():
+    # pick.py imports PhasePApy's AICD pickers at module level; stand-in modules are provided
+    # where PhasePApy is not installed, since the pickers used below do not depend on it
+    modules = {}
+    try:
+        import PhasePApy.phasepapy.phasepicker.aicdpicker
+    except ImportError:
+        names = ['PhasePApy', 'PhasePApy.phasepapy', 'PhasePApy.phasepapy.phasepicker',
+                 'PhasePApy.phasepapy.phasepicker.aicdpicker']
+        modules = dict((name, types.ModuleType(name)) for name in names)
+        modules[names[2]].aicdpicker = modules[names[3]]
+    # end try
+    with mock.patch.dict(sys.modules, modules):
+        return importlib.import_module('seismic.pick_harvester.pick')
+    # end with
+# end func
+
+
+class StubPicker:
+    """
+    Picks the largest absolute amplitude in a trace, if it exceeds nsigma standard deviations of
+    the first quarter of the trace
+    """
+    def __init__(self, nsigma):
+        self.nsigma = nsigma
+    # end func
+
+    def picks(self, tr):
+        snr = np.max(np.abs(tr.data)) / np.std(tr.data[:tr.stats.npts // 4])
+        if (snr < self.nsigma): return None, [], [], [], []
+        return None, [tr.stats.starttime + np.argmax(np.abs(tr.data)) * tr.stats.delta], ['U'], [snr], [0.]
+    # end func
+# end class
+
+
+SLAT, SLON = -25., 135.
+T0 = UTCDateTime(2020, 1, 1)
+DURATION = 3 * 3600.
+SAMPLING_RATE = 40.
+MAX_AMPLITUDE = 500.
+
+# (phase, arrival time relative to T0, amplitude, epicentre and depth); arrivals are placed at the
+# start and end of the day-trace, in a gap, next to a spike and at low amplitudes
+SCENARIOS = [('P', 30., 40., (10., 120., 35.)),
+             ('P', 1500., 40., (-5., 170., 210.)),
+             ('P', 3000., 40., (30., 100., 80.)),     # gap
+             ('P', 4500., 40., (-60., 150., 10.)),    # spike
+             ('P', 6000., 5., (0., 160., 120.)),      # weak
+             ('P', DURATION - 10., 40., (15., 95., 50.)),
+             ('S', 20., 40., (-40., 170., 15.)),
+             ('S', 7800., 40., (20., 110., 300.)),    # gap on the north component
+             ('S', 8700., 5., (-10., 100., 60.)),     # weak
+             ('S', DURATION - 20., 40., (5., 150., 25.))]
+GAPS = {'P': (3010., 3015.), 'S': (7790., 7795.)}
+SPIKE = 4490.
+
+
+@pytest.fixture(scope='module')
+def taup_model():
+    return TauPyModel(model='iasp91')
+# end func
+
+
+@pytest.fixture(scope='module')
+def day_traces(taup_model):
+    """
+    Day-long Z, N and E traces with arrivals of events in SCENARIOS, and the events
+    """
+    rs = np.random.RandomState(0)
+    npts = int(DURATION * SAMPLING_RATE)
+    times = np.arange(npts) / SAMPLING_RATE
+    z, n, e = rs.standard_normal((3, npts))
+
+    def wavelet(onset, amplitude):
+        tt = np.clip(times - onset, 0, None)
+        return amplitude * np.sin(2 * np.pi * 0.8 * tt) * np.exp(-tt / 3.)
+    # end func
+
+    events = []
+    bas = []
+    for i, (phase, arrival, amplitude, (lat, lon, depth)) in enumerate(SCENARIOS):
+        tats = dict((arr.name, arr.time) for arr in
+                    taup_model.get_travel_times_geo(depth, lat, lon, SLAT, SLON, phase_list=('P', 'S'))[::-1])
+        origin_time = T0 + arrival - tats[phase]
+
+        event = Event()
+        event.public_id = 'event%d' % i
+        event.preferred_origin = Origin(origin_time, lat, lon, depth)
+        event.preferred_magnitude = Magnitude(5., 'mb')
+        events.append(event)
+        bas.append(gps2dist_azimuth(lat, lon, SLAT, SLON)[2])
+
+        # both phases of each event are recorded on the vertical component, and S on the transverse component
+        z += wavelet(tats['P'] + (origin_time - T0), amplitude)
+        z += wavelet(tats['S'] + (origin_time - T0), amplitude)
+        dn, de = rotate_rt_ne(np.zeros(npts), wavelet(tats['S'] + (origin_time - T0), amplitude), bas[-1])
+        n += dn
+        e += de
+    # end for
+    z[int(SPIKE * SAMPLING_RATE)] = 1e4
+
+    result = []
+    for data, gap in [(z, GAPS['P']), (n, GAPS['S']), (e, None)]:
+        data = np.ma.masked_array(data, mask=np.zeros(npts, dtype=bool))
+        if (gap is not None): data.mask[int(gap[0] * SAMPLING_RATE):int(gap[1] * SAMPLING_RATE)] = True
+        result.append(Trace(data=data, header={'network': 'XX', 'station': 'AA01', 'starttime': T0,
+                                               'sampling_rate': SAMPLING_RATE}))
+    # end for
+
+    return result, events, bas
+# end func
+
+
+def assert_results_equal(results, expected):
+    assert len(results) == len(expected)
+    for result, exp in zip(results, expected):
+        assert (result is None) == (exp is None)
+        if (result is None): continue
+
+        picks, residuals, snrs, bandindex, pickerindex = result
+        assert np.allclose([p - q for p, q in zip(picks, exp[0])], 0, atol=1e-6)
+        assert np.allclose(residuals, exp[1])
+        assert np.allclose(snrs, exp[2], rtol=1e-6)
+        assert (bandindex, pickerindex) == (exp[3], exp[4])
+    # end for
+# end func
+
+
+@pytest.mark.filterwarnings('ignore::UserWarning')
+def test_extract_batch(pick, taup_model, day_traces, monkeypatch):
+    (trz, trn, tre), events, bas = day_traces
+    pickerlist = [StubPicker(15), StubPicker(5)]
+
+    # per-event extraction, as in the non-batched mode
+    stz, stn, ste = [Stream(traces=tr.split()) for tr in (trz, trn, tre)]
+    expected_p = [pick.extract_p(taup_model, pickerlist, e, SLON, SLAT, stz, max_amplitude=MAX_AMPLITUDE)
+                  for e in events]
+    expected_s = [pick.extract_s(taup_model, pickerlist, e, SLON, SLAT, stz, None, ba, max_amplitude=MAX_AMPLITUDE)
+                  for e, ba in zip(events, bas)]
+    expected_ne = [pick.extract_s(taup_model, pickerlist, e, SLON, SLAT, stn, ste, ba, max_amplitude=MAX_AMPLITUDE)
+                   for e, ba in zip(events, bas)]
+
+    # scenarios are exercised: arrivals at day-edges and in gaps are picked, and those of weak events by the
+    # second picker, while windows with spikes, or with gaps on one of the horizontal components, are discarded
+    assert [None if r is None else r[4] for r in expected_p[:6]] == [0, 0, 0, None, 1, 0]
+    assert [None if r is None else r[4] for r in expected_ne[6:]] == [0, None, 1, 0]
+
+    # windows with gaps are delegated to extract_p/extract_s
+    calls = []
+    for name in ['extract_p', 'extract_s']:
+        def wrapper(*args, __f=getattr(pick, name), **kwargs):
+            calls.append(args[2].public_id)
+            return __f(*args, **kwargs)
+        # end func
+        monkeypatch.setattr(pick, name, wrapper)
+    # end for
+
+    results = pick.extract_p_batch(taup_model, pickerlist, events, SLON, SLAT, trz, max_amplitude=MAX_AMPLITUDE)
+    assert_results_equal(results, expected_p)
+    assert calls == ['event2']
+
+    calls.clear()
+    results = pick.extract_s_batch(taup_model, pickerlist, events, SLON, SLAT, trz, None, bas,
+                                   max_amplitude=MAX_AMPLITUDE)
+    assert_results_equal(results, expected_s)
+
+    calls.clear()
+    results = pick.extract_s_batch(taup_model, pickerlist, events, SLON, SLAT, trn, tre, bas,
+                                   max_amplitude=MAX_AMPLITUDE)
+    assert_results_equal(results, expected_ne)
+    assert calls == ['event7']
+
+    # quality measures computed in single precision, with multiple threads
+    results = pick.extract_p_batch(taup_model, pickerlist, events, SLON, SLAT, trz, max_amplitude=MAX_AMPLITUDE,
+                                  quality_dtype=np.float32, quality_threads=2)
+    for result, exp in zip(results, expected_p):
+        assert (result is None) == (exp is None)
+        if (result is not None): assert np.allclose(result[2], exp[2], rtol=1e-4)
+    # end for
+# end func
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Unit testing for batched computation of pick quality measures
+"""
+
+import numpy as np
+import pytest
+import pywt
+from obspy import Trace
+
+from seismic.pick_harvester.quality import compute_quality_measures, compute_quality_measures_batch, cwt_batch
+
+P_SCALES = np.logspace(0.15, 1.5, 30)
+S_SCALES = np.logspace(0.01, 4, 30)
+
+
+@pytest.fixture
+def traces():
+    rs = np.random.RandomState(0)
+    result = []
+    for k in range(12):
+        npts = 401 if k < 9 else 250 + 50 * (k - 9)
+        data = rs.standard_normal(npts)
+        n = np.arange(npts - npts // 2)
+        data[npts // 2:] += rs.uniform(1, 8) * np.sin(n * rs.uniform(0.2, 1.5)) * np.exp(-n / 50.)
+        result.append(Trace(data=data, header={'sampling_rate': 20.}))
+    # end for
+    return result
+# end func
+
+
+@pytest.mark.parametrize('scales', [P_SCALES, S_SCALES])
+def test_cwt_batch(traces, scales):
+    data = np.array([tr.data for tr in traces[:9]])
+
+    for dtype, rtol in [(np.float64, 1e-12), (np.float32, 1e-5)]:
+        coefs, freqs = cwt_batch(data, scales, 'gaus8', 0.05, dtype=dtype, workers=2)
+        assert coefs.shape == (9, len(scales), 401)
+        assert coefs.dtype == dtype
+
+        for row, x in zip(coefs, data):
+            expected, expected_freqs = pywt.cwt(x, scales, 'gaus8', 0.05)
+            assert np.allclose(freqs, expected_freqs)
+            assert np.max(np.abs(row - expected)) <= rtol * np.max(np.abs(expected))
+        # end for
+    # end for
+# end func
+
+
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+@pytest.mark.parametrize('scales', [P_SCALES, S_SCALES])
+def test_compute_quality_measures_batch(traces, scales):
+    traces.append(Trace(data=np.ones(1), header={'sampling_rate': 20.})) # degenerate measures
+    expected = np.array([compute_quality_measures(tr, tr, scales) for tr in traces])
+
+    result = compute_quality_measures_batch(traces, scales, chunk_size=4)
+    assert np.allclose(result, expected, rtol=1e-7, equal_nan=True)
+    assert result[-1, 2] == -1
+
+    result = compute_quality_measures_batch(traces, scales, dtype=np.float32)
+    assert np.allclose(result, expected, rtol=1e-4, equal_nan=True)
+# end func
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Unit testing for work-units of the pick harvester
+"""
+
+import numpy as np
+import pytest
+from obspy import UTCDateTime
+
+from seismic.pick_harvester.utils import _recorded_seconds, build_work_units, work_unit_key
+
+DAY = 24 * 3600
+
+
+@pytest.fixture
+def spans():
+    t0 = UTCDateTime(2010, 1, 1, 6).timestamp
+    rs = np.random.RandomState(0)
+
+    # three channels of day-long traces over 45 days, with a gap of 10 days, and a station
+    # with a handful of short traces
+    starts = np.array([t0 + i * DAY for i in range(45) if not (20 <= i < 30)])
+    sta1 = np.concatenate([np.column_stack([starts + rs.uniform(0, 60), starts + DAY]) for _ in range(3)])
+    sta1 = sta1[np.argsort(sta1[:, 0])]
+    sta2 = np.array([[t0 + 3.5 * DAY, t0 + 3.75 * DAY], [t0 + 4 * DAY, t0 + 4.25 * DAY]])
+
+    return {('AU', 'STA1'): sta1, ('AU', 'STA2'): sta2, ('AU', 'STA3'): np.zeros((0, 2))}
+# end func
+
+
+def test_recorded_seconds(spans):
+    sspans = spans[('AU', 'STA1')]
+    times = np.linspace(sspans[:, 0].min() - DAY, sspans[:, 1].max() + DAY, 500)
+
+    expected = [np.sum(np.clip(t - sspans[:, 0], 0, sspans[:, 1] - sspans[:, 0])) for t in times]
+    assert np.allclose(_recorded_seconds(sspans, times), expected, rtol=0, atol=1e-3)
+# end func
+
+
+@pytest.mark.parametrize('days_per_unit', [1, 7, 30, 100])
+def test_build_work_units(spans, days_per_unit):
+    t0 = UTCDateTime(2010, 1, 1).timestamp
+    rs = np.random.RandomState(1)
+    origin_timestamps = np.concatenate([t0 + rs.uniform(0, 15 * DAY, 40), t0 + rs.uniform(35 * DAY, 38 * DAY, 5),
+                                        [t0 + 6 * 3600 + 10 * DAY]]) # on a day boundary
+
+    units, costs = build_work_units(spans, origin_timestamps, days_per_unit=days_per_unit)
+    assert len(units) == len(costs)
+    assert np.all(costs >= 0)
+    assert len(set([work_unit_key(unit) for unit in units])) == len(units)
+
+    for (net, sta), sspans in spans.items():
+        if (len(sspans) == 0):
+            assert not [u for u in units if u[1] == sta]
+            continue
+        # end if
+
+        # days with events, as enumerated by the pick harvester for a station, and their costs
+        start_time = UTCDateTime(sspans[:, 0].min())
+        end_time = UTCDateTime(sspans[:, 1].max())
+        expected_days = []
+        expected_cost = 0
+        curr = start_time
+        while (curr < end_time):
+            nevents = np.sum((origin_timestamps >= curr.timestamp) & (origin_timestamps <= (curr + DAY).timestamp))
+            if (nevents > 0):
+                expected_days.append(curr)
+                expected_cost += nevents * np.sum(np.clip(np.minimum(sspans[:, 1], (curr + DAY).timestamp) -
+                                                          np.maximum(sspans[:, 0], curr.timestamp), 0, None)) / DAY
+            # end if
+            curr += DAY
+        # end while
+
+        # days with events, as enumerated for work-units
+        sunits = [u for u in units if u[1] == sta]
+        days = []
+        for _, _, ust, uet in sunits:
+            assert start_time <= UTCDateTime(ust) < UTCDateTime(uet) <= end_time
+            ndays = (ust - start_time.timestamp) / DAY
+            assert np.isclose(ndays, round(ndays), rtol=0, atol=1e-9) and round(ndays) % days_per_unit == 0
+
+            curr = UTCDateTime(ust)
+            while (curr < UTCDateTime(uet)):
+                if (np.any((origin_timestamps >= curr.timestamp) &
+                           (origin_timestamps <= (curr + DAY).timestamp))): days.append(curr)
+                curr += DAY
+            # end while
+        # end for
+
+        assert days == expected_days
+        assert np.isclose(np.sum(costs[[i for i, u in enumerate(units) if u[1] == sta]]), expected_cost)
+    # end for
+# end func
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Unit testing for IDW interpolation of CCP volumes
+"""
+
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from seismic.receiver_fn.rf_ccp_util import CCPVolume, rtp2xyz
+
+ER = 6371.
+
+
+@pytest.fixture(scope='module')
+def ccp_volume(tmpdir_factory):
+    rs = np.random.RandomState(0)
+    n = 20000
+    lon, lat, depth = rs.uniform(130, 132, n), rs.uniform(-21, -19, n), rs.uniform(0, 100, n)
+    phase = rs.uniform(0, 2 * np.pi, n)
+    data = np.column_stack([rtp2xyz(ER - depth, np.radians(90 - lat), np.radians(lon)), depth,
+                            rs.standard_normal(n), np.cos(phase), np.sin(phase)])
+
+    fn = os.path.join(str(tmpdir_factory.mktemp('ccp')), 'ccp.h5')
+    with h5py.File(fn, 'w') as hf:
+        hf.attrs['earth_radius'] = ER
+        dset = hf.create_dataset('AU', data=data)
+        dset.attrs['AU.ARMA.'] = np.array([131., -20., 0., 0.])
+    # end with
+    return CCPVolume(fn)
+# end func
+
+
+def reference_interpolate(vol, xyz, depths, cell_radius, dz, idw_exponent, pw_exponent, cone):
+    # node-by-node implementation previously used in CCP profiles and export_sgrid.py
+    data = vol._data
+    vals = np.zeros(xyz.shape[0])
+    for i in np.arange(xyz.shape[0]):
+        indices = np.array(vol._tree.query_ball_point(xyz[i], r=cell_radius), dtype=int)
+        indices = indices[np.fabs(data[indices, 3] - depths[i]) < dz]
+        d = np.sqrt(np.sum(np.power(xyz[i] - data[indices, :3], 2), axis=1))
+        if(cone):
+            indices = indices[d < depths[i]]
+            d = d[d < depths[i]]
+        # end if
+        if(len(indices) == 0): continue
+
+        idw = 1. / np.power(d, idw_exponent)
+        pw = np.mean(data[indices, 5] + 1j * data[indices, 6])
+        vals[i] = np.sum(idw * data[indices, 4]) / np.sum(idw) * np.power(np.abs(pw), pw_exponent)
+    # end for
+    return vals
+# end func
+
+
+@pytest.mark.parametrize('depth_levels', [True, False])
+@pytest.mark.parametrize('cone', [True, False])
+def test_interpolate(ccp_volume, depth_levels, cone):
+    rs = np.random.RandomState(1)
+    n = 3000
+    if(depth_levels): depths = rs.choice(np.linspace(0, 110, 12), n)  # grid nodes on depth levels
+    else: depths = rs.uniform(0, 110, n)
+    lon, lat = rs.uniform(129.8, 132.2, n), rs.uniform(-21.2, -18.8, n)
+    xyz = rtp2xyz(ER - depths, np.radians(90 - lat), np.radians(lon))
+
+    expected = reference_interpolate(ccp_volume, xyz, depths, 15, 1.5, 2, 1, cone)
+    assert np.count_nonzero(expected) > n // 2
+
+    for chunk_size in [256, 4096]:
+        result = ccp_volume.interpolate(xyz, depths, 15, 1.5, 2, 1, cone=cone, chunk_size=chunk_size)
+        assert np.allclose(result, expected)
+    # end for
+
+    # weights of a chunk
+    w = ccp_volume.idw_weights(xyz[:100], depths[:100], 15, 1.5, 2, cone=cone)
+    assert w.shape == (100, ccp_volume._data.shape[0])
+    assert np.all(w.data > 0)
+# end func
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Unit testing for ray-path lookup tables used in CCP migration
+"""
+
+import numpy as np
+import pytest
+from obspy.core.util import AttribDict
+from obspy.geodetics import locations2degrees
+from obspy.taup import TauPyModel
+from rf.util import DEG2KM
+from scipy.integrate import simps as simpson
+from scipy.interpolate import interp1d, splrep, sproot
+
+from seismic.receiver_fn.rf_ccp_util import RayPathTable, cumulative_simpson, rtp2xyz
+
+
+@pytest.fixture(scope='module')
+def taup_model():
+    return TauPyModel(model='iasp91')
+# end func
+
+
+def _stats(taup_model, event_latitude, event_longitude, event_depth):
+    st = AttribDict(station_latitude=-25., station_longitude=135., event_latitude=event_latitude,
+                    event_longitude=event_longitude, event_depth=event_depth)
+    distance = locations2degrees(st.station_latitude, st.station_longitude, event_latitude, event_longitude)
+    st.slowness = taup_model.get_travel_times(event_depth, distance, ['P'])[0].ray_param_sec_degree
+    return st
+# end func
+
+
+def reference_piercing_points(taup_model, st, zmax=150, nz=1500):
+    # ray-path computations previously carried out for each trace in Migrate.process_streams
+    arr = taup_model.get_ray_paths_geo(source_depth_in_km=st.event_depth,
+                                       source_latitude_in_deg=st.event_latitude,
+                                       source_longitude_in_deg=st.event_longitude,
+                                       receiver_latitude_in_deg=st.station_latitude,
+                                       receiver_longitude_in_deg=st.station_longitude,
+                                       phase_list=['P'], resample=True)[0]
+    times = (arr.path['time'][-1] - arr.path['time'])[::-1]
+    depths = arr.path['depth'][::-1]
+    xyzs = rtp2xyz(6371 - depths, np.radians(90 - arr.path['lat'][::-1]), np.radians(arr.path['lon'][::-1]))
+
+    tck = splrep(times, depths, k=3, s=0)
+    dnew = np.linspace(1e-5, zmax, nz)
+    tnew = np.array([sproot((tck[0], tck[1] - d, tck[2]))[0] for d in dnew])
+
+    return np.array([interp1d(times, xyzs[:, i])(tnew) for i in range(3)]).T, interp1d(times, depths)(tnew)
+# end func
+
+
+def reference_ps_times(taup_model, st, zmax=150, nz=1500):
+    # Ps delay times previously integrated over each prefix of the depth grid in Migrate.process_streams
+    vmodel = taup_model.model.s_mod.v_mod
+    dnew = np.linspace(1e-5, zmax, nz)
+    vp = vmodel.evaluate_above(dnew, 'p')
+    vs = vmodel.evaluate_above(dnew, 's')
+
+    tps = np.zeros(dnew.shape)
+    p = st.slowness / DEG2KM
+    for idx in np.arange(2, dnew.shape[0] + 1):
+        tps[idx - 1] = simpson(np.sqrt(np.power(vs[:idx], -2.) - p * p) -
+                               np.sqrt(np.power(vp[:idx], -2.) - p * p), x=dnew[:idx])
+    # end for
+    return tps
+# end func
+
+
+def test_cumulative_simpson():
+    x = np.linspace(1e-5, 150, 1500)
+    y = np.sqrt(1 + x / 100.) + np.sin(x / 10.)
+    result = cumulative_simpson(y, x)
+
+    assert result[0] == 0
+    # exact Simpson's rule for odd numbers of samples
+    for n in [3, 5, 101, 1499]:
+        assert np.isclose(result[n - 1], simpson(y[:n], x=x[:n]))
+    # end for
+    assert np.allclose(result[1:], [simpson(y[:n], x=x[:n]) for n in range(2, 1501)], rtol=1e-4)
+# end func
+
+
+def test_ray_path_table(taup_model):
+    table = RayPathTable(taup_model, slowness_bin=0.01, depth_bin=10)
+
+    for event in [(10., 120., 35.), (-5., 170., 210.), (30., 100., 80.)]:
+        st = _stats(taup_model, *event)
+        xyzs, depths = table.piercing_points(st)
+        expected_xyzs, expected_depths = reference_piercing_points(taup_model, st)
+
+        assert np.allclose(depths, expected_depths)
+        assert np.max(np.linalg.norm(xyzs - expected_xyzs, axis=1)) < 0.05 # km
+
+        # Ps delay times; Simpson's rule is exact over odd numbers of samples
+        ps_times, expected_ps_times = table.ps_times(st.slowness), reference_ps_times(taup_model, st)
+        assert np.allclose(ps_times[::2], expected_ps_times[::2])
+        assert np.allclose(ps_times, expected_ps_times, rtol=0, atol=1e-4) # s
+    # end for
+    assert len(table) == 3
+
+    # ray-paths for traces in the same bin are cached
+    st = _stats(taup_model, 10., 120., 35.)
+    st.slowness += 0.001
+    st.event_depth += 1
+    table.piercing_points(st)
+    assert len(table) == 3
+# end func
@@ -9,7 +9,8 @@ import numpy as np
 from scipy import signal
 
 from seismic.receiver_fn.rf_synthetic import synthesize_rf_dataset
-from seismic.receiver_fn.rf_deconvolution import iter_deconv_pulsetrain, rf_iter_deconv
+from seismic.receiver_fn.rf_deconvolution import iter_deconv_pulsetrain, iter_deconv_pulsetrain_batch, rf_iter_deconv
+from seismic.receiver_fn import rf_deconvolution
 
 # pylint: disable=invalid-name, missing-docstring, too-many-locals, too-many-statements
 
@@ -207,6 +208,81 @@ def test_rf_integration():
 
 # end func
 
+
+def _reference_iter_deconv(f, g, sampling_rate, time_shift, max_pulses=1000, tol=1.0e-3, gwidth=2.5):
+    # Reference implementation that rebuilds, filters and convolves the whole pulse train in each iteration
+    dt = 1.0 / sampling_rate
+    npts = len(f)
+    f_hat = rf_deconvolution._gauss_filter(f, gwidth, dt)
+    g_hat = rf_deconvolution._gauss_filter(g, gwidth, dt)
+    power = np.dot(f_hat, f_hat)
+    leadin = int(np.ceil(time_shift / dt))
+
+    amps, shifts = [], []
+    resid = f_hat
+    sumsq_i, d_error = 1.0, np.inf
+    while np.abs(d_error) > tol and len(amps) < max_pulses:
+        xc = rf_deconvolution._xcorrelate(resid, g_hat)
+        shift_index = np.argmax(np.abs(xc[:npts - leadin]))
+        shifts.append(shift_index + leadin)
+        amps.append(xc[shift_index])
+
+        p, pulses = rf_deconvolution._build_decon(amps, shifts, npts, gwidth, dt)
+        f_hat_predicted = rf_deconvolution._convolve(p, g, leadin)
+        resid, sumsq = rf_deconvolution._get_residual(f_hat, f_hat_predicted)
+        d_error = 100 * (sumsq_i - sumsq / power)
+        sumsq_i = sumsq / power
+    # end while
+
+    return p, pulses, f_hat, f_hat_predicted, 100 - 100 * sumsq_i
+# end func
+
+
+def test_iter_deconv_batch():
+    # Verify that batched deconvolution, with incremental updates of residuals, is equivalent to
+    # rebuilding the pulse train in each iteration.
+    F_s = 10.0
+    times = np.arange(-50, 150, 1. / F_s)
+    np.random.seed(20190925)
+
+    f_funcs = []
+    g_funcs = []
+    for i in range(4):
+        g = _generate_synthetic_source(times) + np.random.normal(scale=5, size=times.shape)
+        pure_rf = np.zeros(times.shape)
+        pure_rf[[500, 540 + i, 640, len(times) - 2]] = [1, 0.4, -0.2, 0.1] # includes a pulse at the end
+        pure_rf += np.random.normal(scale=0.01, size=times.shape)
+        f_funcs.append(_generate_radial_from_src(pure_rf, g, times))
+        g_funcs.append(g)
+    # end for
+    f_funcs = np.array(f_funcs)
+    g_funcs = np.array(g_funcs)
+
+    for max_pulses in [1, 20, 200]:
+        results = iter_deconv_pulsetrain_batch(f_funcs, g_funcs, F_s, 50.0, max_pulses=max_pulses)
+        for i, (f, g) in enumerate(zip(f_funcs, g_funcs)):
+            expected = _reference_iter_deconv(f, g, F_s, 50.0, max_pulses=max_pulses)
+            for r, e in zip(results, expected):
+                assert np.allclose(r[i], e, rtol=1e-9, atol=1e-12)
+            # end for
+            single = iter_deconv_pulsetrain(f, g, F_s, 50.0, max_pulses=max_pulses)
+            for r, e in zip(results, single):
+                assert np.allclose(r[i], e)
+            # end for
+        # end for
+    # end for
+
+    # a single source signal shared by all response signals
+    results = iter_deconv_pulsetrain_batch(f_funcs, g_funcs[0], F_s, 50.0, max_pulses=20)
+    expected = iter_deconv_pulsetrain(f_funcs[2], g_funcs[0], F_s, 50.0, max_pulses=20)
+    assert np.allclose(results[0][2], expected[0])
+
+    # early exit for signals with no power
+    rf_trace, _, _, _, fit = iter_deconv_pulsetrain(np.zeros(len(times)), g_funcs[0], F_s, 50.0)
+    assert fit == 100.0 and np.allclose(rf_trace, 0)
+# end func
+
 if __name__ == "__main__":
     test_ammon_iter_deconv()
     test_rf_integration()
+    test_iter_deconv_batch()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""Unit testing for sparse distance weighting in Moho gridding
+"""
+
+import numpy as np
+from scipy.spatial.distance import cdist
+
+from seismic.receiver_fn.moho_config import DIST_METRIC, neighbour_pairs
+from seismic.receiver_fn.pointsets2grid import _distance_weights
+
+
+def _points(rs, n):
+    return np.column_stack((rs.uniform(130, 140, n), rs.uniform(-25, -15, n)))
+
+
+def test_neighbour_pairs():
+    rs = np.random.RandomState(0)
+    p1, p2 = _points(rs, 200), _points(rs, 300)
+    # points across the antimeridian and at a pole
+    p1 = np.vstack((p1, [[179.9, 0.], [0., 90.]]))
+    p2 = np.vstack((p2, [[-179.8, 0.1], [100., 89.5]]))
+
+    dist = cdist(p1, p2, metric=DIST_METRIC)
+    for max_dist in [0.018, 1.0, 3.6]:
+        expected = np.argwhere(dist <= max_dist)
+        i1, i2, d = neighbour_pairs(p1[:, 0], p1[:, 1], p2[:, 0], p2[:, 1], max_dist)
+
+        assert np.array_equal(np.column_stack((i1, i2)), expected)
+        assert np.allclose(d, dist[i1, i2])
+
+    i1, i2, d = neighbour_pairs([], [], p2[:, 0], p2[:, 1], 1.0)
+    assert i1.size == i2.size == d.size == 0
+
+
+def test_distance_weights():
+    rs = np.random.RandomState(1)
+    grid_map, xy_map = _points(rs, 500), _points(rs, 100)
+    sigma, max_dist = 0.5, 1.8
+
+    dist = cdist(grid_map, xy_map, metric=DIST_METRIC, max_dist=max_dist)
+    for interpolation, expected in [('gaussian', np.exp(-np.power(dist/sigma, 2.))),
+                                    ('bk_exponential', np.exp(-dist/sigma))]:
+        expected[np.isnan(expected)] = 0
+        weights = _distance_weights(grid_map, xy_map, max_dist, sigma, interpolation)
+        assert weights.shape == expected.shape
+        assert np.allclose(weights.toarray(), expected)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Unit testing for the columnar RF store
+"""
+
+import os
+
+import numpy as np
+import pytest
+from obspy import UTCDateTime
+from rf import RFStream, read_rf
+from rf.rfstream import RFTrace
+
+import seismic.receiver_fn.rf_util as rf_util
+from seismic.receiver_fn import rf_columnar
+from seismic.receiver_fn.rf_h5_file_station_iterator import IterRfH5StationEvents
+
+
+@pytest.fixture
+def rf_stream():
+    rs = np.random.RandomState(0)
+    traces = []
+    for sta in ['AA01', 'AA02']:
+        for iev in range(5):
+            event_time = UTCDateTime(2020, 1, 1) + iev * 86400
+            for cha in ['HHR', 'HHT']:
+                npts = 100 + 10 * iev  # traces of varying lengths
+                tr = RFTrace(data=rs.standard_normal(npts),
+                             header={'network': 'XX', 'station': sta, 'location': '', 'channel': cha,
+                                     'starttime': event_time + 600, 'delta': 0.1,
+                                     'event_time': event_time, 'onset': event_time + 650,
+                                     'event_id': 'smi:event/%d' % iev, 'event_magnitude': 6.0 + iev / 10.,
+                                     'back_azimuth': 10. * iev, 'slope_ratio': 2.5,
+                                     'processing': ['trim', 'filter(%d)' % iev]})
+                tr.data = tr.data.astype(np.float32)
+                if iev % 2: tr.stats.snr = 3.5  # only present for some traces
+                traces.append(tr)
+            # end for
+        # end for
+    # end for
+    return RFStream(traces=traces)
+# end func
+
+
+def _key(tr):
+    return tr.id, str(tr.stats.event_time)
+# end func
+
+
+def _assert_streams_equal(st1, st2, ignore=('_format', 'h5')):
+    assert len(st1) == len(st2)
+    for tr1, tr2 in zip(sorted(st1, key=_key), sorted(st2, key=_key)):
+        assert np.array_equal(tr1.data, tr2.data)
+        for k in set(tr1.stats.keys()) | set(tr2.stats.keys()):
+            if k in ignore: continue
+            assert tr1.stats[k] == tr2.stats[k], k
+        # end for
+    # end for
+# end func
+
+
+def test_round_trip(rf_stream, tmp_path):
+    h5fn = os.path.join(str(tmp_path), 'rf.h5')
+    colfn = os.path.join(str(tmp_path), 'rf_col.h5')
+    h5fn2 = os.path.join(str(tmp_path), 'rf2.h5')
+
+    rf_stream.write(h5fn, format='H5', mode='a')
+    rf_columnar.h5_to_columnar(h5fn, colfn)
+    assert rf_columnar.is_rf_columnar(colfn) and not rf_columnar.is_rf_columnar(h5fn)
+
+    _assert_streams_equal(rf_stream, rf_columnar.read_rf_columnar(colfn))
+    _assert_streams_equal(read_rf(h5fn, format='h5'), rf_columnar.read_rf_columnar(colfn))
+
+    rf_columnar.columnar_to_h5(colfn, h5fn2)
+    _assert_streams_equal(read_rf(h5fn, format='h5'), read_rf(h5fn2, format='h5'))
+
+    # raw arrays
+    data, stats = rf_columnar.read_station_arrays(colfn, 'XX.AA01.', 'HHR')
+    assert data.dtype == np.float32 and data.shape == (5, 140)
+    assert np.array_equal(stats['npts'], [100, 110, 120, 130, 140])
+    assert np.all(np.isnan(data[0, 100:]))
+    assert UTCDateTime(ns=int(stats['event_time'][1])) == UTCDateTime(2020, 1, 2)
+# end func
+
+
+def test_append(rf_stream, tmp_path):
+    colfn = os.path.join(str(tmp_path), 'rf_col.h5')
+
+    rf_columnar.write_rf_columnar(rf_stream[:6], colfn, mode='w')
+    rf_columnar.write_rf_columnar(rf_stream[6:], colfn, mode='a')
+    _assert_streams_equal(rf_stream, rf_columnar.read_rf_columnar(colfn))
+
+    with pytest.raises(IOError):
+        h5fn = os.path.join(str(tmp_path), 'rf.h5')
+        rf_stream.write(h5fn, format='H5', mode='a')
+        rf_columnar.write_rf_columnar(rf_stream, h5fn)
+    # end with
+# end func
+
+
+def test_readers(rf_stream, tmp_path):
+    h5fn = os.path.join(str(tmp_path), 'rf.h5')
+    colfn = os.path.join(str(tmp_path), 'rf_col.h5')
+    rf_stream.write(h5fn, format='H5', mode='a')
+    rf_columnar.write_rf_columnar(rf_stream, colfn)
+
+    assert rf_util.get_hdf_keys(colfn) == rf_util.get_hdf_keys(h5fn) == ['XX.AA01.', 'XX.AA02.']
+    _assert_streams_equal(rf_util.read_hdf_key(h5fn, 'XX.AA02.'), rf_util.read_hdf_key(colfn, 'XX.AA02.'))
+    _assert_streams_equal(rf_util.read_h5_rf(h5fn, 'XX', 'AA01'), rf_util.read_h5_rf(colfn, 'XX', 'AA01'))
+
+    for (sid1, events1), (sid2, events2) in zip(IterRfH5StationEvents(h5fn), IterRfH5StationEvents(colfn)):
+        assert sid1 == sid2 and len(events1) == len(events2) == 5
+        for st1, st2 in zip(events1, events2):
+            assert [tr.id for tr in st1] == [tr.id for tr in st2]
+            _assert_streams_equal(st1, st2)
+        # end for
+    # end for
+
+    rf_util.remove_group(colfn, 'XX.AA01.')
+    assert rf_util.get_hdf_keys(colfn) == ['XX.AA02.']
+# end func
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Unit testing for RF similarity and coherence metrics
+"""
+
+import itertools
+
+import numpy as np
+import pytest
+
+from seismic.receiver_fn import rf_quality_filter
+
+
+@pytest.fixture
+def swipe():
+    rs = np.random.RandomState(0)
+    base = rs.standard_normal(301)
+    data = base + 0.3 * rs.standard_normal((60, 301))
+    data[:10] = rs.standard_normal((10, 301))  # outliers
+    data[3, 10:20] = np.nan
+    data[7, ::3] = np.nan
+    return data
+# end func
+
+
+def test_rms_distance_matrix(swipe):
+    expected = [np.sqrt(np.nanmean(np.square(a - b))) for a, b in itertools.combinations(swipe, 2)]
+
+    for dtype, rtol in [(np.float64, 1e-10), (np.float32, 1e-4)]:
+        distance = rf_quality_filter.rms_distance_matrix(swipe, dtype=dtype)
+        assert distance.shape == (60, 60)
+        assert np.allclose(distance, distance.T)
+        assert np.all(np.diag(distance) == 0)
+        assert np.allclose(distance[np.triu_indices(60, k=1)], expected, rtol=rtol)
+    # end for
+
+    # rows without common samples
+    data = np.array([[1., np.nan], [np.nan, 2.], [0., 1.]])
+    distance = rf_quality_filter.rms_distance_matrix(data)
+    assert np.isnan(distance[0, 1]) and np.isclose(distance[0, 2], 1) and np.isclose(distance[1, 2], 1)
+# end func
+
+
+def test_rf_group_by_similarity(swipe):
+    groups = rf_quality_filter.rf_group_by_similarity(swipe, 0.5)
+    assert np.all(groups[:10] == -1)
+    assert np.all(groups[10:] == 0)
+# end func
+
+
+def test_coherence():
+    rs = np.random.RandomState(0)
+    data = rs.standard_normal((20, 601))
+    median = np.median(data, axis=0)
+
+    f, coh = rf_quality_filter._coh(median, data)
+    assert coh.shape == (20, f.shape[0])
+    for i in range(data.shape[0]):
+        fi, ci = rf_quality_filter._coh(median, data[i])
+        assert np.allclose(f, fi) and np.allclose(coh[i], ci)
+    # end for
+
+    # coherence of a signal with itself
+    f, coh = rf_quality_filter._coh(median, median)
+    assert np.allclose(coh, 1)
+# end func
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""Unit testing for H-k stacking
+"""
+
+import os
+import numpy as np
+import pytest
+import obspy
+from obspy.taup.velocity_model import VelocityModel
+from obspy import UTCDateTime
+from rf.rfstream import RFTrace
+from rf.util import DEG2KM
+from scipy.interpolate import interp1d
+from scipy.integrate import simps as simpson
+from scipy.optimize import minimize, Bounds
+
+import seismic.receiver_fn.rf_stacking as rf_stacking
+
+
+@pytest.fixture
+def rf_traces():
+    rs = np.random.RandomState(0)
+    traces = []
+    for i in range(12):
+        st = UTCDateTime(2020, 1, 1)
+        tr = RFTrace(data=rs.standard_normal(801 + i),
+                     header={'network': 'XX', 'station': 'AA01', 'location': '', 'channel': 'HHR',
+                             'starttime': st, 'delta': 0.05, 'onset': st + 5. + 0.01 * i,
+                             'slowness': float(rs.choice([5., 6.5, 7.])),
+                             'inclination': float(rs.choice([20., 25.]))})
+        if i % 5 == 0: tr.stats.t1_offset = 0.25
+        traces.append(tr)
+    # end for
+    return traces
+# end func
+
+
+def reference_hk_stack(cha_data, h_range, k_range, weights, root_order):
+    # trace-by-trace implementation previously used in compute_hk_stack
+    k_grid, h_grid = np.meshgrid(k_range, h_range)
+    tphase_amps = []
+    for trc in cha_data:
+        lead_time = trc.stats.onset - trc.stats.starttime
+        p = trc.stats.slowness / DEG2KM
+        Vp_inv = p / np.sin(np.deg2rad(trc.stats.inclination))
+        term1 = np.sqrt((k_grid * Vp_inv) ** 2 - p ** 2)
+        term2 = np.sqrt(Vp_inv ** 2 - p ** 2)
+
+        t1 = h_grid * (term1 - term2) + trc.stats.get('t1_offset', 0)
+        t2 = h_grid * (term1 + term2)
+        t3 = h_grid * 2 * term1
+
+        tio = interp1d(trc.times() - lead_time, trc.data, fill_value=0, bounds_error=False)
+        a, b, c = tio(t1), tio(t2), -tio(t3)
+        tphase_amps.append([np.sign(x) * np.power(np.fabs(x), 1. / root_order) for x in (a, b, c)])
+    # end for
+    hk_stack = np.sum(np.dot(np.moveaxis(np.array(tphase_amps), 1, -1), weights), axis=0)
+    return np.sign(hk_stack) * np.power(np.fabs(hk_stack), root_order)
+# end func
+
+
+def reference_sediment_hk_stack(cha_data, H_c, k_c, h_range, k_range, root_order):
+    # trace-by-trace implementation previously used in compute_sediment_hk_stack
+    def obj_func(x0, amps):
+        curr_stack = np.sum(np.dot(np.moveaxis(amps, 1, -1), x0), axis=0)
+        idx = np.unravel_index(np.argmax(curr_stack), np.array(curr_stack).shape)
+        return -curr_stack[idx]
+    # end func
+
+    vfunc = rf_stacking_vfunc()
+    k_grid, h_grid = np.meshgrid(k_range, h_range)
+    tphase_amps = []
+    for trc in cha_data:
+        lead_time = trc.stats.onset - trc.stats.starttime
+        p = trc.stats.slowness / DEG2KM
+
+        t4 = np.zeros(h_grid.shape)
+        t2 = np.zeros(h_grid.shape)
+        t3 = np.zeros(h_grid.shape)
+        for i in np.arange(h_grid.shape[0]):
+            interval1 = np.linspace(-h_grid[i, 0], 0, 50)
+            interval2 = np.linspace(-(h_grid[i, 0] + H_c), -h_grid[i, 0], 50)
+            v_interval1 = vfunc(interval1)
+            v_interval2 = vfunc(interval2)
+
+            for j in np.arange(h_grid.shape[1]):
+                A = simpson(np.sqrt(np.power(v_interval1 / k_grid[i, j], -2.) - p ** 2), interval1)
+                B = simpson(np.sqrt(np.power(v_interval1, -2.) - p ** 2), interval1)
+                C = simpson(np.sqrt(np.power(v_interval2 / k_c, -2.) - p ** 2), interval2)
+                D = simpson(np.sqrt(np.power(v_interval2, -2.) - p ** 2), interval2)
+
+                t4[i, j] = A - B
+                t2[i, j] = A + B + C + D
+                t3[i, j] = 2 * A + 2 * C
+            # end for
+        # end for
+
+        tio = interp1d(trc.times() - lead_time, trc.data)
+        a, b, c = tio(t4), tio(t2), -tio(t3)
+        tphase_amps.append([np.sign(x) * np.power(np.fabs(x), 1. / root_order) for x in (a, b, c)])
+    # end for
+    tphase_amps = np.array(tphase_amps)
+
+    bounds = Bounds(np.zeros(3) + 0.01, np.array([0.3, 1, 1]))
+    constraints = [{'type': 'ineq', 'fun': lambda x: x},
+                   {'type': 'eq', 'fun': lambda x: np.sum(x) - 1}]
+    weights = minimize(obj_func, np.array([0.2, 0.4, 0.4]), tphase_amps, method='SLSQP',
+                       bounds=bounds, constraints=constraints)['x']
+
+    hk_stack = np.sum(np.dot(np.moveaxis(tphase_amps, 1, -1), weights), axis=0)
+    return np.sign(hk_stack) * np.power(np.fabs(hk_stack), root_order), weights
+# end func
+
+
+def rf_stacking_vfunc():
+    # near-surface P-velocity profile used in compute_sediment_hk_stack
+    iasp91_path = os.path.join(os.path.abspath(os.path.dirname(obspy.__file__)), 'taup/data/iasp91.tvel')
+    vmodel = VelocityModel.read_tvel_file(iasp91_path)
+    d = np.linspace(-80, -1, 120)
+    v = vmodel.evaluate_above(depth=-d, prop='P')
+    d[-1] = 0
+    v[-1:-7:-1] = np.linspace(2, v[-6], 6)
+    return interp1d(d, v)
+# end func
+
+
+def test_sample_traces():
+    rs = np.random.RandomState(0)
+    npts = np.array([50, 40])
+    data = np.zeros((2, 51))
+    data[0, :50] = rs.standard_normal(50)
+    data[1, :40] = rs.standard_normal(40)
+    t0 = np.array([-1., 0.5])
+    delta = np.array([0.1, 0.2])
+
+    times = rs.uniform(-2, 10, (2, 7, 3))
+    times[0, 0, 0] = t0[0] + 49 * delta[0]  # last sample
+    result = rf_stacking._sample_traces(data, npts, t0, delta, times)
+    for i in range(2):
+        tio = interp1d(t0[i] + np.arange(npts[i]) * delta[i], data[i, :npts[i]], fill_value=0, bounds_error=False)
+        assert np.allclose(result[i], tio(times[i]))
+    # end for
+# end func
+
+
+@pytest.mark.parametrize('root_order', [1, 2, 3, 4])
+def test_compute_hk_stack(rf_traces, root_order, monkeypatch):
+    h_range = np.linspace(20, 70, 51)
+    k_range = np.linspace(1.5, 2.0, 31)
+
+    # batches of different sizes yield the same result
+    for batch_size in [1, 2 ** 18]:
+        monkeypatch.setattr(rf_stacking, 'HK_BATCH_SIZE', batch_size)
+        k_grid, h_grid, hk_stack = rf_stacking.compute_hk_stack(rf_traces, h_range=h_range, k_range=k_range,
+                                                                root_order=root_order)
+        expected = reference_hk_stack(rf_traces, h_range, k_range, rf_stacking.DEFAULT_WEIGHTS, root_order)
+
+        assert hk_stack.shape == k_grid.shape == h_grid.shape == (51, 31)
+        assert np.allclose(hk_stack, expected)
+    # end for
+# end func
+
+
+@pytest.mark.parametrize('root_order', [1, 9])
+def test_compute_sediment_hk_stack(rf_traces, root_order):
+    h_range = np.linspace(0.01, 6, 11)
+    k_range = np.linspace(1.0, 4.0, 9)
+    H_c, k_c = 35., 1.75
+
+    k_grid, h_grid, hk_stack, weights = rf_stacking.compute_sediment_hk_stack(rf_traces, H_c, k_c, h_range=h_range,
+                                                                              k_range=k_range,
+                                                                              root_order=root_order)
+    expected, expected_weights = reference_sediment_hk_stack(rf_traces, H_c, k_c, h_range, k_range, root_order)
+
+    assert hk_stack.shape == k_grid.shape == h_grid.shape == (11, 9)
+    assert np.allclose(weights, expected_weights)
+    assert np.allclose(hk_stack, expected)
+# end func
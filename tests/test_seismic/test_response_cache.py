@@ -0,0 +1,112 @@
+#!/bin/env python
+"""
+Description:
+    Tests instrument response correction with cached response spectra against that of obspy
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import os
+import copy
+import pytest
+import numpy as np
+from obspy import read_inventory, Trace, UTCDateTime
+from obspy.core import Stats
+from seismic.response_cache import ResponseSpectrumCache, get_channel_epoch
+
+path = os.path.dirname(os.path.abspath(__file__))
+inv = read_inventory(os.path.join(path, 'xcorqc', 'data', 'response_inventory.fdsnxml'))
+
+
+@pytest.fixture(params=['VEL', 'DISP'])
+def output(request):
+    return request.param
+
+@pytest.fixture(params=[50., None])
+def water_level(request):
+    return request.param
+
+def make_trace(npts, starttime, seed=0):
+    return Trace(data=np.random.RandomState(seed).standard_normal(npts).cumsum(),
+                 header=Stats(header={'network': 'AU', 'station': 'ARMA', 'location': '',
+                                      'channel': 'BHZ', 'sampling_rate': 20.,
+                                      'npts': npts, 'starttime': starttime}))
+# end func
+
+def test_response_cache(output, water_level):
+    cache = ResponseSpectrumCache()
+    t0 = UTCDateTime('2011-03-11T00:00:00')
+
+    for i in range(3):
+        expected = make_trace(12001, t0 + i * 600, seed=i)
+        result = expected.copy()
+
+        expected.remove_response(inventory=inv, output=output, water_level=water_level)
+        cache.remove_response(result, inv, output=output, water_level=water_level)
+
+        assert np.allclose(result.data, expected.data, atol=1e-8 * np.max(np.abs(expected.data)))
+    # end for
+
+    # response spectrum is computed once for traces of the same length from a channel-epoch
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # traces of a different length require a new spectrum
+    cache.remove_response(make_trace(6000, t0), inv, output=output, water_level=water_level)
+    assert (cache.hits, cache.misses) == (2, 2)
+# end func
+
+def test_response_cache_eviction():
+    cache = ResponseSpectrumCache(max_size_mb=1)
+    t0 = UTCDateTime('2011-03-11T00:00:00')
+
+    # each spectrum of a 50000-sample trace occupies ~0.8 MB
+    for npts in [50000, 50002, 50004]:
+        cache.remove_response(make_trace(npts, t0), inv)
+    # end for
+    assert len(cache) == 1 and cache.evictions == 2
+
+    cache.remove_response(make_trace(50004, t0), inv)
+    cache.remove_response(make_trace(50000, t0), inv)
+    assert (cache.hits, cache.misses) == (1, 4)
+# end func
+
+def test_response_cache_distinct_responses():
+    # inventories with identical channel-epochs that differ only in response, e.g. a corrected
+    # sensor response, must not share cached spectra
+    t0 = UTCDateTime('2011-03-11T00:00:00')
+    inv2 = copy.deepcopy(inv)
+    _, _, response = get_channel_epoch(inv2, 'AU.ARMA..BHZ', t0)
+    stage = response.response_stages[0]
+    stage.poles = [2 * complex(p) for p in stage.poles[:1]] + stage.poles[1:]
+
+    cache = ResponseSpectrumCache()
+    for inventory in [inv, inv2, copy.deepcopy(inv)]:
+        expected = make_trace(6000, t0)
+        result = expected.copy()
+
+        expected.remove_response(inventory=inventory)
+        cache.remove_response(result, inventory)
+
+        assert np.allclose(result.data, expected.data, atol=1e-8 * np.max(np.abs(expected.data)))
+    # end for
+
+    # the copy of the original inventory reuses its spectrum
+    assert (cache.hits, cache.misses) == (1, 2)
+# end func
+
+def test_response_cache_missing_channel():
+    cache = ResponseSpectrumCache()
+    tr = make_trace(1000, UTCDateTime('2011-03-11T00:00:00'))
+    tr.stats.station = 'XXXX'
+
+    with pytest.raises(Exception):
+        cache.remove_response(tr, inv)
+    # end with
+# end func
@@ -0,0 +1,105 @@
+#!/bin/env python
+"""
+Description:
+    Tests travel-time lookup tables against TauP
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     17/10/26   agent    Added tests at the edges of shadow zones
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import os
+import pytest
+import numpy as np
+from obspy.taup import TauPyModel
+from seismic.travel_time_table import TravelTimeTable
+
+DISTANCES = np.arange(10, 61, 2.)
+DEPTHS = np.array([0., 10., 35., 70., 120.])
+
+
+@pytest.fixture(scope='module')
+def cache_dir(tmpdir_factory):
+    return str(tmpdir_factory.mktemp('tt_tables'))
+
+
+@pytest.fixture(scope='module')
+def table(cache_dir):
+    return TravelTimeTable(phase_list=('P', 'S'), distances=DISTANCES, depths=DEPTHS, cache_dir=cache_dir)
+
+
+def taup_first_arrivals(model, phase, depths, slat, slon, rlat, rlon):
+    result = []
+    for args in zip(depths, slat, slon, rlat, rlon):
+        arrivals = model.get_travel_times_geo(*args, phase_list=(phase,))
+        result.append([arrivals[0].time, arrivals[0].ray_param_sec_degree] if len(arrivals) else [np.nan] * 2)
+    # end for
+    return np.array(result).T
+
+
+@pytest.mark.parametrize('phase', ['P', 'S', 'Pn'])
+def test_query_geo(table, phase):
+    model = TauPyModel(model='iasp91')
+    rs = np.random.RandomState(0)
+    n = 40
+    slat, slon = rs.uniform(-30, 30, n), rs.uniform(100, 120, n)
+    rlat, rlon = rs.uniform(-30, 30, n), rs.uniform(130, 150, n)
+    depths = rs.uniform(0, 150, n) # includes depths beyond the grid
+
+    times, ray_params, _ = table.query_geo(phase, depths, slat, slon, rlat, rlon)
+    expected_times, expected_ray_params = taup_first_arrivals(model, phase, depths, slat, slon, rlat, rlon)
+
+    assert times.shape == (n,)
+    assert np.array_equal(np.isnan(times), np.isnan(expected_times))
+    assert np.nanmax(np.fabs(times - expected_times)) <= table.time_tolerance
+    assert np.nanmax(np.fabs(ray_params - expected_ray_params)) <= table.ray_param_tolerance
+
+
+@pytest.mark.parametrize('phase, distance, depth', [('P', 96.22, 525.), ('P', 96.08, 590.), ('S', 10.03, 600.)])
+def test_shadow_zone_edges(cache_dir, phase, distance, depth):
+    # grid spacings as in the default table; cells at the edges of shadow zones can pass the check at their centres
+    table = TravelTimeTable(phase_list=('P', 'S'), distances=np.concatenate((np.arange(8, 12.1, 0.5),
+                                                                                np.arange(94, 99.1, 1.))),
+                            depths=np.arange(500, 625.1, 25.), cache_dir=cache_dir)
+    model = TauPyModel(model='iasp91')
+
+    time, ray_param, _ = table.query(phase, distance, depth)
+    expected_time, expected_ray_param = taup_first_arrivals(model, phase, [depth], [0.], [0.], [0.], [distance])
+
+    assert np.array_equal(np.isnan(time), np.isnan(expected_time[0]))
+    assert np.nanmax(np.fabs(time - expected_time[0])) <= table.time_tolerance
+    assert np.nanmax(np.fabs(ray_param - expected_ray_param[0])) <= table.ray_param_tolerance
+
+
+def test_cache(table, cache_dir):
+    assert os.path.exists(table.cache_file)
+
+    cached = TravelTimeTable(phase_list=('P', 'S'), distances=DISTANCES, depths=DEPTHS, cache_dir=cache_dir)
+    assert cached.cache_file == table.cache_file
+    assert np.array_equal(cached._values, table._values, equal_nan=True)
+    assert np.array_equal(cached._valid, table._valid)
+
+    # tables are keyed by phase list
+    other = TravelTimeTable(phase_list=('P',), distances=DISTANCES[:3], depths=DEPTHS[:2], cache_dir=cache_dir)
+    assert other.cache_file != table.cache_file
+
+
+def test_get_travel_times_geo(table):
+    model = TauPyModel(model='iasp91')
+    args = (33., -20., 130., 10., 120.)
+
+    arrivals = table.get_travel_times_geo(*args, phase_list=('S', 'P'))
+    expected = model.get_travel_times_geo(*args, phase_list=('P', 'S'))
+    assert [arr.name for arr in arrivals] == ['P', 'S']
+    assert np.allclose([arr.time for arr in arrivals], [expected[0].time, expected[1].time],
+                       atol=table.time_tolerance)
+
+    # phases missing from the table are computed through TauP
+    arrivals = table.get_travel_times_geo(*args, phase_list=('PcP',))
+    assert arrivals[0].time == model.get_travel_times_geo(*args, phase_list=('PcP',))[0].time
@@ -0,0 +1,162 @@
+#!/bin/env python
+"""
+Description:
+    Tests the vectorised engine for estimating clock corrections against row-by-row implementations
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+from seismic.xcorqc.clock_drift import correlate_rows, pearson_rows, shift_rows, \
+    estimate_clock_corrections, cluster_corrections, SEC_PER_WEEK
+import math
+import numpy as np
+import scipy.signal
+import scipy.stats
+from sklearn.cluster import dbscan
+
+def make_ccfs(nrows=60, ncols=401, seed=0):
+    rs = np.random.RandomState(seed)
+    lag = np.linspace(-100, 100, ncols)
+
+    # a wavelet that drifts over time, with noise
+    shifts = np.round(np.linspace(-20, 20, nrows)).astype(int)
+    ccf = np.array([np.roll(np.exp(-lag**2 / 50.) * np.cos(lag), s) for s in shifts])
+    ccf += 0.2 * rs.standard_normal(ccf.shape)
+
+    valid = np.ones(nrows, dtype=bool)
+    valid[[3, 17]] = False
+    ccf[~valid] = 0
+    snr_mask = valid.copy()
+    snr_mask[::5] = False
+    rcf = np.mean(ccf[snr_mask], axis=0)
+
+    return ccf, valid, rcf, snr_mask, lag, shifts
+# end func
+
+def reference_clock_corrections(ccf, valid, rcf, snr_mask, lag, pcf_cutoff_threshold):
+    # row-by-row implementation previously used in XcorrClockAnalyzer
+    raw_correction = []
+    ccf_shifted = []
+    for i, row in enumerate(ccf):
+        if not valid[i]:
+            raw_correction.append(np.nan)
+            ccf_shifted.append(np.array([np.nan] * ccf.shape[1]))
+            continue
+
+        c3 = scipy.signal.correlate(rcf, row, mode='same')
+        c3 /= np.max(c3)
+        peak_index = np.argmax(c3)
+        shift_size = int(peak_index - len(c3) / 2)
+        row_shifted = np.roll(row, shift_size)
+        if shift_size > 0:
+            row_shifted[0:shift_size] = 0
+        elif shift_size < 0:
+            row_shifted[shift_size:] = 0
+        ccf_shifted.append(row_shifted)
+        raw_correction.append(lag[peak_index])
+    # end for
+    raw_correction = np.array(raw_correction)
+    ccf_shifted = np.array(ccf_shifted)
+    rcf_corrected = np.nanmean(ccf_shifted[snr_mask, :], axis=0)
+
+    row_rcf_crosscorr = []
+    for i, row in enumerate(ccf):
+        if not valid[i]:
+            row_rcf_crosscorr.append([np.nan] * ccf.shape[1])
+            continue
+
+        pcf_corrected, _ = scipy.stats.pearsonr(rcf_corrected, ccf_shifted[i, :])
+        if pcf_corrected < pcf_cutoff_threshold:
+            raw_correction[i] = np.nan
+            row_rcf_crosscorr.append([np.nan] * ccf.shape[1])
+            continue
+        c3 = scipy.signal.correlate(rcf_corrected, row, mode='same')
+        c3 /= np.max(c3)
+        raw_correction[i] = lag[np.argmax(c3)]
+        row_rcf_crosscorr.append(c3)
+    # end for
+
+    return raw_correction, rcf_corrected, np.array(row_rcf_crosscorr)
+# end func
+
+def test_row_operations():
+    rs = np.random.RandomState(0)
+
+    for ncols in [100, 101]:
+        ref = rs.standard_normal(ncols)
+        rows = rs.standard_normal((5, ncols))
+
+        expected = np.array([scipy.signal.correlate(ref, row, mode='same') for row in rows])
+        assert np.allclose(correlate_rows(ref, rows), expected)
+
+        expected = np.array([scipy.stats.pearsonr(ref, row)[0] for row in rows])
+        assert np.allclose(pearson_rows(ref, rows), expected)
+
+        shifts = np.array([-3, 0, 5, ncols + 2, -ncols])
+        for row, shifted, s in zip(rows, shift_rows(rows, shifts), shifts):
+            expected = np.roll(row, s)
+            if s > 0: expected[0:s] = 0
+            elif s < 0: expected[s:] = 0
+            assert np.array_equal(shifted, expected)
+        # end for
+    # end for
+
+    # coefficients are undefined for constant rows
+    assert np.isnan(pearson_rows(ref, np.ones((1, ncols)))[0])
+# end func
+
+def test_estimate_clock_corrections():
+    ccf, valid, rcf, snr_mask, lag, shifts = make_ccfs()
+
+    for threshold in [0, 0.5, 0.9]:
+        result = estimate_clock_corrections(ccf, valid, rcf, snr_mask, lag, threshold)
+        expected = reference_clock_corrections(ccf, valid, rcf, snr_mask, lag, threshold)
+
+        for r, e in zip(result, expected):
+            assert np.allclose(r, e, equal_nan=True)
+        # end for
+    # end for
+
+    # drifting corrections are recovered relative to the reference
+    raw_correction = estimate_clock_corrections(ccf, valid, rcf, snr_mask, lag, 0)[0]
+    offsets = raw_correction[valid] + shifts[valid] * (lag[1] - lag[0])
+    offsets = offsets[np.isfinite(offsets)]
+    assert len(offsets) > 0.9 * np.sum(valid)
+    assert np.allclose(offsets, np.median(offsets), atol=2 * (lag[1] - lag[0]))
+
+    # no estimates without a reference function
+    raw_correction, rcf_corrected, _ = estimate_clock_corrections(ccf, valid, None, None, lag, 0)
+    assert np.all(np.isnan(raw_correction)) and rcf_corrected is None
+# end func
+
+def test_cluster_corrections():
+    rs = np.random.RandomState(0)
+
+    # two linear drift segments with a jump in between
+    times = np.arange(200) * 86400.
+    corrections = np.where(times < 100 * 86400, 1e-6 * times, 10 - 1e-6 * times)
+    corrections += 0.01 * rs.standard_normal(len(times))
+    slopes = np.gradient(corrections, times)
+    coeffs = (1, 0.5, 0.1)
+
+    def metric(p0, p1):
+        return math.sqrt((coeffs[0] * (p1[0] - p0[0])) ** 2 +
+                         (coeffs[1] * SEC_PER_WEEK * (p1[1] - p0[1])) ** 2 +
+                         (coeffs[2] * SEC_PER_WEEK * SEC_PER_WEEK * (p1[2] - p0[2])) ** 2)
+    # end func
+
+    data = np.column_stack((times, corrections, slopes))
+    ind_expected, ids_expected = dbscan(data, eps=2 * SEC_PER_WEEK, min_samples=7, metric=metric)
+    ind, ids = cluster_corrections(times, corrections, slopes, coeffs)
+
+    assert np.array_equal(ind, ind_expected)
+    assert np.array_equal(ids, ids_expected)
+    assert len(set(ids[ids >= 0])) == 2
+# end func
@@ -0,0 +1,92 @@
+#!/bin/env python
+"""
+Description:
+    Tests FFT backends used in cross-correlations
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+from seismic.xcorqc import fft
+import pytest
+import numpy as np
+
+@pytest.fixture(params=fft.BACKENDS)
+def backend(request):
+    if request.param == 'fftw' and fft.pyfftw is None: pytest.skip('pyFFTW not available')
+
+    name, threads = fft.get_backend()
+    fft.set_backend(request.param, threads=2)
+    yield request.param
+    fft.set_backend(name, threads=threads)
+# end func
+
+def test_transforms(backend):
+    rs = np.random.RandomState(0)
+    x = rs.standard_normal((3, 100))
+
+    assert fft.get_backend() == (backend, 2)
+    assert np.allclose(fft.fftn(x, shape=[128], axes=[-1]), np.fft.fft(x, n=128, axis=-1))
+    assert np.allclose(fft.fftn(x[0], shape=[128]), np.fft.fft(x[0], n=128))
+    assert np.allclose(fft.ifftn(fft.fftn(x[0])).real, x[0])
+    assert np.allclose(fft.rfft(x, n=128, axis=-1), np.fft.rfft(x, n=128, axis=-1))
+    assert np.allclose(fft.irfft(fft.rfft(x, axis=-1), n=100, axis=-1), x)
+# end func
+
+def test_rfft_plan(backend):
+    rs = np.random.RandomState(0)
+    plan1 = fft.get_rfft_plan(256, 0)
+    plan2 = fft.get_rfft_plan(256, 1)
+    assert plan1 is fft.get_rfft_plan(256, 0) and plan1 is not plan2
+
+    # buffers are reused across inputs of varying lengths
+    for npts in [200, 100, 256]:
+        a = rs.standard_normal(npts)
+        b = rs.standard_normal(npts)
+
+        rf = plan1(a) * plan2(b, reverse=True)
+        assert np.allclose(rf, np.fft.fft(a, n=256)[:129] * np.fft.fft(b[::-1], n=256)[:129])
+
+        # cross-correlation, as computed previously through complex FFTs of zero-padded arrays
+        xcorr = np.fft.ifft(np.fft.fft(a, n=256) * np.fft.fft(b[::-1], n=256)).real
+        assert np.allclose(fft.irfft(rf, n=256), xcorr)
+    # end for
+
+    with pytest.raises(AssertionError):
+        plan1(np.zeros(257))
+    # end with
+# end func
+
+def test_invalid_backend():
+    with pytest.raises(ValueError):
+        fft.set_backend('cufft')
+    # end with
+# end func
+
+def test_fftw_backend():
+    pyfftw = pytest.importorskip('pyfftw')
+    name, threads = fft.get_backend()
+    try:
+        fft.set_backend('auto', threads=2)
+        assert fft.get_backend() == ('fftw', 2)
+        assert isinstance(fft._backend, fft._FFTWBackend)
+
+        # plans execute through FFTW, on SIMD-aligned buffers
+        plan = fft.get_rfft_plan(256)
+        assert isinstance(plan._execute, pyfftw.FFTW)
+        assert pyfftw.is_byte_aligned(plan._buf)
+
+        a = np.random.random(200)
+        assert np.allclose(plan(a), np.fft.rfft(a, n=256))
+        assert np.allclose(plan(a, reverse=True), np.fft.rfft(a[::-1], n=256))
+        assert np.allclose(fft.irfft(fft.rfft(a)), a)
+    finally:
+        fft.set_backend(name, threads=threads)
+    # end try
+# end func
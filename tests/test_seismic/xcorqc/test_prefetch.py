@@ -0,0 +1,149 @@
+#!/bin/env python
+"""
+Description:
+    Tests prefetching of read-buffers for cross-correlations
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
+from seismic.xcorqc.xcorqc import IntervalStackXCorr
+from seismic.xcorqc.utils import BufferPrefetcher
+from collections import defaultdict
+from obspy import Stream, Trace
+import os
+import time
+import threading
+import pytest
+from netCDF4 import Dataset
+import numpy as np
+import tempfile
+
+# Prepare input
+netsta1 = 'II.WRAB'
+netsta2 = 'AU.MAW'
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+# Initialize input data
+files_dir = tempfile.mkdtemp(suffix='_test_prefetch')
+asdf_file_list1 = os.path.join(files_dir, 'asdf_file_list1.txt')
+asdf_file_list2 = os.path.join(files_dir, 'asdf_file_list2.txt')
+
+f1 = open(asdf_file_list1, 'w+')
+f2 = open(asdf_file_list2, 'w+')
+f1.write('%s/data/test_data_WRAB.h5\n'%(path))
+f2.write('%s/data/test_data_MAW.h5\n'%(path))
+f1.close()
+f2.close()
+
+fds1 = FederatedASDFDataSet(asdf_file_list1)
+fds2 = FederatedASDFDataSet(asdf_file_list2)
+
+location_preferences_dict = defaultdict(lambda: None)
+location_preferences_dict[netsta1] = '00'
+
+@pytest.fixture(params=[0, 1, 3])
+def depth(request):
+    return request.param
+
+def test_buffer_prefetcher(depth):
+    nbytes = 8 * 1024**2
+    active = set()
+    lock = threading.Lock()
+
+    calls = []
+
+    def fetch(t0, t1):
+        with lock:
+            active.add(t0)
+            calls.append(t0)
+        # end with
+        time.sleep(0.01)
+        if t0 == 3: raise ValueError('fetch failed')
+        if t0 == 5: return Stream()
+        return Stream([Trace(data=np.full(nbytes // 8, t0, dtype='f8'))])
+    # end func
+
+    time_ranges = [(i, i + 1) for i in range(10)]
+    prefetcher = BufferPrefetcher([fetch, fetch], time_ranges, depth=depth, max_size_mb=16)
+
+    maxAhead = 0
+    maxQueuedBytes = 0
+    for i, (t0, t1, results) in enumerate(prefetcher):
+        assert (t0, t1) == time_ranges[i]
+        assert len(results) == 2
+
+        if t0 == 3:
+            assert results[0][0] is None and isinstance(results[0][1], ValueError)
+        elif t0 == 5:
+            assert len(results[0][0]) == 0 and results[0][1] is None
+        else:
+            for st, error in results:
+                assert error is None and np.all(st[0].data == t0)
+            # end for
+        # end if
+
+        # the second fetch-function is skipped when the first fails or returns no data
+        if t0 in [3, 5]: assert results[1] == (None, None)
+
+        # allow the prefetching thread to catch up
+        time.sleep(0.05)
+        with lock:
+            maxAhead = max(maxAhead, len([t for t in active if t > t0]))
+        # end with
+        maxQueuedBytes = max(maxQueuedBytes, prefetcher._nbytes)
+    # end for
+
+    if depth == 0:
+        assert maxAhead == 0
+    else:
+        # at most 'depth' buffers are queued, while another may be in the process of being read
+        assert 1 <= maxAhead <= depth + 1
+    # end if
+
+    assert sorted(calls) == sorted([t for t, _ in time_ranges for _ in range(1 if t in [3, 5] else 2)])
+
+    # each time-range amounts to 16 MB, which is also the cap
+    assert maxQueuedBytes <= 16 * 1024**2
+# end func
+
+def test_prefetched_xcorr(depth):
+    start_time = '2006-11-03T00:00:00'
+    end_time   = '2006-11-04T00:00:00'
+
+    output_folder = str(tempfile.mkdtemp())
+    tag = 'prefetch%d' % (depth)
+    IntervalStackXCorr(fds1, fds2, start_time, end_time,
+                       netsta1, netsta2, None, None, 'vel', 50, 'BHZ', 'BHZ', None, None,
+                       location_preferences_dict=location_preferences_dict,
+                       resample_rate=4, buffer_seconds=3600 * 4, interval_seconds=3600,
+                       window_seconds=600, flo=0.02, fhi=0.9,
+                       outputPath=output_folder, tracking_tag=tag, prefetch_depth=depth)
+
+    fn = os.path.join(output_folder, 'II.WRAB.00.BHZ.AU.MAW..BHZ.%s.nc' % (tag))
+    ds = Dataset(fn)
+    xcorr = ds.variables['xcorr'][:]
+    ist = ds.variables['IntervalStartTimes'][:]
+    ds.close()
+
+    # results are identical to those from reading data on the calling thread
+    output_folder = str(tempfile.mkdtemp())
+    IntervalStackXCorr(fds1, fds2, start_time, end_time,
+                       netsta1, netsta2, None, None, 'vel', 50, 'BHZ', 'BHZ', None, None,
+                       location_preferences_dict=location_preferences_dict,
+                       resample_rate=4, buffer_seconds=3600 * 4, interval_seconds=3600,
+                       window_seconds=600, flo=0.02, fhi=0.9,
+                       outputPath=output_folder, tracking_tag=tag, prefetch_depth=0)
+    ds = Dataset(fn.replace(os.path.dirname(fn), output_folder))
+    assert np.array_equal(ds.variables['IntervalStartTimes'][:], ist)
+    assert np.array_equal(ds.variables['xcorr'][:], xcorr)
+    ds.close()
+# end func
@@ -0,0 +1,134 @@
+#!/bin/env python
+"""
+Description:
+    Tests scheduling of station-pairs and tracking of completed station-pairs
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     17/10/26   agent    Journals of all ranks are removed in fresh runs
+    LastUpdate:     17/10/26   agent    Added tests for splitting station-pairs by both stations
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
+from seismic.xcorqc.utils import CompletionJournal, DynamicWorkQueue, estimate_pair_costs, \
+    split_list, split_station_pairs
+from obspy import UTCDateTime
+import itertools
+import os
+import pytest
+import tempfile
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+# Initialize input data
+files_dir = tempfile.mkdtemp(suffix='_test_scheduling')
+asdf_file_list1 = os.path.join(files_dir, 'asdf_file_list1.txt')
+asdf_file_list2 = os.path.join(files_dir, 'asdf_file_list2.txt')
+
+f1 = open(asdf_file_list1, 'w+')
+f2 = open(asdf_file_list2, 'w+')
+f1.write('%s/data/test_data_WRAB.h5\n'%(path))
+f2.write('%s/data/test_data_MAW.h5\n'%(path))
+f1.close()
+f2.close()
+
+fds1 = FederatedASDFDataSet(asdf_file_list1)
+fds2 = FederatedASDFDataSet(asdf_file_list2)
+
+def test_dynamic_work_queue():
+    q = DynamicWorkQueue(5)
+    assert list(q) == [0, 1, 2, 3, 4]
+    assert q.next() is None
+    q.close()
+
+    q = DynamicWorkQueue(0)
+    assert list(q) == []
+    q.close()
+# end func
+
+def test_completion_journal():
+    output_folder = tempfile.mkdtemp()
+
+    # restarting requires journals from a previous run
+    with pytest.raises(Exception):
+        CompletionJournal(output_folder, restart_mode=True)
+    # end with
+
+    journal = CompletionJournal(output_folder)
+    journal.mark_complete('AU.A.AU.B')
+    journal.mark_complete('AU.A.AU.C')
+    assert journal.is_complete('AU.A.AU.B')
+
+    # journals from a previous run with a different number of ranks are also read
+    with open(os.path.join(output_folder, 'completed.3.txt'), 'w') as f: f.write('AU.B.AU.C\nAU.C')
+
+    journal = CompletionJournal(output_folder, restart_mode=True)
+    assert journal.completed == set(['AU.A.AU.B', 'AU.A.AU.C', 'AU.B.AU.C', 'AU.C'])
+    assert not journal.is_complete('AU.A.AU.D')
+
+    # journals are reset for fresh runs, including those of ranks beyond the current number of ranks
+    journal = CompletionJournal(output_folder)
+    assert len(journal.completed) == 0
+    assert not os.path.exists(journal.proc_fn)
+    assert not os.path.exists(os.path.join(output_folder, 'completed.3.txt'))
+
+    # restarting again requires journals from the fresh run
+    with pytest.raises(Exception):
+        CompletionJournal(output_folder, restart_mode=True)
+    # end with
+# end func
+
+def test_estimate_pair_costs():
+    st1, et1 = fds1.get_global_time_range('II', 'WRAB')
+    st2, et2 = fds2.get_global_time_range('AU', 'MAW')
+    st, et = max(st1, st2), min(et1, et2)
+    assert et > st
+
+    pairs = [('II.WRAB', 'AU.MAW'), ('II.WRAB', 'AU.XXX')]
+
+    costs = estimate_pair_costs(pairs, fds1, fds2, UTCDateTime(0), UTCDateTime(2100, 1, 1))
+    assert costs[0] == pytest.approx(et - st)
+    # stations without data incur no cost
+    assert costs[1] == 0
+
+    # costs are limited to the time-range of interest
+    costs = estimate_pair_costs(pairs, fds1, fds2, st + 600, st + 1800)
+    assert costs[0] == pytest.approx(1200)
+# end func
+
+def test_split_station_pairs():
+    def station_blocks(blocks):
+        return sum([len(set([netsta for pair in block for netsta in pair])) for block in blocks])
+    # end func
+
+    stations = ['AU.S%02d'%i for i in range(40)]
+    pairs = list(itertools.combinations(stations, 2))
+
+    for npartitions in [1, 4, 16, 64]:
+        blocks = split_station_pairs(pairs, npartitions)
+
+        # all station-pairs are assigned once, in blocks of near-equal length
+        assert len(blocks) == npartitions
+        assert sorted(sum(blocks, [])) == sorted(pairs)
+        assert max(map(len, blocks)) - min(map(len, blocks)) <= 1
+
+        # stations feature on fewer blocks than when station-pairs are ordered by the first station
+        if(npartitions > 1):
+            assert station_blocks(blocks) < station_blocks(split_list(sorted(pairs), npartitions))
+        # end if
+    # end for
+
+    # pairs across two data-sets
+    pairs = list(itertools.product(stations[:20], stations[20:]))
+    blocks = split_station_pairs(pairs, 16)
+    assert sorted(sum(blocks, [])) == sorted(pairs)
+    assert station_blocks(blocks) < station_blocks(split_list(sorted(pairs), 16))
+
+    assert split_station_pairs([], 2) == [[], []]
+# end func
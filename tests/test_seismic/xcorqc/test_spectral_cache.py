@@ -0,0 +1,109 @@
+#!/bin/env python
+"""
+Description:
+    Tests cross-correlations computed from cached window-spectra against those from the
+    standard workflow
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     17/10/26   agent    Tighter tolerances for double-precision caches; added test for inventory keys
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
+from seismic.xcorqc.xcorqc import IntervalStackXCorr
+from seismic.xcorqc.spectral_cache import SpectralCacheManager, inventory_key
+from obspy import read_inventory, UTCDateTime
+from collections import defaultdict
+import os
+import pytest
+from netCDF4 import Dataset
+import numpy as np
+import tempfile
+
+# Prepare input
+netsta1 = 'II.WRAB'
+netsta2 = 'AU.MAW'
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+# Initialize input data
+files_dir = tempfile.mkdtemp(suffix='_test_spectral_cache')
+asdf_file_list1 = os.path.join(files_dir, 'asdf_file_list1.txt')
+asdf_file_list2 = os.path.join(files_dir, 'asdf_file_list2.txt')
+
+f1 = open(asdf_file_list1, 'w+')
+f2 = open(asdf_file_list2, 'w+')
+f1.write('%s/data/test_data_WRAB.h5\n'%(path))
+f2.write('%s/data/test_data_MAW.h5\n'%(path))
+f1.close()
+f2.close()
+
+fds1 = FederatedASDFDataSet(asdf_file_list1)
+fds2 = FederatedASDFDataSet(asdf_file_list2)
+
+location_preferences_dict = defaultdict(lambda: None)
+location_preferences_dict[netsta1] = '00'
+
+@pytest.fixture(params=[(0, None, False, False), (0.05, 4, True, True)])
+def params(request):
+    return request.param
+
+@pytest.fixture(params=[False, True])
+def envelope_normalize(request):
+    return request.param
+
+def test_spectral_cache(params, envelope_normalize):
+    window_buffer_length, resample_rate, whitening, one_bit_normalize = params
+    start_time = '2006-11-03T00:00:00'
+    end_time   = '2006-11-04T00:00:00'
+
+    manager = SpectralCacheManager(scratch_folder=files_dir)
+
+    results = []
+    for cache in [None, manager]:
+        output_folder = str(tempfile.mkdtemp())
+        IntervalStackXCorr(fds1, fds2, start_time, end_time,
+                           netsta1, netsta2, None, None, 'vel', 50, 'BHZ', 'BHZ', None, None,
+                           location_preferences_dict=location_preferences_dict,
+                           resample_rate=resample_rate, buffer_seconds=86400, interval_seconds=3600,
+                           window_seconds=600, window_buffer_length=window_buffer_length,
+                           flo=0.02 if resample_rate else None, fhi=0.9 if resample_rate else None,
+                           whitening=whitening, one_bit_normalize=one_bit_normalize,
+                           envelope_normalize=envelope_normalize,
+                           outputPath=output_folder, spectral_cache_manager=cache)
+
+        fn = os.path.join(output_folder, 'II.WRAB.00.BHZ.AU.MAW..BHZ.nc')
+        ds = Dataset(fn)
+        results.append([ds.variables['xcorr'][:], ds.variables['NumStackedWindows'][:]])
+        ds.close()
+    # end for
+
+    # spectra of both stations should have been cached
+    assert manager.misses == 2
+
+    (xcorr_e, nsw_e), (xcorr_c, nsw_c) = results
+    assert np.allclose(nsw_c, nsw_e)
+    assert np.allclose(xcorr_c, xcorr_e, rtol=1e-8, atol=1e-8 * np.max(np.abs(xcorr_e)))
+
+    manager.close()
+    assert not os.path.exists(manager.folder)
+# end func
+
+def test_inventory_key():
+    inv1 = read_inventory()
+    inv2 = read_inventory()
+
+    assert inventory_key(None) is None
+    assert inventory_key(inv1) == inventory_key(inv2)
+    assert hash(inventory_key(inv1)) == hash(inventory_key(inv2))
+
+    # keys change with channel epochs
+    inv2[0][0][0].end_date = UTCDateTime(2030, 1, 1)
+    assert inventory_key(inv1) != inventory_key(inv2)
+# end func
@@ -15,8 +15,11 @@ Revision History:
     LastUpdate:     dd/mm/yyyy  Who     Optional description
 """
 
-from obspy.core import Trace, Stats
-from seismic.xcorqc.xcorqc import taper, whiten, zeropad_ba, xcorr2
+from obspy.core import Trace, Stats, UTCDateTime
+from obspy import read_inventory
+from seismic.xcorqc.xcorqc import taper, whiten, zeropad_ba, xcorr2, preprocess_window, preprocess_windows
+from seismic.response_cache import ResponseSpectrumCache
+import os
 import pytest
 import numpy as np
 
@@ -98,3 +101,69 @@ def test_xcorr(trace_length, sampling_rate, other_sampling_rate):
     # Mean of the x-correlation function should be close to zero
     assert np.allclose(np.abs(np.mean(arr)), 0, atol=1e-2)
 # end func
+
+
+@pytest.fixture(params=[dict(), dict(resample_rate=4, flo=0.02, fhi=0.9),
+                        dict(resample_rate=4, whitening=True, whitening_window_frequency=0.02),
+                        dict(clip_to_2std=True, window_buffer_seconds=30),
+                        dict(one_bit_normalize=True)])
+def preprocessing_params(request):
+    return request.param
+
+def test_preprocess_windows(preprocessing_params):
+    # Batched preprocessing of windows should match that of individual windows
+    path = os.path.dirname(os.path.abspath(__file__))
+    inv = read_inventory('%s/data/response_inventory.fdsnxml' % path).select(network='AU', station='ARMA',
+                                                                             channel='BHZ')
+    sr = 20.
+    nwindows = 4
+    npts = int(660 * sr)
+    starttimes = [UTCDateTime('2011-03-11T00:00:00') + i * 540 for i in range(nwindows)]
+    data = np.random.RandomState(42).standard_normal((nwindows, npts)).cumsum(axis=1)
+    target_sr = preprocessing_params.get('resample_rate', sr)
+
+    for sta_inv in [None, inv]:
+        expected = np.array([preprocess_window(data[i], sr, npts, target_sr,
+                                               header={'network': 'AU', 'station': 'ARMA', 'location': '',
+                                                       'channel': 'BHZ', 'starttime': starttimes[i]},
+                                               sta_inv=sta_inv, **preprocessing_params)
+                             for i in range(nwindows)])
+
+        response_cache = ResponseSpectrumCache()
+        result = preprocess_windows(data, sr, target_sr, seed_id='AU.ARMA..BHZ', starttimes=starttimes,
+                                    sta_inv=sta_inv, response_cache=response_cache, **preprocessing_params)
+
+        # response spectrum is computed once for all windows from the same channel-epoch
+        assert len(response_cache) == (1 if sta_inv else 0)
+        assert response_cache.misses == len(response_cache)
+        assert np.allclose(result, expected, atol=1e-5 * np.max(np.abs(expected)))
+    # end for
+# end func
+
+
+def test_xcorr_batch_windows(sampling_rate, other_sampling_rate):
+    trace_length = 1000
+    rs = np.random.RandomState(42)
+    tr1 = Trace(data=rs.standard_normal(trace_length*sampling_rate),
+                header=Stats(header={'sampling_rate': sampling_rate,
+                                     'npts': trace_length*sampling_rate,
+                                     'network': 'AU',
+                                     'station': 'A'}))
+    tr2 = Trace(data=rs.standard_normal(trace_length*other_sampling_rate),
+                header=Stats(header={'sampling_rate': other_sampling_rate,
+                                     'npts': trace_length*other_sampling_rate,
+                                     'network': 'AU',
+                                     'station': 'B'}))
+
+    for envelope_normalize in [False, True]:
+        expected = xcorr2(tr1, tr2, window_seconds=100, interval_seconds=500, whitening=True,
+                          envelope_normalize=envelope_normalize)
+        result = xcorr2(tr1, tr2, window_seconds=100, interval_seconds=500, whitening=True,
+                        envelope_normalize=envelope_normalize, batch_windows=True)
+
+        assert np.allclose(result[0], expected[0], atol=1e-5 * np.max(np.abs(expected[0])))
+        for r, e in zip(result[1:], expected[1:]):
+            assert np.all(r == e)
+        # end for
+    # end for
+# end func
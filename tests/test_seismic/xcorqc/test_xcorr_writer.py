@@ -0,0 +1,79 @@
+#!/bin/env python
+"""
+Description:
+    Tests incremental writes of cross-correlation results to NetCDF files
+
+References:
+
+CreationDate:   17/10/26
+Developer:      agent@local
+
+Revision History:
+    LastUpdate:     17/10/26   agent
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+from seismic.xcorqc.utils import XcorrNetCDFWriter
+import os
+import pytest
+from netCDF4 import Dataset
+import numpy as np
+
+@pytest.fixture(params=[False, True])
+def ensemble_stack(request):
+    return request.param
+
+def test_xcorr_writer(ensemble_stack, tmp_path):
+    output_folder = str(tmp_path)
+    fn = os.path.join(output_folder, 'xcorr.nc')
+
+    rs = np.random.RandomState(0)
+    nlags = 101
+    blocks = []
+    for i, nrows in enumerate([3, 5, 1, 7, 2]):
+        xcl = rs.random_sample((nrows, nlags)).astype(np.float32)
+        counts = rs.randint(0, 10, nrows)
+        ist = (np.arange(nrows) + 100 * i) * 3600
+        iet = ist + 3600
+        blocks.append((xcl, counts, ist, iet))
+    # end for
+
+    writer = XcorrNetCDFWriter(fn, description='test', ensemble_stack=ensemble_stack, chunk_rows=4)
+    for block in blocks: writer.write(*block)
+    assert writer.nrows == 18 and writer.ncols == nlags
+
+    writer.root_grp.createVariable('lag', 'f4', ('lag',))[:] = np.arange(nlags)
+    writer.close()
+
+    # results are moved into place once complete
+    assert os.listdir(output_folder) == ['xcorr.nc']
+
+    xcl, counts, ist, iet = [np.concatenate(items) for items in zip(*blocks)]
+    ds = Dataset(fn)
+    assert ds.description == 'test'
+    assert np.array_equal(ds.variables['lag'][:], np.arange(nlags))
+    if ensemble_stack:
+        assert ds.variables['NumStackedWindows'][:] == np.sum(counts)
+        assert np.isclose(ds.variables['AvgNumStackedWindowsPerInterval'][:], np.mean(counts[counts > 0]))
+        assert ds.variables['IntervalStartTime'][:] == np.min(ist)
+        assert ds.variables['IntervalEndTime'][:] == np.max(iet)
+        assert np.allclose(ds.variables['xcorr'][:], np.sum(xcl, axis=0) / np.sum(counts > 0))
+    else:
+        assert ds.variables['xcorr'].chunking() == [4, nlags]
+        assert np.array_equal(ds.variables['xcorr'][:], xcl)
+        assert np.array_equal(ds.variables['NumStackedWindows'][:], counts)
+        assert np.array_equal(ds.variables['IntervalStartTimes'][:], ist)
+        assert np.array_equal(ds.variables['IntervalEndTimes'][:], iet)
+        assert np.array_equal(ds.variables['interval'][:], np.arange(len(xcl)))
+    # end if
+    ds.close()
+# end func
+
+def test_xcorr_writer_no_results(tmp_path):
+    output_folder = str(tmp_path)
+    writer = XcorrNetCDFWriter(os.path.join(output_folder, 'xcorr.nc'))
+    writer.close()
+
+    assert writer.nrows == 0
+    assert len(os.listdir(output_folder)) == 0
+# end func